@@ -0,0 +1,660 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Writes the zip archives the NDK is distributed as.
+
+Files are compressed concurrently by a pool of threads (zlib releases the GIL
+while compressing), and written to the archive in name order as they finish.
+Archives are reproducible: members are sorted and every member has the same
+timestamp, so the same tree always produces the same bytes.
+
+The archives match those of `zip -9r`: Unix permissions are recorded, and
+symlinks may be stored as links rather than followed.
+
+Archives that share files, such as the packages of each host or the macOS app
+bundle and zip, can share a CompressionCache so that each distinct file is
+compressed once and its compressed bytes reused by every archive.
+
+Compressed tarballs are written by write_tar, which splits the tar stream into
+blocks compressed concurrently, as pbzip2 and xz -T do. The blocks are
+separate streams of the compressed format, which decompressors read as one.
+"""
+from __future__ import annotations
+
+import bz2
+from collections import Counter
+from dataclasses import dataclass
+import functools
+import hashlib
+import lzma
+import multiprocessing
+import os
+from pathlib import Path
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+from types import TracebackType
+from typing import (BinaryIO, Callable, Dict, Iterable, List, Optional,
+                    Sequence, Tuple, Type, Union)
+import zlib
+
+import ndk.workqueue
+
+try:
+    # Python 3.14 and newer.
+    from compression import zstd
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+
+ARCHIVE_THREADS = multiprocessing.cpu_count()
+
+# The timestamp of every member: 1980-01-01 00:00:00, the earliest a zip
+# archive can record.
+DOS_TIME = 0
+DOS_DATE = (1 << 5) | 1
+
+# Largest sizes and counts that fit the classic zip format. Anything larger
+# is recorded in ZIP64 fields instead.
+ZIP64_LIMIT = 0xffffffff
+ZIP64_COUNT_LIMIT = 0xffff
+
+# Written in place of a value that is in the ZIP64 fields.
+_ZIP64_MARKER = 0xffffffff
+_ZIP64_COUNT_MARKER = 0xffff
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+# Version needed to extract: 2.0 for deflate, 4.5 for ZIP64.
+VERSION_DEFAULT = 20
+VERSION_ZIP64 = 45
+# Made by version 3.0 on Unix, so that permissions are honored.
+VERSION_MADE_BY = (3 << 8) | 30
+
+FLAG_UTF8 = 0x800
+
+
+@dataclass(frozen=True)
+class Member:
+    """An entry of an archive.
+
+    Attributes:
+        name: Path of the member in the archive, separated by '/'.
+        mode: The st_mode of the member, which gives its type and
+            permissions.
+        source: File the contents are read from, or None if given by data.
+        data: Contents of the member, or the target of a symlink.
+    """
+    name: str
+    mode: int
+    source: Optional[Path] = None
+    data: bytes = b''
+
+    @property
+    def is_dir(self) -> bool:
+        """True if the member is a directory."""
+        return stat.S_ISDIR(self.mode)
+
+    @property
+    def archive_name(self) -> str:
+        """The name written to the archive. Directories end with a '/'."""
+        return self.name + '/' if self.is_dir else self.name
+
+    def read(self) -> bytes:
+        """Returns the contents of the member."""
+        if self.source is not None:
+            return self.source.read_bytes()
+        return self.data
+
+
+def tree_members(src: Path, prefix: str, symlinks: bool) -> List[Member]:
+    """Returns the members for a file or directory tree.
+
+    Args:
+        src: File or directory to archive.
+        prefix: Archive path of src. The members of a directory are named
+            relative to it.
+        symlinks: True if symlinks are stored as links rather than followed.
+    """
+    def member(path: Path, name: str) -> Member:
+        path_stat = path.lstat() if symlinks else path.stat()
+        if stat.S_ISLNK(path_stat.st_mode):
+            return Member(name, path_stat.st_mode,
+                          data=os.fsencode(os.readlink(path)))
+        if stat.S_ISDIR(path_stat.st_mode):
+            return Member(name, path_stat.st_mode)
+        return Member(name, path_stat.st_mode, source=path)
+
+    prefix = prefix.strip('/')
+    root = member(src, prefix)
+    if not root.is_dir:
+        return [root]
+    # An archive has no entry for its own root.
+    members = [root] if prefix else []
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=not symlinks):
+        rel_dir = Path(dirpath).relative_to(src).as_posix()
+        for name in dirnames + filenames:
+            archive_name = '/'.join(
+                p for p in (prefix, rel_dir, name) if p not in ('', '.'))
+            members.append(member(Path(dirpath) / name, archive_name))
+    return members
+
+
+class Manifest:
+    """The layout of an archive.
+
+    Maps trees on disk to the prefixes they are archived under, and holds
+    generated files, so that an archive with a different layout than any
+    directory on disk can be written without first copying the files into
+    that layout.
+
+    >>> def manifest_example():
+    ...     manifest = Manifest(symlinks=True)
+    ...     manifest.add_tree(Path('out/android-ndk'), 'NDK.app/Contents/NDK')
+    ...     manifest.add_file('NDK.app/Contents/Info.plist', '<plist/>')
+    ...     write_zip(Path('dist/ndk.zip'), manifest.members)
+    """
+    def __init__(self, symlinks: bool) -> None:
+        """Initializes a Manifest.
+
+        Args:
+            symlinks: True if symlinks are stored as links rather than
+                followed.
+        """
+        self.symlinks = symlinks
+        self.trees: List[Tuple[Path, str]] = []
+        self.files: List[Member] = []
+
+    def add_tree(self, src: Path, prefix: str) -> None:
+        """Archives a file or directory tree under the given path."""
+        self.trees.append((src, prefix))
+
+    def add_file(self, name: str, contents: Union[bytes, str],
+                 mode: int = 0o644) -> None:
+        """Archives a generated file.
+
+        Args:
+            name: Path of the file in the archive.
+            contents: Contents of the file. Text is encoded as UTF-8.
+            mode: Permissions of the file.
+        """
+        if isinstance(contents, str):
+            contents = contents.encode('utf-8')
+        self.files.append(Member(name, stat.S_IFREG | mode, data=contents))
+
+    @property
+    def members(self) -> List[Member]:
+        """The members of the archive.
+
+        Includes an entry for every directory containing a member, as an
+        archive of the equivalent directory would.
+        """
+        members = list(self.files)
+        for src, prefix in self.trees:
+            members.extend(tree_members(src, prefix, self.symlinks))
+        names = {m.name for m in members}
+        for member in list(members):
+            parent = member.name.rpartition('/')[0]
+            while parent and parent not in names:
+                names.add(parent)
+                members.append(Member(parent, stat.S_IFDIR | 0o755))
+                parent = parent.rpartition('/')[0]
+        return members
+
+
+@dataclass(frozen=True)
+class _Compressed:
+    """A member ready to be written."""
+    method: int
+    crc: int
+    size: int
+    data: bytes
+
+
+def compress(member: Member, level: int) -> _Compressed:
+    """Compresses the contents of a member.
+
+    Contents that deflate doesn't shrink are stored, as zip does.
+    """
+    if member.is_dir:
+        return _Compressed(ZIP_STORED, 0, 0, b'')
+    data = member.read()
+    crc = zlib.crc32(data)
+    if data and not stat.S_ISLNK(member.mode):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        deflated = compressor.compress(data) + compressor.flush()
+        if len(deflated) < len(data):
+            return _Compressed(ZIP_DEFLATED, crc, len(data), deflated)
+    return _Compressed(ZIP_STORED, crc, len(data), data)
+
+
+@dataclass(frozen=True)
+class _SpilledBlob:
+    """Compressed contents written to the spill file of a CompressionCache."""
+    method: int
+    crc: int
+    size: int
+    offset: int
+    length: int
+
+
+def _file_digest(path: Path) -> bytes:
+    digest = hashlib.sha256()
+    with path.open('rb') as src_file:
+        for block in iter(lambda: src_file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _digest_task(_worker: ndk.workqueue.ThreadWorker,
+                 member: Member) -> Tuple[Member, bytes]:
+    assert member.source is not None
+    return member, _file_digest(member.source)
+
+
+class CompressionCache:
+    """Shares compressed files between archives.
+
+    Files that appear more than once among the given archives, whether in
+    the same archive or in different ones, are compressed the first time
+    they are written and reused after that. Files are matched by the hash
+    of their contents, so identical files in different trees are shared.
+    Only files whose size matches another's are hashed.
+
+    The compressed contents of shared files can add up to gigabytes, so they
+    are written to a temporary spill file, and only their offsets are kept
+    in memory. Contents are read back from the spill file when reused. The
+    spill file is removed when the cache is closed.
+
+    >>> def compression_cache_example():
+    ...     linux = tree_members(Path('linux/ndk'), 'android-ndk', True)
+    ...     darwin = tree_members(Path('darwin/ndk'), 'android-ndk', True)
+    ...     with CompressionCache([linux, darwin]) as cache:
+    ...         write_zip(Path('dist/linux.zip'), linux, cache=cache)
+    ...         write_zip(Path('dist/darwin.zip'), darwin, cache=cache)
+
+    Attributes:
+        hits: Number of members written with previously compressed contents.
+        saved_bytes: Uncompressed size of those members.
+        spilled_bytes: Size of the compressed contents in the spill file.
+    """
+    def __init__(self,
+                 archives: Iterable[Sequence[Member]],
+                 num_threads: int = ARCHIVE_THREADS,
+                 spill_dir: Optional[Path] = None) -> None:
+        """Hashes the files that may be shared between the archives.
+
+        Args:
+            archives: The members of each archive that will be written.
+            num_threads: Number of files hashed at once.
+            spill_dir: Directory for the spill file. If None, the system
+                temporary directory, which may be backed by memory.
+        """
+        self.hits = 0
+        self.saved_bytes = 0
+        self.spilled_bytes = 0
+        self._lock = threading.Lock()
+        self._blobs: Dict[Tuple[bytes, int], _SpilledBlob] = {}
+        self._spill_file = tempfile.TemporaryFile(dir=spill_dir)
+
+        files: List[Member] = []
+        sizes: Dict[Member, int] = {}
+        for members in archives:
+            for member in members:
+                if member.source is not None and not member.is_dir:
+                    files.append(member)
+                    sizes[member] = member.source.stat().st_size
+        # Files of a unique size can't match any other, so aren't hashed.
+        size_counts = Counter(sizes[m] for m in files)
+        candidates = {m for m in files if size_counts[sizes[m]] > 1}
+
+        self._digests: Dict[Member, bytes] = {}
+        workqueue = ndk.workqueue.ThreadPoolWorkQueue(num_threads)
+        try:
+            workqueue.add_tasks(_digest_task, [(m, ) for m in candidates],
+                                chunksize=16)
+            while not workqueue.finished():
+                self._digests.update(workqueue.get_results())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+        # Counts uses by member rather than by file so that a file listed in
+        # several archives under the same name is shared too.
+        self._uses = Counter(self._digests[m] for m in files
+                             if m in self._digests)
+        self._shared = {d for d, count in self._uses.items() if count > 1}
+
+    def compress(self, member: Member, level: int) -> _Compressed:
+        """Compresses a member, or returns its previously compressed form."""
+        digest = self._digests.get(member)
+        if digest not in self._shared:
+            return compress(member, level)
+        assert digest is not None
+        key = (digest, level)
+        with self._lock:
+            blob = self._blobs.get(key)
+            if blob is not None:
+                self.hits += 1
+                self.saved_bytes += blob.size
+                self._spill_file.seek(blob.offset)
+                data = self._spill_file.read(blob.length)
+                return _Compressed(blob.method, blob.crc, blob.size, data)
+        # Two threads may compress the same contents at once. Both results
+        # are identical, so only the first one is spilled.
+        compressed = compress(member, level)
+        with self._lock:
+            if key not in self._blobs:
+                self._blobs[key] = _SpilledBlob(compressed.method,
+                                                compressed.crc,
+                                                compressed.size,
+                                                self.spilled_bytes,
+                                                len(compressed.data))
+                self._spill_file.seek(self.spilled_bytes)
+                self._spill_file.write(compressed.data)
+                self.spilled_bytes += len(compressed.data)
+        return compressed
+
+    def release(self, member: Member) -> None:
+        """Drops compressed contents that no remaining member will use."""
+        digest = self._digests.get(member)
+        if digest not in self._shared:
+            return
+        assert digest is not None
+        with self._lock:
+            self._uses[digest] -= 1
+            if self._uses[digest] <= 0:
+                for key in [k for k in self._blobs if k[0] == digest]:
+                    del self._blobs[key]
+
+    def close(self) -> None:
+        """Removes the spill file."""
+        self._blobs.clear()
+        self._spill_file.close()
+
+    def __enter__(self) -> CompressionCache:
+        return self
+
+    def __exit__(self, _exc_type: Optional[Type[BaseException]],
+                 _exc_value: Optional[BaseException],
+                 _traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+
+def _compress_task(_worker: ndk.workqueue.ThreadWorker, index: int,
+                   member: Member, level: int,
+                   cache: Optional[CompressionCache]
+                   ) -> Tuple[int, _Compressed]:
+    if cache is not None:
+        return index, cache.compress(member, level)
+    return index, compress(member, level)
+
+
+def _zip64_extra(values: Iterable[int]) -> bytes:
+    values = list(values)
+    if not values:
+        return b''
+    return struct.pack(f'<HH{len(values)}Q', 0x0001, 8 * len(values), *values)
+
+
+class ZipWriter:
+    """Writes members to a zip archive in the order they are added."""
+    def __init__(self, output: BinaryIO) -> None:
+        self.output = output
+        self.offset = 0
+        self.central_directory: List[bytes] = []
+
+    def _write(self, data: bytes) -> None:
+        self.output.write(data)
+        self.offset += len(data)
+
+    def add(self, member: Member, compressed: _Compressed) -> None:
+        """Writes a member with the given compressed contents."""
+        name = member.archive_name.encode('utf-8')
+        flags = FLAG_UTF8 if not name.isascii() else 0
+        csize = len(compressed.data)
+        offset = self.offset
+
+        large_sizes = max(compressed.size, csize) >= ZIP64_LIMIT
+        local_extra = _zip64_extra(
+            [compressed.size, csize] if large_sizes else [])
+        version = VERSION_ZIP64 if large_sizes else VERSION_DEFAULT
+        self._write(
+            struct.pack('<IHHHHHIIIHH', 0x04034b50, version, flags,
+                        compressed.method, DOS_TIME, DOS_DATE, compressed.crc,
+                        _ZIP64_MARKER if large_sizes else csize,
+                        _ZIP64_MARKER if large_sizes else compressed.size,
+                        len(name), len(local_extra)) + name + local_extra)
+        self._write(compressed.data)
+
+        # The central directory only moves the fields that overflow.
+        fields = [compressed.size, csize, offset]
+        overflow = [v for v in fields if v >= ZIP64_LIMIT]
+        central_extra = _zip64_extra(overflow)
+        if overflow:
+            version = VERSION_ZIP64
+        usize, csize, offset = (_ZIP64_MARKER if v >= ZIP64_LIMIT else v
+                                for v in fields)
+        # MS-DOS directory attribute, for extractors that ignore Unix modes.
+        dos_attributes = 0x10 if member.is_dir else 0
+        self.central_directory.append(
+            struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, VERSION_MADE_BY,
+                        version, flags, compressed.method, DOS_TIME, DOS_DATE,
+                        compressed.crc, csize, usize, len(name),
+                        len(central_extra), 0, 0, 0,
+                        (member.mode << 16) | dos_attributes, offset) +
+            name + central_extra)
+
+    def close(self) -> None:
+        """Writes the central directory."""
+        cd_offset = self.offset
+        for record in self.central_directory:
+            self._write(record)
+        cd_size = self.offset - cd_offset
+        count = len(self.central_directory)
+
+        zip64 = (count >= ZIP64_COUNT_LIMIT or cd_size >= ZIP64_LIMIT
+                 or cd_offset >= ZIP64_LIMIT)
+        if zip64:
+            zip64_offset = self.offset
+            self._write(
+                struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, VERSION_MADE_BY,
+                            VERSION_ZIP64, 0, 0, count, count, cd_size,
+                            cd_offset))
+            self._write(struct.pack('<IIQI', 0x07064b50, 0, zip64_offset, 1))
+            count = _ZIP64_COUNT_MARKER
+            cd_size = cd_offset = _ZIP64_MARKER
+        self._write(
+            struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, cd_size,
+                        cd_offset, 0))
+
+
+def write_zip(path: Path,
+              members: Iterable[Member],
+              level: int = 9,
+              num_threads: int = ARCHIVE_THREADS,
+              cache: Optional[CompressionCache] = None) -> None:
+    """Writes a reproducible zip archive.
+
+    Args:
+        path: Path to write the archive to.
+        members: Members of the archive. They are written sorted by name.
+        level: Deflate compression level.
+        num_threads: Number of files compressed at once.
+        cache: Compressed files shared with other archives, if any.
+
+    Raises:
+        ValueError: Two members have the same name.
+    """
+    sorted_members = sorted(members, key=lambda m: m.name)
+    for prev, member in zip(sorted_members, sorted_members[1:]):
+        if prev.name == member.name:
+            raise ValueError(f'Duplicate archive member: {member.name}')
+
+    # Bounds the compressed data held in memory while waiting for an earlier
+    # member to finish.
+    window = 4 * num_threads
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('wb') as output:
+        writer = ZipWriter(output)
+        workqueue = ndk.workqueue.ThreadPoolWorkQueue(num_threads)
+        try:
+            finished: Dict[int, _Compressed] = {}
+            submitted = 0
+            for index, member in enumerate(sorted_members):
+                while submitted < min(index + window, len(sorted_members)):
+                    workqueue.add_task(_compress_task, submitted,
+                                       sorted_members[submitted], level,
+                                       cache)
+                    submitted += 1
+                while index not in finished:
+                    finished.update(workqueue.get_results())
+                writer.add(member, finished.pop(index))
+                if cache is not None:
+                    cache.release(member)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+        writer.close()
+
+
+@dataclass(frozen=True)
+class TarFormat:
+    """A compression format for tarballs.
+
+    Attributes:
+        suffix: Extension of the tarball, e.g. '.tar.xz'.
+        block_size: Size of the blocks of the tar stream that are compressed
+            concurrently. Larger blocks compress better, but hold more memory
+            and leave threads idle for small tarballs.
+        compress: Compresses a block into a complete stream of the format.
+    """
+    suffix: str
+    block_size: int
+    compress: Callable[[bytes], bytes]
+
+
+TAR_FORMATS = {
+    # bzip2 works in blocks of 900 KB anyway, so splitting costs nothing.
+    'bz2':
+    TarFormat('.tar.bz2', 9 * 900 * 1000,
+              functools.partial(bz2.compress, compresslevel=9)),
+    # Matches the blocks of xz -T, three times the dictionary of preset 6.
+    'xz':
+    TarFormat('.tar.xz', 24 * 1024 * 1024,
+              functools.partial(lzma.compress, format=lzma.FORMAT_XZ)),
+}
+if HAVE_ZSTD:
+    TAR_FORMATS['zstd'] = TarFormat('.tar.zst', 16 * 1024 * 1024,
+                                    functools.partial(zstd.compress, level=9))
+
+
+def _compress_block_task(_worker: ndk.workqueue.ThreadWorker, index: int,
+                         block: bytes, compress: Callable[[bytes], bytes]
+                         ) -> Tuple[int, bytes]:
+    return index, compress(block)
+
+
+class _ParallelCompressor:
+    """A write-only file that compresses its contents with many threads."""
+    def __init__(self, output: BinaryIO, tar_format: TarFormat,
+                 num_threads: int) -> None:
+        self.output = output
+        self.tar_format = tar_format
+        # Bounds the blocks held in memory.
+        self.window = 2 * num_threads
+        self.workqueue = ndk.workqueue.ThreadPoolWorkQueue(num_threads)
+        self.buffer = bytearray()
+        self.submitted = 0
+        self.written = 0
+        self.finished: Dict[int, bytes] = {}
+
+    def write(self, data: bytes) -> int:
+        """Buffers data, compressing each block as it fills."""
+        self.buffer += data
+        block_size = self.tar_format.block_size
+        while len(self.buffer) >= block_size:
+            self._submit(bytes(self.buffer[:block_size]))
+            del self.buffer[:block_size]
+        return len(data)
+
+    def _submit(self, block: bytes) -> None:
+        while self.submitted - self.written >= self.window:
+            self._write_finished()
+        self.workqueue.add_task(_compress_block_task, self.submitted, block,
+                                self.tar_format.compress)
+        self.submitted += 1
+
+    def _write_finished(self) -> None:
+        """Waits for results and writes the blocks that are next in order."""
+        self.finished.update(self.workqueue.get_results())
+        while self.written in self.finished:
+            self.output.write(self.finished.pop(self.written))
+            self.written += 1
+
+    def close(self) -> None:
+        """Compresses what remains and waits for every block."""
+        try:
+            if self.buffer or not self.submitted:
+                self._submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.written < self.submitted:
+                self._write_finished()
+        finally:
+            self.workqueue.terminate()
+            self.workqueue.join()
+
+
+def write_tar(path: Path,
+              base_dir: Path,
+              paths: Iterable[str],
+              tar_format: str = 'bz2',
+              num_threads: int = ARCHIVE_THREADS) -> Path:
+    """Writes a compressed tarball.
+
+    Args:
+        path: Path to the tarball, without an extension.
+        base_dir: Directory that paths are relative to (tar's -C).
+        paths: Files and directories to archive, relative to base_dir.
+            Symlinks are archived as links.
+        tar_format: Compression format. One of TAR_FORMATS.
+        num_threads: Number of blocks compressed at once.
+
+    Returns:
+        The path of the tarball, with the extension of its format.
+
+    Raises:
+        ValueError: The format is not one of TAR_FORMATS.
+    """
+    if tar_format not in TAR_FORMATS:
+        raise ValueError(f'Unsupported tarball format: {tar_format}')
+    fmt = TAR_FORMATS[tar_format]
+    path = path.with_name(path.name + fmt.suffix)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('wb') as output:
+        compressor = _ParallelCompressor(output, fmt, num_threads)
+        try:
+            # Stream mode only needs the file to be writable.
+            with tarfile.open(fileobj=compressor, mode='w|',
+                              format=tarfile.GNU_FORMAT) as tar:
+                for rel_path in paths:
+                    tar.add(base_dir / rel_path, arcname=rel_path)
+        finally:
+            compressor.close()
+    return path
@@ -0,0 +1,320 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A local content-addressed cache of module install trees.
+
+The cache is shared between out directories and branches. Each entry is keyed
+by a module fingerprint (see ndk.fingerprint) and is a manifest of the files,
+directories and symlinks the module installed. File contents are stored once
+per unique content and mode in the objects directory, so identical files from
+different modules or builds share storage.
+
+Restored files are reflinked from the cache where the filesystem supports it,
+and otherwise hardlinked or copied.
+
+Layout of the cache directory:
+
+    entries/<key>.json: Manifest of an install tree. The mtime records when
+        the entry was last used.
+    objects/<xx>/<sha256>-<mode>: Contents of a file.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import stat
+from typing import Any, Dict, Iterable, List, Optional
+
+from ndk.builds import Module
+import ndk.file
+
+
+def logger() -> logging.Logger:
+    """Returns the module logger."""
+    return logging.getLogger(__name__)
+
+
+def _remove(path: Path) -> None:
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.exists():
+        shutil.rmtree(path)
+
+
+class ArtifactCache:
+    """A content-addressed store of module install trees."""
+    def __init__(self, root: Path, max_size: int) -> None:
+        """Initializes an ArtifactCache.
+
+        Args:
+            root: Directory of the cache. Will be created if needed.
+            max_size: Size in bytes that evict() shrinks the cache to.
+        """
+        self.root = root
+        self.max_size = max_size
+
+    @property
+    def entries_dir(self) -> Path:
+        """Directory containing the entry manifests."""
+        return self.root / 'entries'
+
+    @property
+    def objects_dir(self) -> Path:
+        """Directory containing the file contents."""
+        return self.root / 'objects'
+
+    def entry_path(self, key: str) -> Path:
+        """Returns the path to the manifest of an entry."""
+        return self.entries_dir / f'{key}.json'
+
+    def object_path(self, name: str) -> Path:
+        """Returns the path to a stored file."""
+        return self.objects_dir / name[:2] / name
+
+    def _add_object(self, path: Path, mode: int) -> str:
+        name = f'{ndk.file.hash_file(path)}-{mode:o}'
+        object_path = self.object_path(name)
+        if object_path.exists():
+            return name
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        # Workers store entries concurrently, so objects are written to a
+        # unique temporary path and then renamed into place.
+        temp_path = object_path.with_name(f'{name}.{os.getpid()}.tmp')
+        if not ndk.file.reflink(path, temp_path):
+            shutil.copyfile(path, temp_path)
+        temp_path.chmod(mode)
+        os.replace(temp_path, object_path)
+        return name
+
+    def store(self, key: str, path: Path) -> None:
+        """Captures the tree at path as the entry for key.
+
+        Args:
+            key: Key of the entry.
+            path: Installed file or directory to capture.
+        """
+        files: List[List[Any]] = []
+        links: List[List[str]] = []
+        dirs: List[str] = []
+        if path.is_symlink() or not path.is_dir():
+            tree = [path]
+        else:
+            tree = []
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(dirnames + filenames):
+                    tree.append(Path(dirpath) / name)
+            dirs.append('.')
+        for item in tree:
+            name = os.path.relpath(item, path)
+            item_stat = item.lstat()
+            if stat.S_ISLNK(item_stat.st_mode):
+                links.append([name, os.readlink(item)])
+            elif stat.S_ISDIR(item_stat.st_mode):
+                dirs.append(name)
+            else:
+                mode = stat.S_IMODE(item_stat.st_mode)
+                files.append([name, self._add_object(item, mode)])
+
+        entry_path = self.entry_path(key)
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = entry_path.with_name(f'{key}.{os.getpid()}.tmp')
+        temp_path.write_text(
+            json.dumps({
+                'dirs': dirs,
+                'files': files,
+                'links': links,
+            }))
+        os.replace(temp_path, entry_path)
+
+    def _load_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        try:
+            return json.loads(self.entry_path(key).read_text())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger().warning('Ignoring corrupt cache entry %s', key)
+            return None
+
+    def restore(self, key: str, path: Path, allow_hardlinks: bool) -> bool:
+        """Replaces path with the tree stored for key.
+
+        Args:
+            key: Key of the entry.
+            path: Install path to restore to. Anything already at this path
+                is removed.
+            allow_hardlinks: True if the restored files may be hardlinks to
+                the cache. They must then never be modified in place.
+
+        Returns:
+            True if the entry was restored, False if there is no such entry.
+        """
+        entry = self._load_entry(key)
+        if entry is None:
+            return False
+        objects = [self.object_path(name) for _, name in entry['files']]
+        if not all(p.exists() for p in objects):
+            # Evicted by a concurrent build.
+            return False
+
+        _remove(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        for name in entry['dirs']:
+            (path / name).mkdir(parents=True, exist_ok=True)
+        for (name, _), object_path in zip(entry['files'], objects):
+            dst = path / name
+            self._restore_file(object_path, dst, allow_hardlinks)
+            ndk.file.record_install(dst)
+        for name, target in entry['links']:
+            (path / name).symlink_to(target)
+            ndk.file.record_install(path / name)
+
+        # Marks the entry as recently used.
+        os.utime(self.entry_path(key))
+        return True
+
+    @staticmethod
+    def _restore_file(object_path: Path, dst: Path,
+                      allow_hardlinks: bool) -> None:
+        if ndk.file.reflink(object_path, dst):
+            shutil.copymode(object_path, dst)
+            return
+        if allow_hardlinks:
+            try:
+                os.link(object_path, dst)
+                return
+            except OSError:
+                pass
+        shutil.copy2(object_path, dst)
+
+    def _entries(self) -> Iterable[Path]:
+        if not self.entries_dir.exists():
+            return []
+        return self.entries_dir.glob('*.json')
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits.
+
+        Objects shared by several entries are only counted once, and are
+        removed once no remaining entry refers to them. Must not be called
+        while other processes are using the cache.
+        """
+        entries = sorted(self._entries(), key=lambda p: p.stat().st_mtime)
+        refcounts: Dict[str, int] = {}
+        entry_objects: Dict[Path, List[str]] = {}
+        for entry_path in entries:
+            entry = self._load_entry(entry_path.stem)
+            names = [] if entry is None else [n for _, n in entry['files']]
+            entry_objects[entry_path] = names
+            for name in set(names):
+                refcounts[name] = refcounts.get(name, 0) + 1
+
+        sizes: Dict[str, int] = {}
+        for object_path in self.objects_dir.glob('*/*'):
+            sizes[object_path.name] = object_path.stat().st_size
+        total = sum(sizes.get(name, 0) for name in refcounts)
+
+        for entry_path in entries:
+            if total <= self.max_size:
+                break
+            entry_path.unlink()
+            for name in set(entry_objects[entry_path]):
+                refcounts[name] -= 1
+                if refcounts[name] == 0:
+                    del refcounts[name]
+                    total -= sizes.get(name, 0)
+
+        # Also cleans up objects left behind by interrupted stores.
+        for object_path in self.objects_dir.glob('*/*'):
+            if object_path.name not in refcounts:
+                object_path.unlink()
+
+
+def _overlaps(a: Path, b: Path) -> bool:
+    return a == b or a in b.parents or b in a.parents
+
+
+@dataclass(frozen=True)
+class CachedInstall:
+    """The cache entry of a module being built.
+
+    Attributes:
+        cache: The cache.
+        key: The fingerprint of the module.
+        allow_hardlinks: True if no other module installs into the install
+            path of this module, so restored files are never modified.
+        restorable: True if the cache had an entry for the module when the
+            build started, so the module need not be built.
+    """
+    cache: ArtifactCache
+    key: str
+    allow_hardlinks: bool
+    restorable: bool
+
+    def restore(self, path: Path) -> bool:
+        """Restores the module. Returns False if it is not cached."""
+        return self.cache.restore(self.key, path, self.allow_hardlinks)
+
+    def prepare(self, path: Path) -> None:
+        """Prepares the install path for installing the module.
+
+        Modules normally overwrite their previous install in place, which
+        would modify the cache if that install was restored as hardlinks.
+        """
+        if self.allow_hardlinks:
+            _remove(path)
+
+    def store(self, path: Path) -> None:
+        """Captures the installed module."""
+        if not os.path.lexists(path):
+            return
+        try:
+            self.cache.store(self.key, path)
+        except OSError as ex:
+            logger().warning('Could not cache %s: %s', path, ex)
+
+
+def get_cached_install(cache: ArtifactCache, module: Module,
+                       fingerprint: Optional[str],
+                       modules: Iterable[Module]) -> Optional[CachedInstall]:
+    """Returns the cache entry for a module, or None if it can't be cached.
+
+    A module can be cached if it has a fingerprint, installs within the out
+    directory, and its install tree contains only its own files. That is the
+    case if no other module installs to an overlapping path, or if the module
+    replaces its install path when installing.
+
+    Args:
+        cache: The cache.
+        module: The module to build.
+        fingerprint: The fingerprint of the module.
+        modules: Every module that might install to the same tree.
+    """
+    if fingerprint is None:
+        return None
+    install_path = module.get_install_path()
+    if module.out_dir not in install_path.parents:
+        return None
+    overlapping = any(
+        _overlaps(install_path, m.get_install_path()) for m in modules
+        if m != module)
+    if overlapping and not module.install_replaces_path:
+        return None
+    return CachedInstall(cache, fingerprint, not overlapping,
+                         cache.entry_path(fingerprint).exists())
@@ -19,9 +19,6 @@ Note: this isn't the ndk-build API, but the API for building the NDK itself.
 """
 from __future__ import annotations
 
-# pylint: disable=import-error,no-name-in-module
-# https://github.com/PyCQA/pylint/issues/73
-from distutils.dir_util import copy_tree
 from enum import auto, Enum, unique
 import os
 from pathlib import Path, PureWindowsPath
@@ -34,6 +31,7 @@ from typing import Any, Dict, Iterator, List, Optional, Set
 from ndk.autoconf import AutoconfBuilder
 from ndk.cmake import CMakeBuilder
 import ndk.ext.shutil
+import ndk.file
 from ndk.hosts import Host
 import ndk.paths
 
@@ -77,6 +75,17 @@ class Module:
     path: Path = Path()
     deps: Set[str] = set()
 
+    # By default the build of a module waits for its dependencies to be
+    # installed. These subsets of deps relax that for dependencies that build()
+    # does not need installed. install() always waits for every dependency to
+    # be installed.
+    #
+    # Dependencies whose build outputs (but not installed files) are used by
+    # build().
+    build_output_deps: Set[str] = set()
+    # Dependencies used only by install().
+    install_only_deps: Set[str] = set()
+
     def __getattribute__(self, name: str) -> Any:
         attr = super().__getattribute__(name)
         if name in ('name', 'path') and attr == '':
@@ -109,6 +118,12 @@ class Module:
     # install directory will not be within the NDK.
     intermediate_module = False
 
+    # Set to True if install() removes the install path before installing.
+    # The installed tree then contains only this module's files even if other
+    # modules install to the same path, so it can be restored from an
+    # ndk.artifactcache.ArtifactCache.
+    install_replaces_path = False
+
     def __init__(self) -> None:
         self.context: Optional[BuildContext] = None
         if self.notice is None:
@@ -150,6 +165,12 @@ class Module:
             raise self.validate_error('path property not set')
         if self.notice_group not in NoticeGroup:
             raise self.validate_error('invalid notice group')
+        if not self.build_output_deps | self.install_only_deps <= self.deps:
+            raise self.validate_error(
+                'build_output_deps and install_only_deps must be in deps')
+        if self.build_output_deps & self.install_only_deps:
+            raise self.validate_error(
+                'build_output_deps and install_only_deps must be disjoint')
         self.validate_notice()
 
     def validate_notice(self) -> None:
@@ -260,6 +281,22 @@ class Module:
         """Path for intermediate outputs of this module."""
         return self.out_dir / self.host.value / self.name
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        """Source paths that determine the output of this module.
+
+        Used by ndk.fingerprint to skip modules that have not changed since
+        their last successful build. The code of the module class, the
+        fingerprints of its dependencies, the host and the build number are
+        always included, so only inputs from the source tree are listed here.
+        Directories are included recursively.
+
+        Returns:
+            The list of input paths, or None if the inputs are not known. A
+            module with unknown inputs is always rebuilt.
+        """
+        return None
+
     def __str__(self) -> str:
         return self.name
 
@@ -308,15 +345,17 @@ class AutoconfModule(Module):
             "--disable-rpath",
         ]
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.src]
+
     def build(self) -> None:
         self.builder.build(self.configure_args)
 
     def install(self) -> None:
         install_dir = self.get_install_path()
         install_dir.mkdir(parents=True, exist_ok=True)
-        copy_tree(
-            str(self.builder.install_directory),
-            str(install_dir))
+        ndk.file.copy_tree(self.builder.install_directory, install_dir)
 
 
 class CMakeModule(Module):
@@ -355,15 +394,17 @@ class CMakeModule(Module):
     def defines(self) -> Dict[str, str]:
         return dict()
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.src]
+
     def build(self) -> None:
         self.builder.build(self.defines)
 
     def install(self) -> None:
         install_dir = self.get_install_path()
         install_dir.mkdir(parents=True, exist_ok=True)
-        copy_tree(
-            str(self.builder.install_directory),
-            str(install_dir))
+        ndk.file.copy_tree(self.builder.install_directory, install_dir)
 
 
 class PackageModule(Module):
@@ -378,6 +419,10 @@ class PackageModule(Module):
     def default_notice_path(self) -> Path:
         return self.src / 'NOTICE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.src]
+
     def build(self) -> None:
         pass
 
@@ -395,13 +440,17 @@ class FileModule(Module):
     #: True if no notice file is needed for this module.
     no_notice = True
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.src]
+
     def build(self) -> None:
         pass
 
     def install(self) -> None:
         install_path = self.get_install_path()
         install_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(self.src, install_path)
+        ndk.file.copy_file(self.src, install_path)
 
 
 class MultiFileModule(Module):
@@ -416,6 +465,10 @@ class MultiFileModule(Module):
         """List of absolute paths to files to be installed."""
         yield from []
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return list(self.files)
+
     def build(self) -> None:
         pass
 
@@ -423,7 +476,7 @@ class MultiFileModule(Module):
         install_dir = self.get_install_path()
         install_dir.mkdir(parents=True, exist_ok=True)
         for file_path in self.files:
-            shutil.copy2(file_path, install_dir)
+            ndk.file.copy_file(file_path, install_dir)
 
 
 class ScriptShortcutModule(Module):
@@ -451,6 +504,11 @@ class ScriptShortcutModule(Module):
             raise self.validate_error(
                 'ScriptShortcutModule requires windows_ext')
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        # The generated script depends only on the module definition.
+        return []
+
     def build(self) -> None:
         pass
 
@@ -506,6 +564,10 @@ class PythonPackage(Module):
         # Assume there's a NOTICE file in the same directory as the setup.py.
         return self.path.parent / 'NOTICE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.path.parent]
+
     def build(self) -> None:
         subprocess.check_call(
             ['python3', str(self.path), 'sdist', '-d', self.out_dir],
@@ -541,7 +603,7 @@ def install_directory(src: Path, dst: Path) -> None:
         shutil.rmtree(dst)
     ignore_patterns = shutil.ignore_patterns('*.pyc', '*.pyo', '*.swp',
                                              '*.git*')
-    shutil.copytree(src, dst, ignore=ignore_patterns)
+    ndk.file.copy_tree(src, dst, ignore=ignore_patterns)
 
 
 def make_repo_prop(out_dir: Path) -> None:
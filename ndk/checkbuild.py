@@ -28,10 +28,8 @@ import argparse
 import collections
 import contextlib
 import copy
-# pylint: disable=import-error,no-name-in-module
-# https://github.com/PyCQA/pylint/issues/73
-from distutils.dir_util import copy_tree
-# pylint: enable=import-error,no-name-in-module
+from dataclasses import dataclass
+import datetime
 import inspect
 import json
 import logging
@@ -54,6 +52,8 @@ from typing import (
     Iterable,
     Iterator,
     List,
+    Mapping,
+    Optional,
     Set,
     TextIO,
     Tuple,
@@ -62,14 +62,20 @@ from typing import (
 
 import ndk.abis
 import ndk.ansi
+import ndk.archive
+import ndk.artifactcache
 import ndk.autoconf
 import ndk.builds
 import ndk.cmake
 import ndk.config
 import ndk.deps
+import ndk.durations
+import ndk.elf
 import ndk.ext.shutil
 import ndk.file
+import ndk.fingerprint
 from ndk.hosts import Host
+import ndk.installmanifest
 import ndk.notify
 import ndk.paths
 from ndk.paths import ANDROID_DIR, NDK_DIR
@@ -77,6 +83,7 @@ import ndk.test.builder
 import ndk.test.printers
 import ndk.test.spec
 import ndk.timer
+import ndk.trace
 from ndk.toolchains import ClangToolchain
 import ndk.ui
 import ndk.workqueue
@@ -87,52 +94,21 @@ def get_version_string(build_number: str) -> str:
     return f'{ndk.config.major}.{ndk.config.hotfix}.{build_number}'
 
 
-def _make_tar_package(package_path: str, base_dir: str, path: str) -> str:
-    """Creates a tarball package for distribution.
+def _make_zip_package_manifest(base_dir: Path, paths: List[str],
+                               host: Host) -> ndk.archive.Manifest:
+    """Returns the layout of a zip package for distribution.
 
     Args:
-        package_path (string): Path (without extention) to the output archive.
-        base_dir (string): Path to the directory from which to perform the
-                           packaging (identical to tar's -C).
-        path (string): Path to the directory to package.
-    """
-    has_pbzip2 = shutil.which('pbzip2') is not None
-    if has_pbzip2:
-        compress_arg = '--use-compress-prog=pbzip2'
-    else:
-        compress_arg = '-j'
-
-    package_path = package_path + '.tar.bz2'
-    cmd = ['tar', compress_arg, '-cf', package_path, '-C', base_dir, path]
-    subprocess.check_call(cmd)
-    return package_path
-
-
-def _make_zip_package(package_path: Path, base_dir: Path, paths: List[str],
-                      host: Host) -> Path:
-    """Creates a zip package for distribution.
-
-    Args:
-        package_path: Path (without extension) to the output archive.
         base_dir: Path to the directory from which to perform the packaging
                   (identical to tar's -C).
         paths: Paths to files and directories to package, relative to base_dir.
         host: The host the package is being built for. Windows packages will
               flatten symlinks, but other platforms will not.
     """
-    cwd = os.getcwd()
-    package_path = package_path.with_suffix('.zip')
-
-    args = ['zip', '-9qr', str(package_path)]
-    if host != Host.Windows64:
-        args.append('--symlinks')
-    args.extend(paths)
-    os.chdir(base_dir)
-    try:
-        subprocess.check_call(args)
-        return package_path
-    finally:
-        os.chdir(cwd)
+    manifest = ndk.archive.Manifest(symlinks=host != Host.Windows64)
+    for path in paths:
+        manifest.add_tree(base_dir / path, path)
+    return manifest
 
 
 def purge_unwanted_files(ndk_dir: Path) -> None:
@@ -145,28 +121,24 @@ def purge_unwanted_files(ndk_dir: Path) -> None:
             path.unlink()
 
 
-def create_stub_entry_point(path: Path) -> None:
-    """Creates a stub "application" for the app bundle.
+def make_stub_entry_point() -> str:
+    """Returns a stub "application" for the app bundle.
 
     App bundles must have at least one entry point in the Contents/MacOS
     directory. We don't have a single entry point, and none of our executables
     are useful if moved, so just put a welcome script in place that explains
     that.
     """
-    path.parent.mkdir(exist_ok=True, parents=True)
-    path.write_text(
-        textwrap.dedent("""\
+    return textwrap.dedent("""\
         #!/bin/sh
         echo "The Android NDK is installed to the Contents/NDK directory of this application bundle."
-        """))
-    path.chmod(0o755)
+        """)
 
 
-def create_plist(plist: Path, version: str, entry_point_name: str) -> None:
-    """Populates the NDK plist at the given location."""
+def make_plist(version: str, entry_point_name: str) -> str:
+    """Returns the NDK plist."""
 
-    plist.write_text(
-        textwrap.dedent(f"""\
+    return textwrap.dedent(f"""\
         <?xml version="1.0" encoding="UTF-8"?>
         <!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
         <plist version="1.0">
@@ -185,19 +157,15 @@ def create_plist(plist: Path, version: str, entry_point_name: str) -> None:
             <string>{entry_point_name}</string>
         </dict>
         </plist>
-        """))
+        """)
 
 
-def create_signer_metadata(package_dir: Path) -> None:
-    """Populates the _codesign metadata directory for the ADRT signer.
+def add_signer_metadata(manifest: ndk.archive.Manifest) -> None:
+    """Adds the _codesign metadata directory for the ADRT signer.
 
     Args:
-        package_dir: Path to the root of the directory that will be zipped for
-                     the signer.
+        manifest: The layout of the archive that will be given to the signer.
     """
-    metadata_dir = package_dir / '_codesign'
-    metadata_dir.mkdir()
-
     # This directory can optionally contain a few pieces of metadata:
     #
     # filelist: For any jar files that need to be unpacked and signed. We have
@@ -209,13 +177,13 @@ def create_signer_metadata(package_dir: Path) -> None:
     #
     # See http://go/studio-signer for more information.
 
-    volumename_file = metadata_dir / 'volumename'
-    volumename_file.write_text(f'Android NDK {ndk.config.release}')
+    manifest.add_file('_codesign/volumename',
+                      f'Android NDK {ndk.config.release}')
 
 
-def make_app_bundle(zip_path: Path, ndk_dir: Path, build_number: str,
-                    build_dir: Path) -> None:
-    """Builds a macOS App Bundle of the NDK.
+def make_app_bundle_manifest(ndk_dir: Path,
+                             build_number: str) -> ndk.archive.Manifest:
+    """Returns the layout of a macOS App Bundle of the NDK.
 
     The NDK is distributed in two forms on macOS: as a app bundle and in the
     traditional layout. The traditional layout is needed by the SDK because AGP
@@ -228,57 +196,104 @@ def make_app_bundle(zip_path: Path, ndk_dir: Path, build_number: str,
     Information on the macOS bundle format can be found at
     https://developer.apple.com/library/archive/documentation/CoreFoundation/Conceptual/CFBundles/BundleTypes/BundleTypes.html.
 
+    The bundle is archived straight from ndk_dir, with the files that exist
+    only in the bundle generated in memory.
+
+    Args:
+        ndk_dir: The path to the NDK being bundled.
+        build_number: The build number of the NDK.
+    """
+    manifest = ndk.archive.Manifest(symlinks=True)
+    contents_dir = f'AndroidNDK{build_number}.app/Contents'
+    entry_point_name = 'ndk'
+    manifest.add_file(f'{contents_dir}/MacOS/{entry_point_name}',
+                      make_stub_entry_point(),
+                      mode=0o755)
+    manifest.add_tree(ndk_dir, f'{contents_dir}/NDK')
+    manifest.add_file(
+        f'{contents_dir}/Info.plist',
+        make_plist(get_version_string(build_number), entry_point_name))
+    manifest.add_tree(ndk_dir / 'source.properties', 'source.properties')
+    add_signer_metadata(manifest)
+    return manifest
+
+
+def make_app_bundle(zip_path: Path, ndk_dir: Path, build_number: str) -> None:
+    """Builds a macOS App Bundle of the NDK.
+
+    See make_app_bundle_manifest for the layout of the bundle.
+
     Args:
         zip_path: The desired file path of the resultant zip file (without the
                   extension).
         ndk_dir: The path to the NDK being bundled.
-        build_dir: The path to the top level build directory.
+        build_number: The build number of the NDK.
     """
-    package_dir = build_dir / 'bundle'
-    app_directory_name = f'AndroidNDK{build_number}.app'
-    bundle_dir = package_dir / app_directory_name
-    if package_dir.exists():
-        shutil.rmtree(package_dir)
-
-    contents_dir = bundle_dir / 'Contents'
-    entry_point_name = 'ndk'
-    create_stub_entry_point(contents_dir / 'MacOS' / entry_point_name)
+    manifest = make_app_bundle_manifest(ndk_dir, build_number)
+    ndk.archive.write_zip(zip_path.with_suffix('.zip'), manifest.members)
 
-    bundled_ndk = contents_dir / 'NDK'
-    shutil.copytree(ndk_dir, bundled_ndk)
 
-    plist = contents_dir / 'Info.plist'
-    create_plist(plist, get_version_string(build_number), entry_point_name)
+def package_ndks(ndk_dirs: Mapping[Host, Path], dist_dir: Path,
+                 build_number: str) -> Dict[Host, Path]:
+    """Packages the built NDKs of several hosts for distribution.
 
-    shutil.copy2(ndk_dir / 'source.properties',
-                 package_dir / 'source.properties')
-    create_signer_metadata(package_dir)
-    _make_zip_package(zip_path, package_dir,
-                      [p.name for p in package_dir.iterdir()], Host.Darwin)
+    Much of the NDK is identical for every host: headers, libraries, sources
+    and the Clang resource directory. The packages are written in one pass
+    that compresses each distinct file once and reuses the compressed bytes
+    in every package containing it. The macOS app bundle and zip share all
+    of their files this way too.
 
+    Args:
+        ndk_dirs: Path to the built NDK of each host to package.
+        dist_dir: Path to place the built packages in.
+        build_number: Build number to use in the package names.
 
-def package_ndk(ndk_dir: Path, out_dir: Path, dist_dir: Path, host: Host,
+    Returns:
+        The path of the package of each host.
+    """
+    archives: Dict[Path, List[ndk.archive.Member]] = {}
+    package_paths: Dict[Host, Path] = {}
+    for host, ndk_dir in ndk_dirs.items():
+        with ndk.trace.span(f'purge {host.value}', 'package'):
+            purge_unwanted_files(ndk_dir)
+
+        if host == Host.Darwin:
+            bundle_path = (dist_dir /
+                           f'android-ndk-{build_number}-app-bundle.zip')
+            archives[bundle_path] = make_app_bundle_manifest(
+                ndk_dir, build_number).members
+        package_path = (dist_dir /
+                        f'android-ndk-{build_number}-{host.tag}.zip')
+        archives[package_path] = _make_zip_package_manifest(
+            ndk_dir.parent, [ndk_dir.name], host).members
+        package_paths[host] = package_path
+
+    with ndk.trace.span('hash shared files', 'package'):
+        # Spilled beside the packages, since /tmp may be backed by memory.
+        dist_dir.mkdir(parents=True, exist_ok=True)
+        cache = ndk.archive.CompressionCache(archives.values(),
+                                             spill_dir=dist_dir)
+    with cache:
+        for path, members in archives.items():
+            with ndk.trace.span(path.stem, 'package'):
+                ndk.archive.write_zip(path, members, cache=cache)
+    if cache.hits:
+        print('Reused compressed contents of {} files ({} MiB)'.format(
+            cache.hits, cache.saved_bytes // 2**20))
+    return package_paths
+
+
+def package_ndk(ndk_dir: Path, dist_dir: Path, host: Host,
                 build_number: str) -> Path:
     """Packages the built NDK for distribution.
 
     Args:
         ndk_dir: Path to the built NDK.
-        out_dir: Path to use for constructing any intermediate outputs.
         dist_dir: Path to place the built package in.
         host: Host the given NDK was built for.
         build_number: Build number to use in the package name.
     """
-    package_name = f'android-ndk-{build_number}-{host.tag}'
-    package_path = dist_dir / package_name
-
-    purge_unwanted_files(ndk_dir)
-
-    if host == Host.Darwin:
-        bundle_name = f'android-ndk-{build_number}-app-bundle'
-        bundle_path = dist_dir / bundle_name
-        make_app_bundle(bundle_path, ndk_dir, build_number, out_dir)
-    return _make_zip_package(package_path, ndk_dir.parent, [ndk_dir.name],
-                             host)
+    return package_ndks({host: ndk_dir}, dist_dir, build_number)[host]
 
 
 def build_ndk_tests(out_dir: str, dist_dir: str,
@@ -303,7 +318,11 @@ def build_ndk_tests(out_dir: str, dist_dir: str,
     site.addsitedir(os.path.join(ndk_dir, 'python-packages'))
 
     test_options = ndk.test.spec.TestOptions(
-        test_src_dir, ndk_dir, test_out_dir, clean=True)
+        test_src_dir,
+        ndk_dir,
+        test_out_dir,
+        clean=True,
+        durations_db=os.path.join(dist_dir, 'logs', DURATIONS_DB_NAME))
 
     printer = ndk.test.printers.StdoutPrinter()
     with open(ndk.paths.ndk_path('qa_config.json')) as config_file:
@@ -318,8 +337,8 @@ def build_ndk_tests(out_dir: str, dist_dir: str,
 
     if report.successful and args.package:
         print('Packaging tests...')
-        package_path = os.path.join(dist_dir, 'ndk-tests')
-        _make_tar_package(package_path, out_dir, 'tests/dist')
+        ndk.archive.write_tar(Path(dist_dir) / 'ndk-tests', Path(out_dir),
+                              ['tests/dist'], args.test_package_format)
     else:
         # Write out the result to logs/build_error.log so we can find the
         # failure easily on the build server.
@@ -348,7 +367,7 @@ def _install_dir(src_dir: str, dst_dir: str) -> None:
     parent_dir = os.path.normpath(os.path.join(dst_dir, '..'))
     if not os.path.exists(parent_dir):
         os.makedirs(parent_dir)
-    shutil.copytree(src_dir, dst_dir, symlinks=True)
+    ndk.file.copy_tree(Path(src_dir), Path(dst_dir), symlinks=True)
 
 
 def _install_symlink(src_file: str, dst_file: str) -> None:
@@ -357,20 +376,21 @@ def _install_symlink(src_file: str, dst_file: str) -> None:
         os.makedirs(dirname)
     link_target = os.readlink(src_file)
     os.symlink(link_target, dst_file)
+    ndk.file.record_install(Path(dst_file))
 
 
 def _install_file(src_file: str, dst_file: str) -> None:
     dirname = os.path.dirname(dst_file)
     if not os.path.exists(dirname):
         os.makedirs(dirname)
-    # copy2 is just copy followed by copystat (preserves file metadata).
-    shutil.copy2(src_file, dst_file)
+    ndk.file.copy_file(Path(src_file), Path(dst_file))
 
 
 class Clang(ndk.builds.Module):
     name = 'clang'
     path = Path('toolchains/llvm/prebuilt/{host}')
     notice_group = ndk.builds.NoticeGroup.TOOLCHAIN
+    install_replaces_path = True
 
     @property
     def notices(self) -> Iterator[Path]:
@@ -378,6 +398,14 @@ class Clang(ndk.builds.Module):
         for host in Host:
             yield ClangToolchain.path_for_host(host) / 'NOTICE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        # Non-Linux toolchains take their target libraries from Linux.
+        return [
+            ClangToolchain.path_for_host(self.host),
+            ClangToolchain.path_for_host(Host.Linux),
+        ]
+
     def build(self) -> None:
         pass
 
@@ -389,8 +417,12 @@ class Clang(ndk.builds.Module):
             shutil.rmtree(install_path)
         if not install_path.parent.exists():
             install_path.parent.mkdir(parents=True)
-        shutil.copytree(ClangToolchain.path_for_host(self.host), install_path,
-                        symlinks=not self.host.is_windows)
+        # The prebuilts are never modified, and files are only ever removed
+        # from or added to the installed tree, so it can share their files.
+        ndk.file.copy_tree(ClangToolchain.path_for_host(self.host),
+                           install_path,
+                           symlinks=not self.host.is_windows,
+                           allow_hardlinks=True)
 
         # clang-4053586 was patched in the prebuilts directory to add the
         # libc++ includes. These are almost certainly a different revision than
@@ -412,6 +444,7 @@ class Clang(ndk.builds.Module):
             clang = install_path / 'bin/clang'
             (bin_dir / 'clang.real').rename(clang)
             (bin_dir / 'clang++').symlink_to('clang')
+            ndk.file.record_install(bin_dir / 'clang++')
 
         bin_ext = '.exe' if self.host.is_windows else ''
         if self.host.is_windows:
@@ -452,8 +485,9 @@ class Clang(ndk.builds.Module):
             # between each host, so we can just replace them with the one from
             # the Linux toolchain.
             shutil.rmtree(install_clanglib)
-            shutil.copytree(linux_prebuilt_path / 'lib64/clang',
-                            install_clanglib)
+            ndk.file.copy_tree(linux_prebuilt_path / 'lib64/clang',
+                               install_clanglib,
+                               allow_hardlinks=True)
 
         # The Clang prebuilts have the platform toolchain libraries in
         # lib64/clang. The libraries we want are in runtimes_ndk_cxx.
@@ -461,7 +495,7 @@ class Clang(ndk.builds.Module):
         for version_dir in install_clanglib.iterdir():
             dst_lib_dir = version_dir / 'lib/linux'
             shutil.rmtree(dst_lib_dir)
-            shutil.copytree(ndk_runtimes, dst_lib_dir)
+            ndk.file.copy_tree(ndk_runtimes, dst_lib_dir)
 
             # Create empty libatomic.a stub libraries to keep -latomic working.
             # This is needed for backwards compatibility and might be useful if
@@ -474,11 +508,13 @@ class Clang(ndk.builds.Module):
                     ndk.abis.Abi('x86'): 'i386',
                     ndk.abis.Abi('x86_64'): 'x86_64',
                 }[arch]
-                (dst_lib_dir / subdir / 'libatomic.a').write_text(
+                libatomic = dst_lib_dir / subdir / 'libatomic.a'
+                libatomic.write_text(
                     textwrap.dedent("""\
                     /* The __atomic_* APIs are now in libclang_rt.builtins-*.a. They might
                        eventually be broken out into a separate library -- see llvm.org/D47606. */
                     """))
+                ndk.file.record_install(libatomic)
 
         # Also remove the other libraries that we installed, but they were only
         # installed on Linux.
@@ -540,6 +576,16 @@ class ShaderTools(ndk.builds.CMakeModule):
         yield glslang_dir / 'LICENSE.txt'
         yield spirv_dir / 'LICENSE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        external = ANDROID_DIR / 'external'
+        return [
+            self.src.parent,
+            external / 'googletest',
+            external / 'effcee',
+            external / 'regex-re2',
+        ]
+
     @property
     def defines(self) -> Dict[str, str]:
         gtest_dir = ANDROID_DIR / 'external' / 'googletest'
@@ -612,8 +658,8 @@ class ShaderTools(ndk.builds.CMakeModule):
 
         # Copy to install tree.
         for src in files_to_copy + scripts_to_copy:
-            shutil.copy2(self.builder.install_directory / 'bin' / src,
-                         self.get_install_path())
+            ndk.file.copy_file(self.builder.install_directory / 'bin' / src,
+                               self.get_install_path())
 
         if self.host.is_windows:
             for src in scripts_to_copy:
@@ -629,6 +675,7 @@ class ShaderTools(ndk.builds.CMakeModule):
             symlink_name.unlink(missing_ok=True)
             symlink_name.symlink_to(
                 Path(os.path.relpath(lib, symlink_name.parent)))
+            ndk.file.record_install(symlink_name)
 
 
 class Make(ndk.builds.AutoconfModule):
@@ -684,12 +731,16 @@ class Python(ndk.builds.Module):
     notice = ANDROID_DIR / 'prebuilts/ndk/python/NOTICE'
     notice_group = ndk.builds.NoticeGroup.TOOLCHAIN
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.PREBUILTS_BASE / self.host.tag]
+
     def build(self) -> None:
         pass
 
     def install(self) -> None:
-        copy_tree(str(self.PREBUILTS_BASE / self.host.tag),
-                  str(self.get_install_path()))
+        ndk.file.copy_tree(self.PREBUILTS_BASE / self.host.tag,
+                           self.get_install_path())
 
 
 class Toolbox(ndk.builds.Module):
@@ -709,6 +760,10 @@ class Toolbox(ndk.builds.Module):
         ] + toolchain.flags
         subprocess.run(cmd, check=True)
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [NDK_DIR / 'sources/host-tools/toolbox']
+
     def build(self) -> None:
         if not self.host.is_windows:
             print(f'Nothing to do for {self.host}')
@@ -728,8 +783,8 @@ class Toolbox(ndk.builds.Module):
         install_dir = self.get_install_path()
         install_dir.mkdir(parents=True, exist_ok=True)
 
-        shutil.copy2(self.intermediate_out_dir / 'echo.exe', install_dir)
-        shutil.copy2(self.intermediate_out_dir / 'cmp.exe', install_dir)
+        ndk.file.copy_file(self.intermediate_out_dir / 'echo.exe', install_dir)
+        ndk.file.copy_file(self.intermediate_out_dir / 'cmp.exe', install_dir)
 
 def install_exe(out_dir: str, install_dir: str, name: str, host: Host) -> None:
     ext = '.exe' if host.is_windows else ''
@@ -738,7 +793,7 @@ def install_exe(out_dir: str, install_dir: str, name: str, host: Host) -> None:
     dst = os.path.join(install_dir, exe_name)
 
     ndk.ext.shutil.create_directory(install_dir)
-    shutil.copy2(src, dst)
+    ndk.file.copy_file(Path(src), Path(dst))
 
 
 def make_linker_script(path: str, libs: List[str]) -> None:
@@ -766,6 +821,15 @@ class Libcxx(ndk.builds.Module):
     def lib_out(self) -> str:
         return os.path.join(self.out_dir, 'libcxx/libs')
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [
+            self.src,
+            ANDROID_DIR / 'toolchain/llvm-project/libcxxabi',
+            ANDROID_DIR / 'bionic',
+            NDK_DIR / 'meta/platforms.json',
+        ]
+
     def build(self) -> None:
         ndk_build = os.path.join(
             self.get_dep('ndk-build').get_build_host_install(), 'ndk-build')
@@ -806,12 +870,9 @@ class Libcxx(ndk.builds.Module):
             shutil.rmtree(install_root)
         os.makedirs(install_root)
 
-        shutil.copy2(
-            str(self.src / 'Android.mk'), install_root)
-        shutil.copytree(
-            str(self.src / 'include'),
-            os.path.join(install_root, 'include'))
-        shutil.copytree(self.lib_out, os.path.join(install_root, 'libs'))
+        ndk.file.copy_file(self.src / 'Android.mk', install_root)
+        ndk.file.copy_tree(self.src / 'include', install_root / 'include')
+        ndk.file.copy_tree(Path(self.lib_out), install_root / 'libs')
 
         for abi in ndk.abis.ALL_ABIS:
             lib_dir = os.path.join(install_root, 'libs', abi)
@@ -832,12 +893,12 @@ class Libcxx(ndk.builds.Module):
     def install_static_libs(self, lib_dir: str, abi: ndk.abis.Abi) -> None:
         static_lib_dir = os.path.join(self.obj_out, 'local', abi)
 
-        shutil.copy2(os.path.join(static_lib_dir, 'libc++abi.a'), lib_dir)
-        shutil.copy2(os.path.join(static_lib_dir, 'libc++_static.a'), lib_dir)
+        for lib in ('libc++abi.a', 'libc++_static.a'):
+            ndk.file.copy_file(Path(static_lib_dir) / lib, Path(lib_dir))
 
         if abi in ndk.abis.LP32_ABIS:
-            shutil.copy2(
-                os.path.join(static_lib_dir, 'libandroid_support.a'), lib_dir)
+            ndk.file.copy_file(
+                Path(static_lib_dir) / 'libandroid_support.a', Path(lib_dir))
 
 
 class Platforms(ndk.builds.Module):
@@ -951,26 +1012,22 @@ class Platforms(ndk.builds.Module):
 
         return args
 
-    def check_elf_note(self, obj_file: str) -> None:
-        # readelf is a cross platform tool, so arch doesn't matter.
-        readelf = self.llvm_tool('llvm-readelf')
-        out = subprocess.check_output([str(readelf), '--notes', obj_file])
-        if 'Android' not in out.decode('utf-8'):
-            raise RuntimeError(
-                '{} does not contain NDK ELF note'.format(obj_file))
-
-    def build_crt_object(self, dst: str, srcs: List[str], api: int,
-                         arch: ndk.abis.Arch, build_number: Union[int, str],
-                         defines: List[str]) -> None:
-        cc_args = self.get_build_cmd(dst, srcs, api, arch, build_number)
-        cc_args.extend(defines)
-
-        print('Running: ' + ' '.join([pipes.quote(arg) for arg in cc_args]))
-        subprocess.check_call(cc_args)
-
-    def build_crt_objects(self, dst_dir: str, api: int,
-                          arch: ndk.abis.Arch,
-                          build_number: Union[int, str]) -> None:
+    @staticmethod
+    def check_elf_note(obj_file: str) -> None:
+        with ndk.elf.ElfFile(Path(obj_file)) as elf:
+            if not any(note.name == 'Android' for note in elf.notes()):
+                raise RuntimeError(
+                    '{} does not contain NDK ELF note'.format(obj_file))
+
+    def get_crt_object_cmds(
+            self, dst_dir: str, api: int, arch: ndk.abis.Arch,
+            build_number: Union[int, str]) -> Dict[str, List[str]]:
+        """Returns the command to build each CRT object for an API and arch.
+
+        Returns:
+            A dict mapping the path of each object to the command that builds
+            it.
+        """
         src_dir = ndk.paths.android_path('bionic/libc/arch-common/bionic')
         crt_brand = ndk.paths.ndk_path('sources/crt/crtbrand.S')
 
@@ -995,23 +1052,58 @@ class Platforms(ndk.builds.Module):
             ],
         }
 
+        cmds = {}
         for name, srcs in objects.items():
             dst_path = os.path.join(dst_dir, name)
-            defs = []
+            cc_args = self.get_build_cmd(dst_path, srcs, api, arch,
+                                         build_number)
             if name == 'crtbegin_static.o':
                 # libc.a is always the latest version, so ignore the API level
                 # setting for crtbegin_static.
-                defs.append('-D_FORCE_CRT_ATFORK')
-            self.build_crt_object(
-                dst_path, srcs, api, arch, build_number, defs)
-            if name.startswith('crtbegin'):
-                self.check_elf_note(dst_path)
+                cc_args.append('-D_FORCE_CRT_ATFORK')
+            cmds[dst_path] = cc_args
+        return cmds
+
+    def build_crt_object(self, _worker: ndk.workqueue.ThreadWorker,
+                         cc_args: List[str]) -> str:
+        """Builds a single CRT object.
+
+        Returns:
+            The log of the build. Objects are built concurrently, so their
+            output is collected rather than interleaved in the module log.
+        """
+        log = 'Running: {}\n'.format(' '.join(
+            [pipes.quote(arg) for arg in cc_args]))
+        result = subprocess.run(cc_args,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                check=False)
+        log += result.stdout.decode('utf-8', errors='replace')
+        if result.returncode != 0:
+            raise RuntimeError(f'{log}\nFailed with exit status '
+                               f'{result.returncode}')
+        dst = cc_args[cc_args.index('-o') + 1]
+        if os.path.basename(dst).startswith('crtbegin'):
+            self.check_elf_note(dst)
+        return log
+
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [
+            self.prebuilts_path,
+            ANDROID_DIR / 'bionic/libc',
+            NDK_DIR / 'sources/crt',
+        ]
 
     def build(self) -> None:
         build_dir = os.path.join(self.out_dir, self.path)
         if os.path.exists(build_dir):
             shutil.rmtree(build_dir)
 
+        # Objects with identical build commands (other than the output path)
+        # are only built once and copied to the other paths.
+        copies: Dict[Tuple[str, ...], List[str]] = {}
+        cmds: Dict[Tuple[str, ...], List[str]] = {}
         for api in self.get_apis():
             if api in self.skip_apis:
                 continue
@@ -1022,8 +1114,30 @@ class Platforms(ndk.builds.Module):
                 dst_dir = os.path.join(build_dir, platform, arch_name)
                 os.makedirs(dst_dir)
                 assert self.context is not None
-                self.build_crt_objects(dst_dir, api, arch,
-                                       self.context.build_number)
+                for dst, cc_args in self.get_crt_object_cmds(
+                        dst_dir, api, arch,
+                        self.context.build_number).items():
+                    key = tuple(a if a != dst else '' for a in cc_args)
+                    copies.setdefault(key, []).append(dst)
+                    cmds.setdefault(key, cc_args)
+
+        # Each of the hundreds of objects is a separate compiler invocation,
+        # so they are built concurrently rather than one at a time.
+        workqueue = ndk.workqueue.ThreadPoolWorkQueue(
+            min(len(cmds), multiprocessing.cpu_count()))
+        try:
+            workqueue.add_tasks(self.build_crt_object,
+                                [(cc_args, ) for cc_args in cmds.values()])
+            while not workqueue.finished():
+                for log in workqueue.get_results():
+                    print(log, end='')
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+        for dsts in copies.values():
+            for dst in dsts[1:]:
+                shutil.copy2(dsts[0], dst)
 
     def install(self) -> None:
         build_dir = os.path.join(self.out_dir, self.path)
@@ -1041,7 +1155,7 @@ class Platforms(ndk.builds.Module):
             platform = 'android-{}'.format(api)
             platform_src = self.prebuilts_path / 'platforms' / platform
             platform_dst = os.path.join(install_dir, 'android-{}'.format(api))
-            shutil.copytree(platform_src, platform_dst)
+            ndk.file.copy_tree(platform_src, Path(platform_dst))
 
             for arch in self.get_arches(api):
                 arch_name = 'arch-{}'.format(arch)
@@ -1058,7 +1172,7 @@ class Platforms(ndk.builds.Module):
                 for name in os.listdir(lib_dir):
                     lib_src = os.path.join(lib_dir, name)
                     lib_dst = os.path.join(lib_dir_dst, name)
-                    shutil.copy2(lib_src, lib_dst)
+                    ndk.file.copy_file(Path(lib_src), Path(lib_dst))
 
                 if libdir_name == 'lib64':
                     # The Clang driver won't accept a sysroot that contains
@@ -1071,14 +1185,14 @@ class Platforms(ndk.builds.Module):
                 for name in os.listdir(obj_dir):
                     obj_src = os.path.join(obj_dir, name)
                     obj_dst = os.path.join(lib_dir_dst, name)
-                    shutil.copy2(obj_src, obj_dst)
+                    ndk.file.copy_file(Path(obj_src), Path(obj_dst))
 
         # https://github.com/android-ndk/ndk/issues/372
         for root, dirs, files in os.walk(install_dir):
             if not files and not dirs:
-                with open(os.path.join(root, '.keep_dir'), 'w') as keep_file:
-                    keep_file.write(
-                        'This file forces git to keep the directory.')
+                ndk.file.write_file(
+                    os.path.join(root, '.keep_dir'),
+                    'This file forces git to keep the directory.')
 
 
 class Gdb(ndk.builds.Module):
@@ -1095,6 +1209,10 @@ class Gdb(ndk.builds.Module):
     notice = ANDROID_DIR / 'prebuilts/ndk/gdb/NOTICE'
     notice_group = ndk.builds.NoticeGroup.TOOLCHAIN
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.PREBUILTS_BASE]
+
     def build(self) -> None:
         pass
 
@@ -1110,11 +1228,11 @@ class Gdb(ndk.builds.Module):
         install_dir = self.install_dir / gdbserver_dir
         if install_dir.exists():
             shutil.rmtree(install_dir)
-        shutil.copytree(self.PREBUILTS_BASE / gdbserver_dir, install_dir)
+        ndk.file.copy_tree(self.PREBUILTS_BASE / gdbserver_dir, install_dir)
 
     def install_gdb(self) -> None:
-        copy_tree(str(self.PREBUILTS_BASE / self.host.tag),
-                  str(self.install_dir / self.host.tag))
+        ndk.file.copy_tree(self.PREBUILTS_BASE / self.host.tag,
+                           self.install_dir / self.host.tag)
 
     def install(self) -> None:
         """Installs GDB."""
@@ -1137,6 +1255,10 @@ class LibShaderc(ndk.builds.Module):
         yield glslang_dir / 'LICENSE.txt'
         yield shaderc_dir / 'third_party/LICENSE.spirv-tools'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.src]
+
     def build(self) -> None:
         pass
 
@@ -1226,8 +1348,8 @@ class LibShaderc(ndk.builds.Module):
                 src = os.path.join(source_dir, d)
                 dst = os.path.join(dest_dir, d)
                 print(src, " -> ", dst)
-                shutil.copytree(src, dst,
-                                ignore=default_ignore_patterns)
+                ndk.file.copy_tree(Path(src), Path(dst),
+                                   ignore=default_ignore_patterns)
             for f in properties['files']:
                 print(source_dir, ':', dest_dir, ":", f)
                 # Only copy if the source file exists.  That way
@@ -1275,6 +1397,10 @@ class Sysroot(ndk.builds.Module):
     notice = ANDROID_DIR / 'prebuilts/ndk/platform/sysroot/NOTICE'
     intermediate_module = True
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [ANDROID_DIR / 'prebuilts/ndk/platform/sysroot']
+
     def build(self) -> None:
         pass
 
@@ -1283,7 +1409,7 @@ class Sysroot(ndk.builds.Module):
         if install_path.exists():
             shutil.rmtree(install_path)
         path = ndk.paths.android_path('prebuilts/ndk/platform/sysroot')
-        shutil.copytree(path, install_path)
+        ndk.file.copy_tree(Path(path), install_path)
         if self.host != 'linux':
             # linux/netfilter has some headers with names that differ only
             # by case, which can't be extracted to a case-insensitive
@@ -1357,6 +1483,7 @@ class Sysroot(ndk.builds.Module):
                  */
                 #define __NDK_CANARY__ {canary}
                 """))
+        ndk.file.record_install(Path(ndk_version_h_path))
 
 
 def write_clang_shell_script(wrapper_path: str, clang_name: str,
@@ -1374,6 +1501,7 @@ def write_clang_shell_script(wrapper_path: str, clang_name: str,
 
     mode = os.stat(wrapper_path).st_mode
     os.chmod(wrapper_path, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    ndk.file.record_install(Path(wrapper_path))
 
 
 def write_clang_batch_script(wrapper_path: str, clang_name: str,
@@ -1403,6 +1531,7 @@ def write_clang_batch_script(wrapper_path: str, clang_name: str,
 
             :done
         """.format(clang=clang_name, flags=' '.join(flags))))
+    ndk.file.record_install(Path(wrapper_path))
 
 
 def write_clang_wrapper(install_dir: str, api: int, triple: str,
@@ -1463,6 +1592,8 @@ class BaseToolchain(ndk.builds.Module):
         'system-stl',
         'yasm',
     }
+    # build() does nothing, so it does not need to wait for installs.
+    install_only_deps = deps
 
     @property
     def notices(self) -> Iterator[Path]:
@@ -1474,6 +1605,10 @@ class BaseToolchain(ndk.builds.Module):
         yield from SystemStl().notices
         yield ANDROID_DIR / 'toolchain/binutils/binutils-2.27/gas/COPYING'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [ANDROID_DIR / 'prebuilts/ndk/binutils']
+
     def build(self) -> None:
         pass
 
@@ -1486,26 +1621,23 @@ class BaseToolchain(ndk.builds.Module):
         sysroot_dir = self.get_dep('sysroot').get_install_path()
         system_stl_dir = self.get_dep('system-stl').get_install_path()
 
-        copy_tree(str(sysroot_dir), str(install_dir / 'sysroot'))
+        ndk.file.copy_tree(sysroot_dir, install_dir / 'sysroot')
 
         exe = '.exe' if self.host.is_windows else ''
-        shutil.copy2(
-            os.path.join(yasm_dir, 'bin', 'yasm' + exe),
-            os.path.join(install_dir, 'bin'))
-
         bin_dir = Path(install_dir) / 'bin'
+        ndk.file.copy_file(Path(yasm_dir) / 'bin' / f'yasm{exe}', bin_dir)
+
         lld = bin_dir / f'ld.lld{exe}'
         new_bin_ld = bin_dir / f'ld{exe}'
 
-        shutil.copyfile(lld, new_bin_ld)
-        shutil.copystat(lld, new_bin_ld)
+        ndk.file.copy_file(lld, new_bin_ld)
 
         for arch in ndk.abis.ALL_ARCHITECTURES:
             binutils_dir = get_binutils_prebuilt_path(self.host, arch)
             triple = ndk.abis.arch_to_triple(arch)
 
             gas = binutils_dir / f'bin/{triple}-as{exe}'
-            shutil.copy2(gas, bin_dir)
+            ndk.file.copy_file(gas, bin_dir)
 
         platforms = self.get_dep('platforms')
         assert isinstance(platforms, Platforms)
@@ -1522,7 +1654,7 @@ class BaseToolchain(ndk.builds.Module):
                                        'usr', lib_dir)
                 dst_dir = os.path.join(install_dir, 'sysroot/usr/lib', triple,
                                        str(api))
-                shutil.copytree(src_dir, dst_dir)
+                ndk.file.copy_tree(Path(src_dir), Path(dst_dir))
                 # TODO: Remove duplicate static libraries from this directory.
                 # We already have them in the version-generic directory.
 
@@ -1538,7 +1670,7 @@ class BaseToolchain(ndk.builds.Module):
         os.makedirs(system_stl_hdr_dir)
         system_stl_inc_src = os.path.join(system_stl_dir, 'include')
         system_stl_inc_dst = os.path.join(system_stl_hdr_dir, '4.9.x')
-        shutil.copytree(system_stl_inc_src, system_stl_inc_dst)
+        ndk.file.copy_tree(Path(system_stl_inc_src), Path(system_stl_inc_dst))
 
         # $SYSROOT/usr/local/include comes before $SYSROOT/usr/include, so we
         # can use that for libandroid_support's headers. Puting them here
@@ -1551,7 +1683,7 @@ class BaseToolchain(ndk.builds.Module):
         os.makedirs(support_hdr_dir)
         support_inc_src = os.path.join(libandroid_support_dir, 'include')
         support_inc_dst = os.path.join(support_hdr_dir, 'include')
-        shutil.copytree(support_inc_src, support_inc_dst)
+        ndk.file.copy_tree(Path(support_inc_src), Path(support_inc_dst))
 
 
 class Vulkan(ndk.builds.Module):
@@ -1559,6 +1691,10 @@ class Vulkan(ndk.builds.Module):
     path = Path('sources/third_party/vulkan')
     notice = ANDROID_DIR / 'external/vulkan-headers/NOTICE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [ANDROID_DIR / 'external/vulkan-headers']
+
     def build(self) -> None:
         pass
 
@@ -1575,8 +1711,7 @@ class Vulkan(ndk.builds.Module):
             src = source_dir / d
             dst = dest_dir / d
             shutil.rmtree(dst, ignore_errors=True)
-            shutil.copytree(src, dst,
-                            ignore=default_ignore_patterns)
+            ndk.file.copy_tree(src, dst, ignore=default_ignore_patterns)
 
         android_mk = dest_dir / 'build-android/jni/Android.mk'
         android_mk.parent.mkdir(parents=True, exist_ok=True)
@@ -1585,6 +1720,7 @@ class Vulkan(ndk.builds.Module):
             $(warning The Vulkan Validation Layers are now distrubted on \\
                 GitHub. See {url} for more information.)
             """))
+        ndk.file.record_install(android_mk)
 
 
 class Toolchain(ndk.builds.Module):
@@ -1604,12 +1740,19 @@ class Toolchain(ndk.builds.Module):
         'libc++abi',
         'platforms',
     }
+    # build() does nothing, so it does not need to wait for installs.
+    install_only_deps = deps
 
     @property
     def notices(self) -> Iterator[Path]:
         yield from Libcxx().notices
         yield from Libcxxabi().notices
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        # Everything installed comes from dependencies.
+        return []
+
     def build(self) -> None:
         pass
 
@@ -1622,10 +1765,10 @@ class Toolchain(ndk.builds.Module):
         os.makedirs(libcxx_hdr_dir)
         libcxx_inc_src = os.path.join(libcxx_dir, 'include')
         libcxx_inc_dst = os.path.join(libcxx_hdr_dir, 'v1')
-        shutil.copytree(libcxx_inc_src, libcxx_inc_dst)
+        ndk.file.copy_tree(Path(libcxx_inc_src), Path(libcxx_inc_dst))
 
         libcxxabi_inc_src = os.path.join(libcxxabi_dir, 'include')
-        copy_tree(libcxxabi_inc_src, libcxx_inc_dst)
+        ndk.file.copy_tree(Path(libcxxabi_inc_src), Path(libcxx_inc_dst))
 
         for arch in ndk.abis.ALL_ARCHITECTURES:
             triple = ndk.abis.arch_to_triple(arch)
@@ -1642,7 +1785,8 @@ class Toolchain(ndk.builds.Module):
                 libs.append('libandroid_support.a')
 
             for lib in libs:
-                shutil.copy2(os.path.join(libcxx_lib_dir, lib), sysroot_dst)
+                ndk.file.copy_file(Path(libcxx_lib_dir) / lib,
+                                   Path(sysroot_dst))
 
         platforms = self.get_dep('platforms')
         assert isinstance(platforms, Platforms)
@@ -1674,12 +1818,14 @@ class Toolchain(ndk.builds.Module):
                     shared_script.insert(0, '-landroid_support')
 
                 libcxx_so_path = os.path.join(dst_dir, 'libc++.so')
-                with open(libcxx_so_path, 'w') as script:
-                    script.write('INPUT({})'.format(' '.join(shared_script)))
+                ndk.file.write_file(
+                    libcxx_so_path,
+                    'INPUT({})'.format(' '.join(shared_script)))
 
                 libcxx_a_path = os.path.join(dst_dir, 'libc++.a')
-                with open(libcxx_a_path, 'w') as script:
-                    script.write('INPUT({})'.format(' '.join(static_script)))
+                ndk.file.write_file(
+                    libcxx_a_path,
+                    'INPUT({})'.format(' '.join(static_script)))
 
 
 def make_format_value(value: Any) -> Any:
@@ -1783,6 +1929,8 @@ class NdkBuild(ndk.builds.PackageModule):
         'meta',
         'clang',
     }
+    # build() does nothing, so it does not need to wait for installs.
+    install_only_deps = deps
 
     def install(self) -> None:
         super().install()
@@ -1807,6 +1955,7 @@ class NdkBuild(ndk.builds.PackageModule):
             NDK_BETA := {ndk.config.beta}
             NDK_CANARY := {str(ndk.config.canary).lower()}
             """))
+        ndk.file.record_install(version_mk)
 
 
     def get_clang_version(self, clang: Path) -> str:
@@ -1837,6 +1986,7 @@ class NdkBuild(ndk.builds.PackageModule):
             set(CMAKE_C_COMPILER_VERSION {clang_version})
             set(CMAKE_CXX_COMPILER_VERSION {clang_version})
             """))
+        ndk.file.record_install(compiler_id_file)
 
     def generate_language_specific_metadata(
             self, name: str, func: Callable[[Dict], Dict[str, Any]]) -> None:
@@ -1883,6 +2033,10 @@ class SimplePerf(ndk.builds.Module):
     path = Path('simpleperf')
     notice = ANDROID_DIR / 'prebuilts/simpleperf/NOTICE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [ANDROID_DIR / 'prebuilts/simpleperf']
+
     def build(self) -> None:
         pass
 
@@ -1898,8 +2052,8 @@ class SimplePerf(ndk.builds.Module):
         host_bin_dir = 'windows' if self.host.is_windows else self.host.value
         dirs.append(os.path.join('bin/', host_bin_dir))
         for d in dirs:
-            shutil.copytree(os.path.join(simpleperf_path, d),
-                            os.path.join(install_dir, d))
+            ndk.file.copy_tree(Path(simpleperf_path) / d,
+                               Path(install_dir) / d)
 
         for item in os.listdir(simpleperf_path):
             should_copy = False
@@ -1913,9 +2067,11 @@ class SimplePerf(ndk.builds.Module):
             elif item == 'inferno.bat' and self.host.is_windows:
                 should_copy = True
             if should_copy:
-                shutil.copy2(os.path.join(simpleperf_path, item), install_dir)
+                ndk.file.copy_file(Path(simpleperf_path) / item,
+                                   Path(install_dir))
 
-        shutil.copy2(os.path.join(simpleperf_path, 'ChangeLog'), install_dir)
+        ndk.file.copy_file(Path(simpleperf_path) / 'ChangeLog',
+                           Path(install_dir))
 
 
 class RenderscriptLibs(ndk.builds.PackageModule):
@@ -1935,6 +2091,10 @@ class RenderscriptToolchain(ndk.builds.Module):
         yield base / 'linux-x86/current/NOTICE'
         yield base / 'windows-x86/current/NOTICE'
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return [self.prebuilt_directory]
+
     def build(self) -> None:
         pass
 
@@ -2043,6 +2203,10 @@ class CanaryReadme(ndk.builds.Module):
     path = Path('README.canary')
     no_notice = True
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return []
+
     def build(self) -> None:
         pass
 
@@ -2060,6 +2224,8 @@ class Meta(ndk.builds.PackageModule):
     deps = {
         'base-toolchain',
     }
+    # build() does nothing, so it does not need to wait for installs.
+    install_only_deps = deps
 
     def install(self) -> None:
         super().install()
@@ -2106,6 +2272,7 @@ class Meta(ndk.builds.PackageModule):
         json_path = os.path.join(self.get_install_path(), 'system_libs.json')
         with open(json_path, 'w') as json_file:
             json.dump(system_libs, json_file, indent=2, separators=(',', ': '))
+        ndk.file.record_install(Path(json_path))
 
 
 class WrapSh(ndk.builds.PackageModule):
@@ -2120,6 +2287,10 @@ class SourceProperties(ndk.builds.Module):
     path = Path('source.properties')
     no_notice = True
 
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return []
+
     def build(self) -> None:
         pass
 
@@ -2173,63 +2344,177 @@ def create_notice_file(path: Path, for_group: ndk.builds.NoticeGroup) -> None:
         output_file.write(os.linesep.join(sorted(list(licenses))))
 
 
-def launch_build(worker: ndk.workqueue.Worker, module: ndk.builds.Module,
-                 log_dir: Path) -> Tuple[bool, ndk.builds.Module]:
-    result = do_build(worker, module, log_dir)
-    if not result:
-        return result, module
-    do_install(worker, module)
-    return True, module
+# Name of the database of module and test durations in the log directory.
+DURATIONS_DB_NAME = 'durations.jsonl'
 
+# Name of the timeline of the build in the log directory.
+BUILD_TRACE_NAME = 'build_trace.json'
 
-def do_build(worker: ndk.workqueue.Worker, module: ndk.builds.Module,
-             log_dir: Path) -> bool:
-    with module.log_path(log_dir).open('w') as log_file:
+# Name of the report of what each module installs in the log directory.
+INSTALL_SIZES_NAME = 'install_sizes.txt'
+
+# Directory of the manifests of module installs in the out directory of each
+# host.
+INSTALL_MANIFESTS_DIR = 'install_manifests'
+
+
+@contextlib.contextmanager
+def record_trace(trace_path: Path) -> Iterator[None]:
+    """Records the spans of the build and writes them as a Chrome trace.
+
+    The trace is written even if the build fails.
+    """
+    span_dir = trace_path.with_suffix('.spans')
+    ndk.trace.start_recording(span_dir)
+    try:
+        yield
+    finally:
+        ndk.trace.stop_recording()
+        ndk.trace.write_recorded_trace(span_dir, trace_path,
+                                       {os.getpid(): 'checkbuild'})
+        shutil.rmtree(span_dir)
+
+
+StepResult = Tuple[bool, ndk.deps.Step,
+                   Optional[ndk.durations.Measurement],
+                   Optional[ndk.file.InstallRecord],
+                   Optional[ndk.fingerprint.ModuleInputs]]
+
+
+@dataclass
+class ModuleReport:
+    """What building a module cost, for the summary of the build.
+
+    Attributes:
+        build_time: Seconds spent building the module.
+        install_time: Seconds spent installing the module.
+        restored: True if the module was restored from the cache rather than
+            built and installed.
+        files: Number of files and symlinks installed.
+        size: Size in bytes of the installed files.
+    """
+    build_time: float = 0.0
+    install_time: float = 0.0
+    restored: bool = False
+    files: int = 0
+    size: int = 0
+
+
+def launch_build(
+        worker: ndk.workqueue.Worker, step: ndk.deps.Step, log_dir: Path,
+        known_digests: Optional[Dict[str, ndk.fingerprint.DigestEntry]]
+) -> StepResult:
+    inputs = None
+    with ndk.trace.span(str(step), 'step'):
+        if known_digests is not None:
+            # The inputs were not hashed before the build started, so they
+            # are hashed here, before the build can read them.
+            worker.status = 'Hashing {}...'.format(step.module)
+            with ndk.trace.span(str(step.module), 'fingerprint'):
+                inputs = ndk.fingerprint.hash_module_inputs(
+                    step.module, known_digests)
+        with ndk.durations.Stopwatch('build',
+                                     step.module.name) as stopwatch:
+            result = do_build(worker, step.module, log_dir)
+    return result, step, stopwatch.measurement, None, inputs
+
+
+def launch_install(
+        worker: ndk.workqueue.Worker, step: ndk.deps.Step, log_dir: Path,
+        cached_install: Optional[ndk.artifactcache.CachedInstall]
+) -> StepResult:
+    module = step.module
+    with ndk.trace.span(str(step), 'step'):
+        # Accounts for the installed files as they are written, rather than
+        # measuring install trees that modules share afterwards.
+        with ndk.file.record_installs() as record:
+            result, measurement = _launch_install(worker, step, log_dir,
+                                                  cached_install)
+    install_path = module.get_install_path()
+    if (result and module.out_dir in install_path.parents
+            and install_path.is_file()):
+        # Modules that install a single file may write it directly.
+        record.add(install_path)
+    if result:
+        worker.status = 'Hashing {}...'.format(module)
+        ndk_dir = Path(
+            ndk.paths.get_install_path(str(module.out_dir), module.host))
+        ndk.installmanifest.InstallManifest.from_record(
+            module.name, record, ndk_dir).save(install_manifest_path(module))
+    return result, step, measurement, record, None
+
+
+def install_manifest_path(module: ndk.builds.Module) -> Path:
+    """Returns the path of the manifest of the module's last install.
+
+    Manifests are kept beside the module outputs rather than in the install
+    directory so that they are neither packaged nor cached, and survive
+    builds that skip the module.
+    """
+    return (module.out_dir / module.host.value / INSTALL_MANIFESTS_DIR /
+            f'{module.name}.json')
+
+
+def _launch_install(
+        worker: ndk.workqueue.Worker, step: ndk.deps.Step, log_dir: Path,
+        cached_install: Optional[ndk.artifactcache.CachedInstall]
+) -> Tuple[bool, Optional[ndk.durations.Measurement]]:
+    module = step.module
+    if cached_install is not None and cached_install.restorable:
+        worker.status = 'Restoring {}...'.format(module)
+        with ndk.trace.span(str(module), 'restore'):
+            restored = cached_install.restore(module.get_install_path())
+        if restored:
+            # Not measured, since the duration of a restore says nothing
+            # about how long the module takes to install.
+            return True, None
+        # The build was skipped in favor of the restore, but the entry was
+        # evicted by a concurrent build since.
+        if not do_build(worker, module, log_dir):
+            return False, None
+
+    with ndk.durations.Stopwatch('install', module.name) as stopwatch:
+        if cached_install is not None:
+            cached_install.prepare(module.get_install_path())
+        result = do_install(worker, module, log_dir)
+    if result and cached_install is not None:
+        worker.status = 'Caching {}...'.format(module)
+        with ndk.trace.span(str(module), 'cache'):
+            cached_install.store(module.get_install_path())
+    return result, stopwatch.measurement
+
+
+def run_logged(func: Callable[[], None], log_path: Path, mode: str) -> bool:
+    """Runs func with its output redirected to a log file.
+
+    Returns:
+        True if func succeeded, False if it raised an exception.
+    """
+    with log_path.open(mode) as log_file:
         os.dup2(log_file.fileno(), sys.stdout.fileno())
         os.dup2(log_file.fileno(), sys.stderr.fileno())
         try:
-            worker.status = 'Building {}...'.format(module)
-            module.build()
+            func()
             return True
         except Exception:  # pylint: disable=broad-except
             traceback.print_exc()
             return False
 
 
-def do_install(worker: ndk.workqueue.Worker,
-               module: ndk.builds.Module) -> None:
-    worker.status = 'Installing {}...'.format(module)
-    module.install()
-
-
-def _get_transitive_module_deps(
-        module: ndk.builds.Module, deps: Set[ndk.builds.Module],
-        unknown_deps: Set[str], seen: Set[ndk.builds.Module]) -> None:
-    seen.add(module)
-
-    for name in module.deps:
-        if name not in NAMES_TO_MODULES:
-            unknown_deps.add(name)
-            continue
-
-        dep = NAMES_TO_MODULES[name]
-        if dep in seen:
-            # Cycle detection is already handled by ndk.deps.DependencyManager.
-            # Just avoid falling into an infinite loop here and let that do the
-            # work.
-            continue
-
-        deps.add(dep)
-        _get_transitive_module_deps(dep, deps, unknown_deps, seen)
+def do_build(worker: ndk.workqueue.Worker, module: ndk.builds.Module,
+             log_dir: Path) -> bool:
+    worker.status = 'Building {}...'.format(module)
+    with ndk.trace.span(str(module), 'build'):
+        return run_logged(module.build, module.log_path(log_dir), 'w')
 
 
-def get_transitive_module_deps(
-        module: ndk.builds.Module) -> Tuple[Set[ndk.builds.Module], Set[str]]:
-    seen: Set[ndk.builds.Module] = set()
-    deps: Set[ndk.builds.Module] = set()
-    unknown_deps: Set[str] = set()
-    _get_transitive_module_deps(module, deps, unknown_deps, seen)
-    return deps, unknown_deps
+def do_install(worker: ndk.workqueue.Worker, module: ndk.builds.Module,
+               log_dir: Path) -> bool:
+    # The install may run on a different worker than the build, so it appends
+    # to the log of the build.
+    worker.status = 'Installing {}...'.format(module)
+    with ndk.trace.span(str(module), 'install'):
+        return run_logged(module.install, module.log_path(log_dir), 'a')
 
 
 def get_modules_to_build(
@@ -2241,42 +2526,27 @@ def get_modules_to_build(
     In the event that the user has passed a subset of modules, we need to also
     return the dependencies of that module.
     """
-    unknown_modules = set()
-    modules = set()
-    deps_only = set()
-    for name in module_names:
-        if name not in NAMES_TO_MODULES:
-            # Build a list of all the unknown modules rather than error out
-            # immediately so we can provide a complete error message.
-            unknown_modules.add(name)
-
-        module = NAMES_TO_MODULES[name]
-        modules.add(module)
-
-        deps, unknown_deps = get_transitive_module_deps(module)
-        modules.update(deps)
-
-        # --skip-deps may be passed if the user wants to avoid rebuilding a
-        # costly dependency. It's up to the user to guarantee that the
-        # dependency has actually been built. Modules are skipped by
-        # immediately completing them rather than sending them to the
-        # workqueue. As such, we need to return a list of which modules are
-        # *only* in the list because they are dependencies rather than being a
-        # part of the requested set.
-        for dep in deps:
-            if dep.name not in module_names:
-                deps_only.add(dep)
-        unknown_modules.update(unknown_deps)
-
+    module_names = set(module_names)
+    # Build a list of all the unknown modules rather than error out
+    # immediately so we can provide a complete error message.
+    unknown_modules = module_names - NAMES_TO_MODULES.keys()
+    known_names = module_names - unknown_modules
+    unknown_modules.update(DEPENDENCY_INDEX.unknown_deps(*known_names))
     if unknown_modules:
         sys.exit('Unknown modules: {}'.format(
             ', '.join(sorted(list(unknown_modules)))))
 
-    build_modules = []
-    for module in modules:
-        build_modules.append(module)
+    modules = DEPENDENCY_INDEX.closure(known_names)
+
+    # --skip-deps may be passed if the user wants to avoid rebuilding a costly
+    # dependency. It's up to the user to guarantee that the dependency has
+    # actually been built. Modules are skipped by immediately completing them
+    # rather than sending them to the workqueue. As such, we need to return a
+    # list of which modules are *only* in the list because they are
+    # dependencies rather than being a part of the requested set.
+    deps_only = {m for m in modules if m.name not in module_names}
 
-    return sorted(list(build_modules), key=str), deps_only
+    return sorted(list(modules), key=str), deps_only
 
 
 ALL_MODULES = [
@@ -2329,6 +2599,11 @@ ALL_MODULES = [
 NAMES_TO_MODULES = {m.name: m for m in ALL_MODULES}
 
 
+# Transitive dependency queries over ALL_MODULES, e.g.
+# DEPENDENCY_INDEX.dependents('sysroot').
+DEPENDENCY_INDEX = ndk.deps.DependencyIndex(ALL_MODULES)
+
+
 def get_all_module_names() -> List[str]:
     return [m.name for m in ALL_MODULES if m.enabled]
 
@@ -2354,6 +2629,24 @@ def parse_args() -> Tuple[argparse.Namespace, List[str]]:
         '--skip-deps', action='store_true',
         help=('Assume that dependencies have been built and only build '
               'explicitly named modules.'))
+    parser.add_argument(
+        '--force-rebuild', action='store_true',
+        help=('Rebuild every module, even those unchanged since their last '
+              'successful build.'))
+    parser.add_argument(
+        '--cache-dir', type=Path,
+        help=('Directory of a cache of module install trees shared between '
+              'builds. Modules found in the cache are restored rather than '
+              'built. Disabled by default.'))
+    parser.add_argument(
+        '--cache-size', type=int, default=20, metavar='GiB',
+        help='Size the cache is trimmed to after each build (default: 20).')
+    parser.add_argument(
+        '--plan', action='store_true',
+        help=('Do not build. Instead predict how the build would be scheduled '
+              'from the durations of previous builds, and write the predicted '
+              'timeline to build_plan.json in the log directory. The file can '
+              'be viewed with chrome://tracing or ui.perfetto.dev.'))
 
     package_group = parser.add_mutually_exclusive_group()
     package_group.add_argument(
@@ -2362,6 +2655,12 @@ def parse_args() -> Tuple[argparse.Namespace, List[str]]:
     package_group.add_argument(
         '--no-package', action='store_false', dest='package',
         help='Do not package the NDK when done building (default).')
+    parser.add_argument(
+        '--package-host', action='append', default=[], dest='package_hosts',
+        choices=Host, type=Host, metavar='HOST',
+        help=('Also package the NDK already built for HOST in the same out '
+              'directory. All packages are written in one pass that '
+              'compresses the files they share only once. May be repeated.'))
 
     test_group = parser.add_mutually_exclusive_group()
     test_group.add_argument(
@@ -2374,6 +2673,20 @@ def parse_args() -> Tuple[argparse.Namespace, List[str]]:
         '--no-build-tests', action='store_false', dest='build_tests',
         help='Skip building tests after building the NDK.')
 
+    parser.add_argument(
+        '--test-package-format', default='bz2',
+        choices=sorted(ndk.archive.TAR_FORMATS),
+        help=('Compression of the ndk-tests tarball (default: bz2). xz and '
+              'zstd (Python 3.14 and newer) are smaller and much faster to '
+              'extract.'))
+
+    parser.add_argument(
+        '--size-budget', type=Path, metavar='PATH',
+        help=('JSON file of the largest size in MiB and file count each '
+              'module may install, such as {"clang": {"max_size_mib": 1500, '
+              '"max_files": 5000}}. The build fails before packaging if a '
+              'module exceeds its budget.'))
+
     parser.add_argument(
         '--build-number', default='0', type=build_number_arg,
         help='Build number for use in version files.')
@@ -2410,88 +2723,378 @@ def log_build_failure(log_path: str, dist_dir: str) -> None:
             error_log.write(contents)
 
 
-def launch_buildable(deps: ndk.deps.DependencyManager,
-                     workqueue: ndk.workqueue.AnyWorkQueue, log_dir: Path,
-                     skip_deps: bool,
-                     skip_modules: Set[ndk.builds.Module]) -> None:
-    # If args.skip_deps is true, we could get into a case where we just
-    # dequeued the only module that was still building and the only
-    # items in get_buildable() are modules that will be skipped.
+def launch_buildable(
+        deps: ndk.deps.StepDependencyManager,
+        workqueue: ndk.workqueue.AnyWorkQueue, log_dir: Path,
+        skip_modules: Set[ndk.builds.Module],
+        stamps: ndk.fingerprint.ModuleStamps,
+        cached_installs: Mapping[ndk.builds.Module,
+                                 ndk.artifactcache.CachedInstall]
+) -> None:
+    # If any modules are skipped, we could get into a case where we just
+    # dequeued the only step that was still running and the only
+    # items in get_buildable() are steps that will be skipped.
     # Without this outer while loop, we'd mark the skipped dependencies
     # as complete and then complete the outer loop.  The workqueue
     # would be out of work and we'd exit.
     #
     # Avoid this by making sure that we queue all possible buildable
-    # modules before we complete the loop.
-    while deps.buildable_modules:
-        for module in deps.get_buildable():
-            if skip_deps and module in skip_modules:
-                deps.complete(module)
+    # steps before we complete the loop.
+    #
+    # Steps are prioritized by the expected duration of the longest chain
+    # of steps waiting on them so that the critical path is built as early
+    # as possible.
+    while deps.buildable_steps:
+        for step in deps.get_buildable():
+            module = step.module
+            if module in skip_modules:
+                deps.complete(step)
                 continue
-            workqueue.add_task(launch_build, module, log_dir)
-
-
-def wait_for_build(deps: ndk.deps.DependencyManager,
-                   workqueue: ndk.workqueue.AnyWorkQueue, dist_dir: str,
-                   log_dir: Path, skip_deps: bool,
-                   skip_modules: Set[ndk.builds.Module]) -> None:
+            priority = deps.critical_path_weights[step]
+            cached_install = cached_installs.get(module)
+            if step.phase is ndk.deps.Phase.INSTALL:
+                workqueue.add_task(launch_install,
+                                   step,
+                                   log_dir,
+                                   cached_install,
+                                   priority=priority)
+                continue
+            stamps.invalidate(module)
+            if cached_install is not None and cached_install.restorable:
+                # The install step restores the module instead.
+                deps.complete(step)
+                continue
+            known_digests = None
+            if module not in stamps.inputs:
+                known_digests = stamps.known_digests_for(module)
+            workqueue.add_task(launch_build,
+                               step,
+                               log_dir,
+                               known_digests,
+                               priority=priority)
+
+
+def wait_for_build(
+        deps: ndk.deps.StepDependencyManager,
+        workqueue: ndk.workqueue.AnyWorkQueue, dist_dir: str, log_dir: Path,
+        skip_modules: Set[ndk.builds.Module],
+        durations: ndk.durations.DurationDatabase,
+        stamps: ndk.fingerprint.ModuleStamps,
+        cached_installs: Mapping[ndk.builds.Module,
+                                 ndk.artifactcache.CachedInstall],
+        reports: Dict[ndk.builds.Module, ModuleReport]
+) -> None:
     console = ndk.ansi.get_console()
     ui = ndk.ui.get_build_progress_ui(console, workqueue)
     with ndk.ansi.disable_terminal_echo(sys.stdin):
         with console.cursor_hide_context():
             while not workqueue.finished():
-                result, module = workqueue.get_result()
-                if not result:
-                    ui.clear()
-                    print('Build failed: {}'.format(module))
-                    log_build_failure(
-                        module.log_path(log_dir), dist_dir)
-                    sys.exit(1)
-                elif not console.smart_console:
-                    ui.clear()
-                    print('Build succeeded: {}'.format(module))
-
-                deps.complete(module)
-                launch_buildable(deps, workqueue, log_dir, skip_deps,
-                                 skip_modules)
-
+                results = workqueue.get_results()
+                durations.record_all(
+                    measurement
+                    for result, _, measurement, _, _ in results
+                    if result and measurement is not None)
+                for result, step, measurement, record, inputs in results:
+                    module = step.module
+                    if inputs is not None:
+                        stamps.add_inputs(module, inputs)
+                    if result:
+                        update_module_report(
+                            reports.setdefault(module, ModuleReport()), step,
+                            measurement, record)
+                    if not result:
+                        ui.clear()
+                        print('Build failed: {}'.format(step))
+                        log_build_failure(
+                            module.log_path(log_dir), dist_dir)
+                        sys.exit(1)
+                    elif not console.smart_console:
+                        ui.clear()
+                        print('Build succeeded: {}'.format(step))
+
+                    if step.phase is ndk.deps.Phase.INSTALL:
+                        stamps.record(module)
+                    deps.complete(step)
+
+                launch_buildable(deps, workqueue, log_dir, skip_modules,
+                                 stamps, cached_installs)
                 ui.draw()
             ui.clear()
             print('Build finished')
 
 
-def build_ndk(modules: List[ndk.builds.Module],
-              deps_only: Set[ndk.builds.Module], out_dir: Path, dist_dir: Path,
-              args: argparse.Namespace) -> Path:
+def update_module_report(
+        report: ModuleReport, step: ndk.deps.Step,
+        measurement: Optional[ndk.durations.Measurement],
+        record: Optional[ndk.file.InstallRecord]) -> None:
+    """Adds the result of a finished step to the report of its module."""
+    if step.phase is ndk.deps.Phase.INSTALL:
+        if measurement is None:
+            report.restored = True
+        else:
+            report.install_time = measurement.wall_time
+        if record is not None:
+            report.files = len(record.files)
+            report.size = record.size
+    elif measurement is not None:
+        report.build_time = measurement.wall_time
+
+
+def print_module_reports(reports: Mapping[ndk.builds.Module,
+                                          ModuleReport]) -> None:
+    """Prints the size and build time of each module, largest first."""
+    print('{:>10}  {:>7}  {:>8}  {:>8}  {}'.format('Size (MiB)', 'Files',
+                                                   'Build', 'Install',
+                                                   'Module'))
+    for module, report in sorted(reports.items(),
+                                 key=lambda item: item[1].size,
+                                 reverse=True):
+        if report.restored:
+            build_time = install_time = 'cached'
+        else:
+            build_time = '{:.1f}s'.format(report.build_time)
+            install_time = '{:.1f}s'.format(report.install_time)
+        print('{:>10.1f}  {:>7}  {:>8}  {:>8}  {}'.format(
+            report.size / 2**20, report.files, build_time, install_time,
+            module))
+
+
+def report_install_sizes(
+        modules: Iterable[ndk.builds.Module], dist_dir: Path,
+        budgets: Mapping[str, ndk.installmanifest.SizeBudget]) -> Path:
+    """Writes the install size report and enforces the size budgets.
+
+    Modules skipped by this build are reported from the manifest of their
+    last install.
+
+    Returns:
+        The path to the report.
+    """
+    manifests = ndk.installmanifest.load_manifests(
+        {module.name: install_manifest_path(module) for module in modules})
+    report_path = dist_dir / 'logs' / INSTALL_SIZES_NAME
+    report_path.write_text(
+        ndk.installmanifest.format_size_report(manifests))
+    violations = ndk.installmanifest.check_budgets(manifests, budgets)
+    if violations:
+        print('Modules exceed their size budgets:')
+        for violation in violations:
+            print('  ' + violation)
+        print('Sizes of the largest files are in {}'.format(report_path))
+        sys.exit(1)
+    return report_path
+
+
+def set_build_context(out_dir: Path, dist_dir: Path,
+                      args: argparse.Namespace) -> None:
     build_context = ndk.builds.BuildContext(
         out_dir, dist_dir, ALL_MODULES, args.system, args.build_number)
 
-    for module in modules:
+    # Modules that are not being built also need a context so that their
+    # install paths can be compared with those of the modules being built.
+    for module in ALL_MODULES:
         module.context = build_context
 
+
+def create_dependency_manager(
+        modules: List[ndk.builds.Module],
+        durations: ndk.durations.DurationDatabase
+) -> ndk.deps.StepDependencyManager:
+    # Modules are weighted by how long they took in previous builds so that
+    # the longest chains of work are started first.
+    #
+    # Durations from before builds and installs were measured separately
+    # are used for builds until they are replaced.
+    build_costs = durations.expected_durations('module')
+    build_costs.update(durations.expected_durations('build'))
+    return ndk.deps.StepDependencyManager(
+        modules, build_costs, durations.expected_durations('install'))
+
+
+def create_module_stamps(
+        modules: List[ndk.builds.Module],
+        args: argparse.Namespace) -> ndk.fingerprint.ModuleStamps:
+    """Loads the stamps of the modules, hashing inputs up front if needed.
+
+    Fingerprints are only needed before the build to find unchanged modules
+    and cached installs. A forced rebuild, or a build with no stamps and no
+    cache, skips the up front pass over every input, and each module's
+    inputs are hashed by its worker instead.
+    """
+    stamps = ndk.fingerprint.ModuleStamps(modules, eager=False)
+    if args.cache_dir is not None or (not args.force_rebuild
+                                      and stamps.any_stamps):
+        with ndk.trace.span('Hashing module inputs', 'fingerprint'):
+            stamps.hash_all(args.jobs)
+    return stamps
+
+
+def get_skip_modules(modules: List[ndk.builds.Module],
+                     deps_only: Set[ndk.builds.Module],
+                     stamps: ndk.fingerprint.ModuleStamps,
+                     args: argparse.Namespace) -> Set[ndk.builds.Module]:
+    # Modules that have not changed since their last successful build are not
+    # rebuilt.
+    skip_modules = set() if args.force_rebuild else stamps.up_to_date()
+    if skip_modules:
+        print('Up to date: {}'.format(' '.join(
+            sorted(str(m) for m in skip_modules))))
+    if args.skip_deps:
+        skip_modules |= deps_only
+    return skip_modules
+
+
+def get_cached_installs(
+        modules: List[ndk.builds.Module],
+        stamps: ndk.fingerprint.ModuleStamps, args: argparse.Namespace
+) -> Tuple[Optional[ndk.artifactcache.ArtifactCache], Dict[
+        ndk.builds.Module, ndk.artifactcache.CachedInstall]]:
+    cached_installs: Dict[ndk.builds.Module,
+                          ndk.artifactcache.CachedInstall] = {}
+    if args.cache_dir is None:
+        return None, cached_installs
+    cache = ndk.artifactcache.ArtifactCache(args.cache_dir,
+                                            args.cache_size * 1024**3)
+    for module in modules:
+        cached_install = ndk.artifactcache.get_cached_install(
+            cache, module, stamps.fingerprint(module), ALL_MODULES)
+        if cached_install is not None:
+            cached_installs[module] = cached_install
+    return cache, cached_installs
+
+
+def plan_build(modules: List[ndk.builds.Module],
+               deps_only: Set[ndk.builds.Module], out_dir: Path,
+               dist_dir: Path, args: argparse.Namespace) -> Path:
+    """Predicts the timeline of a build without building anything.
+
+    The build is simulated with args.jobs workers, using the durations of
+    previous builds. Modules that would be skipped or restored from the cache
+    take no time.
+
+    Returns:
+        The path to the predicted timeline, a Chrome trace.
+    """
+    set_build_context(out_dir, dist_dir, args)
+    log_dir = dist_dir / 'logs'
+    durations = ndk.durations.DurationDatabase.load(log_dir /
+                                                    DURATIONS_DB_NAME)
+    deps = create_dependency_manager(modules, durations)
+    stamps = create_module_stamps(modules, args)
+    skip_modules = get_skip_modules(modules, deps_only, stamps, args)
+    _, cached_installs = get_cached_installs(modules, stamps, args)
+
+    skipped = set()
+    for step in deps.step_deps:
+        cached_install = cached_installs.get(step.module)
+        if step.module in skip_modules:
+            skipped.add(step)
+        elif (step.phase is ndk.deps.Phase.BUILD
+              and cached_install is not None and cached_install.restorable):
+            skipped.add(step)
+
+    step_deps = deps.step_deps
+    schedule = ndk.deps.schedule_steps(deps, args.jobs, skipped)
+    critical_path = ndk.deps.find_critical_path(schedule, step_deps)
+    on_critical_path = {s.step for s in critical_path}
+
+    # Workers are drawn on tracks 1 to N. Track 0 repeats the critical path.
+    spans = []
+    for scheduled in schedule:
+        if scheduled.worker is None:
+            continue
+        critical = scheduled.step in on_critical_path
+        spans.append(
+            ndk.trace.Span(str(scheduled.step.module),
+                           scheduled.step.phase.value,
+                           scheduled.start,
+                           scheduled.end - scheduled.start,
+                           pid=0,
+                           tid=scheduled.worker + 1,
+                           args={'critical_path': critical},
+                           color='bad' if critical else None))
+    for scheduled in critical_path:
+        if scheduled.worker is None:
+            continue
+        spans.append(
+            ndk.trace.Span(str(scheduled.step.module),
+                           scheduled.step.phase.value,
+                           scheduled.start,
+                           scheduled.end - scheduled.start,
+                           pid=0,
+                           tid=0,
+                           args={'worker': scheduled.worker + 1},
+                           color='bad'))
+    thread_names = {(0, 0): 'Critical path'}
+    for worker in range(args.jobs):
+        thread_names[(0, worker + 1)] = f'Worker {worker + 1}'
+    trace_path = log_dir / 'build_plan.json'
+    ndk.trace.write_trace(trace_path, spans, {0: 'Predicted build'},
+                          thread_names)
+
+    makespan = max((s.end for s in schedule), default=0.0)
+    print('Predicted build time with {} workers: {}'.format(
+        args.jobs, datetime.timedelta(seconds=round(makespan))))
+    print('Critical path:')
+    for scheduled in critical_path:
+        if scheduled.worker is not None:
+            print('  {:>8.1f}s  {}'.format(scheduled.end - scheduled.start,
+                                          scheduled.step))
+    measured = set(durations.expected_durations('module'))
+    measured.update(durations.expected_durations('build'))
+    unknown = sorted(m.name for m in modules
+                     if m not in skip_modules and m.name not in measured)
+    if unknown:
+        print('No duration history (assumed 1s): {}'.format(
+            ' '.join(unknown)))
+    return trace_path
+
+
+def build_ndk(modules: List[ndk.builds.Module],
+              deps_only: Set[ndk.builds.Module], out_dir: Path, dist_dir: Path,
+              args: argparse.Namespace
+              ) -> Tuple[Path, Dict[ndk.builds.Module, ModuleReport]]:
+    """Builds and installs the given modules.
+
+    Returns:
+        The path to the built NDK, and a report of each module built or
+        restored from the cache. Unchanged modules are not reported.
+    """
+    set_build_context(out_dir, dist_dir, args)
+
     log_dir = dist_dir / 'logs'
     log_dir.mkdir(parents=True, exist_ok=True)
 
     ndk_dir = Path(ndk.paths.get_install_path(str(out_dir), args.system))
     ndk_dir.mkdir(parents=True, exist_ok=True)
 
-    deps = ndk.deps.DependencyManager(modules)
+    durations = ndk.durations.DurationDatabase.load(log_dir /
+                                                    DURATIONS_DB_NAME)
+    deps = create_dependency_manager(modules, durations)
+    stamps = create_module_stamps(modules, args)
+    skip_modules = get_skip_modules(modules, deps_only, stamps, args)
+    cache, cached_installs = get_cached_installs(modules, stamps, args)
+    reports: Dict[ndk.builds.Module, ModuleReport] = {}
+
     workqueue = ndk.workqueue.WorkQueue(args.jobs)
     try:
-        launch_buildable(deps, workqueue, log_dir, args.skip_deps,
-                         deps_only)
-        wait_for_build(deps, workqueue, str(dist_dir), log_dir,
-                       args.skip_deps, deps_only)
-
-        if deps.get_buildable():
+        launch_buildable(deps, workqueue, log_dir, skip_modules, stamps,
+                         cached_installs)
+        wait_for_build(deps, workqueue, str(dist_dir), log_dir, skip_modules,
+                       durations, stamps, cached_installs, reports)
+        if cache is not None:
+            cache.evict()
+
+        buildable = deps.get_buildable()
+        if buildable:
             raise RuntimeError(
-                'Builder stopped early. Modules are still '
-                'buildable: {}'.format(', '.join(str(deps.get_buildable()))))
+                'Builder stopped early. Steps are still buildable: {}'.format(
+                    ', '.join(str(s) for s in buildable)))
 
         create_notice_file(ndk_dir / 'NOTICE', ndk.builds.NoticeGroup.BASE)
         create_notice_file(ndk_dir / 'NOTICE.toolchain',
                            ndk.builds.NoticeGroup.TOOLCHAIN)
-        return ndk_dir
+        return ndk_dir, reports
     finally:
         workqueue.terminate()
         workqueue.join()
@@ -2517,15 +3120,6 @@ def create_ndk_symlink(out_dir: str) -> None:
         os.symlink(this_host_ndk, ndk_symlink)
 
 
-def get_directory_size(path: Path) -> int:
-    du_str = subprocess.check_output(['du', '-sm', str(path)])
-    match = re.match(r'^(\d+)', du_str.decode('utf-8'))
-    if match is None:
-        raise RuntimeError(f'Could not determine the size of {path}')
-    size_str = match.group(1)
-    return int(size_str)
-
-
 def main() -> None:
     logging.basicConfig()
 
@@ -2566,51 +3160,88 @@ def main() -> None:
 
     print('Machine has {} CPUs'.format(multiprocessing.cpu_count()))
 
-    if args.system.is_windows and not args.skip_deps:
-        # Since the Windows NDK is cross compiled, we need to build a Linux NDK
-        # first so we can build components like libc++.
-        build_ndk_for_cross_compile(Path(out_dir), args)
+    other_ndk_dirs = {
+        host: Path(ndk.paths.get_install_path(out_dir, host))
+        for host in args.package_hosts if host != args.system
+    }
+    for host, other_ndk_dir in other_ndk_dirs.items():
+        if not other_ndk_dir.is_dir():
+            sys.exit('Cannot package {}: {} has not been built.'.format(
+                host.value, other_ndk_dir))
 
-    modules, deps_only = get_modules_to_build(module_names)
-    print('Building modules: {}'.format(' '.join(
-        [str(m) for m in modules
-         if not args.skip_deps or m not in deps_only])))
-
-    build_timer = ndk.timer.Timer()
-    with build_timer:
-        ndk_dir = build_ndk(modules, deps_only, Path(out_dir), Path(dist_dir),
-                            args)
-    installed_size = get_directory_size(ndk_dir)
-
-    # Create a symlink to the NDK usable by this host in the root of the out
-    # directory for convenience.
-    create_ndk_symlink(out_dir)
-
-    package_timer = ndk.timer.Timer()
-    with package_timer:
-        if args.package:
-            print('Packaging NDK...')
-            # NB: Purging of unwanted files (.pyc, Android.bp, etc) happens as
-            # part of packaging. If testing is ever moved to happen before
-            # packaging, ensure that the directory is purged before and after
-            # building the tests.
-            package_path = package_ndk(ndk_dir, Path(out_dir),
-                                       Path(dist_dir), args.system,
-                                       args.build_number)
-            packaged_size_bytes = os.path.getsize(package_path)
-            packaged_size = packaged_size_bytes // (2 ** 20)
-
-    good = True
-    test_timer = ndk.timer.Timer()
-    with test_timer:
-        if args.build_tests:
-            good = build_ndk_tests(out_dir, dist_dir, args)
-            print()  # Blank line between test results and timing data.
+    budgets: Dict[str, ndk.installmanifest.SizeBudget] = {}
+    if args.size_budget is not None:
+        try:
+            budgets = ndk.installmanifest.load_budgets(
+                args.size_budget, NAMES_TO_MODULES)
+        except (OSError, ValueError) as ex:
+            sys.exit('Invalid size budget: {}'.format(ex))
+
+    if args.plan:
+        modules, deps_only = get_modules_to_build(module_names)
+        trace_path = plan_build(modules, deps_only, Path(out_dir),
+                                Path(dist_dir), args)
+        print('Predicted timeline written to {}'.format(trace_path))
+        return
+
+    # Every build records its timeline for finding idle workers and serial
+    # bottlenecks.
+    trace_path = Path(dist_dir) / 'logs' / BUILD_TRACE_NAME
+    with record_trace(trace_path):
+        if args.system.is_windows and not args.skip_deps:
+            # Since the Windows NDK is cross compiled, we need to build a Linux
+            # NDK first so we can build components like libc++.
+            with ndk.trace.span('Linux build', 'phase'):
+                build_ndk_for_cross_compile(Path(out_dir), args)
+
+        modules, deps_only = get_modules_to_build(module_names)
+        print('Building modules: {}'.format(' '.join(
+            [str(m) for m in modules
+             if not args.skip_deps or m not in deps_only])))
+
+        build_timer = ndk.timer.Timer()
+        with build_timer, ndk.trace.span('Build', 'phase'):
+            ndk_dir, module_reports = build_ndk(modules, deps_only,
+                                                Path(out_dir), Path(dist_dir),
+                                                args)
+        installed_size = ndk.file.tree_size(ndk_dir) // 2**20
+        size_report_path = report_install_sizes(modules, Path(dist_dir),
+                                                budgets)
+
+        # Create a symlink to the NDK usable by this host in the root of the
+        # out directory for convenience.
+        create_ndk_symlink(out_dir)
+
+        package_timer = ndk.timer.Timer()
+        with package_timer, ndk.trace.span('Packaging', 'phase'):
+            if args.package:
+                print('Packaging NDK...')
+                # NB: Purging of unwanted files (.pyc, Android.bp, etc) happens
+                # as part of packaging. If testing is ever moved to happen
+                # before packaging, ensure that the directory is purged before
+                # and after building the tests.
+                package_paths = package_ndks(
+                    {args.system: ndk_dir, **other_ndk_dirs}, Path(dist_dir),
+                    args.build_number)
+                package_path = package_paths[args.system]
+                packaged_size_bytes = os.path.getsize(package_path)
+                packaged_size = packaged_size_bytes // (2 ** 20)
+
+        good = True
+        test_timer = ndk.timer.Timer()
+        with test_timer, ndk.trace.span('Testing', 'phase'):
+            if args.build_tests:
+                good = build_ndk_tests(out_dir, dist_dir, args)
+                print()  # Blank line between test results and timing data.
 
     total_timer.finish()
 
     print('')
+    if module_reports:
+        print_module_reports(module_reports)
+        print('')
     print('Installed size: {} MiB'.format(installed_size))
+    print('Installed size by module: {}'.format(size_report_path))
     if args.package:
         print('Package size: {} MiB'.format(packaged_size))
     print('Finished {}'.format('successfully' if good else 'unsuccessfully'))
@@ -2618,6 +3249,7 @@ def main() -> None:
     print('Packaging: {}'.format(package_timer.duration))
     print('Testing: {}'.format(test_timer.duration))
     print('Total: {}'.format(total_timer.duration))
+    print('Timeline: {}'.format(trace_path))
 
     subject = 'NDK Build {}!'.format('Passed' if good else 'Failed')
     body = 'Build finished in {}'.format(total_timer.duration)
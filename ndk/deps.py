@@ -14,7 +14,11 @@
 # limitations under the License.
 #
 """Performs dependency tracking for ndk.builds modules."""
-from typing import Dict, Iterable, List, Set
+from dataclasses import dataclass
+from enum import Enum, unique
+import heapq
+from typing import (Callable, Dict, Iterable, List, Mapping, Optional, Set,
+                    Tuple)
 
 from ndk.builds import Module
 import ndk.graph
@@ -39,7 +43,8 @@ def prove_acyclic(modules: Iterable[Module]) -> None:
     """
     nodes = {m.name: ndk.graph.Node(m.name, []) for m in modules}
     for module in modules:
-        for dep in module.deps:
+        # Dependencies outside the graph can't be part of a cycle.
+        for dep in sorted(module.deps & nodes.keys()):
             nodes[module.name].outs.append(nodes[dep])
     graph = ndk.graph.Graph(nodes.values())
     cycle = graph.find_cycle()
@@ -47,6 +52,223 @@ def prove_acyclic(modules: Iterable[Module]) -> None:
         raise CyclicDependencyError(cycle)
 
 
+class DependencyIndex:
+    """Answers transitive dependency queries about a module graph.
+
+    The transitive dependencies and dependents of every module are computed
+    once, in a single pass over the graph in topological order, and stored as
+    bitsets indexed by topological position. Queries are then a matter of
+    unpacking a bitset.
+
+    Dependencies that name modules outside the graph are ignored by the
+    queries and reported by unknown_deps().
+    """
+    def __init__(self, modules: Iterable[Module]) -> None:
+        """Initializes a DependencyIndex.
+
+        Args:
+            modules: All modules in the graph.
+
+        Raises:
+            CyclicDependencyError: A cycle was found in the module graph.
+        """
+        modules = list(modules)
+        self.names_to_modules = {m.name: m for m in modules}
+
+        known_deps = {
+            m.name: m.deps & self.names_to_modules.keys()
+            for m in modules
+        }
+        dependents: Dict[str, List[Module]] = {m.name: [] for m in modules}
+        for module in sorted(modules, key=str):
+            for dep in known_deps[module.name]:
+                dependents[dep].append(module)
+
+        # Kahn's algorithm, seeded in name order so that the order is
+        # deterministic.
+        num_deps = {name: len(deps) for name, deps in known_deps.items()}
+        self.topological_order = [
+            m for m in sorted(modules, key=str) if not num_deps[m.name]
+        ]
+        for module in self.topological_order:
+            for dependent in dependents[module.name]:
+                num_deps[dependent.name] -= 1
+                if not num_deps[dependent.name]:
+                    self.topological_order.append(dependent)
+        if len(self.topological_order) < len(modules):
+            # The modules that could not be ordered contain a cycle.
+            unordered = set(modules) - set(self.topological_order)
+            prove_acyclic(unordered)
+            raise RuntimeError(f'Could not order modules: {unordered}')
+
+        self._bits = {
+            m.name: 1 << i
+            for i, m in enumerate(self.topological_order)
+        }
+        self._deps_bits: Dict[str, int] = {}
+        self._unknown_deps: Dict[str, Set[str]] = {}
+        for module in self.topological_order:
+            bits = 0
+            unknown = module.deps - known_deps[module.name]
+            for dep in known_deps[module.name]:
+                bits |= self._bits[dep] | self._deps_bits[dep]
+                unknown |= self._unknown_deps[dep]
+            self._deps_bits[module.name] = bits
+            self._unknown_deps[module.name] = unknown
+
+        self._dependents_bits: Dict[str, int] = {}
+        for module in reversed(self.topological_order):
+            bits = 0
+            for dependent in dependents[module.name]:
+                bits |= (self._bits[dependent.name]
+                         | self._dependents_bits[dependent.name])
+            self._dependents_bits[module.name] = bits
+
+    def _unpack(self, bits: int) -> Set[Module]:
+        modules = set()
+        while bits:
+            lowest = bits & -bits
+            modules.add(self.topological_order[lowest.bit_length() - 1])
+            bits ^= lowest
+        return modules
+
+    def _union(self, bitsets: Mapping[str, int], names: Iterable[str]) -> int:
+        bits = 0
+        for name in names:
+            bits |= bitsets[name]
+        return bits
+
+    def dependencies(self, *names: str) -> Set[Module]:
+        """Returns every module the named modules depend on, directly or not.
+
+        Raises:
+            KeyError: A name is not a module in the graph.
+        """
+        return self._unpack(self._union(self._deps_bits, names))
+
+    def dependents(self, *names: str) -> Set[Module]:
+        """Returns every module that depends on the named modules.
+
+        For example, dependents('sysroot') is everything that must be rebuilt
+        when the sysroot changes.
+
+        Raises:
+            KeyError: A name is not a module in the graph.
+        """
+        return self._unpack(self._union(self._dependents_bits, names))
+
+    def closure(self, names: Iterable[str]) -> Set[Module]:
+        """Returns the named modules and all of their dependencies.
+
+        Raises:
+            KeyError: A name is not a module in the graph.
+        """
+        names = list(names)
+        bits = self._union(self._bits, names)
+        return self._unpack(bits | self._union(self._deps_bits, names))
+
+    def unknown_deps(self, *names: str) -> Set[str]:
+        """Returns the dependencies of the named modules that are not known.
+
+        Includes the unknown dependencies of transitive dependencies.
+
+        Raises:
+            KeyError: A name is not a module in the graph.
+        """
+        unknown: Set[str] = set()
+        for name in names:
+            unknown |= self._unknown_deps[name]
+        return unknown
+
+
+def compute_critical_path_weights(
+        modules: Iterable[Module], deps_to_modules: Mapping[str, List[Module]],
+        costs: Optional[Mapping[str, float]] = None) -> Dict[str, float]:
+    """Computes the critical path weight of each module.
+
+    The weight of a module is its own cost plus the largest weight of any of
+    its dependents, i.e. the length of the longest path from the start of the
+    module's build to the end of the whole build. Dispatching the module with
+    the largest weight first keeps the critical path moving.
+
+    Args:
+        modules: All modules in the (acyclic) build graph.
+        deps_to_modules: Map of module name to the modules that depend on it.
+        costs: Expected cost of building each module, keyed by module name.
+            Modules without an entry are assumed to cost 1.
+
+    Returns:
+        A dict mapping module names to their critical path weight.
+    """
+    if costs is None:
+        costs = {}
+    modules = list(modules)
+    # Visit modules in reverse topological order so that every dependent has
+    # been weighed before the modules it depends on.
+    num_deps = {m.name: len(m.deps) for m in modules}
+    order = [m for m in modules if not m.deps]
+    for module in order:
+        for dependent in deps_to_modules[module.name]:
+            num_deps[dependent.name] -= 1
+            if not num_deps[dependent.name]:
+                order.append(dependent)
+
+    weights: Dict[str, float] = {}
+    for module in reversed(order):
+        downstream = max((weights[d.name]
+                          for d in deps_to_modules[module.name]),
+                         default=0)
+        weights[module.name] = costs.get(module.name, 1) + downstream
+    return weights
+
+
+def simulate_build(modules: Iterable[Module], num_workers: int,
+                   costs: Mapping[str, float],
+                   priority: Optional[Callable[[Module], float]] = None
+                   ) -> float:
+    """Simulates a parallel build and returns its makespan.
+
+    Buildable modules are handed to idle workers in the order checkbuild
+    would queue them: by priority if one is given, otherwise first in first
+    out. Modules that become buildable at the same time are queued in name
+    order so the result is deterministic.
+
+    Args:
+        modules: All modules in the build graph.
+        num_workers: Number of modules that may be built concurrently.
+        costs: Time taken to build each module, keyed by module name.
+        priority: Function returning the priority of a module, or None for
+            FIFO scheduling.
+
+    Returns:
+        The time at which the last module finished building.
+    """
+    deps = DependencyManager(modules)
+    pending: List[Tuple[float, int, Module]] = []
+    counter = 0
+
+    def queue_buildable() -> None:
+        nonlocal counter
+        for module in sorted(deps.get_buildable(), key=str):
+            key = -priority(module) if priority is not None else 0
+            heapq.heappush(pending, (key, counter, module))
+            counter += 1
+
+    now = 0.0
+    running: List[Tuple[float, str, Module]] = []
+    queue_buildable()
+    while pending or running:
+        while pending and len(running) < num_workers:
+            module = heapq.heappop(pending)[2]
+            heapq.heappush(running,
+                           (now + costs.get(module.name, 1), str(module),
+                            module))
+        now, _, module = heapq.heappop(running)
+        deps.complete(module)
+        queue_buildable()
+    return now
+
+
 class DependencyManager:
     """Tracks module dependencies.
 
@@ -56,8 +278,16 @@ class DependencyManager:
     the DependencyManager is informated of a module build being completed via
     DependencyManager.complete().
     """
-    def __init__(self, all_modules: Iterable[Module]) -> None:
-        """Initializes a DependencyManager."""
+    def __init__(self,
+                 all_modules: Iterable[Module],
+                 costs: Optional[Mapping[str, float]] = None) -> None:
+        """Initializes a DependencyManager.
+
+        Args:
+            all_modules: All modules in the build graph.
+            costs: Expected cost of building each module, keyed by module
+                name. Modules without an entry are assumed to cost 1.
+        """
         if not all_modules:
             raise ValueError
         prove_acyclic(all_modules)
@@ -79,6 +309,9 @@ class DependencyManager:
             for dep in module.deps:
                 self.deps_to_modules[dep].append(module)
 
+        self.critical_path_weights = compute_critical_path_weights(
+            all_modules, self.deps_to_modules, costs)
+
     def get_buildable(self) -> Set[Module]:
         """Returns a set of modules that are ready to be built.
 
@@ -107,3 +340,245 @@ class DependencyManager:
                 continue
             del self.blocked_modules[dependent]
             self.buildable_modules.add(dependent)
+
+
+@unique
+class Phase(Enum):
+    """A phase of building a module."""
+    BUILD = 'build'
+    INSTALL = 'install'
+
+
+@dataclass(frozen=True)
+class Step:
+    """A single phase of a module, scheduled as its own unit of work."""
+    module: Module
+    phase: Phase
+
+    def __str__(self) -> str:
+        return f'{self.module} ({self.phase.value})'
+
+
+class StepDependencyManager:
+    """Tracks dependencies between the build and install steps of modules.
+
+    Every module is split into a build step and an install step so that the
+    build of a module is not held up by the slow install of a dependency it
+    does not need installed. The install of a module follows its build and
+    the installs of all of its dependencies. The build of a module follows:
+
+    * The build of each dependency in Module.build_output_deps.
+    * Nothing for each dependency in Module.install_only_deps.
+    * The install of every other dependency.
+
+    Installs of modules that depend on each other are therefore still ordered,
+    which matters because installs may overwrite each other's files.
+    """
+    def __init__(self,
+                 all_modules: Iterable[Module],
+                 build_costs: Optional[Mapping[str, float]] = None,
+                 install_costs: Optional[Mapping[str, float]] = None) -> None:
+        """Initializes a StepDependencyManager.
+
+        Args:
+            all_modules: All modules in the build graph.
+            build_costs: Expected duration of building each module, keyed by
+                module name. Modules without an entry are assumed to cost 1.
+            install_costs: Expected duration of installing each module, keyed
+                by module name. Modules without an entry are assumed to cost
+                1.
+        """
+        all_modules = list(all_modules)
+        if not all_modules:
+            raise ValueError
+        # A cycle of steps implies a cycle of modules.
+        prove_acyclic(all_modules)
+        modules = {m.name: m for m in all_modules}
+
+        # The steps each step is still waiting for.
+        self.blocked_steps: Dict[Step, Set[Step]] = {}
+        # Reverse map from a step to the steps waiting for it.
+        self.dependents: Dict[Step, List[Step]] = {}
+        for module in all_modules:
+            build = Step(module, Phase.BUILD)
+            install = Step(module, Phase.INSTALL)
+            self.blocked_steps[build] = set()
+            self.blocked_steps[install] = {build}
+            for dep_name in module.deps:
+                dep = modules[dep_name]
+                self.blocked_steps[install].add(Step(dep, Phase.INSTALL))
+                if dep_name in module.build_output_deps:
+                    self.blocked_steps[build].add(Step(dep, Phase.BUILD))
+                elif dep_name not in module.install_only_deps:
+                    self.blocked_steps[build].add(Step(dep, Phase.INSTALL))
+        # The steps each step waits for. Unlike blocked_steps, this is not
+        # updated as steps complete.
+        self.step_deps = {s: set(w) for s, w in self.blocked_steps.items()}
+        for step in self.blocked_steps:
+            self.dependents[step] = []
+        for step, waiting_for in self.blocked_steps.items():
+            for dep_step in waiting_for:
+                self.dependents[dep_step].append(step)
+
+        self.buildable_steps = {
+            s
+            for s, waiting_for in self.blocked_steps.items() if not waiting_for
+        }
+        for step in self.buildable_steps:
+            del self.blocked_steps[step]
+
+        costs = {
+            Phase.BUILD: build_costs or {},
+            Phase.INSTALL: install_costs or {},
+        }
+        # The expected duration of each step.
+        self.costs = {
+            s: costs[s.phase].get(s.module.name, 1)
+            for s in self.step_deps
+        }
+        self.critical_path_weights = self._compute_critical_path_weights()
+
+    def _compute_critical_path_weights(self) -> Dict[Step, float]:
+        """Computes the critical path weight of each step.
+
+        See compute_critical_path_weights.
+        """
+        num_deps = {s: len(w) for s, w in self.blocked_steps.items()}
+        order = list(self.buildable_steps)
+        for step in order:
+            for dependent in self.dependents[step]:
+                num_deps[dependent] -= 1
+                if not num_deps[dependent]:
+                    order.append(dependent)
+
+        weights: Dict[Step, float] = {}
+        for step in reversed(order):
+            downstream = max((weights[d] for d in self.dependents[step]),
+                             default=0)
+            weights[step] = self.costs[step] + downstream
+        return weights
+
+    def get_buildable(self) -> Set[Step]:
+        """Returns the steps that are ready to run.
+
+        As with DependencyManager.get_buildable, the returned steps are
+        removed from buildable_steps.
+        """
+        buildable = self.buildable_steps
+        self.buildable_steps = set()
+        return buildable
+
+    def complete(self, step: Step) -> None:
+        """Signals that the given step has completed.
+
+        Args:
+            step: The step that has completed.
+        """
+        for dependent in self.dependents[step]:
+            self.blocked_steps[dependent].remove(step)
+            if self.blocked_steps[dependent]:
+                # Still blocked on other steps.
+                continue
+            del self.blocked_steps[dependent]
+            self.buildable_steps.add(dependent)
+
+
+@dataclass(frozen=True)
+class ScheduledStep:
+    """A step placed on the timeline of a simulated build.
+
+    Attributes:
+        step: The step.
+        worker: Index of the worker that runs the step, or None if the step
+            is skipped and completes as soon as it is buildable.
+        start: Time at which the step starts.
+        end: Time at which the step completes.
+    """
+    step: Step
+    worker: Optional[int]
+    start: float
+    end: float
+
+
+def schedule_steps(deps: StepDependencyManager, num_workers: int,
+                   skipped: Set[Step]) -> List[ScheduledStep]:
+    """Simulates the build checkbuild would run.
+
+    Steps are handed to idle workers in the order checkbuild queues them: by
+    critical path weight, and then by name so the result is deterministic.
+    Each step takes its expected duration from deps.costs.
+
+    Args:
+        deps: The steps to schedule. Completes every step.
+        num_workers: Number of steps that may run concurrently.
+        skipped: Steps that complete without running.
+
+    Returns:
+        Every step in the order they start.
+    """
+    schedule: List[ScheduledStep] = []
+    pending: List[Tuple[float, str, Step]] = []
+    idle_workers = list(range(num_workers))
+    running: List[Tuple[float, str, int, Step]] = []
+    now = 0.0
+
+    def queue_buildable() -> None:
+        while deps.buildable_steps:
+            for step in deps.get_buildable():
+                if step in skipped:
+                    schedule.append(ScheduledStep(step, None, now, now))
+                    deps.complete(step)
+                    continue
+                heapq.heappush(pending, (-deps.critical_path_weights[step],
+                                         str(step), step))
+
+    queue_buildable()
+    while pending or running:
+        while pending and idle_workers:
+            step = heapq.heappop(pending)[2]
+            worker = heapq.heappop(idle_workers)
+            end = now + deps.costs[step]
+            schedule.append(ScheduledStep(step, worker, now, end))
+            heapq.heappush(running, (end, str(step), worker, step))
+        now, _, worker, step = heapq.heappop(running)
+        heapq.heappush(idle_workers, worker)
+        deps.complete(step)
+        queue_buildable()
+    return schedule
+
+
+def find_critical_path(schedule: List[ScheduledStep],
+                       step_deps: Mapping[Step, Set[Step]]
+                       ) -> List[ScheduledStep]:
+    """Returns the chain of steps that determined the length of a schedule.
+
+    Starting from the last step to finish, each step is preceded by whatever
+    it was waiting for when it started: the last of its dependencies to
+    complete, or, if it was instead waiting for an idle worker, the step that
+    freed that worker. Shortening any step on this path shortens the build.
+
+    Args:
+        schedule: A schedule from schedule_steps.
+        step_deps: The steps each step waits for, i.e.
+            StepDependencyManager.step_deps.
+
+    Returns:
+        The critical path in order of execution.
+    """
+    if not schedule:
+        return []
+    scheduled = {s.step: s for s in schedule}
+    current = max(schedule, key=lambda s: (s.end, str(s.step)))
+    path = [current]
+    while current.start > 0:
+        blocker = max((scheduled[d] for d in step_deps[current.step]),
+                      key=lambda s: (s.end, str(s.step)),
+                      default=None)
+        if blocker is None or blocker.end < current.start:
+            blocker = max((s for s in schedule if s.worker is not None
+                           and s.end <= current.start),
+                          key=lambda s: (s.end, str(s.step)))
+        path.append(blocker)
+        current = blocker
+    path.reverse()
+    return path
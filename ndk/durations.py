@@ -0,0 +1,234 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Records how long build modules and tests take.
+
+Measurements are appended to a JSON lines file (one JSON object per line) so
+that later builds can schedule the longest expected work first. Only the most
+recent measurements of each item are used, and the file is compacted to those
+when it has grown well beyond them.
+"""
+import collections
+from dataclasses import asdict, dataclass
+import json
+import logging
+import os
+from pathlib import Path
+import sys
+import time
+from types import TracebackType
+from typing import Deque, Dict, Iterable, Optional, Type
+
+try:
+    import resource
+    HAVE_RESOURCE = True
+except ImportError:
+    HAVE_RESOURCE = False
+
+
+# Number of recent measurements of each item used to estimate its duration.
+HISTORY_LENGTH = 5
+
+# The database file is rewritten with only the measurements still in use once
+# it holds more than this many times as many lines.
+COMPACTION_RATIO = 2
+
+
+def logger() -> logging.Logger:
+    """Returns the module logger."""
+    return logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Measurement:
+    """Resource usage of a single module build or test run.
+
+    Attributes:
+        kind: The type of item measured, e.g. 'module' or 'test'.
+        name: The name of the item measured.
+        wall_time: Elapsed time in seconds.
+        cpu_time: User and system CPU time in seconds of the worker and any
+            children it waited for.
+        peak_rss: Peak resident set size in KiB of the worker or any child it
+            waited for. Workers are reused, so this is the high water mark of
+            the worker rather than of this item alone. 0 if unknown.
+    """
+    kind: str
+    name: str
+    wall_time: float
+    cpu_time: float
+    peak_rss: int
+
+
+def _cpu_time() -> float:
+    """Returns CPU time used by this process and its waited for children."""
+    if not HAVE_RESOURCE:
+        return time.process_time()
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def _peak_rss() -> int:
+    """Returns the peak RSS in KiB of this process or its children."""
+    if not HAVE_RESOURCE:
+        return 0
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Darwin reports bytes, Linux reports KiB.
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+class Stopwatch:
+    """Measures the resources used while in a context.
+
+    >>> def stopwatch_example():
+    ...     with Stopwatch('module', 'clang') as stopwatch:
+    ...         do_something()
+    ...     print(f'clang took {stopwatch.measurement.wall_time}s.')
+    """
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+        self.start_wall_time = 0.0
+        self.start_cpu_time = 0.0
+        self.measurement: Optional[Measurement] = None
+
+    def __enter__(self) -> 'Stopwatch':
+        self.start_wall_time = time.monotonic()
+        self.start_cpu_time = _cpu_time()
+        return self
+
+    def __exit__(self, _exc_type: Optional[Type[BaseException]],
+                 _exc_value: Optional[BaseException],
+                 _traceback: Optional[TracebackType]) -> None:
+        self.measurement = Measurement(
+            self.kind, self.name,
+            time.monotonic() - self.start_wall_time,
+            _cpu_time() - self.start_cpu_time, _peak_rss())
+
+
+class DurationDatabase:
+    """History of measured module builds and test runs.
+
+    The database is stored as JSON lines. New measurements are appended to
+    the file as they are recorded. A database without a path is kept only in
+    memory.
+
+    Measurements appended by another process while the file is compacted may
+    be lost. They only guide scheduling, so that is harmless.
+    """
+    def __init__(self, path: Optional[Path] = None) -> None:
+        """Initializes a DurationDatabase.
+
+        Args:
+            path: Path to the database file, or None to keep the history in
+                memory only. The file will be created if it does not exist.
+        """
+        self.path = path
+        self.history: Dict[str, Dict[str, Deque[Measurement]]] = {}
+
+    @classmethod
+    def load(cls, path: Path) -> 'DurationDatabase':
+        """Loads the database stored at the given path.
+
+        Corrupt lines (for example from an interrupted write) are ignored.
+        The file is compacted if most of its lines are no longer used.
+        """
+        database = cls(path)
+        if not path.exists():
+            return database
+        num_lines = 0
+        with path.open() as database_file:
+            for line in database_file:
+                num_lines += 1
+                try:
+                    measurement = Measurement(**json.loads(line))
+                except (TypeError, ValueError):
+                    logger().warning('Ignoring corrupt line in %s: %s', path,
+                                     line.rstrip())
+                    continue
+                database.add(measurement)
+        if num_lines > COMPACTION_RATIO * database.num_measurements:
+            database.compact()
+        return database
+
+    @property
+    def num_measurements(self) -> int:
+        """Number of measurements in the in-memory history."""
+        return sum(
+            len(measurements) for by_name in self.history.values()
+            for measurements in by_name.values())
+
+    def compact(self) -> None:
+        """Rewrites the database file with only the in-memory history."""
+        if self.path is None:
+            return
+        temp_path = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+        with temp_path.open('w') as database_file:
+            for by_name in self.history.values():
+                for measurements in by_name.values():
+                    for measurement in measurements:
+                        database_file.write(
+                            json.dumps(asdict(measurement)) + '\n')
+        os.replace(temp_path, self.path)
+
+    def add(self, measurement: Measurement) -> None:
+        """Adds a measurement to the in-memory history."""
+        by_name = self.history.setdefault(measurement.kind, {})
+        if measurement.name not in by_name:
+            by_name[measurement.name] = collections.deque(
+                maxlen=HISTORY_LENGTH)
+        by_name[measurement.name].append(measurement)
+
+    def record(self, measurement: Measurement) -> None:
+        """Adds a measurement and appends it to the database file."""
+        self.record_all([measurement])
+
+    def record_all(self, measurements: Iterable[Measurement]) -> None:
+        """Adds measurements and appends them to the file in one write."""
+        lines = []
+        for measurement in measurements:
+            self.add(measurement)
+            lines.append(json.dumps(asdict(measurement)) + '\n')
+        if self.path is None or not lines:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.path.open('a') as database_file:
+            database_file.write(''.join(lines))
+
+    def expected_duration(self, kind: str, name: str) -> Optional[float]:
+        """Returns the expected wall time of an item, or None if unknown.
+
+        The expected wall time is the mean of the most recent measurements.
+        """
+        measurements = self.history.get(kind, {}).get(name)
+        if not measurements:
+            return None
+        return sum(m.wall_time for m in measurements) / len(measurements)
+
+    def expected_durations(self, kind: str) -> Dict[str, float]:
+        """Returns the expected wall time of every known item of a kind."""
+        durations: Dict[str, float] = {}
+        for name in self.history.get(kind, {}):
+            duration = self.expected_duration(kind, name)
+            assert duration is not None
+            durations[name] = duration
+        return durations
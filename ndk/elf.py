@@ -0,0 +1,248 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""A minimal ELF reader for inspecting sections and notes.
+
+Reads the file with mmap so that only the headers and the sections asked for
+are paged in, and so that checking a build output doesn't require spawning
+readelf. Both 32-bit and 64-bit files of either byte order are supported.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass
+import mmap
+from pathlib import Path
+import struct
+from types import TracebackType
+from typing import Any, Iterator, List, Optional, Tuple, Type
+
+
+ELF_MAGIC = b'\x7fELF'
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+SHT_NOTE = 7
+SHT_NOBITS = 8
+
+# Marks e_shstrndx values that don't fit in the ELF header.
+SHN_XINDEX = 0xffff
+
+# Type of the note in .note.android.ident. See sources/crt/crtbrand.S.
+NT_ANDROID_IDENT = 1
+
+
+class ElfError(RuntimeError):
+    """An error indicating a file is not a valid ELF file."""
+
+
+@dataclass(frozen=True)
+class Section:
+    """A section header.
+
+    Attributes:
+        name: Name of the section, e.g. '.text'.
+        type: The sh_type of the section, e.g. SHT_NOTE.
+        offset: Offset of the section contents in the file.
+        size: Size of the section contents in bytes.
+        align: Required alignment of the section.
+    """
+    name: str
+    type: int
+    offset: int
+    size: int
+    align: int
+
+
+@dataclass(frozen=True)
+class Note:
+    """An entry in a note section.
+
+    Attributes:
+        name: Owner of the note, e.g. 'Android' or 'GNU'.
+        type: Owner specific type of the note.
+        desc: Contents of the note.
+    """
+    name: str
+    type: int
+    desc: bytes
+
+
+def _align(value: int, alignment: int) -> int:
+    return (value + alignment - 1) // alignment * alignment
+
+
+class ElfFile:
+    """An ELF file opened for reading.
+
+    >>> def elf_file_example():
+    ...     with ElfFile(Path('crtbegin_so.o')) as elf:
+    ...         for note in elf.notes():
+    ...             print(note.name)
+    """
+    def __init__(self, path: Path) -> None:
+        """Opens an ELF file.
+
+        Raises:
+            ElfError: The file is not an ELF file or is truncated.
+        """
+        self.path = path
+        self._byte_order = '<'
+        with path.open('rb') as elf_file:
+            try:
+                self._data = mmap.mmap(elf_file.fileno(),
+                                       0,
+                                       access=mmap.ACCESS_READ)
+            except ValueError as ex:
+                # mmap can't map empty files.
+                raise ElfError(f'{path} is not an ELF file') from ex
+        try:
+            self._sections = self._read_sections()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self) -> None:
+        """Closes the file."""
+        self._data.close()
+
+    def __enter__(self) -> ElfFile:
+        return self
+
+    def __exit__(self, _exc_type: Optional[Type[BaseException]],
+                 _exc_value: Optional[BaseException],
+                 _traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+    def _unpack(self, fmt: str, offset: int, kind: str) -> Tuple[Any, ...]:
+        try:
+            return struct.unpack_from(self._byte_order + fmt, self._data,
+                                      offset)
+        except struct.error as ex:
+            raise ElfError(f'{self.path}: {kind} is truncated') from ex
+
+    def _read_sections(self) -> List[Section]:
+        if len(self._data) < 16 or self._data[:4] != ELF_MAGIC:
+            raise ElfError(f'{self.path} is not an ELF file')
+        elf_class = self._data[4]
+        byte_order = self._data[5]
+        if elf_class not in (ELFCLASS32, ELFCLASS64):
+            raise ElfError(f'{self.path}: unknown ELF class {elf_class}')
+        if byte_order not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ElfError(f'{self.path}: unknown byte order {byte_order}')
+        self._byte_order = '<' if byte_order == ELFDATA2LSB else '>'
+
+        # The header fields that follow the 16 byte e_ident.
+        if elf_class == ELFCLASS32:
+            header_fmt = 'HHIIIIIHHHHHH'
+            section_fmt = 'IIIIIIIIII'
+        else:
+            header_fmt = 'HHIQQQIHHHHHH'
+            section_fmt = 'IIQQQQIIQQ'
+        (_, _, _, _, _, shoff, _, _, _, _, shentsize, shnum,
+         shstrndx) = self._unpack(header_fmt, 16, 'ELF header')
+        if shoff == 0:
+            return []
+
+        def read_header(index: int) -> Tuple[Any, ...]:
+            return self._unpack(section_fmt, shoff + index * shentsize,
+                                'section header table')
+
+        # Files with too many sections for the ELF header store the counts
+        # in the first section header instead.
+        first = read_header(0)
+        if shnum == 0:
+            shnum = first[5]
+        if shstrndx == SHN_XINDEX:
+            shstrndx = first[6]
+
+        headers = [read_header(i) for i in range(shnum)]
+        if shstrndx >= len(headers):
+            raise ElfError(f'{self.path}: bad section name table index')
+        strtab_offset = headers[shstrndx][4]
+        strtab_size = headers[shstrndx][5]
+
+        sections = []
+        for name_offset, sh_type, _, _, offset, size, _, _, align, _ in (
+                headers):
+            start = strtab_offset + name_offset
+            end = self._data.find(b'\0', start, strtab_offset + strtab_size)
+            if end == -1:
+                raise ElfError(f'{self.path}: bad section name')
+            name = self._data[start:end].decode('utf-8', errors='replace')
+            sections.append(Section(name, sh_type, offset, size, align))
+        return sections
+
+    @property
+    def sections(self) -> List[Section]:
+        """The sections of the file, in section header table order."""
+        return self._sections
+
+    def section(self, name: str) -> Optional[Section]:
+        """Returns the first section with the given name, if any."""
+        for section in self._sections:
+            if section.name == name:
+                return section
+        return None
+
+    def section_data(self, section: Section) -> bytes:
+        """Returns the contents of a section.
+
+        Raises:
+            ElfError: The section extends past the end of the file.
+        """
+        if section.type == SHT_NOBITS:
+            return b''
+        if section.offset + section.size > len(self._data):
+            raise ElfError(f'{self.path}: section {section.name} is '
+                           'truncated')
+        return self._data[section.offset:section.offset + section.size]
+
+    def notes(self, section: Optional[Section] = None) -> Iterator[Note]:
+        """Yields the notes in a note section, or in every note section.
+
+        Raises:
+            ElfError: A note is truncated.
+        """
+        if section is None:
+            for note_section in self._sections:
+                if note_section.type == SHT_NOTE:
+                    yield from self.notes(note_section)
+            return
+
+        data = self.section_data(section)
+        # Note entries are 4 byte aligned, except in sections aligned to 8
+        # bytes such as .note.gnu.property on 64-bit targets.
+        alignment = 8 if section.align == 8 else 4
+        pos = 0
+        while pos < len(data):
+            try:
+                namesz, descsz, note_type = struct.unpack_from(
+                    self._byte_order + 'III', data, pos)
+            except struct.error as ex:
+                raise ElfError(f'{self.path}: note header in {section.name} '
+                               'is truncated') from ex
+            name_start = pos + 12
+            desc_start = name_start + _align(namesz, alignment)
+            pos = desc_start + _align(descsz, alignment)
+            if desc_start + descsz > len(data):
+                raise ElfError(f'{self.path}: note in {section.name} is '
+                               'truncated')
+            name = data[name_start:name_start + namesz].rstrip(b'\0')
+            yield Note(name.decode('utf-8', errors='replace'), note_type,
+                       data[desc_start:desc_start + descsz])
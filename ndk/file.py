@@ -14,6 +14,128 @@
 # limitations under the License.
 #
 """Contains file I/O APIs."""
+from __future__ import annotations
+
+import contextlib
+from dataclasses import dataclass, field
+import hashlib
+import multiprocessing
+import os
+from pathlib import Path
+import shutil
+import stat
+import sys
+from typing import (BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Tuple)
+
+import ndk.workqueue
+
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
+
+
+# The Linux ioctl that shares the extents of one file with another.
+FICLONE = 0x40049409
+
+# Copying is I/O bound, but installs already run one per core.
+COPY_THREADS = min(8, multiprocessing.cpu_count())
+
+# Trees with fewer files than this are copied without starting any threads.
+MIN_FILES_FOR_THREADS = 32
+
+# Matches the ignore argument of shutil.copytree.
+IgnoreFunc = Callable[[str, List[str]], Iterable[str]]
+
+
+@dataclass
+class InstallRecord:
+    """The files written by a module install.
+
+    Attributes:
+        files: Size in bytes of each file or symlink written, by path.
+    """
+    files: Dict[Path, int] = field(default_factory=dict)
+
+    @property
+    def size(self) -> int:
+        """Total size of the files in bytes."""
+        return sum(self.files.values())
+
+    def add(self, path: Path) -> None:
+        """Records a file or symlink that was written."""
+        self.files[path] = path.lstat().st_size
+
+    def refresh(self) -> None:
+        """Updates the record for files since modified or removed."""
+        for path in list(self.files):
+            try:
+                self.files[path] = path.lstat().st_size
+            except FileNotFoundError:
+                del self.files[path]
+
+
+# The record of the install in progress in this process, if any. Installs run
+# one at a time in each worker process.
+_install_record: Optional[InstallRecord] = None
+
+
+@contextlib.contextmanager
+def record_installs() -> Iterator[InstallRecord]:
+    """Records the files written by copy_file, copy_tree and record_install.
+
+    The record is refreshed on exit, so files removed or rewritten later in
+    the install are accounted for by what is left at the end.
+    """
+    global _install_record  # pylint: disable=global-statement
+    previous = _install_record
+    record = InstallRecord()
+    _install_record = record
+    try:
+        yield record
+    finally:
+        _install_record = previous
+        record.refresh()
+
+
+def record_install(path: Path) -> None:
+    """Records a file written other than by copying, such as a script."""
+    if _install_record is not None:
+        _install_record.add(path)
+
+
+def tree_size(path: Path) -> int:
+    """Returns the total size in bytes of the files in a tree.
+
+    Symlinks are not followed, and count the size of the link itself.
+    """
+    path_stat = path.lstat()
+    if not stat.S_ISDIR(path_stat.st_mode):
+        return path_stat.st_size
+    total = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                total += tree_size(Path(entry.path))
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def hash_bytes(data: bytes) -> str:
+    """Returns the SHA-256 of the given bytes, in hex."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    """Returns the SHA-256 of the contents of a file, in hex."""
+    hasher = hashlib.sha256()
+    with path.open('rb') as input_file:
+        for block in iter(lambda: input_file.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
 
 
 def read_file(path: str) -> str:
@@ -26,3 +148,215 @@ def write_file(path: str, contents: str) -> None:
     """Writes the given string to the path specified, closing the file."""
     with open(path, 'w') as the_file:
         the_file.write(contents)
+    record_install(Path(path))
+
+
+def reflink(src: Path, dst: Path) -> bool:
+    """Makes dst a copy-on-write clone of src if the filesystem supports it.
+
+    Returns:
+        True if dst was created, False if cloning is not supported.
+    """
+    with src.open('rb') as src_file, dst.open('wb') as dst_file:
+        if _clone(src_file, dst_file):
+            return True
+    dst.unlink()
+    return False
+
+
+def _clone(src_file: BinaryIO, dst_file: BinaryIO) -> bool:
+    if not HAVE_FCNTL or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _copy_contents(src_file: BinaryIO, dst_file: BinaryIO) -> None:
+    """Copies a file, within the kernel where possible.
+
+    copy_file_range lets filesystems that can share extents or copy on the
+    server side do so, and otherwise avoids copying through user space.
+    """
+    remaining = os.fstat(src_file.fileno()).st_size
+    if hasattr(os, 'copy_file_range'):
+        while remaining > 0:
+            try:
+                count = os.copy_file_range(src_file.fileno(),
+                                           dst_file.fileno(), remaining)
+            except OSError:
+                # Unsupported by the filesystem, or crossing filesystems on
+                # older kernels.
+                break
+            if count == 0:
+                # Some special files report a size but can't be copied this
+                # way.
+                break
+            remaining -= count
+    if remaining > 0:
+        # Either nothing or a prefix of the file was copied, and both files
+        # are positioned after it.
+        shutil.copyfileobj(src_file, dst_file)
+
+
+def _remove_file(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def copy_file(src: Path, dst: Path, allow_hardlink: bool = False) -> str:
+    """Copies a file and its metadata as cheaply as possible.
+
+    The copy is a hardlink if allowed, and otherwise a reflink if the
+    filesystem supports it. Failing both, the contents are copied by the
+    kernel, or by reading and writing the file.
+
+    Args:
+        src: File to copy.
+        dst: Path to copy the file to, or a directory to copy it into, as
+            for shutil.copy2. An existing file is replaced rather than
+            overwritten, since it may itself be a hardlink.
+        allow_hardlink: True if dst may be a hardlink to src. It must then
+            never be modified in place, only replaced.
+
+    Returns:
+        How the file was copied: 'hardlink', 'reflink' or 'copy'.
+    """
+    if dst.is_dir():
+        dst = dst / src.name
+    _remove_file(dst)
+    if allow_hardlink:
+        try:
+            # os.link does not follow symlinks on every platform.
+            os.link(src.resolve() if src.is_symlink() else src, dst)
+            record_install(dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    with src.open('rb') as src_file, dst.open('wb') as dst_file:
+        if _clone(src_file, dst_file):
+            method = 'reflink'
+        else:
+            _copy_contents(src_file, dst_file)
+            method = 'copy'
+    shutil.copystat(src, dst)
+    record_install(dst)
+    return method
+
+
+@dataclass
+class CopyStats:
+    """How the files of a tree were copied.
+
+    Attributes:
+        reflinks: Number of files cloned.
+        hardlinks: Number of files hardlinked.
+        copies: Number of files copied.
+        symlinks: Number of symlinks recreated.
+        size: Total size of the files in bytes.
+    """
+    reflinks: int = 0
+    hardlinks: int = 0
+    copies: int = 0
+    symlinks: int = 0
+    size: int = 0
+
+    def add(self, method: str, size: int) -> None:
+        """Counts a file copied by copy_file()."""
+        if method == 'reflink':
+            self.reflinks += 1
+        elif method == 'hardlink':
+            self.hardlinks += 1
+        else:
+            self.copies += 1
+        self.size += size
+
+
+def _copy_task(_worker: ndk.workqueue.ThreadWorker, src: Path, dst: Path,
+               allow_hardlink: bool) -> Tuple[str, int]:
+    return copy_file(src, dst, allow_hardlink), os.path.getsize(dst)
+
+
+def copy_tree(src: Path,
+              dst: Path,
+              symlinks: bool = False,
+              ignore: Optional[IgnoreFunc] = None,
+              allow_hardlinks: bool = False,
+              num_threads: int = COPY_THREADS) -> CopyStats:
+    """Copies a directory tree, copying files concurrently.
+
+    Like shutil.copytree, but the tree is walked once up front and the files
+    are then copied by a pool of threads with copy_file(). Directories that
+    already exist are merged into, like distutils.dir_util.copy_tree.
+
+    Args:
+        src: Directory to copy.
+        dst: Path to copy the directory to.
+        symlinks: True if symlinks are recreated rather than followed.
+        ignore: As for shutil.copytree. Returns the names in a directory that
+            are not copied.
+        allow_hardlinks: True if the copied files may be hardlinks to the
+            originals. They must then never be modified in place, only
+            replaced. Use only for read-only inputs such as prebuilts.
+        num_threads: Maximum number of files copied at once.
+
+    Returns:
+        How the files were copied.
+    """
+    stats = CopyStats()
+    dirs: List[Tuple[Path, Path]] = [(src, dst)]
+    files: List[Tuple[Path, Path, bool]] = []
+    dst.mkdir(parents=True, exist_ok=True)
+    for dirpath, dirnames, filenames in os.walk(src, followlinks=not symlinks):
+        src_dir = Path(dirpath)
+        dst_dir = dst / src_dir.relative_to(src)
+        ignored = set()
+        if ignore is not None:
+            ignored = set(ignore(dirpath, dirnames + filenames))
+        subdirs = []
+        for name in sorted(dirnames):
+            if name in ignored:
+                continue
+            if symlinks and (src_dir / name).is_symlink():
+                filenames.append(name)
+                continue
+            subdirs.append(name)
+            dirs.append((src_dir / name, dst_dir / name))
+            (dst_dir / name).mkdir(exist_ok=True)
+        dirnames[:] = subdirs
+        for name in sorted(filenames):
+            if name in ignored:
+                continue
+            if symlinks and (src_dir / name).is_symlink():
+                _remove_file(dst_dir / name)
+                (dst_dir / name).symlink_to(os.readlink(src_dir / name))
+                record_install(dst_dir / name)
+                stats.symlinks += 1
+            else:
+                files.append((src_dir / name, dst_dir / name, allow_hardlinks))
+
+    if len(files) < MIN_FILES_FOR_THREADS or num_threads <= 1:
+        for src_file, dst_file, allow_hardlink in files:
+            stats.add(copy_file(src_file, dst_file, allow_hardlink),
+                      os.path.getsize(dst_file))
+    else:
+        workqueue = ndk.workqueue.ThreadPoolWorkQueue(
+            min(num_threads, len(files)))
+        try:
+            # Most files are small, so they are sent to workers in batches.
+            workqueue.add_tasks(_copy_task, files, chunksize=16)
+            while not workqueue.finished():
+                for method, size in workqueue.get_results():
+                    stats.add(method, size)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    # Copying the contents of a directory changes its timestamps.
+    for src_dir, dst_dir in reversed(dirs):
+        shutil.copystat(src_dir, dst_dir)
+    return stats
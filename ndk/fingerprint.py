@@ -0,0 +1,480 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Fingerprints build modules so unchanged modules can be skipped.
+
+A module's fingerprint is a hash of its source inputs, the code that builds
+it, the fingerprints of its dependencies, the host and the build number. After
+a module is built and installed successfully its fingerprint is written to a
+stamp file. A later build may skip any module whose fingerprint matches its
+stamp.
+
+Hashing gigabytes of prebuilts on every build would defeat the purpose, so the
+stamp also records the size, mtime and digest of every input file. Files whose
+size and mtime are unchanged are not read again. Inputs are hashed on several
+threads, and inputs shared by several modules are hashed once.
+
+When there is nothing to skip, as in a clean build or a forced rebuild, the
+inputs of each module can instead be hashed by the worker that builds it, so
+that hashing runs alongside the build rather than delaying it.
+"""
+from __future__ import annotations
+
+import fnmatch
+import hashlib
+import inspect
+import json
+import logging
+import os
+import multiprocessing
+from pathlib import Path
+import stat
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import ndk.abis
+import ndk.autoconf
+from ndk.builds import Module
+import ndk.cmake
+import ndk.config
+import ndk.paths
+import ndk.toolchains
+import ndk.workqueue
+
+
+# Size, mtime in nanoseconds and SHA-256 of a file.
+DigestEntry = Tuple[int, int, str]
+
+# Hash of an input and the digests of the files within it.
+RootDigest = Tuple[str, Dict[str, DigestEntry]]
+
+# Files and directories that never affect the output of a module. These match
+# what ndk.builds.install_directory ignores.
+IGNORED_PATTERNS = ('*.pyc', '*.pyo', '*.swp', '.git*', '__pycache__')
+
+# Modules of the build system that affect the output of every module.
+BUILD_SYSTEM_MODULES = (
+    ndk.abis,
+    ndk.autoconf,
+    ndk.cmake,
+    ndk.config,
+    ndk.paths,
+    ndk.toolchains,
+)
+
+
+def logger() -> logging.Logger:
+    """Returns the module logger."""
+    return logging.getLogger(__name__)
+
+
+def hash_file(path: Path) -> str:
+    """Returns the SHA-256 of the contents of a file."""
+    hasher = hashlib.sha256()
+    with path.open('rb') as input_file:
+        for block in iter(lambda: input_file.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+class DigestCache:
+    """Digests of files, reused while a file's size and mtime are unchanged.
+
+    Only the entries looked up through this cache are kept in entries, so
+    saving them drops files that are no longer inputs.
+    """
+    def __init__(self,
+                 known: Optional[Dict[str, DigestEntry]] = None) -> None:
+        self.known = known if known is not None else {}
+        self.entries: Dict[str, DigestEntry] = {}
+        # Number of files that had to be read. Used by tests.
+        self.files_hashed = 0
+
+    def digest(self, path: Path, file_stat: os.stat_result) -> str:
+        """Returns the digest of a file, reading it only if it changed."""
+        key = str(path)
+        entry = self.entries.get(key, self.known.get(key))
+        if entry is not None and entry[:2] == (file_stat.st_size,
+                                               file_stat.st_mtime_ns):
+            digest = entry[2]
+        else:
+            digest = hash_file(path)
+            self.files_hashed += 1
+        self.entries[key] = (file_stat.st_size, file_stat.st_mtime_ns, digest)
+        return digest
+
+
+def _ignored(name: str) -> bool:
+    return any(fnmatch.fnmatch(name, p) for p in IGNORED_PATTERNS)
+
+
+def _walk(root: Path) -> Iterator[Path]:
+    """Yields every path in a tree in a deterministic order.
+
+    Symlinks to directories are yielded but not followed.
+    """
+    yield root
+    if root.is_symlink() or not root.is_dir():
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not _ignored(d))
+        for name in sorted(dirnames + filenames):
+            if not _ignored(name):
+                yield Path(dirpath) / name
+
+
+def hash_inputs(paths: Iterable[Path], cache: DigestCache) -> str:
+    """Hashes the names, types, modes and contents of files.
+
+    Args:
+        paths: Files or directories to hash. Directories are hashed
+            recursively.
+        cache: Cache of file digests to consult and update.
+
+    Returns:
+        The SHA-256 of all the inputs.
+    """
+    hasher = hashlib.sha256()
+    for root in paths:
+        hasher.update(f'input {root}\n'.encode('utf-8'))
+        if not os.path.lexists(root):
+            hasher.update(b'missing\n')
+            continue
+        for path in _walk(root):
+            name = os.path.relpath(path, root)
+            file_stat = path.lstat()
+            if stat.S_ISLNK(file_stat.st_mode):
+                line = f'link {name} {os.readlink(path)}'
+            elif stat.S_ISDIR(file_stat.st_mode):
+                line = f'dir {name}'
+            else:
+                executable = bool(file_stat.st_mode & stat.S_IXUSR)
+                digest = cache.digest(path, file_stat)
+                line = f'file {name} {executable} {digest}'
+            hasher.update(f'{line}\n'.encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def _hash_root_task(_worker: ndk.workqueue.Worker, root: Path,
+                    known: Dict[str, DigestEntry]
+                    ) -> Tuple[Path, str, Dict[str, DigestEntry]]:
+    cache = DigestCache(known)
+    return root, hash_inputs([root], cache), cache.entries
+
+
+def hash_roots(roots: Iterable[Path],
+               known: Dict[str, DigestEntry],
+               num_threads: int = 1) -> Dict[Path, RootDigest]:
+    """Hashes each of a set of inputs separately.
+
+    Args:
+        roots: Files or directories to hash. Duplicates are hashed once.
+        known: Digests of files from earlier builds. Not modified.
+        num_threads: Number of threads hashing inputs.
+
+    Returns:
+        The hash of each input and the digests of the files within it.
+    """
+    unique_roots = sorted(set(roots))
+    if num_threads <= 1 or len(unique_roots) <= 1:
+        return {
+            root: _hash_root_task(None, root, known)[1:]
+            for root in unique_roots
+        }
+    results: Dict[Path, RootDigest] = {}
+    workqueue = ndk.workqueue.ThreadPoolWorkQueue(
+        min(num_threads, len(unique_roots)))
+    try:
+        for root in unique_roots:
+            workqueue.add_task(_hash_root_task, root, known)
+        while not workqueue.finished():
+            for root, digest, entries in workqueue.get_results():
+                results[root] = (digest, entries)
+    finally:
+        workqueue.terminate()
+        workqueue.join()
+    return results
+
+
+def build_system_files(module: Module) -> List[Path]:
+    """Returns the source files of the code that builds a module."""
+    files: Set[Path] = set()
+    for cls in type(module).__mro__:
+        if cls is object:
+            continue
+        source = inspect.getsourcefile(cls)
+        if source is not None:
+            files.add(Path(source))
+    for build_module in BUILD_SYSTEM_MODULES:
+        source = inspect.getsourcefile(build_module)
+        if source is not None:
+            files.add(Path(source))
+    return sorted(files)
+
+
+def input_roots(module: Module) -> Optional[List[Tuple[str, Path]]]:
+    """Returns the inputs of a module and what each one is.
+
+    Returns None if the module does not declare its inputs.
+    """
+    inputs = module.fingerprint_inputs
+    if inputs is None:
+        return None
+    roots = [('build-system', p) for p in build_system_files(module)]
+    roots.extend(('input', p) for p in inputs)
+    return roots
+
+
+class ModuleInputs:
+    """The hash of everything a module is built from, except its deps."""
+    def __init__(self, digest: str, entries: Dict[str, DigestEntry]) -> None:
+        self.digest = digest
+        self.entries = entries
+
+    @classmethod
+    def combine(
+            cls, roots: List[Tuple[str, Path]],
+            digests: Dict[Path, RootDigest]) -> ModuleInputs:
+        """Combines the hashes of the inputs of a module.
+
+        Args:
+            roots: The inputs of the module, as returned by input_roots.
+            digests: The hashes of the inputs, as returned by hash_roots.
+        """
+        hasher = hashlib.sha256()
+        entries: Dict[str, DigestEntry] = {}
+        for kind, root in roots:
+            digest, root_entries = digests[root]
+            hasher.update(f'{kind} {root} {digest}\n'.encode('utf-8'))
+            entries.update(root_entries)
+        return cls(hasher.hexdigest(), entries)
+
+
+def hash_module_inputs(
+        module: Module,
+        known: Dict[str, DigestEntry]) -> Optional[ModuleInputs]:
+    """Hashes the inputs of a single module.
+
+    Used by the worker that builds the module when the inputs were not
+    hashed before the build.
+
+    Returns:
+        The hash of the inputs, or None if the module does not declare its
+        inputs.
+    """
+    roots = input_roots(module)
+    if roots is None:
+        return None
+    return ModuleInputs.combine(roots,
+                                hash_roots((p for _, p in roots), known))
+
+
+class Stamp:
+    """The fingerprint of a module as of its last successful build."""
+    def __init__(self, fingerprint: str,
+                 digests: Dict[str, DigestEntry]) -> None:
+        self.fingerprint = fingerprint
+        self.digests = digests
+
+    @classmethod
+    def load(cls, path: Path) -> Optional[Stamp]:
+        """Loads a stamp, returning None if it is missing or corrupt."""
+        try:
+            data = json.loads(path.read_text())
+            digests = {
+                name: (int(size), int(mtime), str(digest))
+                for name, (size, mtime, digest) in data['digests'].items()
+            }
+            return cls(str(data['fingerprint']), digests)
+        except FileNotFoundError:
+            return None
+        except (KeyError, OSError, TypeError, ValueError):
+            logger().warning('Ignoring corrupt stamp %s', path)
+            return None
+
+    def save(self, path: Path) -> None:
+        """Writes the stamp, replacing any existing stamp atomically."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + '.tmp')
+        temp_path.write_text(
+            json.dumps({
+                'fingerprint': self.fingerprint,
+                'digests': self.digests,
+            }))
+        os.replace(temp_path, path)
+
+
+def stamp_path(module: Module) -> Path:
+    """Returns the path to the stamp of a module."""
+    return module.out_dir / module.host.value / 'stamps' / f'{module}.json'
+
+
+def _overlaps(outer: Path, inner: Path) -> bool:
+    """Returns True if inner is the same as or within outer."""
+    return outer == inner or outer in inner.parents
+
+
+class ModuleStamps:
+    """Tracks which modules are unchanged since they were last built.
+
+    When inputs are hashed up front, every module is hashed before anything
+    is built, since the inputs of a module may be modified by the builds of
+    other modules. Otherwise the hash of each module's inputs is added with
+    add_inputs once the module's worker has hashed them, just before the
+    module is built.
+    """
+    def __init__(self,
+                 modules: Iterable[Module],
+                 eager: bool = True,
+                 num_threads: int = multiprocessing.cpu_count()) -> None:
+        """Initializes a ModuleStamps.
+
+        Args:
+            modules: The modules that will be built. Every module must have a
+                context.
+            eager: Hash the inputs of every module now. Otherwise call
+                hash_all or add_inputs before the fingerprints are needed.
+            num_threads: Number of threads hashing inputs.
+        """
+        self.modules = list(modules)
+        self.stamps = {m: Stamp.load(stamp_path(m)) for m in self.modules}
+        # Several modules may share inputs (the Clang prebuilts, for
+        # example), so digests known to any module are shared by all.
+        self.known_digests: Dict[str, DigestEntry] = {}
+        for stamp in self.stamps.values():
+            if stamp is not None:
+                self.known_digests.update(stamp.digests)
+        self.inputs: Dict[Module, ModuleInputs] = {}
+        self.fingerprints: Dict[Module, str] = {}
+        self._visiting: Set[Module] = set()
+        if eager:
+            self.hash_all(num_threads)
+
+    @property
+    def any_stamps(self) -> bool:
+        """True if any of the modules has been built before."""
+        return any(stamp is not None for stamp in self.stamps.values())
+
+    def hash_all(self, num_threads: int) -> None:
+        """Hashes the inputs of every module that declares them."""
+        roots = {m: input_roots(m) for m in self.modules}
+        digests = hash_roots(
+            (p for module_roots in roots.values() if module_roots is not None
+             for _, p in module_roots), self.known_digests, num_threads)
+        for module, module_roots in roots.items():
+            if module_roots is not None:
+                self.add_inputs(module,
+                                ModuleInputs.combine(module_roots, digests))
+
+    def known_digests_for(self, module: Module) -> Dict[str, DigestEntry]:
+        """Returns the digests known from the module's last stamp."""
+        stamp = self.stamps.get(module)
+        return stamp.digests if stamp is not None else {}
+
+    def add_inputs(self, module: Module, inputs: ModuleInputs) -> None:
+        """Adds the hash of a module's inputs."""
+        self.inputs[module] = inputs
+        self.known_digests.update(inputs.entries)
+
+    def fingerprint(self, module: Module) -> Optional[str]:
+        """Returns the fingerprint of a module.
+
+        Returns None if the inputs of the module or of any of its
+        dependencies are unknown, either because they are not declared or
+        because they have not been hashed yet. Such modules are rebuilt.
+        """
+        if module in self.fingerprints:
+            return self.fingerprints[module]
+        inputs = self.inputs.get(module)
+        # Guards against cycles. The dependency manager reports those.
+        if inputs is None or module in self._visiting:
+            return None
+        assert module.context is not None
+        parts = [
+            f'name {module.name}',
+            f'host {module.host.value}',
+            f'build-number {module.context.build_number}',
+        ]
+        self._visiting.add(module)
+        try:
+            for dep_name in sorted(module.deps):
+                dep_fingerprint = self.fingerprint(module.get_dep(dep_name))
+                if dep_fingerprint is None:
+                    return None
+                parts.append(f'dep {dep_name} {dep_fingerprint}')
+        finally:
+            self._visiting.remove(module)
+        parts.append(f'inputs {inputs.digest}')
+
+        fingerprint = hashlib.sha256('\n'.join(parts).encode(
+            'utf-8')).hexdigest()
+        self.fingerprints[module] = fingerprint
+        return fingerprint
+
+    def _matches_stamp(self, module: Module) -> bool:
+        fingerprint = self.fingerprint(module)
+        stamp = self.stamps[module]
+        if fingerprint is None or stamp is None:
+            return False
+        if stamp.fingerprint != fingerprint:
+            return False
+        return module.get_install_path().exists()
+
+    def up_to_date(self) -> Set[Module]:
+        """Returns the modules that do not need to be rebuilt.
+
+        A module is up to date if its fingerprint matches its stamp and its
+        install path still exists, unless it must be reinstalled because of
+        another module being rebuilt. That happens when:
+
+        1. A dependency of the module is rebuilt. Modules may modify the
+           install directories of their dependencies.
+        2. Another module installs to the same path as the module or to a
+           directory containing it. Installs typically replace their install
+           directory.
+        """
+        stale = {m for m in self.modules if not self._matches_stamp(m)}
+        changed = True
+        while changed:
+            changed = False
+            for module in self.modules:
+                if module in stale:
+                    continue
+                install_path = module.get_install_path()
+                if any(
+                        module.get_dep(d) in stale
+                        for d in module.deps) or any(
+                            _overlaps(s.get_install_path(), install_path)
+                            for s in stale):
+                    stale.add(module)
+                    changed = True
+        return set(self.modules) - stale
+
+    def invalidate(self, module: Module) -> None:
+        """Removes the stamp of a module before it is rebuilt.
+
+        This prevents a build that is interrupted during install from leaving
+        behind a partially installed module with a valid stamp.
+        """
+        path = stamp_path(module)
+        if path.exists():
+            path.unlink()
+
+    def record(self, module: Module) -> None:
+        """Writes the stamp of a module after a successful build."""
+        fingerprint = self.fingerprint(module)
+        if fingerprint is None:
+            return
+        Stamp(fingerprint, self.inputs[module].entries).save(
+            stamp_path(module))
@@ -15,7 +15,7 @@
 #
 """Graph classes and functions."""
 import functools
-from typing import Iterable, List, Optional, Set
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
 
 @functools.total_ordering
@@ -27,10 +27,11 @@ class Node:
 
         Args:
             name: The name of this node.
-            outs: Nodes with an edge leading out from this node.
+            outs: Nodes with an edge leading out from this node. Edges are
+                searched in this order.
         """
         self.name = name
-        self.outs = sorted(list(outs))
+        self.outs = list(outs)
 
     def __repr__(self) -> str:
         return self.name
@@ -44,7 +45,7 @@ class Node:
         return self.name < other.name
 
     def __hash__(self) -> int:
-        return hash(str(self))
+        return hash(self.name)
 
 
 class Graph:
@@ -61,6 +62,8 @@ class Graph:
     def find_cycle(self) -> Optional[List[Node]]:
         """Finds a cycle in the graph if there is one.
 
+        Runs in O(V+E) time.
+
         Returns:
             A list of nodes that make up a cycle or None if no cycle exists.
             The list will begin and end with the same node, i.e. [A, B, A].
@@ -79,20 +82,25 @@ class Graph:
             path: Optional[List[Node]] = None) -> Optional[List[Node]]:
         """Finds a cycle from a given node if there is one.
 
-        Performs a recursive depth-first search to see if there are any cycles
-        in a connected component. The caller of this method should ensure that
-        the first node searched is a source node if there is one, as this
-        method will not backtrack to find cycles prior to the given node.
+        Performs an iterative depth-first search to see if there are any
+        cycles in a connected component. The caller of this method should
+        ensure that the first node searched is a source node if there is one,
+        as this method will not backtrack to find cycles prior to the given
+        node.
 
         If there is no source node in the connected component, there is
         certainly a cycle in the component, but this method can still be used
         to trace that cycle.
 
+        Nodes are added to visited once all of their successors have been
+        searched, so each node and edge is searched at most once across calls
+        sharing visited.
+
         Args:
-            node: Current node to check for cycles.
-            visied: A set of all nodes that have been previously checked. Used
+            node: Node to start searching from.
+            visited: A set of all nodes that have been previously checked. Used
                 to short circuit searching.
-            path: A list containing the path to the current node from the first
+            path: A list containing the path to the given node from the first
                 node.
 
         Returns:
@@ -101,19 +109,24 @@ class Graph:
         """
         if path is None:
             path = []
-
-        path.append(node)
-        if node in path[:-1]:
-            return path[path.index(node):]
-
-        if node in visited:
-            path.pop()
-            return None
-
-        visited.add(node)
-        for in_node in node.outs:
-            cycle = self.find_cycle_from_node(in_node, visited, path)
-            if cycle is not None:
-                return cycle
-        path.pop()
-        return None
+        # Position of each node of the current path within the path.
+        path_index: Dict[Node, int] = {n: i for i, n in enumerate(path)}
+        outs_stack: List[Iterator[Node]] = []
+
+        next_node: Optional[Node] = node
+        while True:
+            if next_node is not None:
+                if next_node in path_index:
+                    return path[path_index[next_node]:] + [next_node]
+                if next_node not in visited:
+                    path_index[next_node] = len(path)
+                    path.append(next_node)
+                    outs_stack.append(iter(next_node.outs))
+            if not outs_stack:
+                return None
+            next_node = next(outs_stack[-1], None)
+            if next_node is None:
+                outs_stack.pop()
+                done = path.pop()
+                del path_index[done]
+                visited.add(done)
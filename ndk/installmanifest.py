@@ -0,0 +1,228 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Records what each module installs, and checks it against size budgets.
+
+Every module install writes a manifest of the files it installed, with their
+sizes and hashes. The manifests of all modules are summarized in a report of
+the largest modules and what they are made of, so that growth of the NDK can
+be traced to a module without bisecting builds.
+
+A size budget file caps the size and file count of modules:
+
+    {
+        "clang": {"max_size_mib": 1500},
+        "libc++": {"max_size_mib": 200, "max_files": 2000}
+    }
+"""
+from __future__ import annotations
+
+import collections
+from dataclasses import asdict, dataclass
+import json
+import os
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import ndk.file
+
+
+# Number of files and directories listed for each module in the size report.
+TOP_CONTRIBUTORS = 10
+
+
+@dataclass(frozen=True)
+class InstalledFile:
+    """A file installed by a module.
+
+    Attributes:
+        path: Path of the file relative to the NDK, separated by '/'.
+        size: Size of the file in bytes.
+        sha256: Hash of the contents of the file, or of the target of a
+            symlink.
+    """
+    path: str
+    size: int
+    sha256: str
+
+
+@dataclass(frozen=True)
+class InstallManifest:
+    """The files installed by a module.
+
+    Attributes:
+        module: Name of the module.
+        files: The installed files, sorted by path.
+    """
+    module: str
+    files: List[InstalledFile]
+
+    @classmethod
+    def from_record(cls, module: str, record: ndk.file.InstallRecord,
+                    root: Path) -> InstallManifest:
+        """Hashes the files of an install.
+
+        Args:
+            module: Name of the module.
+            record: The files the module installed.
+            root: Directory the paths of the manifest are relative to,
+                usually the NDK. Intermediate installs outside of it are
+                recorded with a relative path that leaves it.
+        """
+        files = []
+        for path, size in record.files.items():
+            if path.is_symlink():
+                sha256 = ndk.file.hash_bytes(os.fsencode(os.readlink(path)))
+            else:
+                sha256 = ndk.file.hash_file(path)
+            name = Path(os.path.relpath(path, root)).as_posix()
+            files.append(InstalledFile(name, size, sha256))
+        return cls(module, sorted(files, key=lambda f: f.path))
+
+    @property
+    def size(self) -> int:
+        """Total size of the installed files in bytes."""
+        return sum(f.size for f in self.files)
+
+    def largest_files(self, count: int) -> List[InstalledFile]:
+        """Returns the largest files, largest first."""
+        return sorted(self.files, key=lambda f: f.size, reverse=True)[:count]
+
+    def largest_directories(self, count: int) -> List[Tuple[str, int]]:
+        """Returns the directories holding the most bytes, largest first.
+
+        Only the files directly within each directory are counted.
+        """
+        sizes: Dict[str, int] = collections.defaultdict(int)
+        for installed in self.files:
+            sizes[str(PurePosixPath(installed.path).parent)] += installed.size
+        return sorted(sizes.items(), key=lambda item: item[1],
+                      reverse=True)[:count]
+
+    @classmethod
+    def load(cls, path: Path) -> InstallManifest:
+        """Loads a manifest saved by save()."""
+        data = json.loads(path.read_text())
+        return cls(data['module'],
+                   [InstalledFile(**f) for f in data['files']])
+
+    def save(self, path: Path) -> None:
+        """Writes the manifest to a JSON file."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        temp_path.write_text(json.dumps(asdict(self), indent=1))
+        os.replace(temp_path, path)
+
+
+def load_manifests(paths: Mapping[str, Path]) -> List[InstallManifest]:
+    """Loads the manifests of the modules that have been installed.
+
+    Args:
+        paths: Path of the manifest of each module, by module name. Modules
+            that have never been installed have no manifest, and are
+            skipped.
+    """
+    manifests = []
+    for path in paths.values():
+        if path.exists():
+            manifests.append(InstallManifest.load(path))
+    return manifests
+
+
+def _mib(size: int) -> str:
+    return '{:.1f} MiB'.format(size / 2**20)
+
+
+def format_size_report(manifests: Iterable[InstallManifest],
+                       top: int = TOP_CONTRIBUTORS) -> str:
+    """Returns a report of the largest modules and their largest parts."""
+    lines = []
+    for manifest in sorted(manifests, key=lambda m: m.size, reverse=True):
+        lines.append('{}: {} in {} files'.format(manifest.module,
+                                                 _mib(manifest.size),
+                                                 len(manifest.files)))
+        if not manifest.files:
+            continue
+        lines.append('  Largest directories:')
+        for directory, size in manifest.largest_directories(top):
+            lines.append('    {:>12}  {}'.format(_mib(size), directory))
+        lines.append('  Largest files:')
+        for installed in manifest.largest_files(top):
+            lines.append('    {:>12}  {}'.format(_mib(installed.size),
+                                                 installed.path))
+    return '\n'.join(lines) + '\n'
+
+
+@dataclass(frozen=True)
+class SizeBudget:
+    """The limits on what a module may install.
+
+    Attributes:
+        max_size_mib: Largest total size of the module's files in MiB.
+        max_files: Largest number of files the module may install.
+    """
+    max_size_mib: Optional[float] = None
+    max_files: Optional[int] = None
+
+
+def load_budgets(path: Path,
+                 module_names: Iterable[str]) -> Dict[str, SizeBudget]:
+    """Loads a size budget file.
+
+    Args:
+        path: Path to the budget file.
+        module_names: Names of every module, for rejecting typos.
+
+    Raises:
+        ValueError: The file is malformed or names an unknown module.
+    """
+    try:
+        data = json.loads(path.read_text())
+    except ValueError as ex:
+        raise ValueError(f'{path}: {ex}') from ex
+    if not isinstance(data, dict):
+        raise ValueError(f'{path}: expected an object of module budgets')
+    known_modules = set(module_names)
+    budgets = {}
+    for module, limits in data.items():
+        if module not in known_modules:
+            raise ValueError(f'{path}: unknown module {module}')
+        try:
+            budgets[module] = SizeBudget(**limits)
+        except TypeError as ex:
+            raise ValueError(f'{path}: bad budget for {module}: {ex}') from ex
+    return budgets
+
+
+def check_budgets(manifests: Iterable[InstallManifest],
+                  budgets: Mapping[str, SizeBudget]) -> List[str]:
+    """Returns a description of each budget that a module exceeds."""
+    violations = []
+    for manifest in manifests:
+        budget = budgets.get(manifest.module)
+        if budget is None:
+            continue
+        size_mib = manifest.size / 2**20
+        if budget.max_size_mib is not None and (size_mib >
+                                                budget.max_size_mib):
+            violations.append(
+                '{} is {:.1f} MiB, over its budget of {} MiB'.format(
+                    manifest.module, size_mib, budget.max_size_mib))
+        if budget.max_files is not None and (len(manifest.files) >
+                                             budget.max_files):
+            violations.append(
+                '{} has {} files, over its budget of {} files'.format(
+                    manifest.module, len(manifest.files), budget.max_files))
+    return violations
@@ -50,6 +50,7 @@ import ndk.ansi
 import ndk.ext.subprocess
 import ndk.notify
 import ndk.paths
+import ndk.test.asyncadb
 import ndk.test.builder
 from ndk.test.config import DeviceTestConfig, LibcxxTestConfig
 from ndk.test.devices import (
@@ -74,7 +75,12 @@ import ndk.test.types
 import ndk.test.ui
 from ndk.timer import Timer
 import ndk.ui
-from ndk.workqueue import ShardingWorkQueue, Worker, WorkQueue
+from ndk.workqueue import (
+    AnyWorkQueue,
+    ShardingWorkQueue,
+    ThreadPoolWorkQueue,
+    Worker,
+)
 
 
 DEVICE_TEST_BASE_DIR = '/data/local/tmp/tests'
@@ -121,9 +127,15 @@ class TestCase:
             self, device: Device) -> Union[Tuple[None, None], Tuple[str, str]]:
         raise NotImplementedError
 
-    def run(self, device: Device) -> Tuple[int, str, str]:
+    def get_command(self) -> str:
+        """Returns the shell command that runs the test on a device."""
         raise NotImplementedError
 
+    def run(self, device: Device) -> Tuple[int, str, str]:
+        cmd = self.get_command()
+        logger().info('%s: shell_nocheck "%s"', device.name, cmd)
+        return shell_nocheck_wrap_errors(device, [cmd])
+
 
 class BasicTestCase(TestCase):
     """A test case for the standard NDK test builder.
@@ -157,11 +169,9 @@ class BasicTestCase(TestCase):
             self, device: Device) -> Union[Tuple[None, None], Tuple[str, str]]:
         return self.get_test_config().run_broken(self, device)
 
-    def run(self, device: Device) -> Tuple[int, str, str]:
-        cmd = 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
+    def get_command(self) -> str:
+        return 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
             self.device_dir, self.device_dir, self.executable)
-        logger().info('%s: shell_nocheck "%s"', device.name, cmd)
-        return shell_nocheck_wrap_errors(device, [cmd])
 
 
 class LibcxxTestCase(TestCase):
@@ -212,13 +222,11 @@ class LibcxxTestCase(TestCase):
             return config, bug
         return None, None
 
-    def run(self, device: Device) -> Tuple[int, str, str]:
+    def get_command(self) -> str:
         libcxx_so_dir = posixpath.join(
             DEVICE_TEST_BASE_DIR, str(self.config), 'libcxx/libc++')
-        cmd = 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
+        return 'cd {} && LD_LIBRARY_PATH={} ./{} 2>&1'.format(
             self.device_dir, libcxx_so_dir, self.executable)
-        logger().info('%s: shell_nocheck "%s"', device.name, cmd)
-        return shell_nocheck_wrap_errors(device, [cmd])
 
 
 class TestRun:
@@ -269,6 +277,17 @@ class TestRun:
             return Skipped(self, f'test unsupported for {config}')
         return self.make_result(self.test_case.run(device), device)
 
+    async def run_async(self, device: Device) -> TestResult:
+        """Runs the test from an asyncio event loop. See run."""
+        config = self.test_case.check_unsupported(device)
+        if config is not None:
+            return Skipped(self, f'test unsupported for {config}')
+        cmd = self.test_case.get_command()
+        logger().info('%s: shell_nocheck "%s"', device.name, cmd)
+        adb_result = await ndk.test.asyncadb.shell_nocheck_wrap_errors(
+            device.serial, [cmd])
+        return self.make_result(adb_result, device)
+
 
 def build_tests(test_src_dir: str, ndk_dir: str, out_dir: str, clean: bool,
                 printer: Printer, config: Dict[Any, Any],
@@ -410,7 +429,8 @@ def clear_test_directory(_worker: Worker, device: Device) -> None:
     device.shell_nocheck(cmd)
 
 
-def clear_test_directories(workqueue: WorkQueue, fleet: DeviceFleet) -> None:
+def clear_test_directories(workqueue: AnyWorkQueue,
+                           fleet: DeviceFleet) -> None:
     for group in fleet.get_unique_device_groups():
         for device in group.devices:
             workqueue.add_task(clear_test_directory, device)
@@ -456,20 +476,20 @@ def push_tests_to_device(worker: Worker, src_dir: str, dest_dir: str,
         device.shell(['chmod', '-R', '777', dest_dir])
 
 
-def finish_workqueue_with_ui(workqueue: WorkQueue) -> None:
+def finish_workqueue_with_ui(workqueue: AnyWorkQueue) -> None:
     console = ndk.ansi.get_console()
     ui = ndk.ui.get_work_queue_ui(console, workqueue)
     with ndk.ansi.disable_terminal_echo(sys.stdin):
         with console.cursor_hide_context():
             ui.draw()
             while not workqueue.finished():
-                workqueue.get_result()
+                workqueue.get_results()
                 ui.draw()
             ui.clear()
 
 
 def push_tests_to_devices(
-        workqueue: WorkQueue, test_dir: str,
+        workqueue: AnyWorkQueue, test_dir: str,
         groups_for_config: Mapping[BuildConfiguration,
                                    Iterable[DeviceShardingGroup]],
         use_sync: bool) -> None:
@@ -578,6 +598,56 @@ def wait_for_results(report: Report, workqueue: ShardingWorkQueue,
             ui.clear()
 
 
+def run_tests_with_workqueue(report: Report, test_runs: Iterable[TestRun],
+                             fleet: DeviceFleet, printer: Printer) -> None:
+    """Runs tests on a pool of threads per device."""
+    # Need an input queue per device group, a single result queue, and a pool
+    # of threads per device.
+    shard_queue = ShardingWorkQueue(fleet.get_unique_device_groups(),
+                                    4,
+                                    use_threads=True)
+    try:
+        for test_run in test_runs:
+            shard_queue.add_task(test_run.device_group, run_test, test_run)
+
+        wait_for_results(report, shard_queue, printer)
+        restart_flaky_tests(report, shard_queue)
+        wait_for_results(report, shard_queue, printer)
+    finally:
+        shard_queue.terminate()
+        shard_queue.join()
+
+
+def run_tests_async(report: Report, test_runs: Iterable[TestRun],
+                    groups: Iterable[DeviceShardingGroup],
+                    printer: Printer) -> None:
+    """Runs tests from a single asyncio event loop.
+
+    Results are added to the report and printed as each test finishes.
+    """
+    runner = ndk.test.asyncadb.ShardRunner(groups, 4)
+    console = ndk.ansi.get_console()
+    ui = ndk.test.ui.get_async_test_progress_ui(console, runner)
+    verbose = logger().isEnabledFor(logging.INFO)
+
+    async def run_one(device: Device, test: TestRun) -> TestResult:
+        return await test.run_async(device)
+
+    def on_result(result: TestResult) -> None:
+        if verbose or result.failed():
+            ui.clear()
+            printer.print_result(result)
+        report.add_result(result.test.build_system, result)
+        ui.draw()
+
+    with ndk.ansi.disable_terminal_echo(sys.stdin):
+        with console.cursor_hide_context():
+            ui.draw()
+            runner.run(((t.device_group, t) for t in test_runs), run_one,
+                       on_result)
+            ui.clear()
+
+
 def flake_filter(result: TestResult) -> bool:
     if isinstance(result, UnexpectedSuccess):
         # There are no flaky successes.
@@ -598,8 +668,11 @@ def flake_filter(result: TestResult) -> bool:
     return False
 
 
-def restart_flaky_tests(report: Report, workqueue: ShardingWorkQueue) -> None:
-    """Finds and restarts any failing flaky tests."""
+def remove_flaky_tests(report: Report) -> List[TestRun]:
+    """Removes failing flaky tests from the report and returns them.
+
+    Sleeps before returning if any were found to let the devices recover.
+    """
     rerun_tests = report.remove_all_failing_flaky(flake_filter)
     if rerun_tests:
         cooldown = 10
@@ -608,10 +681,17 @@ def restart_flaky_tests(report: Report, workqueue: ShardingWorkQueue) -> None:
             'devices recover.', len(rerun_tests), cooldown)
         time.sleep(cooldown)
 
+    test_runs = []
     for flaky_report in rerun_tests:
         logger().warning('Flaky test failure: %s', flaky_report.result)
-        group = flaky_report.result.test.device_group
-        workqueue.add_task(group, run_test, flaky_report.result.test)
+        test_runs.append(flaky_report.result.test)
+    return test_runs
+
+
+def restart_flaky_tests(report: Report, workqueue: ShardingWorkQueue) -> None:
+    """Finds and restarts any failing flaky tests."""
+    for test_run in remove_flaky_tests(report):
+        workqueue.add_task(test_run.device_group, run_test, test_run)
 
 
 def get_config_dict(config: str, abis: Iterable[Abi]) -> Dict[str, Any]:
@@ -675,6 +755,10 @@ def parse_args() -> argparse.Namespace:
     run_options.add_argument(
         '--require-all-devices', action='store_true',
         help='Abort if any devices specified by the config are not available.')
+    run_options.add_argument(
+        '--asyncio-adb', action='store_true',
+        help='Run tests from a single asyncio event loop instead of a pool '
+        'of workers per device.')
 
     display_options = parser.add_argument_group('Display Options')
     display_options.add_argument(
@@ -815,7 +899,11 @@ def run_tests(args: argparse.Namespace) -> Results:
     # a warning. Then compare that list of devices against all our tests and
     # make sure each test is claimed by at least one device. For each
     # configuration that is unclaimed, print a warning.
-    workqueue = WorkQueue()
+    #
+    # Device discovery, cleaning and pushing spend all their time waiting on
+    # adb, so threads serve them as well as processes at a fraction of the
+    # startup cost and memory.
+    workqueue = ThreadPoolWorkQueue()
     try:
         device_discovery_timer = Timer()
         with device_discovery_timer:
@@ -849,30 +937,24 @@ def run_tests(args: argparse.Namespace) -> Results:
         workqueue.terminate()
         workqueue.join()
 
-    shard_queue = ShardingWorkQueue(fleet.get_unique_device_groups(), 4)
-    try:
-        # Need an input queue per device group, a single result queue, and a
-        # pool of threads per device.
-
-        # Shuffle the test runs to distribute the load more evenly. These are
-        # ordered by (build config, device, test), so most of the tests running
-        # at any given point in time are all running on the same device.
-        test_runs = pair_test_runs(test_groups, groups_for_config)
-        random.shuffle(test_runs)
-        test_run_timer = Timer()
-        with test_run_timer:
-            for test_run in test_runs:
-                shard_queue.add_task(test_run.device_group, run_test, test_run)
-
-            wait_for_results(report, shard_queue, printer)
-            restart_flaky_tests(report, shard_queue)
-            wait_for_results(report, shard_queue, printer)
-        results.add_timing_report('Run', test_run_timer)
+    # Shuffle the test runs to distribute the load more evenly. These are
+    # ordered by (build config, device, test), so most of the tests running at
+    # any given point in time are all running on the same device.
+    test_runs = pair_test_runs(test_groups, groups_for_config)
+    random.shuffle(test_runs)
+
+    test_run_timer = Timer()
+    with test_run_timer:
+        if args.asyncio_adb:
+            groups = fleet.get_unique_device_groups()
+            run_tests_async(report, test_runs, groups, printer)
+            run_tests_async(report, remove_flaky_tests(report), groups,
+                            printer)
+        else:
+            run_tests_with_workqueue(report, test_runs, fleet, printer)
+    results.add_timing_report('Run', test_run_timer)
 
-        printer.print_summary(report)
-    finally:
-        shard_queue.terminate()
-        shard_queue.join()
+    printer.print_summary(report)
 
     if report.successful:
         results.passed()
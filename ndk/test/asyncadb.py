@@ -0,0 +1,169 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Drives adb from a single asyncio event loop.
+
+Running tests on devices is almost entirely waiting on adb. Rather than
+blocking a worker process or thread per in-flight command, the commands are
+run as asyncio subprocesses so one process can keep every device busy.
+"""
+import asyncio
+import collections
+import shlex
+import traceback
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Iterable,
+    List,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+from ndk.workqueue import ShardingGroupType
+
+
+# Appended to shell commands so that the exit status can be recovered from the
+# output. Legacy adb shell does not report the status of the remote command.
+# This matches what adb.AndroidDevice.shell_nocheck does.
+RETURN_CODE_DELIMITER = 'x'
+RETURN_CODE_PROBE = f'; echo {RETURN_CODE_DELIMITER}$?'
+
+
+def parse_shell_output(output: str) -> Tuple[int, str]:
+    """Splits the exit status from the output of a probed shell command.
+
+    Args:
+        output: Output of a command run with RETURN_CODE_PROBE appended.
+
+    Returns:
+        Tuple of (exit status, output of the command).
+
+    Raises:
+        RuntimeError: The output did not end with an exit status.
+    """
+    output = output.replace('\r\n', '\n')
+    delimiter_index = output.rfind(RETURN_CODE_DELIMITER)
+    if delimiter_index == -1:
+        raise RuntimeError('Could not find exit status in shell output.')
+    status = output[delimiter_index + len(RETURN_CODE_DELIMITER):].strip()
+    if not status.isdigit():
+        raise RuntimeError('Could not find exit status in shell output.')
+    return int(status), output[:delimiter_index]
+
+
+async def shell_nocheck(serial: str,
+                        cmd: Sequence[str]) -> Tuple[int, str, str]:
+    """Runs a shell command on a device without checking the exit status.
+
+    Args:
+        serial: Serial number of the device.
+        cmd: Command to run. Joined with spaces and interpreted by the device
+            shell, as with adb.AndroidDevice.shell_nocheck.
+
+    Returns:
+        Tuple of (exit status, stdout, stderr).
+    """
+    proc = await asyncio.create_subprocess_exec(
+        'adb',
+        '-s',
+        serial,
+        'shell',
+        ' '.join(cmd) + RETURN_CODE_PROBE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await proc.communicate()
+    status, out = parse_shell_output(stdout.decode('utf-8', 'replace'))
+    return status, out, stderr.decode('utf-8', 'replace')
+
+
+async def shell_nocheck_wrap_errors(
+        serial: str, cmd: Sequence[str]) -> Tuple[int, str, str]:
+    """Runs shell_nocheck and wraps exceptions as failed commands."""
+    try:
+        return await shell_nocheck(serial, cmd)
+    except (OSError, RuntimeError):
+        return 1, shlex.join(cmd), traceback.format_exc()
+
+
+ResultType = TypeVar('ResultType')
+
+
+class ShardRunner(Generic[ShardingGroupType]):
+    """Runs coroutines on the shards of sharding groups.
+
+    The asyncio counterpart of ndk.workqueue.ShardingWorkQueue. Each group has
+    a semaphore allowing jobs_per_shard tasks per shard in the group, and each
+    task runs on the least busy shard of its group when it is admitted.
+    """
+
+    def __init__(self, groups: Iterable[ShardingGroupType],
+                 jobs_per_shard: int) -> None:
+        self.groups = list(groups)
+        self.jobs_per_shard = jobs_per_shard
+        # Tasks in each group that have not yet been admitted.
+        self.pending: Dict[ShardingGroupType, int] = collections.Counter()
+        # Tasks running on each shard.
+        self.running: Dict[Any, int] = collections.Counter()
+        self.num_tasks = 0
+
+    async def run_all(
+            self, tasks: Iterable[Tuple[ShardingGroupType, Any]],
+            func: Callable[[Any, Any], Awaitable[ResultType]],
+            on_result: Callable[[ResultType], None]) -> None:
+        """Runs every task and reports results as they complete.
+
+        Args:
+            tasks: Tuples of (group, argument). func is invoked with a shard
+                from the group and the argument.
+            func: Coroutine function to run for each task.
+            on_result: Called with each result as soon as it is available.
+        """
+        # Semaphores must be created inside the running event loop.
+        semaphores = {
+            group: asyncio.Semaphore(
+                len(group.shards) * self.jobs_per_shard)
+            for group in self.groups
+        }
+
+        async def run_one(group: ShardingGroupType, arg: Any) -> None:
+            async with semaphores[group]:
+                self.pending[group] -= 1
+                shard = min(group.shards, key=lambda s: self.running[s])
+                self.running[shard] += 1
+                try:
+                    result = await func(shard, arg)
+                finally:
+                    self.running[shard] -= 1
+            self.num_tasks -= 1
+            on_result(result)
+
+        coroutines: List[Awaitable[None]] = []
+        for group, arg in tasks:
+            self.pending[group] += 1
+            self.num_tasks += 1
+            coroutines.append(run_one(group, arg))
+        await asyncio.gather(*coroutines)
+
+    def run(self, tasks: Iterable[Tuple[ShardingGroupType, Any]],
+            func: Callable[[Any, Any], Awaitable[ResultType]],
+            on_result: Callable[[ResultType], None]) -> None:
+        """Runs every task on a new event loop. See run_all."""
+        asyncio.run(self.run_all(tasks, func, on_result))
+
@@ -19,6 +19,7 @@ from __future__ import absolute_import
 import json
 import logging
 import os
+from pathlib import Path
 import pickle
 import random
 import shutil
@@ -26,11 +27,14 @@ import sys
 import traceback
 from typing import (
     Dict,
+    Iterable,
     List,
+    Optional,
     Tuple,
 )
 
 import ndk.abis
+from ndk.durations import DurationDatabase, Measurement, Stopwatch
 from ndk.test.filters import TestFilter
 from ndk.test.printers import Printer
 from ndk.test.report import Report
@@ -39,7 +43,8 @@ import ndk.test.spec
 import ndk.test.suites
 from ndk.test.types import Test
 import ndk.test.ui
-from ndk.workqueue import LoadRestrictingWorkQueue, Worker
+import ndk.trace
+from ndk.workqueue import ResourceWorkQueue, Worker
 
 
 def logger() -> logging.Logger:
@@ -90,9 +95,10 @@ def _fixup_negative_test(
         return result
 
 
-def _run_test(worker: Worker, suite: str, test: Test,
-              obj_dir: str, dist_dir: str, test_filters: TestFilter
-              ) -> Tuple[str, ndk.test.result.TestResult, List[Test]]:
+def _run_test(
+        worker: Worker, suite: str, test: Test, obj_dir: str, dist_dir: str,
+        test_filters: TestFilter
+) -> Tuple[str, ndk.test.result.TestResult, List[Test], Optional[Measurement]]:
     """Runs a given test according to the given filters.
 
     Args:
@@ -103,18 +109,23 @@ def _run_test(worker: Worker, suite: str, test: Test,
         dist_dir: Out directory for build artifacts needed for running.
         test_filters: Filters to apply when running tests.
 
-    Returns: Tuple of (suite, TestResult, [Test]). The [Test] element is a list
-             of additional tests to be run.
+    Returns: Tuple of (suite, TestResult, [Test], Measurement). The [Test]
+             element is a list of additional tests to be run. The Measurement
+             is the resource usage of the test build, or None if the test was
+             not built.
     """
     worker.status = 'Building {}'.format(test)
 
     config = test.check_unsupported()
     if config is not None:
         message = 'test unsupported for {}'.format(config)
-        return suite, ndk.test.result.Skipped(test, message), []
+        return suite, ndk.test.result.Skipped(test, message), [], None
 
+    stopwatch = Stopwatch('test', str(test))
     try:
-        result, additional_tests = test.run(obj_dir, dist_dir, test_filters)
+        with stopwatch, ndk.trace.span(str(test), 'test', suite=suite):
+            result, additional_tests = test.run(obj_dir, dist_dir,
+                                                test_filters)
         if test.is_negative_test():
             result = _fixup_negative_test(result)
         config, bug = test.check_broken()
@@ -126,7 +137,7 @@ def _run_test(worker: Worker, suite: str, test: Test,
     except Exception:  # pylint: disable=broad-except
         result = ndk.test.result.Failure(test, traceback.format_exc())
         additional_tests = []
-    return suite, result, additional_tests
+    return suite, result, additional_tests, stopwatch.measurement
 
 
 class TestBuilder:
@@ -142,6 +153,12 @@ class TestBuilder:
         self.obj_dir = os.path.join(self.test_options.out_dir, 'obj')
         self.dist_dir = os.path.join(self.test_options.out_dir, 'dist')
 
+        if self.test_options.durations_db is not None:
+            self.durations = DurationDatabase.load(
+                Path(self.test_options.durations_db))
+        else:
+            self.durations = DurationDatabase()
+
         self.find_tests(test_spec)
 
     def find_tests(self, test_spec: ndk.test.spec.TestSpec) -> None:
@@ -218,27 +235,60 @@ class TestBuilder:
             write_build_report(self.test_options.build_report, result)
         return result
 
+    def expected_durations(self) -> Dict[str, float]:
+        """Returns the expected build time of each test.
+
+        Tests without any history are assumed to take as long as other
+        configurations of the same test, or failing that, as long as the
+        average test.
+        """
+        known = self.durations.expected_durations('test')
+        by_test_name: Dict[str, List[float]] = {}
+        for suite_tests in self.tests.values():
+            for test in suite_tests:
+                if str(test) in known:
+                    by_test_name.setdefault(test.name, []).append(
+                        known[str(test)])
+        default = sum(known.values()) / len(known) if known else 0.0
+
+        durations: Dict[str, float] = {}
+        for suite_tests in self.tests.values():
+            for test in suite_tests:
+                if str(test) in known:
+                    durations[str(test)] = known[str(test)]
+                elif test.name in by_test_name:
+                    similar = by_test_name[test.name]
+                    durations[str(test)] = sum(similar) / len(similar)
+                else:
+                    durations[str(test)] = default
+        return durations
+
     def do_build(self, test_filters: TestFilter) -> Report:
-        workqueue = LoadRestrictingWorkQueue()
+        workqueue = ResourceWorkQueue()
         try:
+            # Tests are built longest expected first (LPT) so that the run
+            # isn't held up by a large test that started last.
+            durations = self.expected_durations()
             for suite, tests in self.tests.items():
                 # Each test configuration was expanded when each test was
                 # discovered, so the current order has all the largest tests
-                # right next to each other. Spread them out to try to avoid
-                # having too many heavy builds happening simultaneously.
+                # right next to each other. Tests with equal priority (those
+                # with no history) are run in insertion order, so spread them
+                # out to try to avoid having too many heavy builds happening
+                # simultaneously.
                 random.shuffle(tests)
                 for test in tests:
                     if not test_filters.filter(test.name):
                         continue
 
-                    if test.name == 'libc++':
-                        workqueue.add_load_restricted_task(
-                            _run_test, suite, test, self.obj_dir,
-                            self.dist_dir, test_filters)
-                    else:
-                        workqueue.add_task(
-                            _run_test, suite, test, self.obj_dir,
-                            self.dist_dir, test_filters)
+                    workqueue.add_task(_run_test,
+                                       suite,
+                                       test,
+                                       self.obj_dir,
+                                       self.dist_dir,
+                                       test_filters,
+                                       priority=durations[str(test)],
+                                       resources=test.resources)
 
             report = Report()
             self.wait_for_results(report, workqueue, test_filters)
@@ -249,32 +299,51 @@ class TestBuilder:
             workqueue.join()
 
     def wait_for_results(self, report: Report,
-                         workqueue: LoadRestrictingWorkQueue,
+                         workqueue: ResourceWorkQueue,
                          test_filters: TestFilter) -> None:
         console = ndk.ansi.get_console()
         ui = ndk.test.ui.get_test_build_progress_ui(console, workqueue)
         with ndk.ansi.disable_terminal_echo(sys.stdin):
             with console.cursor_hide_context():
                 while not workqueue.finished():
-                    suite, result, additional_tests = workqueue.get_result()
-                    # Filtered test. Skip them entirely to avoid polluting
-                    # --show-all results.
-                    if result is None:
-                        assert not additional_tests
-                        ui.draw()
-                        continue
-
-                    assert result.passed() or not additional_tests
-                    for test in additional_tests:
-                        workqueue.add_task(
-                            _run_test, suite, test, self.obj_dir,
-                            self.dist_dir, test_filters)
-                    if logger().isEnabledFor(logging.INFO):
-                        ui.clear()
-                        self.printer.print_result(result)
-                    elif result.failed():
-                        ui.clear()
-                        self.printer.print_result(result)
-                    report.add_result(suite, result)
+                    results = workqueue.get_results()
+                    # Filtered tests did not run, so their durations mean
+                    # nothing.
+                    self.durations.record_all(
+                        measurement
+                        for _, result, _, measurement in results
+                        if result is not None and measurement is not None)
+                    for suite, result, additional_tests, _ in results:
+                        # Filtered test. Skip them entirely to avoid polluting
+                        # --show-all results.
+                        if result is None:
+                            assert not additional_tests
+                            continue
+
+                        assert result.passed() or not additional_tests
+                        self.add_tests(workqueue, suite, additional_tests,
+                                       test_filters)
+                        if logger().isEnabledFor(logging.INFO):
+                            ui.clear()
+                            self.printer.print_result(result)
+                        elif result.failed():
+                            ui.clear()
+                            self.printer.print_result(result)
+                        report.add_result(suite, result)
                     ui.draw()
                 ui.clear()
+
+    def add_tests(self, workqueue: ResourceWorkQueue, suite: str,
+                  tests: Iterable[Test], test_filters: TestFilter) -> None:
+        """Queues tests discovered by a finished test.
+
+        These are the thousands of per-case results of a libc++ run, each of
+        which only reports a result that is already known. They are sent to
+        the workers in chunks so they do not flood the work queue with round
+        trips.
+        """
+        args = [(suite, test, self.obj_dir, self.dist_dir, test_filters)
+                for test in tests]
+        # Aim for a few chunks per worker, like multiprocessing.Pool.map.
+        chunksize = max(1, len(args) // (4 * max(1, len(workqueue.workers))))
+        workqueue.add_tasks(_run_test, args, chunksize=chunksize)
@@ -28,7 +28,7 @@ from ndk.abis import Abi
 import ndk.ext.shutil
 import ndk.paths
 from ndk.test.spec import BuildConfiguration
-from ndk.workqueue import ShardingGroup, Worker, WorkQueue
+from ndk.workqueue import AnyWorkQueue, ShardingGroup, Worker
 
 try:
     import adb  # pylint: disable=import-error
@@ -321,7 +321,7 @@ def create_device(_worker: Worker, serial: str, precache: bool) -> Device:
     return Device(serial, precache)
 
 
-def get_all_attached_devices(workqueue: WorkQueue) -> List[Device]:
+def get_all_attached_devices(workqueue: AnyWorkQueue) -> List[Device]:
     """Returns a list of all connected devices."""
     if shutil.which('adb') is None:
         raise RuntimeError('Could not find adb.')
@@ -374,7 +374,7 @@ def exclude_device(device: Device) -> bool:
 
 
 def find_devices(sought_devices: Dict[int, List[Abi]],
-                 workqueue: WorkQueue) -> DeviceFleet:
+                 workqueue: AnyWorkQueue) -> DeviceFleet:
     """Detects connected devices and returns a set for testing.
 
     We get a list of devices by scanning the output of `adb devices` and
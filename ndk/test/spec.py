@@ -38,7 +38,8 @@ class TestOptions:
                  out_dir: str,
                  test_filter: str = None,
                  clean: bool = True,
-                 build_report: str = None) -> None:
+                 build_report: str = None,
+                 durations_db: str = None) -> None:
         """Initializes a TestOptions object.
 
         Args:
@@ -48,6 +49,8 @@ class TestOptions:
             test_filter: Test filter string.
             clean: True if the out directory should be cleaned before building.
             build_report: Path to write a build report to, if any.
+            durations_db: Path to the database of test durations used to
+                schedule the longest tests first, if any.
         """
         self.src_dir = src_dir
         self.ndk_path = ndk_path
@@ -55,6 +58,7 @@ class TestOptions:
         self.test_filter = test_filter
         self.clean = clean
         self.build_report = build_report
+        self.durations_db = durations_db
 
 
 class TestSpec:
@@ -0,0 +1,100 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.test.asyncadb."""
+import asyncio
+from typing import Any, Dict, List, Tuple
+import unittest
+
+from ndk.test.asyncadb import parse_shell_output, ShardRunner
+from ndk.workqueue import ShardingGroup
+
+
+class FakeShardingGroup(ShardingGroup):
+    """A sharding group with a fixed list of shards."""
+    def __init__(self, shards: List[str]) -> None:
+        self._shards = shards
+
+    @property
+    def shards(self) -> List[Any]:
+        return self._shards
+
+
+class ParseShellOutputTest(unittest.TestCase):
+    def test_status(self) -> None:
+        """Tests that the exit status is split from the output."""
+        self.assertTupleEqual((0, 'foo\n'), parse_shell_output('foo\nx0\n'))
+        self.assertTupleEqual((1, 'foo\n'),
+                              parse_shell_output('foo\r\nx1\r\n'))
+        self.assertTupleEqual((127, 'x\n'), parse_shell_output('x\nx127'))
+
+    def test_missing_status(self) -> None:
+        """Tests that truncated output is an error."""
+        with self.assertRaises(RuntimeError):
+            parse_shell_output('')
+        with self.assertRaises(RuntimeError):
+            parse_shell_output('foo\nx')
+
+
+class ShardRunnerTest(unittest.TestCase):
+    def test_run(self) -> None:
+        """Tests that tasks run on their group within the concurrency limit."""
+        group_a = FakeShardingGroup(['a1', 'a2'])
+        group_b = FakeShardingGroup(['b1'])
+        runner: ShardRunner[FakeShardingGroup] = ShardRunner(
+            [group_a, group_b], 2)
+
+        max_running: Dict[str, int] = {}
+
+        async def run_task(shard: str, i: int) -> Tuple[str, int]:
+            for running_shard, count in runner.running.items():
+                max_running[running_shard] = max(
+                    count, max_running.get(running_shard, 0))
+            await asyncio.sleep(0.01)
+            return shard, i
+
+        results: List[Tuple[str, int]] = []
+        tasks = [(group_a, i) for i in range(10)]
+        tasks.extend((group_b, i) for i in range(10, 15))
+        runner.run(tasks, run_task, results.append)
+
+        self.assertEqual(15, len(results))
+        self.assertEqual(0, runner.num_tasks)
+        for shard, i in results:
+            if i < 10:
+                self.assertIn(shard, group_a.shards)
+            else:
+                self.assertIn(shard, group_b.shards)
+        self.assertDictEqual({'a1': 2, 'a2': 2, 'b1': 2}, max_running)
+
+    def test_results_streamed(self) -> None:
+        """Tests that results are reported as soon as each task finishes."""
+        group = FakeShardingGroup(['a'])
+        runner: ShardRunner[FakeShardingGroup] = ShardRunner([group], 2)
+
+        async def run_task(_shard: str, delay: float) -> float:
+            await asyncio.sleep(delay)
+            return delay
+
+        results: List[float] = []
+        remaining: List[int] = []
+
+        def on_result(result: float) -> None:
+            results.append(result)
+            remaining.append(runner.num_tasks)
+
+        runner.run([(group, 0.2), (group, 0.01)], run_task, on_result)
+        self.assertListEqual([0.01, 0.2], results)
+        self.assertListEqual([1, 0], remaining)
@@ -16,15 +16,44 @@
 """Tests for ndk.workqueue."""
 import multiprocessing
 import os
+from pathlib import Path
 from queue import Queue
 import signal
 import sys
+import tempfile
+import threading
 from threading import Event
 from types import FrameType
 import time
+from typing import Any, Callable, List
 import unittest
 
-from ndk.workqueue import BasicWorkQueue, TaskError, Worker, WorkQueue
+from ndk.workqueue import (
+    adjust_num_workers,
+    BasicWorkQueue,
+    ElasticResourceWorkQueue,
+    ElasticWorkQueue,
+    LoadMonitor,
+    LoadSample,
+    LoadRestrictingWorkQueue,
+    parse_worker_range,
+    Resources,
+    ResourceWorkQueue,
+    ShardingGroup,
+    ShardingWorkQueue,
+    StatusTable,
+    Task,
+    TaskError,
+    TaskQueue,
+    ThreadPoolWorkQueue,
+    Worker,
+    WorkQueue,
+)
+
+
+# Set NDK_RUN_BENCHMARKS=1 to run the (slow) workqueue benchmarks. Run pytest
+# with -s to see the results.
+RUN_BENCHMARKS = bool(os.environ.get('NDK_RUN_BENCHMARKS'))
 
 
 def put(_worker: Worker, i: int) -> int:
@@ -32,6 +61,16 @@ def put(_worker: Worker, i: int) -> int:
     return i
 
 
+def add(_worker: Worker, i: int, j: int, offset: int = 0) -> int:
+    """Returns the sum of the passed arguments."""
+    return i + j + offset
+
+
+def get_pid(_worker: Worker, _i: int) -> int:
+    """Returns the PID of the worker process."""
+    return os.getpid()
+
+
 class Functor:
     """Functor that returns the argument passed to the constructor."""
     def __init__(self, value: int) -> None:
@@ -87,6 +126,31 @@ def raise_error() -> None:
     raise RuntimeError('Error in child')
 
 
+def raise_error_from_worker(_worker: Worker) -> None:
+    """Raises a RuntimeError to be re-raised in the caller."""
+    raise RuntimeError('Error in child')
+
+
+def kill_worker(_worker: Worker) -> None:
+    """Kills the worker process without sending a result."""
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def get_shard(worker: Worker, i: int) -> Any:
+    """Returns the shard the task ran on and the passed argument."""
+    return worker.data[0], i
+
+
+class FakeShardingGroup(ShardingGroup):
+    """A sharding group with a fixed list of shards."""
+    def __init__(self, shards: List[str]) -> None:
+        self._shards = shards
+
+    @property
+    def shards(self) -> List[Any]:
+        return self._shards
+
+
 class WorkQueueTest(unittest.TestCase):
     """Tests for WorkQueue."""
     def test_put_func(self) -> None:
@@ -121,6 +185,89 @@ class WorkQueueTest(unittest.TestCase):
         workqueue.terminate()
         workqueue.join()
 
+    def test_priority(self) -> None:
+        """Tests that higher priority tasks are dispatched first."""
+        workqueue = WorkQueue(1)
+        try:
+            # The first task is dispatched to the only worker immediately. The
+            # rest wait in the queue and are dispatched in priority order.
+            workqueue.add_task(put, 0)
+            workqueue.add_task(put, 1)
+            workqueue.add_task(put, 2, priority=2)
+            workqueue.add_task(put, 3, priority=2)
+            workqueue.add_task(put, 4, priority=1)
+            results = [workqueue.get_result() for _ in range(5)]
+            self.assertListEqual([0, 2, 3, 4, 1], results)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_get_results(self) -> None:
+        """Tests that get_results drains every finished task at once."""
+        workqueue = WorkQueue(4)
+        try:
+            for i in range(4):
+                workqueue.add_task(put, i)
+            for worker in workqueue.busy_workers:
+                self.assertTrue(worker.connection.poll(10))
+            results = workqueue.get_results(max_items=2)
+            self.assertEqual(2, len(results))
+            self.assertEqual(2, workqueue.num_tasks)
+            results.extend(workqueue.get_results())
+            self.assertListEqual([0, 1, 2, 3], sorted(results))
+            self.assertTrue(workqueue.finished())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_add_tasks(self) -> None:
+        """Tests that chunked tasks return one result per call."""
+        workqueue = WorkQueue(2)
+        try:
+            workqueue.add_tasks(add, [(i, i) for i in range(10)],
+                                chunksize=3, offset=1)
+            self.assertEqual(10, workqueue.num_tasks)
+            # Chunks arrive whole, but results are still handed out singly.
+            results = [workqueue.get_result()]
+            self.assertEqual(9, workqueue.num_tasks)
+            while not workqueue.finished():
+                results.extend(workqueue.get_results())
+            self.assertListEqual([2 * i + 1 for i in range(10)],
+                                 sorted(results))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_add_tasks_chunks_share_worker(self) -> None:
+        """Tests that the calls in a chunk run on a single worker."""
+        workqueue = WorkQueue(4)
+        try:
+            workqueue.add_tasks(get_pid, [(i,) for i in range(5)],
+                                chunksize=5)
+            pids = []
+            while not workqueue.finished():
+                pids.extend(workqueue.get_results())
+            self.assertEqual(5, len(pids))
+            self.assertEqual(1, len(set(pids)))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_get_results_timeout(self) -> None:
+        """Tests that get_results returns nothing when the timeout expires."""
+        workqueue = WorkQueue(1)
+        try:
+            manager = multiprocessing.Manager()
+            event = manager.Event()
+            workqueue.add_task(block_on_event, event)
+            self.assertListEqual([], workqueue.get_results(timeout=0.1))
+            self.assertFalse(workqueue.finished())
+            event.set()
+            self.assertListEqual([None], workqueue.get_results())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
     def test_finished(self) -> None:
         """Tests that finished() returns the correct result."""
         workqueue = WorkQueue(4)
@@ -190,6 +337,538 @@ class WorkQueueTest(unittest.TestCase):
             workqueue.terminate()
             workqueue.join()
 
+    def test_worker_killed(self) -> None:
+        """Tests that a worker dying without a result raises TaskError."""
+        workqueue = WorkQueue(1)
+
+        try:
+            workqueue.add_task(kill_worker)
+            with self.assertRaises(TaskError):
+                workqueue.get_result()
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_all_workers_failed(self) -> None:
+        """Tests the error when no workers remain for pending tasks."""
+        workqueue = WorkQueue(1)
+
+        try:
+            workqueue.add_task(raise_error_from_worker)
+            workqueue.add_task(put, 1)
+            with self.assertRaises(TaskError):
+                workqueue.get_result()
+            with self.assertRaisesRegex(RuntimeError, 'All workers'):
+                workqueue.get_result()
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+        self.assertListEqual([], workqueue.failed_workers)
+
+
+class ThreadPoolWorkQueueTest(unittest.TestCase):
+    """Tests for ThreadPoolWorkQueue."""
+    def test_put_func(self) -> None:
+        """Test that we can pass a function to the queue and get results."""
+        workqueue = ThreadPoolWorkQueue(4)
+
+        workqueue.add_task(put, 1)
+        workqueue.add_task(put, 2)
+        expected_results = [1, 2]
+
+        while expected_results:
+            i = workqueue.get_result()
+            self.assertIn(i, expected_results)
+            expected_results.remove(i)
+
+        workqueue.terminate()
+        workqueue.join()
+
+    def test_put_functor(self) -> None:
+        """Test that we can pass a functor to the queue and get results."""
+        workqueue = ThreadPoolWorkQueue(4)
+
+        workqueue.add_task(Functor(1))
+        workqueue.add_task(Functor(2))
+        expected_results = [1, 2]
+
+        while expected_results:
+            i = workqueue.get_result()
+            self.assertIn(i, expected_results)
+            expected_results.remove(i)
+
+        workqueue.terminate()
+        workqueue.join()
+
+    def test_unpicklable_task(self) -> None:
+        """Tests that tasks do not need to be picklable."""
+        workqueue = ThreadPoolWorkQueue(1)
+        try:
+            workqueue.add_task(lambda _worker, lock: lock.locked(),
+                               threading.Lock())
+            self.assertFalse(workqueue.get_result())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_priority(self) -> None:
+        """Tests that higher priority tasks are dispatched first."""
+        workqueue = ThreadPoolWorkQueue(1)
+        try:
+            workqueue.add_task(put, 0)
+            workqueue.add_task(put, 1)
+            workqueue.add_task(put, 2, priority=2)
+            workqueue.add_task(put, 3, priority=2)
+            workqueue.add_task(put, 4, priority=1)
+            results = [workqueue.get_result() for _ in range(5)]
+            self.assertListEqual([0, 2, 3, 4, 1], results)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_finished(self) -> None:
+        """Tests that finished() returns the correct result."""
+        workqueue = ThreadPoolWorkQueue(4)
+        self.assertTrue(workqueue.finished())
+
+        event = Event()
+        workqueue.add_task(block_on_event, event)
+        self.assertFalse(workqueue.finished())
+        event.set()
+        workqueue.get_result()
+        self.assertTrue(workqueue.finished())
+
+        workqueue.terminate()
+        workqueue.join()
+        self.assertTrue(workqueue.finished())
+
+    def test_status(self) -> None:
+        """Tests that worker status can be accessed from the caller."""
+        workqueue = ThreadPoolWorkQueue(1)
+
+        ready_event = Event()
+        finish_event = Event()
+        self.assertEqual(Worker.IDLE_STATUS, workqueue.workers[0].status)
+        workqueue.add_task(update_status, ready_event, finish_event, 'working')
+        ready_event.wait()
+        self.assertEqual('working', workqueue.workers[0].status)
+        finish_event.set()
+        workqueue.get_result()
+        self.assertEqual(Worker.IDLE_STATUS, workqueue.workers[0].status)
+
+        workqueue.terminate()
+        workqueue.join()
+
+    def test_exception(self) -> None:
+        """Tests that exceptions raised in the task are re-raised."""
+        workqueue = ThreadPoolWorkQueue(1)
+
+        try:
+            workqueue.add_task(raise_error_from_worker)
+            workqueue.add_task(put, 1)
+            with self.assertRaises(TaskError):
+                workqueue.get_result()
+            # Unlike a worker process, the thread survives the exception.
+            self.assertEqual(1, workqueue.get_result())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_no_tasks(self) -> None:
+        """Tests that waiting with nothing queued raises."""
+        workqueue = ThreadPoolWorkQueue(1)
+        try:
+            with self.assertRaisesRegex(RuntimeError, 'No tasks'):
+                workqueue.get_result()
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_join(self) -> None:
+        """Tests that join() stops every worker thread."""
+        workqueue = ThreadPoolWorkQueue(4)
+        threads = [worker.thread for worker in workqueue.workers]
+        workqueue.terminate()
+        workqueue.join()
+        for thread in threads:
+            self.assertFalse(thread.is_alive())
+
+
+    def test_get_results(self) -> None:
+        """Tests that get_results drains every finished task at once."""
+        workqueue = ThreadPoolWorkQueue(4)
+        try:
+            for i in range(4):
+                workqueue.add_task(put, i)
+            while workqueue.result_queue.qsize() < 4:
+                time.sleep(0.01)
+            results = workqueue.get_results(max_items=2)
+            self.assertEqual(2, len(results))
+            results.extend(workqueue.get_results())
+            self.assertListEqual([0, 1, 2, 3], sorted(results))
+            self.assertTrue(workqueue.finished())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_add_tasks(self) -> None:
+        """Tests that chunked tasks return one result per call."""
+        workqueue = ThreadPoolWorkQueue(2)
+        try:
+            workqueue.add_tasks(add, [(i, i) for i in range(10)],
+                                chunksize=4)
+            results = []
+            while not workqueue.finished():
+                results.extend(workqueue.get_results(max_items=3))
+            self.assertListEqual([2 * i for i in range(10)], sorted(results))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_get_results_timeout(self) -> None:
+        """Tests that get_results returns nothing when the timeout expires."""
+        workqueue = ThreadPoolWorkQueue(1)
+        try:
+            event = threading.Event()
+            workqueue.add_task(block_on_event, event)
+            self.assertListEqual([], workqueue.get_results(timeout=0.1))
+            event.set()
+            self.assertListEqual([None], workqueue.get_results())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+
+class StatusTableTest(unittest.TestCase):
+    """Tests for StatusTable."""
+    def test_slots_are_independent(self) -> None:
+        """Tests that each slot holds its own status."""
+        table = StatusTable(2)
+        table.set(0, 'foo')
+        table.set(1, 'bar')
+        self.assertEqual('foo', table.get(0))
+        self.assertEqual('bar', table.get(1))
+        table.set(0, 'f')
+        self.assertEqual('f', table.get(0))
+        self.assertEqual('bar', table.get(1))
+
+    def test_truncation(self) -> None:
+        """Tests that long statuses are truncated on a character boundary."""
+        table = StatusTable(1)
+        table.set(0, 'a' * (StatusTable.SLOT_SIZE + 10))
+        self.assertEqual('a' * StatusTable.SLOT_SIZE, table.get(0))
+        table.set(0, '\u00e9' * StatusTable.SLOT_SIZE)
+        self.assertEqual('\u00e9' * (StatusTable.SLOT_SIZE // 2), table.get(0))
+
+
+class ShardingWorkQueueTest(unittest.TestCase):
+    """Tests for ShardingWorkQueue."""
+    def test_tasks_run_on_group_shards(self) -> None:
+        """Tests that tasks only run on the shards of their group."""
+        self.check_tasks_run_on_group_shards(use_threads=False)
+
+    def test_tasks_run_on_group_shards_threads(self) -> None:
+        """Tests that thread workers only run tasks for their group."""
+        self.check_tasks_run_on_group_shards(use_threads=True)
+
+    def check_tasks_run_on_group_shards(self, use_threads: bool) -> None:
+        """Runs tasks on two groups and checks where they ran."""
+        group_a = FakeShardingGroup(['a1', 'a2'])
+        group_b = FakeShardingGroup(['b1'])
+        workqueue: ShardingWorkQueue[FakeShardingGroup] = ShardingWorkQueue(
+            [group_a, group_b], 2, use_threads=use_threads)
+
+        try:
+            for i in range(10):
+                workqueue.add_task(group_a, get_shard, i)
+            workqueue.add_tasks(group_b, get_shard,
+                                [(i,) for i in range(10, 20)],
+                                chunksize=3)
+            results = []
+            while not workqueue.finished():
+                results.extend(workqueue.get_results())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+        self.assertEqual(20, len(results))
+        for shard, i in results:
+            if i < 10:
+                self.assertIn(shard, group_a.shards)
+            else:
+                self.assertIn(shard, group_b.shards)
+        self.assertListEqual(list(range(20)), sorted(i for _, i in results))
+
+
+class TaskQueueTest(unittest.TestCase):
+    def test_priority_across_resources(self) -> None:
+        """Tests that tasks are returned by priority whatever they ask for."""
+        task_queue = TaskQueue()
+        task_queue.put(Task(put, (1,), {}, 0))
+        task_queue.put(Task(put, (2,), {}, 2, Resources(cpus=2)))
+        task_queue.put(Task(put, (3,), {}, 1))
+        task_queue.put(Task(put, (4,), {}, 2, Resources(exclusive=True)))
+        self.assertEqual(4, task_queue.qsize())
+        self.assertListEqual([(2,), (4,), (3,), (1,)],
+                             [task_queue.get().args for _ in range(4)])
+        self.assertTrue(task_queue.empty())
+
+    def test_get_first_checks_heads(self) -> None:
+        """Tests that blocked tasks are skipped without being examined."""
+        task_queue = TaskQueue()
+        for i in range(100):
+            task_queue.put(Task(put, (i,), {}, 1, Resources(exclusive=True)))
+        task_queue.put(Task(put, (100,), {}, 0))
+        checked = []
+
+        def fits(resources: Resources) -> bool:
+            checked.append(resources)
+            return not resources.exclusive
+
+        task = task_queue.get_first(fits)
+        assert task is not None
+        self.assertEqual((100,), task.args)
+        self.assertListEqual([Resources(exclusive=True), Resources()],
+                             checked)
+        self.assertIsNone(task_queue.get_first(fits))
+        self.assertEqual(100, task_queue.qsize())
+
+
+class ResourceWorkQueueTest(unittest.TestCase):
+    """Tests for ResourceWorkQueue.
+
+    Dispatch happens in the parent and only changes when a result is
+    received, so the admission state can be checked before any get_result.
+    """
+    def drain(self, workqueue: ResourceWorkQueue) -> List[int]:
+        """Returns the results of all remaining tasks."""
+        results = []
+        while not workqueue.finished():
+            results.append(workqueue.get_result())
+        return results
+
+    def test_cpu_slots(self) -> None:
+        """Tests that tasks wait for CPU slots to be free."""
+        workqueue = ResourceWorkQueue(4, cpus=2)
+        try:
+            workqueue.add_task(put, 1, resources=Resources(cpus=2))
+            workqueue.add_task(put, 2)
+            self.assertEqual(1, len(workqueue.busy_workers))
+            self.assertEqual(1, workqueue.task_queue.qsize())
+            self.assertEqual(0, workqueue.free_cpus)
+
+            self.assertEqual(1, workqueue.get_result())
+            self.assertEqual(1, len(workqueue.busy_workers))
+            self.assertEqual(2, workqueue.get_result())
+            self.assertEqual(2, workqueue.free_cpus)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_memory(self) -> None:
+        """Tests that tasks wait for memory to be free."""
+        workqueue = ResourceWorkQueue(4, cpus=4, memory_mib=1024)
+        try:
+            workqueue.add_task(put, 1, resources=Resources(memory_mib=768))
+            workqueue.add_task(put, 2, resources=Resources(memory_mib=512))
+            workqueue.add_task(put, 3, resources=Resources(memory_mib=256))
+            self.assertEqual(2, len(workqueue.busy_workers))
+            self.assertEqual(0, workqueue.free_memory_mib)
+            self.assertListEqual([1, 2, 3], sorted(self.drain(workqueue)))
+            self.assertEqual(1024, workqueue.free_memory_mib)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_exclusive(self) -> None:
+        """Tests that only one exclusive task runs at a time."""
+        workqueue = ResourceWorkQueue(4, cpus=4)
+        try:
+            workqueue.add_task(put, 1, resources=Resources(exclusive=True))
+            workqueue.add_task(put, 2, resources=Resources(exclusive=True))
+            workqueue.add_task(put, 3)
+            self.assertEqual(2, len(workqueue.busy_workers))
+            self.assertEqual(1, workqueue.task_queue.qsize())
+            self.assertListEqual([1, 2, 3], sorted(self.drain(workqueue)))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_small_tasks_fill_gaps(self) -> None:
+        """Tests that a blocked large task does not block smaller ones."""
+        workqueue = ResourceWorkQueue(4, cpus=2)
+        try:
+            workqueue.add_task(put, 1)
+            workqueue.add_task(put, 2, priority=1,
+                               resources=Resources(cpus=2))
+            workqueue.add_task(put, 3)
+            self.assertEqual(2, len(workqueue.busy_workers))
+            self.assertEqual(1, workqueue.task_queue.qsize())
+            self.assertListEqual([1, 2, 3], sorted(self.drain(workqueue)))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_oversized_task_runs_alone(self) -> None:
+        """Tests that a task larger than the queue still runs."""
+        workqueue = ResourceWorkQueue(2, cpus=2, memory_mib=100)
+        try:
+            workqueue.add_task(put,
+                               1,
+                               resources=Resources(cpus=8, memory_mib=200))
+            workqueue.add_task(put, 2)
+            self.assertEqual(1, len(workqueue.busy_workers))
+            self.assertListEqual([1, 2], self.drain(workqueue))
+            self.assertEqual(2, workqueue.free_cpus)
+            self.assertEqual(100, workqueue.free_memory_mib)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+
+IDLE_HOST = LoadSample(load=0.1, cpu_pressure=0.0, memory_pressure=0.0)
+BUSY_HOST = LoadSample(load=3.0, cpu_pressure=80.0, memory_pressure=0.0)
+
+
+class FakeLoadMonitor(LoadMonitor):
+    """A LoadMonitor that reports a fixed sample."""
+    def __init__(self, sample: LoadSample) -> None:
+        super().__init__()
+        self.load = sample
+
+    def sample(self) -> LoadSample:
+        return self.load
+
+
+class LoadMonitorTest(unittest.TestCase):
+    """Tests for LoadMonitor."""
+    def test_read_pressure(self) -> None:
+        """Tests that PSI files are parsed."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            pressure_dir = Path(temp_dir)
+            (pressure_dir / 'cpu').write_text(
+                'some avg10=12.50 avg60=1.50 avg300=3.70 total=94303904\n'
+                'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+            monitor = LoadMonitor(pressure_dir)
+            self.assertEqual(12.5, monitor.read_pressure('cpu'))
+            self.assertIsNone(monitor.read_pressure('memory'))
+            sample = monitor.sample()
+            self.assertEqual(12.5, sample.cpu_pressure)
+            self.assertIsNone(sample.memory_pressure)
+
+    def test_adjust_num_workers(self) -> None:
+        """Tests the pool size controller."""
+        self.assertEqual(5, adjust_num_workers(4, IDLE_HOST, 1, 8))
+        self.assertEqual(8, adjust_num_workers(8, IDLE_HOST, 1, 8))
+        self.assertEqual(3, adjust_num_workers(4, BUSY_HOST, 1, 8))
+        self.assertEqual(1, adjust_num_workers(1, BUSY_HOST, 1, 8))
+        swapping = LoadSample(load=0.1, cpu_pressure=0.0, memory_pressure=50)
+        self.assertEqual(4, adjust_num_workers(8, swapping, 1, 8))
+        # Without any load information the pool grows.
+        unknown = LoadSample(load=None, cpu_pressure=None,
+                             memory_pressure=None)
+        self.assertEqual(5, adjust_num_workers(4, unknown, 1, 8))
+
+
+class ElasticWorkQueueTest(unittest.TestCase):
+    """Tests for ElasticWorkQueue."""
+    def test_grows_and_parks(self) -> None:
+        """Tests that the pool follows load and reuses parked workers."""
+        monitor = FakeLoadMonitor(IDLE_HOST)
+        workqueue = ElasticWorkQueue(1, 3, load_monitor=monitor,
+                                     sample_interval=0)
+        try:
+            self.assertEqual(1, workqueue.num_active_workers)
+            for i in range(3):
+                workqueue.add_task(put, i)
+            self.assertEqual(3, workqueue.num_active_workers)
+            self.assertEqual(3, workqueue.num_spawned)
+            self.assertListEqual([0, 1, 2],
+                                 sorted(workqueue.get_result()
+                                        for _ in range(3)))
+
+            monitor.load = BUSY_HOST
+            workqueue.dispatch()
+            workqueue.dispatch()
+            self.assertEqual(1, workqueue.num_active_workers)
+            self.assertEqual(2, len(workqueue.parked_workers))
+            for worker in workqueue.parked_workers:
+                self.assertEqual(Worker.PARKED_STATUS, worker.status)
+                self.assertTrue(worker.is_alive())
+
+            monitor.load = IDLE_HOST
+            workqueue.add_task(put, 3)
+            self.assertEqual(2, workqueue.num_active_workers)
+            self.assertEqual(3, workqueue.num_spawned)
+            self.assertEqual(3, workqueue.get_result())
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_sample_interval(self) -> None:
+        """Tests that the load is not sampled more often than requested."""
+        monitor = FakeLoadMonitor(IDLE_HOST)
+        workqueue = ElasticWorkQueue(1, 4, load_monitor=monitor,
+                                     sample_interval=3600)
+        try:
+            workqueue.add_task(put, 0)
+            workqueue.add_task(put, 1)
+            self.assertEqual(2, workqueue.num_active_workers)
+            self.assertListEqual([0, 1],
+                                 sorted(workqueue.get_result()
+                                        for _ in range(2)))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+
+    def test_resources(self) -> None:
+        """Tests that an elastic pool still admits tasks by resources."""
+        monitor = FakeLoadMonitor(IDLE_HOST)
+        workqueue = ElasticResourceWorkQueue(1, 4, load_monitor=monitor,
+                                             sample_interval=0, cpus=2)
+        try:
+            self.assertEqual(2, workqueue.total_cpus)
+            workqueue.add_task(put, 0, resources=Resources(exclusive=True))
+            workqueue.add_task(put, 1, resources=Resources(exclusive=True))
+            workqueue.add_task(put, 2)
+            self.assertEqual(2, len(workqueue.busy_workers))
+            self.assertEqual(0, workqueue.free_cpus)
+            self.assertListEqual([0, 1, 2],
+                                 sorted(workqueue.get_result()
+                                        for _ in range(3)))
+            self.assertEqual(2, workqueue.free_cpus)
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
+    def test_parse_worker_range(self) -> None:
+        """Tests that MIN:MAX ranges are parsed and checked."""
+        self.assertTupleEqual((2, 8), parse_worker_range('2:8'))
+        for value in ('8', '0:4', '4:2', 'a:b'):
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    parse_worker_range(value)
+
+
+class LoadRestrictingWorkQueueTest(unittest.TestCase):
+    """Tests for LoadRestrictingWorkQueue."""
+    def test_results_from_both_queues(self) -> None:
+        """Tests that results are collected from both kinds of task."""
+        workqueue = LoadRestrictingWorkQueue(2)
+
+        try:
+            workqueue.add_task(put, 1)
+            workqueue.add_load_restricted_task(put, 2)
+            workqueue.add_task(put, 3)
+            results = []
+            while not workqueue.finished():
+                results.append(workqueue.get_result())
+            self.assertListEqual([1, 2, 3], sorted(results))
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+
 
 class BasicWorkQueueTest(unittest.TestCase):
     """Tests for BasicWorkQueue."""
@@ -225,6 +904,19 @@ class BasicWorkQueueTest(unittest.TestCase):
         workqueue.terminate()
         workqueue.join()
 
+    def test_priority(self) -> None:
+        """Tests that higher priority tasks are executed first."""
+        workqueue = BasicWorkQueue()
+
+        workqueue.add_task(put, 1)
+        workqueue.add_task(put, 2, priority=1)
+        workqueue.add_task(put, 3)
+        self.assertListEqual([2, 1, 3],
+                             [workqueue.get_result() for _ in range(3)])
+
+        workqueue.terminate()
+        workqueue.join()
+
     def test_finished(self) -> None:
         """Tests that finished() returns the correct result."""
         workqueue = WorkQueue()
@@ -239,6 +931,23 @@ class BasicWorkQueueTest(unittest.TestCase):
         workqueue.join()
         self.assertTrue(workqueue.finished())
 
+    def test_get_results(self) -> None:
+        """Tests that get_results runs one task at a time."""
+        workqueue = BasicWorkQueue()
+        workqueue.add_task(put, 1)
+        workqueue.add_task(put, 2)
+        self.assertListEqual([1], workqueue.get_results())
+        self.assertListEqual([2], workqueue.get_results(max_items=4))
+        self.assertTrue(workqueue.finished())
+
+    def test_add_tasks(self) -> None:
+        """Tests that add_tasks queues a task for each set of arguments."""
+        workqueue = BasicWorkQueue()
+        workqueue.add_tasks(add, [(1, 2), (3, 4)], chunksize=2)
+        self.assertListEqual([3, 7],
+                             [workqueue.get_result() for _ in range(2)])
+        self.assertTrue(workqueue.finished())
+
     def test_subprocess_exception(self) -> None:
         """Tests that exceptions raised in the task are re-raised."""
         workqueue = BasicWorkQueue()
@@ -250,3 +959,133 @@ class BasicWorkQueueTest(unittest.TestCase):
         finally:
             workqueue.terminate()
             workqueue.join()
+
+
+def _manager_queue_worker(task_queue: Queue, result_queue: Queue,
+                          status: Any, status_lock: Any) -> None:
+    """Worker loop for ManagerQueueWorkQueue."""
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        result = task.run(None)
+        with status_lock:
+            status.value = Worker.IDLE_STATUS
+        result_queue.put(result)
+
+
+class ManagerQueueWorkQueue:
+    """Reference pool that dispatches through multiprocessing.Manager queues.
+
+    This is how ProcessPoolWorkQueue used to dispatch tasks. Each task, each
+    result, and each worker status update makes a round trip through the
+    manager's server process. It is kept here only as a baseline for the
+    benchmarks.
+    """
+    def __init__(self, num_workers: int) -> None:
+        self.manager = multiprocessing.Manager()
+        self.task_queue = self.manager.Queue()
+        self.result_queue = self.manager.Queue()
+        # The status proxies must outlive the workers. The manager deletes the
+        # referent when the parent's last proxy is garbage collected.
+        self.statuses = [(self.manager.Value('', Worker.IDLE_STATUS),
+                          self.manager.Lock()) for _ in range(num_workers)]
+        self.processes = [
+            multiprocessing.Process(
+                target=_manager_queue_worker,
+                args=(self.task_queue, self.result_queue, status, status_lock))
+            for status, status_lock in self.statuses
+        ]
+        for process in self.processes:
+            process.start()
+
+    def add_task(self, func: Callable[..., Any], *args: Any) -> None:
+        """Queues up a new task for execution."""
+        self.task_queue.put(Task(func, args, {}))
+
+    def get_result(self) -> Any:
+        """Gets a result from the queue, blocking until one is available."""
+        return self.result_queue.get()
+
+    def terminate(self) -> None:
+        """Asks all worker processes to exit."""
+        for _ in self.processes:
+            self.task_queue.put(None)
+
+    def join(self) -> None:
+        """Waits for all worker processes to exit."""
+        for process in self.processes:
+            process.join()
+        self.manager.shutdown()
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, 'set NDK_RUN_BENCHMARKS=1 to run')
+class WorkQueueBenchmark(unittest.TestCase):
+    """Throughput benchmarks for the work queue dispatch engine."""
+
+    NUM_TASKS = 20000
+    NUM_WORKERS = 4
+
+    def measure(self, workqueue: Any) -> float:
+        """Returns the tasks per second processed by the given work queue."""
+        try:
+            start = time.monotonic()
+            for i in range(self.NUM_TASKS):
+                workqueue.add_task(put, i)
+            results: List[int] = []
+            for _ in range(self.NUM_TASKS):
+                results.append(workqueue.get_result())
+            elapsed = time.monotonic() - start
+        finally:
+            workqueue.terminate()
+            workqueue.join()
+        self.assertEqual(self.NUM_TASKS, len(results))
+        return self.NUM_TASKS / elapsed
+
+    def test_status_reads(self) -> None:
+        """Compares shared memory status reads with manager status reads."""
+        num_reads = 20000
+        manager = multiprocessing.Manager()
+        status = manager.Value('', Worker.IDLE_STATUS)
+        status_lock = manager.Lock()
+        start = time.monotonic()
+        for _ in range(num_reads):
+            with status_lock:
+                _ = status.value
+        before = num_reads / (time.monotonic() - start)
+        manager.shutdown()
+
+        table = StatusTable(1)
+        table.set(0, Worker.IDLE_STATUS)
+        start = time.monotonic()
+        for _ in range(num_reads):
+            table.get(0)
+        after = num_reads / (time.monotonic() - start)
+        print()
+        print(f'Manager status: {before:.0f} reads/s')
+        print(f'Shared memory: {after:.0f} reads/s ({after / before:.1f}x)')
+
+    def test_thread_pool_startup(self) -> None:
+        """Compares the startup and teardown cost of processes and threads."""
+        num_workers = multiprocessing.cpu_count()
+        timings = {}
+        for name, factory in (('Processes', WorkQueue),
+                              ('Threads', ThreadPoolWorkQueue)):
+            start = time.monotonic()
+            workqueue = factory(num_workers)
+            workqueue.add_task(put, 1)
+            workqueue.get_result()
+            workqueue.terminate()
+            workqueue.join()
+            timings[name] = time.monotonic() - start
+        print()
+        for name, elapsed in timings.items():
+            print(f'{name}: {num_workers} workers in {elapsed * 1000:.1f} ms')
+
+    def test_throughput(self) -> None:
+        """Compares direct pipe dispatch with manager queue dispatch."""
+        before = self.measure(ManagerQueueWorkQueue(self.NUM_WORKERS))
+        after = self.measure(WorkQueue(self.NUM_WORKERS))
+        print()
+        print(f'Manager queues: {before:.0f} tasks/s')
+        print(f'Direct pipes: {after:.0f} tasks/s ({after / before:.1f}x)')
@@ -43,6 +43,7 @@ from ndk.test.config import LibcxxTestConfig, TestConfig
 from ndk.test.filters import TestFilter
 from ndk.test.spec import BuildConfiguration, CMakeToolchainFile
 from ndk.test.result import Failure, Skipped, Success, TestResult
+from ndk.workqueue import Resources
 
 
 def logger() -> logging.Logger:
@@ -50,9 +51,11 @@ def logger() -> logging.Logger:
     return logging.getLogger(__name__)
 
 
-def _get_jobs_args() -> List[str]:
+def _get_jobs_args(test: 'Test') -> List[str]:
+    # Only run as many jobs as the test was granted CPU slots by the work
+    # queue so that concurrent test builds do not oversubscribe the machine.
     cpus = multiprocessing.cpu_count()
-    return [f'-j{cpus}', f'-l{cpus}']
+    return [f'-j{test.resources.cpus}', f'-l{cpus}']
 
 
 def _prep_build_dir(src_dir: str, out_dir: str) -> None:
@@ -69,6 +72,11 @@ class Test:
         self.config = config
         self.ndk_path = ndk_path
 
+    @property
+    def resources(self) -> Resources:
+        """Resources the test consumes while it is being built."""
+        return Resources()
+
     def get_test_config(self) -> TestConfig:
         return TestConfig.from_test_dir(self.test_dir)
 
@@ -224,7 +232,8 @@ def _run_build_sh_test(test: ShellBuildTest, build_dir: str, test_dir: str,
                        platform: int) -> TestResult:
     _prep_build_dir(test_dir, build_dir)
     with ndk.ext.os.cd(build_dir):
-        build_cmd = ['bash', 'build.sh'] + _get_jobs_args() + ndk_build_flags
+        build_cmd = (['bash', 'build.sh'] + _get_jobs_args(test) +
+                     ndk_build_flags)
         test_env = dict(os.environ)
         test_env['NDK'] = ndk_path
         if abi is not None:
@@ -339,7 +348,7 @@ def _run_ndk_build_test(test: NdkBuildTest, obj_dir: str, dist_dir: str,
             f'APP_ABI={abi}',
             f'APP_PLATFORM=android-{platform}',
             f'NDK_LIBS_OUT={dist_dir}',
-        ] + _get_jobs_args()
+        ] + _get_jobs_args(test)
         rc, out = ndk.ndkbuild.build(ndk_path, args + ndk_build_flags)
         if rc == 0:
             return Success(test)
@@ -427,7 +436,7 @@ def _run_cmake_build_test(test: CMakeBuildTest, obj_dir: str, dist_dir: str,
     if rc != 0:
         return Failure(test, out)
     rc, out = ndk.ext.subprocess.call_output(
-        [cmake_bin, '--build', abi_obj_dir, '--'] + _get_jobs_args(),
+        [cmake_bin, '--build', abi_obj_dir, '--'] + _get_jobs_args(test),
         encoding='utf-8')
     if rc != 0:
         return Failure(test, out)
@@ -553,6 +562,13 @@ class LibcxxTest(Test):
     def get_build_dir(self, out_dir: str) -> str:
         return os.path.join(out_dir, str(self.config), 'libcxx', self.name)
 
+    @property
+    def resources(self) -> Resources:
+        # The libc++ test suite is huge. Give it half the machine and never
+        # build two configurations of it at once.
+        return Resources(cpus=max(1, multiprocessing.cpu_count() // 2),
+                         exclusive=True)
+
     def run_lit(self, lit: List[str], ndk_path: Path, libcxx_src: Path,
                 libcxx_install: Path, build_dir: str,
                 filters: List[str]) -> None:
@@ -590,6 +606,7 @@ class LibcxxTest(Test):
 
         lit_args = lit + [
             '-sv',
+            f'-j{self.resources.cpus}',
             '--param=build_only=True',
             '--no-progress-bar',
             '--show-all',
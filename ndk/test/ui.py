@@ -22,8 +22,9 @@ from typing import List
 
 from ndk.ansi import AnsiConsole, Console, font_bold, font_faint, font_reset
 from ndk.ui import Ui, UiRenderer, AnsiUiRenderer, NonAnsiUiRenderer, columnate
+from ndk.test.asyncadb import ShardRunner
 from ndk.test.devices import DeviceShardingGroup
-from ndk.workqueue import LoadRestrictingWorkQueue, ShardingWorkQueue, Worker
+from ndk.workqueue import ResourceWorkQueue, ShardingWorkQueue, Worker
 
 
 class TestProgressUi(Ui):
@@ -89,11 +90,66 @@ def get_test_progress_ui(console: Console,
         ui_renderer, show_worker_status, show_device_groups, workqueue)
 
 
+class AsyncTestProgressUi(Ui):
+    NUM_TESTS_DIGITS = 6
+
+    def __init__(self, ui_renderer: UiRenderer, show_device_status: bool,
+                 show_device_groups: bool,
+                 runner: ShardRunner[DeviceShardingGroup]) -> None:
+        super().__init__(ui_renderer)
+        self.show_device_status = show_device_status
+        self.show_device_groups = show_device_groups
+        self.runner = runner
+
+    def get_ui_lines(self) -> List[str]:
+        lines = []
+
+        if self.show_device_status:
+            for group in self.runner.groups:
+                for device in group.devices:
+                    running = self.runner.running[device]
+                    style = font_bold() if running else font_faint()
+                    lines.append(
+                        f'{style}{running} running on {device}{font_reset()}')
+
+        lines.append('{: >{width}} tests remaining'.format(
+            self.runner.num_tasks, width=self.NUM_TESTS_DIGITS))
+
+        if self.show_device_groups:
+            for group in sorted(self.runner.groups):
+                group_id = f'{len(group.devices)} devices {group}'
+                lines.append('{: >{width}} {}'.format(
+                    self.runner.pending[group], group_id,
+                    width=self.NUM_TESTS_DIGITS))
+
+        return lines
+
+
+def get_async_test_progress_ui(
+        console: Console,
+        runner: ShardRunner[DeviceShardingGroup]) -> AsyncTestProgressUi:
+    ui_renderer: UiRenderer
+    if console.smart_console:
+        ui_renderer = AnsiUiRenderer(console)
+        show_device_status = True
+        show_device_groups = True
+    elif os.name == 'nt':
+        ui_renderer = NonAnsiUiRenderer(console)
+        show_device_status = False
+        show_device_groups = False
+    else:
+        ui_renderer = NonAnsiUiRenderer(console)
+        show_device_status = False
+        show_device_groups = True
+    return AsyncTestProgressUi(
+        ui_renderer, show_device_status, show_device_groups, runner)
+
+
 class TestBuildProgressUi(Ui):
     NUM_TESTS_DIGITS = 6
 
     def __init__(self, ui_renderer: UiRenderer, show_worker_status: bool,
-                 workqueue: LoadRestrictingWorkQueue):
+                 workqueue: ResourceWorkQueue):
         super().__init__(ui_renderer)
         self.show_worker_status = show_worker_status
         self.workqueue = workqueue
@@ -102,9 +158,7 @@ class TestBuildProgressUi(Ui):
         lines = []
 
         if self.show_worker_status:
-            for worker in self.workqueue.main_work_queue.workers:
-                lines.append(worker.status)
-            for worker in self.workqueue.restricted_work_queue.workers:
+            for worker in self.workqueue.workers:
                 lines.append(worker.status)
 
         if self.ui_renderer.console.smart_console:
@@ -122,7 +176,7 @@ class TestBuildProgressUi(Ui):
 
 def get_test_build_progress_ui(
         console: Console,
-        workqueue: LoadRestrictingWorkQueue) -> TestBuildProgressUi:
+        workqueue: ResourceWorkQueue) -> TestBuildProgressUi:
     ui_renderer: UiRenderer
     if console.smart_console:
         ui_renderer = AnsiUiRenderer(console)
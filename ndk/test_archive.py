@@ -0,0 +1,426 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.archive."""
+import os
+from pathlib import Path
+import random
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import time
+from typing import Dict, List
+import unittest
+from unittest import mock
+import zipfile
+
+import ndk.archive
+from ndk.archive import (
+    CompressionCache,
+    Manifest,
+    Member,
+    TAR_FORMATS,
+    TarFormat,
+    tree_members,
+    write_tar,
+    write_zip,
+)
+
+
+RUN_BENCHMARKS = bool(os.environ.get('NDK_RUN_BENCHMARKS'))
+
+
+def read_zip(path: Path) -> Dict[str, zipfile.ZipInfo]:
+    """Returns the members of an archive after checking their contents."""
+    with zipfile.ZipFile(path) as archive:
+        if archive.testzip() is not None:
+            raise AssertionError(f'{path} is corrupt')
+        return {info.filename: info for info in archive.infolist()}
+
+
+class WriteZipTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.ndk = self.temp_dir / 'android-ndk'
+        (self.ndk / 'bin').mkdir(parents=True)
+        (self.ndk / 'empty').mkdir()
+        (self.ndk / 'bin/tool').write_text('#!/bin/sh\n' * 100)
+        (self.ndk / 'bin/tool').chmod(0o755)
+        (self.ndk / 'bin/alias').symlink_to('tool')
+        (self.ndk / 'random').write_bytes(os.urandom(1000))
+        (self.ndk / 'lib').symlink_to('bin')
+
+    def write(self, symlinks: bool, name: str = 'ndk.zip') -> Path:
+        path = self.temp_dir / name
+        write_zip(path, tree_members(self.ndk, 'android-ndk', symlinks))
+        return path
+
+    def test_contents(self) -> None:
+        """Tests that the archive has the tree with its permissions."""
+        infos = read_zip(self.write(symlinks=True))
+        self.assertListEqual([
+            'android-ndk/',
+            'android-ndk/bin/',
+            'android-ndk/bin/alias',
+            'android-ndk/bin/tool',
+            'android-ndk/empty/',
+            'android-ndk/lib',
+            'android-ndk/random',
+        ], list(infos))
+
+        tool = infos['android-ndk/bin/tool']
+        self.assertEqual(0o100755, tool.external_attr >> 16)
+        self.assertEqual(zipfile.ZIP_DEFLATED, tool.compress_type)
+        self.assertEqual((1980, 1, 1, 0, 0, 0), tool.date_time)
+        # Incompressible data is stored.
+        self.assertEqual(zipfile.ZIP_STORED,
+                         infos['android-ndk/random'].compress_type)
+        self.assertTrue(infos['android-ndk/empty/'].is_dir())
+
+        alias = infos['android-ndk/bin/alias']
+        self.assertTrue(stat.S_ISLNK(alias.external_attr >> 16))
+        with zipfile.ZipFile(self.temp_dir / 'ndk.zip') as archive:
+            self.assertEqual(b'tool', archive.read(alias))
+            self.assertEqual(b'bin', archive.read('android-ndk/lib'))
+
+    def test_follow_symlinks(self) -> None:
+        """Tests that symlinks are followed for Windows packages."""
+        path = self.write(symlinks=False)
+        infos = read_zip(path)
+        self.assertIn('android-ndk/lib/tool', infos)
+        alias = infos['android-ndk/bin/alias']
+        self.assertTrue(stat.S_ISREG(alias.external_attr >> 16))
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual((self.ndk / 'bin/tool').read_bytes(),
+                             archive.read(alias))
+
+    def test_reproducible(self) -> None:
+        """Tests that the archive depends only on the tree's contents."""
+        first = self.write(symlinks=True, name='first.zip')
+        os.utime(self.ndk / 'bin/tool', (0, 0))
+        second = self.write(symlinks=True, name='second.zip')
+        self.assertEqual(first.read_bytes(), second.read_bytes())
+
+    def test_in_memory_members(self) -> None:
+        """Tests that members need not come from files."""
+        path = self.temp_dir / 'ndk.zip'
+        write_zip(path, [Member('a/README', stat.S_IFREG | 0o644, data=b'hi')])
+        with zipfile.ZipFile(path) as archive:
+            self.assertEqual(b'hi', archive.read('a/README'))
+
+    def test_duplicates(self) -> None:
+        """Tests that members may not share a name."""
+        members = [Member('a', stat.S_IFREG | 0o644)] * 2
+        with self.assertRaises(ValueError):
+            write_zip(self.temp_dir / 'ndk.zip', members)
+
+    def test_zip64(self) -> None:
+        """Tests the records written for archives too large for zip."""
+        with mock.patch.object(ndk.archive, 'ZIP64_LIMIT', 100), \
+                mock.patch.object(ndk.archive, 'ZIP64_COUNT_LIMIT', 3):
+            path = self.write(symlinks=True)
+        infos = read_zip(path)
+        self.assertEqual(7, len(infos))
+        self.assertGreater(infos['android-ndk/random'].header_offset, 100)
+        if shutil.which('unzip') is not None:
+            subprocess.run(['unzip', '-tq', str(path)],
+                           check=True,
+                           stdout=subprocess.DEVNULL)
+
+
+class ManifestTest(unittest.TestCase):
+    def test_layout(self) -> None:
+        """Tests that trees and generated files are archived where mapped."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src = Path(temp_dir) / 'android-ndk'
+            (src / 'bin').mkdir(parents=True)
+            (src / 'bin/tool').write_text('tool')
+            (src / 'source.properties').write_text('Pkg.Revision = 1')
+
+            manifest = Manifest(symlinks=True)
+            manifest.add_tree(src, 'NDK.app/Contents/NDK')
+            manifest.add_tree(src / 'source.properties', 'source.properties')
+            manifest.add_file('NDK.app/Contents/MacOS/ndk', '#!/bin/sh\n',
+                              mode=0o755)
+            path = Path(temp_dir) / 'bundle.zip'
+            write_zip(path, manifest.members)
+
+            infos = read_zip(path)
+            self.assertListEqual([
+                'NDK.app/',
+                'NDK.app/Contents/',
+                'NDK.app/Contents/MacOS/',
+                'NDK.app/Contents/MacOS/ndk',
+                'NDK.app/Contents/NDK/',
+                'NDK.app/Contents/NDK/bin/',
+                'NDK.app/Contents/NDK/bin/tool',
+                'NDK.app/Contents/NDK/source.properties',
+                'source.properties',
+            ], list(infos))
+            self.assertEqual(
+                0o100755,
+                infos['NDK.app/Contents/MacOS/ndk'].external_attr >> 16)
+            with zipfile.ZipFile(path) as archive:
+                self.assertEqual(b'tool',
+                                 archive.read('NDK.app/Contents/NDK/bin/tool'))
+
+
+class CompressionCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.trees = [self.temp_dir / 'linux', self.temp_dir / 'windows']
+        for tree in self.trees:
+            (tree / 'sysroot').mkdir(parents=True)
+            (tree / 'sysroot/stdio.h').write_text('int printf();\n' * 100)
+            (tree / 'sysroot/empty.h').write_text('')
+            (tree / 'bin').mkdir()
+            (tree / 'bin/clang').write_text(f'{tree.name} clang\n' * 100)
+        # Shared within a single archive too.
+        (self.trees[0] / 'sysroot/stdio_copy.h').write_text(
+            'int printf();\n' * 100)
+
+    def members(self, tree: Path) -> List[Member]:
+        return tree_members(tree, 'android-ndk', symlinks=True)
+
+    def test_shared(self) -> None:
+        """Tests that identical files are compressed once."""
+        archives = [self.members(tree) for tree in self.trees]
+        spill_dir = self.temp_dir / 'spill'
+        spill_dir.mkdir()
+        with CompressionCache(archives, spill_dir=spill_dir) as cache:
+            for tree, members in zip(self.trees, archives):
+                write_zip(self.temp_dir / f'{tree.name}.zip', members,
+                          cache=cache)
+        # Of the three copies of stdio.h and two of empty.h, all but the
+        # first of each are reused.
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(2 * len('int printf();\n' * 100), cache.saved_bytes)
+        # Only the compressed stdio.h was kept, and only on disk.
+        self.assertGreater(cache.spilled_bytes, 0)
+        self.assertLess(cache.spilled_bytes, len('int printf();\n' * 100))
+        self.assertListEqual([], list(spill_dir.iterdir()))
+
+        for tree in self.trees:
+            with zipfile.ZipFile(self.temp_dir / f'{tree.name}.zip') as zf:
+                self.assertEqual(
+                    (tree / 'bin/clang').read_bytes(),
+                    zf.read('android-ndk/bin/clang'))
+                self.assertEqual(
+                    (tree / 'sysroot/stdio.h').read_bytes(),
+                    zf.read('android-ndk/sysroot/stdio.h'))
+
+    def test_same_bytes(self) -> None:
+        """Tests that sharing doesn't change the archives written."""
+        archives = [self.members(tree) for tree in self.trees]
+        with CompressionCache(archives) as cache:
+            for tree, members in zip(self.trees, archives):
+                shared = self.temp_dir / f'{tree.name}-shared.zip'
+                write_zip(shared, members, cache=cache)
+                unshared = self.temp_dir / f'{tree.name}.zip'
+                write_zip(unshared, members)
+                self.assertEqual(unshared.read_bytes(), shared.read_bytes())
+
+    def test_unlisted_members(self) -> None:
+        """Tests that archives not given to the cache are still written."""
+        path = self.temp_dir / 'windows.zip'
+        with CompressionCache([self.members(self.trees[0])]) as cache:
+            write_zip(path, self.members(self.trees[1]), cache=cache)
+        self.assertEqual(0, cache.hits)
+        self.assertIn('android-ndk/bin/clang', read_zip(path))
+
+
+class WriteTarTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.dist = self.temp_dir / 'tests/dist'
+        (self.dist / 'bin').mkdir(parents=True)
+        (self.dist / 'bin/test').write_bytes(os.urandom(10000))
+        (self.dist / 'bin/test').chmod(0o755)
+        (self.dist / 'bin/alias').symlink_to('test')
+
+    def test_formats(self) -> None:
+        """Tests that tarballs split into many blocks read back whole."""
+        # Small blocks, so that the tarball has several compressed streams.
+        small_blocks = {
+            name: TarFormat(fmt.suffix, 1000, fmt.compress)
+            for name, fmt in TAR_FORMATS.items()
+        }
+        for name, fmt in small_blocks.items():
+            with self.subTest(format=name), \
+                    mock.patch.dict(TAR_FORMATS, small_blocks):
+                path = write_tar(self.temp_dir / 'ndk-tests', self.temp_dir,
+                                 ['tests/dist'], name, num_threads=4)
+                self.assertEqual(f'ndk-tests{fmt.suffix}', path.name)
+                if name == 'zstd':
+                    # tarfile only reads zstd as of Python 3.14.
+                    continue
+                with tarfile.open(path) as tar:
+                    self.assertListEqual([
+                        'tests/dist',
+                        'tests/dist/bin',
+                        'tests/dist/bin/alias',
+                        'tests/dist/bin/test',
+                    ], tar.getnames())
+                    test = tar.extractfile('tests/dist/bin/test')
+                    assert test is not None
+                    self.assertEqual((self.dist / 'bin/test').read_bytes(),
+                                     test.read())
+                    self.assertEqual(0o755,
+                                     tar.getmember('tests/dist/bin/test').mode)
+                    self.assertEqual('test',
+                                     tar.getmember(
+                                         'tests/dist/bin/alias').linkname)
+
+    def test_unknown_format(self) -> None:
+        """Tests that unsupported formats are rejected."""
+        with self.assertRaises(ValueError):
+            write_tar(self.temp_dir / 'ndk-tests', self.temp_dir,
+                      ['tests/dist'], 'rar')
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, 'set NDK_RUN_BENCHMARKS=1 to run')
+class WriteZipBenchmark(unittest.TestCase):
+    """Compares write_zip with the `zip -9qr` it replaced.
+
+    The tree mixes compressible text, like headers and scripts, with
+    incompressible data, like stripped binaries.
+    """
+
+    NUM_FILES = 500
+
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.src = self.temp_dir / 'android-ndk'
+        rng = random.Random(0)
+        words = [f'symbol_{i}' for i in range(1000)]
+        for i in range(self.NUM_FILES):
+            path = self.src / f'dir{i % 10}/file{i}'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if i % 4:
+                path.write_text(' '.join(rng.choices(words, k=8000)))
+            else:
+                path.write_bytes(os.urandom(32 * 1024))
+        self.input_size = sum(
+            p.stat().st_size for p in self.src.glob('*/*'))
+
+    def report(self, name: str, path: Path, elapsed: float) -> None:
+        ratio = path.stat().st_size / self.input_size
+        print(f'{name}: {self.input_size / 1024**2:.0f} MiB in '
+              f'{elapsed * 1000:.0f} ms, {ratio:.3f} of input size')
+
+    @unittest.skipIf(shutil.which('zip') is None, 'zip is not installed')
+    def test_zip(self) -> None:
+        """Measures zip -9qr."""
+        path = self.temp_dir / 'zip.zip'
+        start = time.monotonic()
+        subprocess.run(['zip', '-9qr', '--symlinks', str(path), self.src.name],
+                       check=True,
+                       cwd=self.temp_dir)
+        self.report('\nzip -9qr', path, time.monotonic() - start)
+
+    def test_write_zip(self) -> None:
+        """Measures write_zip."""
+        path = self.temp_dir / 'write_zip.zip'
+        start = time.monotonic()
+        write_zip(path, tree_members(self.src, self.src.name, True))
+        self.report('\nwrite_zip', path, time.monotonic() - start)
+
+    @unittest.skipIf(shutil.which('tar') is None, 'tar is not installed')
+    def test_tar(self) -> None:
+        """Measures the tar -j that ndk-tests was packaged with."""
+        path = self.temp_dir / 'tar.tar.bz2'
+        start = time.monotonic()
+        subprocess.run(['tar', '-jcf', str(path), self.src.name],
+                       check=True,
+                       cwd=self.temp_dir)
+        self.report('\ntar -j', path, time.monotonic() - start)
+
+    def test_write_tar(self) -> None:
+        """Measures write_tar in each format, and extracting the result."""
+        print()
+        for name in TAR_FORMATS:
+            start = time.monotonic()
+            path = write_tar(self.temp_dir / name, self.temp_dir,
+                             [self.src.name], name)
+            self.report(f'write_tar {name}', path, time.monotonic() - start)
+            if name == 'zstd' or shutil.which('tar') is None:
+                continue
+            out_dir = self.temp_dir / f'{name}-out'
+            out_dir.mkdir()
+            start = time.monotonic()
+            subprocess.run(['tar', '-xf', str(path), '-C', str(out_dir)],
+                           check=True)
+            print(f'  tar -xf: {(time.monotonic() - start) * 1000:.0f} ms')
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, 'set NDK_RUN_BENCHMARKS=1 to run')
+class CompressionCacheBenchmark(unittest.TestCase):
+    """Compares packaging three hosts with and without a shared cache.
+
+    Like a release, most of each host's tree is identical to the others.
+    """
+
+    NUM_SHARED_FILES = 300
+    NUM_HOST_FILES = 100
+
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        rng = random.Random(0)
+        words = [f'symbol_{i}' for i in range(1000)]
+        shared = [' '.join(rng.choices(words, k=8000))
+                  for _ in range(self.NUM_SHARED_FILES)]
+        self.trees = []
+        for host in ('linux', 'darwin', 'windows'):
+            tree = self.temp_dir / host
+            for i, text in enumerate(shared):
+                path = tree / f'sysroot/dir{i % 10}/file{i}.h'
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(text)
+            (tree / 'bin').mkdir()
+            for i in range(self.NUM_HOST_FILES):
+                (tree / f'bin/tool{i}').write_text(
+                    ' '.join(rng.choices(words, k=8000)))
+            self.trees.append(tree)
+
+    def measure(self, name: str, cache: bool) -> None:
+        archives = [tree_members(t, 'android-ndk', True) for t in self.trees]
+        start = time.monotonic()
+        shared = CompressionCache(archives) if cache else None
+        for tree, members in zip(self.trees, archives):
+            write_zip(self.temp_dir / f'{tree.name}-{name}.zip',
+                      members,
+                      cache=shared)
+        if shared is not None:
+            shared.close()
+        print(f'{name}: {len(self.trees)} packages in '
+              f'{(time.monotonic() - start) * 1000:.0f} ms')
+
+    def test_compression_cache(self) -> None:
+        """Measures packaging each host separately and in one pass."""
+        print()
+        self.measure('separately', cache=False)
+        self.measure('shared', cache=True)
@@ -0,0 +1,163 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.artifactcache."""
+import os
+from pathlib import Path
+import tempfile
+from typing import Dict
+import unittest
+
+from ndk.artifactcache import ArtifactCache, get_cached_install
+from ndk.builds import BuildContext, Module
+import ndk.file
+from ndk.hosts import Host
+
+
+class FakeModule(Module):
+    no_notice = True
+
+    def __init__(self, name: str, path: str,
+                 install_replaces_path: bool = False) -> None:
+        self.name = name
+        self.path = Path(path)
+        self.install_replaces_path = install_replaces_path
+        super().__init__()
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.cache = ArtifactCache(self.temp_dir / 'cache', 1024**3)
+
+    def make_tree(self, name: str, contents: str = 'foo') -> Path:
+        tree = self.temp_dir / name
+        (tree / 'bin').mkdir(parents=True)
+        (tree / 'empty').mkdir()
+        (tree / 'bin/tool').write_text(contents)
+        (tree / 'bin/tool').chmod(0o755)
+        (tree / 'bin/alias').symlink_to('tool')
+        (tree / 'README').write_text(contents)
+        return tree
+
+    def test_round_trip(self) -> None:
+        """Tests that a restored tree matches the stored tree."""
+        self.cache.store('key', self.make_tree('src'))
+        dst = self.temp_dir / 'dst'
+        dst.mkdir()
+        (dst / 'stale').write_text('')
+        self.assertTrue(self.cache.restore('key', dst, False))
+
+        self.assertFalse((dst / 'stale').exists())
+        self.assertTrue((dst / 'empty').is_dir())
+        self.assertEqual('foo', (dst / 'bin/tool').read_text())
+        self.assertTrue(os.access(dst / 'bin/tool', os.X_OK))
+        self.assertFalse(os.access(dst / 'README', os.X_OK))
+        self.assertEqual('tool', os.readlink(dst / 'bin/alias'))
+
+    def test_restore_recorded(self) -> None:
+        """Tests that restored files count towards the install's size."""
+        self.cache.store('key', self.make_tree('src'))
+        dst = self.temp_dir / 'dst'
+        with ndk.file.record_installs() as record:
+            self.cache.restore('key', dst, True)
+        self.assertSetEqual(
+            {dst / 'README', dst / 'bin/tool', dst / 'bin/alias'},
+            set(record.files))
+        self.assertEqual(len('foo') * 2 + len('tool'), record.size)
+
+    def test_single_file(self) -> None:
+        """Tests that a module installing a single file can be cached."""
+        src = self.temp_dir / 'README.md'
+        src.write_text('readme')
+        self.cache.store('key', src)
+        dst = self.temp_dir / 'out/README.md'
+        self.assertTrue(self.cache.restore('key', dst, True))
+        self.assertEqual('readme', dst.read_text())
+
+    def test_miss(self) -> None:
+        """Tests that restoring a missing entry leaves the path alone."""
+        dst = self.make_tree('dst')
+        self.assertFalse(self.cache.restore('key', dst, True))
+        self.assertTrue((dst / 'README').exists())
+
+    def test_copies_unless_hardlinks_allowed(self) -> None:
+        """Tests that files are only shared with the cache when allowed."""
+        self.cache.store('key', self.make_tree('src'))
+        copied = self.temp_dir / 'copied'
+        self.cache.restore('key', copied, False)
+        (copied / 'README').write_text('modified')
+
+        linked = self.temp_dir / 'linked'
+        self.cache.restore('key', linked, True)
+        self.assertEqual('foo', (linked / 'README').read_text())
+
+    def test_identical_files_stored_once(self) -> None:
+        """Tests that file contents are deduplicated."""
+        self.cache.store('a', self.make_tree('a'))
+        self.cache.store('b', self.make_tree('b'))
+        objects = list(self.cache.objects_dir.glob('*/*'))
+        # The executable and the readme differ only by mode.
+        self.assertEqual(2, len(objects))
+
+    def test_evict(self) -> None:
+        """Tests that the least recently used entries are evicted first."""
+        for i, key in enumerate(('old', 'used', 'new')):
+            self.cache.store(key, self.make_tree(key, str(i) * 300))
+            # Entries are ordered by mtime, which may be coarse.
+            os.utime(self.cache.entry_path(key), (i, i))
+        self.cache.restore('used', self.temp_dir / 'dst', False)
+
+        # Each entry has two 300 byte files.
+        self.cache.max_size = 2 * 600
+        self.cache.evict()
+        self.assertFalse(self.cache.entry_path('old').exists())
+        self.assertTrue(self.cache.restore('used', self.temp_dir / 'a', True))
+        self.assertTrue(self.cache.restore('new', self.temp_dir / 'b', True))
+        self.assertEqual(4, len(list(self.cache.objects_dir.glob('*/*'))))
+
+        self.cache.max_size = 0
+        self.cache.evict()
+        self.assertEqual([], list(self.cache.objects_dir.glob('*/*')))
+
+
+class GetCachedInstallTest(unittest.TestCase):
+    def test_policy(self) -> None:
+        """Tests which modules may be cached and hardlinked."""
+        modules = [
+            FakeModule('clang', 'toolchain', install_replaces_path=True),
+            FakeModule('sysroot-installer', 'toolchain'),
+            FakeModule('libcxx', 'sources/cxx-stl'),
+            FakeModule('gdb', 'prebuilt'),
+            FakeModule('make', 'prebuilt/bin'),
+            FakeModule('setup.py', '/src/setup.py'),
+        ]
+        context = BuildContext(Path('/out'), Path('/dist'), modules,
+                               Host.current(), '0')
+        for module in modules:
+            module.context = context
+        cache = ArtifactCache(Path('/cache'), 0)
+
+        cached: Dict[str, bool] = {}
+        for module in modules:
+            cached_install = get_cached_install(cache, module, module.name,
+                                                modules)
+            if cached_install is not None:
+                cached[module.name] = cached_install.allow_hardlinks
+        self.assertDictEqual({'clang': False, 'libcxx': True}, cached)
+        self.assertIsNone(
+            get_cached_install(cache, modules[2], None, modules))
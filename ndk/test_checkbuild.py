@@ -0,0 +1,312 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.checkbuild."""
+import contextlib
+import copy
+import io
+import os
+from pathlib import Path
+import sys
+import tempfile
+import textwrap
+import unittest
+import zipfile
+
+from ndk.builds import BuildContext
+from ndk.checkbuild import (
+    ALL_MODULES,
+    install_manifest_path,
+    make_app_bundle,
+    ModuleReport,
+    package_ndks,
+    Platforms,
+    print_module_reports,
+    report_install_sizes,
+    update_module_report,
+)
+from ndk.deps import (
+    DependencyManager,
+    find_critical_path,
+    Phase,
+    schedule_steps,
+    simulate_build,
+    Step,
+    StepDependencyManager,
+)
+from ndk.durations import Measurement
+from ndk.elf import ElfFile
+from ndk.file import InstallRecord
+from ndk.hosts import Host
+from ndk.installmanifest import InstalledFile, InstallManifest, SizeBudget
+
+
+# Rough relative build times of the slowest modules. Everything else is
+# assumed to cost 1.
+MODULE_COSTS = {
+    'base-toolchain': 3,
+    'clang': 5,
+    'gdb': 15,
+    'libc++': 20,
+    'libshaderc': 12,
+    'make': 4,
+    'platforms': 10,
+    'shader-tools': 15,
+    'sysroot': 2,
+    'toolchain': 3,
+    'yasm': 3,
+}
+
+
+class ScheduleSimulationTest(unittest.TestCase):
+    """Simulates builds of the real module graph."""
+    def test_priority_makespan(self) -> None:
+        """Tests that critical path priority never loses to FIFO."""
+        weights = DependencyManager(ALL_MODULES,
+                                    MODULE_COSTS).critical_path_weights
+        critical_path = max(weights.values())
+        for num_workers in (1, 2, 4, 8, 16, 64):
+            fifo = simulate_build(ALL_MODULES, num_workers, MODULE_COSTS)
+            prioritized = simulate_build(ALL_MODULES, num_workers,
+                                         MODULE_COSTS,
+                                         lambda m: weights[m.name])
+            self.assertLessEqual(prioritized, fifo)
+            self.assertGreaterEqual(prioritized, critical_path)
+
+    def test_priority_shortens_build(self) -> None:
+        """Tests that critical path priority beats FIFO on a small pool."""
+        weights = DependencyManager(ALL_MODULES,
+                                    MODULE_COSTS).critical_path_weights
+        fifo = simulate_build(ALL_MODULES, 4, MODULE_COSTS)
+        prioritized = simulate_build(ALL_MODULES, 4, MODULE_COSTS,
+                                     lambda m: weights[m.name])
+        self.assertLess(prioritized, fifo)
+
+    def test_plan(self) -> None:
+        """Tests that the predicted critical path spans the whole build."""
+        for num_workers in (1, 4, 64):
+            deps = StepDependencyManager(ALL_MODULES, MODULE_COSTS)
+            step_deps = deps.step_deps
+            longest_chain = max(deps.critical_path_weights.values())
+            schedule = schedule_steps(deps, num_workers, set())
+            self.assertEqual(2 * len(ALL_MODULES), len(schedule))
+            makespan = max(s.end for s in schedule)
+            self.assertGreaterEqual(makespan, longest_chain)
+
+            critical_path = find_critical_path(schedule, step_deps)
+            self.assertEqual(0, critical_path[0].start)
+            self.assertEqual(makespan, critical_path[-1].end)
+            for before, after in zip(critical_path, critical_path[1:]):
+                self.assertEqual(before.end, after.start)
+
+
+# Stands in for clang and llvm-readelf. Objects contain their command line,
+# and the note check passes unless an object is named in FAIL_OBJECTS.
+# A compiler that writes an object file with an Android note describing its
+# arguments.
+FAKE_TOOL = textwrap.dedent(f"""\
+    #!{sys.executable}
+    import os, sys
+    sys.path.insert(0, {str(Path(__file__).resolve().parents[1])!r})
+    from ndk.test_elf import make_android_object, make_elf
+    dst = sys.argv[sys.argv.index('-o') + 1]
+    if os.path.basename(dst) in os.environ.get('FAIL_OBJECTS', ''):
+        sys.exit('error: ' + dst)
+    with open(dst, 'wb') as obj:
+        if os.path.basename(dst) in os.environ.get('NOTELESS_OBJECTS', ''):
+            obj.write(make_elf([]))
+        else:
+            obj.write(make_android_object(' '.join(sys.argv[1:]).encode()))
+    """)
+
+
+class FakeToolPlatforms(Platforms):
+    def __init__(self, temp_dir: Path) -> None:
+        super().__init__()
+        self.tool = temp_dir / 'tool'
+        self.prebuilts_path = temp_dir / 'prebuilts'
+        for api in (16, 21):
+            (self.prebuilts_path / f'platforms/android-{api}').mkdir(
+                parents=True)
+
+    def llvm_tool(self, tool: str) -> Path:
+        return self.tool
+
+
+class ModuleReportTest(unittest.TestCase):
+    def test_report(self) -> None:
+        """Tests that each step's time and the install's size are reported."""
+        module = ALL_MODULES[0]
+        report = ModuleReport()
+        update_module_report(report, Step(module, Phase.BUILD),
+                             Measurement('build', module.name, 12.0, 1.0, 0),
+                             None)
+        record = InstallRecord({Path('a'): 2**20, Path('b'): 2**20})
+        update_module_report(report, Step(module, Phase.INSTALL),
+                             Measurement('install', module.name, 3.0, 1.0, 0),
+                             record)
+        self.assertEqual(ModuleReport(12.0, 3.0, False, 2, 2 * 2**20), report)
+
+        restored = ModuleReport()
+        update_module_report(restored, Step(module, Phase.INSTALL), None,
+                             record)
+        self.assertTrue(restored.restored)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            print_module_reports({module: report})
+        self.assertListEqual(['2.0', '2', '12.0s', '3.0s', str(module)],
+                             output.getvalue().splitlines()[1].split())
+
+
+class InstallSizesTest(unittest.TestCase):
+    def test_budgets(self) -> None:
+        """Tests that installs of earlier builds are checked too."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            context = BuildContext(Path(temp_dir) / 'out',
+                                   Path(temp_dir) / 'dist', ALL_MODULES,
+                                   Host.current(), '1234')
+            (context.dist_dir / 'logs').mkdir(parents=True)
+            modules = [copy.copy(m) for m in ALL_MODULES[:3]]
+            for module, size in zip(modules[:2], (2**20, 3 * 2**20)):
+                module.context = context
+                InstallManifest(module.name, [
+                    InstalledFile('lib/libfoo.a', size, '0' * 64)
+                ]).save(install_manifest_path(module))
+            modules[2].context = context
+
+            report_path = report_install_sizes(modules, context.dist_dir, {})
+            report = report_path.read_text()
+            self.assertTrue(report.startswith(modules[1].name))
+            self.assertIn(modules[0].name, report)
+            self.assertNotIn(modules[2].name, report)
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                with self.assertRaises(SystemExit):
+                    report_install_sizes(
+                        modules, context.dist_dir,
+                        {modules[1].name: SizeBudget(max_size_mib=2)})
+            self.assertIn(
+                f'{modules[1].name} is 3.0 MiB, over its budget of 2 MiB',
+                output.getvalue())
+
+
+class AppBundleTest(unittest.TestCase):
+    def test_layout(self) -> None:
+        """Tests that the bundle is archived without staging a copy."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ndk_dir = Path(temp_dir) / 'out/android-ndk-r23'
+            (ndk_dir / 'build').mkdir(parents=True)
+            (ndk_dir / 'build/ndk-build').write_text('ndk-build')
+            (ndk_dir / 'source.properties').write_text('Pkg.Revision = 23')
+            zip_path = Path(temp_dir) / 'dist/bundle'
+            make_app_bundle(zip_path, ndk_dir, '1234')
+
+            self.assertListEqual(['android-ndk-r23'],
+                                 os.listdir(Path(temp_dir) / 'out'))
+            with zipfile.ZipFile(zip_path.with_suffix('.zip')) as archive:
+                names = archive.namelist()
+                contents = 'AndroidNDK1234.app/Contents'
+                self.assertEqual(
+                    b'ndk-build',
+                    archive.read(f'{contents}/NDK/build/ndk-build'))
+                self.assertIn(b'<string>ndk</string>',
+                              archive.read(f'{contents}/Info.plist'))
+                self.assertIn(f'{contents}/MacOS/ndk', names)
+                self.assertIn('_codesign/volumename', names)
+                self.assertEqual(b'Pkg.Revision = 23',
+                                 archive.read('source.properties'))
+
+
+class PackageNdksTest(unittest.TestCase):
+    def test_hosts(self) -> None:
+        """Tests that every host is packaged in one pass."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ndk_dirs = {}
+            for host in (Host.Linux, Host.Darwin, Host.Windows64):
+                ndk_dir = Path(temp_dir) / f'out/{host.value}/android-ndk-r23'
+                (ndk_dir / 'sysroot').mkdir(parents=True)
+                (ndk_dir / 'sysroot/stdio.h').write_text('int printf();')
+                (ndk_dir / 'sysroot/Android.bp').write_text('')
+                (ndk_dir / 'source.properties').write_text('Pkg.Revision')
+                ndk_dirs[host] = ndk_dir
+            dist_dir = Path(temp_dir) / 'dist'
+            with contextlib.redirect_stdout(io.StringIO()):
+                paths = package_ndks(ndk_dirs, dist_dir, '1234')
+
+            self.assertEqual(
+                dist_dir / 'android-ndk-1234-linux-x86_64.zip',
+                paths[Host.Linux])
+            self.assertListEqual([
+                'android-ndk-1234-app-bundle.zip',
+                'android-ndk-1234-darwin-x86_64.zip',
+                'android-ndk-1234-linux-x86_64.zip',
+                'android-ndk-1234-windows-x86_64.zip',
+            ], sorted(os.listdir(dist_dir)))
+            for path in paths.values():
+                with zipfile.ZipFile(path) as archive:
+                    self.assertEqual(
+                        b'int printf();',
+                        archive.read('android-ndk-r23/sysroot/stdio.h'))
+                    self.assertNotIn('android-ndk-r23/sysroot/Android.bp',
+                                     archive.namelist())
+
+
+class PlatformsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.platforms = FakeToolPlatforms(self.temp_dir)
+        self.platforms.tool.write_text(FAKE_TOOL)
+        self.platforms.tool.chmod(0o755)
+        self.platforms.context = BuildContext(self.temp_dir / 'out',
+                                              self.temp_dir / 'dist',
+                                              [self.platforms],
+                                              Host.current(), '1234')
+
+    def test_build(self) -> None:
+        """Tests that every CRT object is built for every API and arch."""
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            self.platforms.build()
+        self.assertIn('Running: ', log.getvalue())
+        build_dir = self.temp_dir / 'out/platforms'
+        objects = sorted(
+            str(p.relative_to(build_dir)) for p in build_dir.glob('*/*/*'))
+        self.assertEqual(5 * (2 + 4), len(objects))
+        self.assertIn('android-21/arch-arm64/crtbegin_static.o', objects)
+        crtbegin = build_dir / 'android-16/arch-x86/crtbegin_static.o'
+        with ElfFile(crtbegin) as elf:
+            args = b''.join(note.desc for note in elf.notes()).decode()
+        self.assertIn('-DPLATFORM_SDK_VERSION=16', args)
+        self.assertIn('-D_FORCE_CRT_ATFORK', args)
+
+    def test_missing_note(self) -> None:
+        """Tests that a crtbegin object without an Android note is an error."""
+        os.environ['NOTELESS_OBJECTS'] = 'crtbegin_so.o'
+        self.addCleanup(os.environ.pop, 'NOTELESS_OBJECTS')
+        with self.assertRaisesRegex(Exception, 'crtbegin_so.o does not'):
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.platforms.build()
+
+    def test_build_failure(self) -> None:
+        """Tests that a failed compile fails the build with its output."""
+        os.environ['FAIL_OBJECTS'] = 'crtend_so.o'
+        self.addCleanup(os.environ.pop, 'FAIL_OBJECTS')
+        with self.assertRaisesRegex(Exception, 'error: .*crtend_so.o'):
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.platforms.build()
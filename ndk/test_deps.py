@@ -18,8 +18,15 @@ from typing import Set
 import unittest
 
 from ndk.deps import CyclicDependencyError
+from ndk.deps import DependencyIndex
 from ndk.deps import DependencyManager
-from ndk.builds import Module
+from ndk.deps import find_critical_path
+from ndk.deps import Phase
+from ndk.deps import schedule_steps
+from ndk.deps import simulate_build
+from ndk.deps import Step
+from ndk.deps import StepDependencyManager
+from ndk.builds import Module, ModuleValidateError
 
 
 class MockModule(Module):
@@ -163,3 +170,260 @@ class DependencyManagerTest(unittest.TestCase):
         self.assertSetEqual({complexD}, deps.get_buildable())
         self.assertSetEqual(set(), deps.buildable_modules)
         deps.complete(complexD)
+
+    def test_critical_path_weights(self) -> None:
+        """Test that weights measure the longest chain of dependents."""
+        modules = [ComplexA(), ComplexB(), ComplexC(), ComplexD()]
+        deps = DependencyManager(modules)
+        self.assertDictEqual({
+            'complexA': 3,
+            'complexB': 2,
+            'complexC': 1,
+            'complexD': 1,
+        }, deps.critical_path_weights)
+
+        deps = DependencyManager(modules, {'complexC': 10})
+        self.assertEqual(11, deps.critical_path_weights['complexA'])
+        self.assertEqual(10, deps.critical_path_weights['complexC'])
+
+
+# A graph in which FIFO scheduling picks the wrong modules first. chainA starts
+# a long chain, but the bulk modules sort before it and occupy both workers.
+class BulkA(MockModule):
+    name = 'bulkA'
+    deps: Set[str] = set()
+
+
+class BulkB(MockModule):
+    name = 'bulkB'
+    deps: Set[str] = set()
+
+
+class ChainA(MockModule):
+    name = 'chainA'
+    deps: Set[str] = set()
+
+
+class ChainB(MockModule):
+    name = 'chainB'
+    deps = {'chainA'}
+
+
+class ChainC(MockModule):
+    name = 'chainC'
+    deps = {'chainB'}
+
+
+class SimulateBuildTest(unittest.TestCase):
+    def test_single_worker(self) -> None:
+        """Test that a single worker always takes the sum of all costs."""
+        modules = [ComplexA(), ComplexB(), ComplexC(), ComplexD()]
+        costs = {'complexA': 1, 'complexB': 2, 'complexC': 3, 'complexD': 4}
+        self.assertEqual(10, simulate_build(modules, 1, costs))
+
+    def test_critical_path_priority(self) -> None:
+        """Test that critical path priority shortens the build."""
+        modules = [BulkA(), BulkB(), ChainA(), ChainB(), ChainC()]
+        costs = {'bulkA': 2, 'bulkB': 2}
+        weights = DependencyManager(modules, costs).critical_path_weights
+
+        self.assertEqual(5, simulate_build(modules, 2, costs))
+        self.assertEqual(
+            4,
+            simulate_build(modules, 2, costs,
+                           lambda m: weights[m.name]))
+
+
+# simpleB's build only needs simpleA's build outputs.
+class BuildOutputB(MockModule):
+    name = 'simpleB'
+    deps = {'simpleA'}
+    build_output_deps = {'simpleA'}
+
+
+# simpleB's build does not need simpleA at all.
+class InstallOnlyB(MockModule):
+    name = 'simpleB'
+    deps = {'simpleA'}
+    install_only_deps = {'simpleA'}
+
+
+class StepDependencyManagerTest(unittest.TestCase):
+    def test_installed_dep(self) -> None:
+        """Test that builds wait for dependencies to be installed."""
+        a = SimpleA()
+        b = SimpleB()
+        deps = StepDependencyManager([a, b])
+        self.assertSetEqual({Step(a, Phase.BUILD)}, deps.get_buildable())
+        deps.complete(Step(a, Phase.BUILD))
+        self.assertSetEqual({Step(a, Phase.INSTALL)}, deps.get_buildable())
+        deps.complete(Step(a, Phase.INSTALL))
+        self.assertSetEqual({Step(b, Phase.BUILD)}, deps.get_buildable())
+        deps.complete(Step(b, Phase.BUILD))
+        self.assertSetEqual({Step(b, Phase.INSTALL)}, deps.get_buildable())
+        deps.complete(Step(b, Phase.INSTALL))
+        self.assertSetEqual(set(), deps.get_buildable())
+        self.assertDictEqual({}, deps.blocked_steps)
+
+    def test_build_output_dep(self) -> None:
+        """Test that a build can start before its dependency is installed."""
+        a = SimpleA()
+        b = BuildOutputB()
+        deps = StepDependencyManager([a, b])
+        self.assertSetEqual({Step(a, Phase.BUILD)}, deps.get_buildable())
+        deps.complete(Step(a, Phase.BUILD))
+        self.assertSetEqual({Step(a, Phase.INSTALL),
+                             Step(b, Phase.BUILD)}, deps.get_buildable())
+        deps.complete(Step(b, Phase.BUILD))
+        # The install of b still waits for the install of a.
+        self.assertSetEqual(set(), deps.get_buildable())
+        deps.complete(Step(a, Phase.INSTALL))
+        self.assertSetEqual({Step(b, Phase.INSTALL)}, deps.get_buildable())
+
+    def test_install_only_dep(self) -> None:
+        """Test that a build need not wait for install only dependencies."""
+        a = SimpleA()
+        b = InstallOnlyB()
+        deps = StepDependencyManager([a, b])
+        self.assertSetEqual({Step(a, Phase.BUILD),
+                             Step(b, Phase.BUILD)}, deps.get_buildable())
+        deps.complete(Step(b, Phase.BUILD))
+        deps.complete(Step(a, Phase.BUILD))
+        self.assertSetEqual({Step(a, Phase.INSTALL)}, deps.get_buildable())
+        deps.complete(Step(a, Phase.INSTALL))
+        self.assertSetEqual({Step(b, Phase.INSTALL)}, deps.get_buildable())
+
+    def test_complete_invalid_step_raises(self) -> None:
+        """Test that completing an unknown step raises."""
+        deps = StepDependencyManager([Isolated()])
+        with self.assertRaises(KeyError):
+            deps.complete(Step(Unknown(), Phase.BUILD))
+
+    def test_critical_path_weights(self) -> None:
+        """Test that installs are weighed separately from builds."""
+        a = SimpleA()
+        b = InstallOnlyB()
+        deps = StepDependencyManager([a, b], {'simpleB': 5}, {'simpleA': 10})
+        self.assertDictEqual({
+            Step(a, Phase.BUILD): 12,
+            Step(a, Phase.INSTALL): 11,
+            Step(b, Phase.BUILD): 6,
+            Step(b, Phase.INSTALL): 1,
+        }, deps.critical_path_weights)
+
+
+class NeedsUnknown(MockModule):
+    name = 'needsUnknown'
+    deps = {'complexA', 'missing'}
+
+
+class DependencyIndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.a = ComplexA()
+        self.b = ComplexB()
+        self.c = ComplexC()
+        self.d = ComplexD()
+        self.index = DependencyIndex([self.d, self.c, self.b, self.a])
+
+    def test_cyclic_dependency_message(self) -> None:
+        """Test that a cycle raises the proper exception."""
+        pattern = '^Detected cyclic dependency: cycleA -> cycleB -> cycleA$'
+        with self.assertRaisesRegex(CyclicDependencyError, pattern):
+            DependencyIndex([CycleA(), CycleB(), Isolated()])
+
+    def test_topological_order(self) -> None:
+        """Test that modules are ordered after their dependencies."""
+        self.assertListEqual([self.a, self.b, self.c, self.d],
+                             self.index.topological_order)
+
+    def test_queries(self) -> None:
+        """Test transitive dependency queries."""
+        self.assertSetEqual(set(), self.index.dependencies('complexA'))
+        self.assertSetEqual({self.a, self.b},
+                            self.index.dependencies('complexD'))
+        self.assertSetEqual({self.a},
+                            self.index.dependencies('complexB', 'complexC'))
+        self.assertSetEqual({self.b, self.c, self.d},
+                            self.index.dependents('complexA'))
+        self.assertSetEqual({self.d}, self.index.dependents('complexB'))
+        self.assertSetEqual({self.a, self.c},
+                            self.index.closure(['complexC']))
+        with self.assertRaises(KeyError):
+            self.index.dependencies('unknown')
+
+    def test_unknown_deps(self) -> None:
+        """Test that unknown deps are reported transitively."""
+        a = ComplexA()
+        needs_unknown = NeedsUnknown()
+        b = SimpleB()
+        b.deps = {'needsUnknown'}
+        index = DependencyIndex([a, needs_unknown, b])
+        self.assertSetEqual({'missing'}, index.unknown_deps('simpleB'))
+        self.assertSetEqual(set(), index.unknown_deps('complexA'))
+        self.assertSetEqual({a, needs_unknown}, index.dependencies('simpleB'))
+
+
+class ScheduleStepsTest(unittest.TestCase):
+    def test_schedule(self) -> None:
+        """Test that steps are placed after their deps on free workers."""
+        a = ComplexA()
+        b = ComplexB()
+        c = ComplexC()
+        deps = StepDependencyManager([a, b, c], {'complexA': 4, 'complexB': 2})
+        step_deps = deps.step_deps
+        schedule = schedule_steps(deps, 2, set())
+        timeline = {(s.step.module.name, s.step.phase): (s.start, s.end)
+                    for s in schedule}
+        self.assertDictEqual({
+            ('complexA', Phase.BUILD): (0, 4),
+            ('complexA', Phase.INSTALL): (4, 5),
+            ('complexB', Phase.BUILD): (5, 7),
+            ('complexC', Phase.BUILD): (5, 6),
+            ('complexC', Phase.INSTALL): (6, 7),
+            ('complexB', Phase.INSTALL): (7, 8),
+        }, timeline)
+        self.assertListEqual([
+            Step(a, Phase.BUILD),
+            Step(a, Phase.INSTALL),
+            Step(b, Phase.BUILD),
+            Step(b, Phase.INSTALL),
+        ], [s.step for s in find_critical_path(schedule, step_deps)])
+
+    def test_worker_contention(self) -> None:
+        """Test that waiting for a worker is part of the critical path."""
+        a = ComplexA()
+        isolated = Isolated()
+        deps = StepDependencyManager([a, isolated], {'complexA': 4})
+        step_deps = deps.step_deps
+        schedule = schedule_steps(deps, 1, set())
+        # With a single worker every step is on the critical path.
+        self.assertListEqual([
+            Step(a, Phase.BUILD),
+            Step(isolated, Phase.BUILD),
+            Step(a, Phase.INSTALL),
+            Step(isolated, Phase.INSTALL),
+        ], [s.step for s in find_critical_path(schedule, step_deps)])
+
+    def test_skipped(self) -> None:
+        """Test that skipped steps take no time or worker."""
+        a = SimpleA()
+        b = SimpleB()
+        deps = StepDependencyManager([a, b], {'simpleA': 10})
+        skipped = {Step(a, Phase.BUILD), Step(a, Phase.INSTALL)}
+        schedule = schedule_steps(deps, 1, skipped)
+        self.assertListEqual([(None, 0, 0), (None, 0, 0), (0, 0, 1),
+                              (0, 1, 2)],
+                             [(s.worker, s.start, s.end) for s in schedule])
+
+
+class ModuleDepsValidateTest(unittest.TestCase):
+    def test_unknown_dep_kinds(self) -> None:
+        """Test that dep kinds must refer to deps."""
+        class BadModule(Module):
+            name = 'bad'
+            no_notice = True
+            deps = {'a'}
+            install_only_deps = {'b'}
+
+        with self.assertRaises(ModuleValidateError):
+            BadModule()
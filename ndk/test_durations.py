@@ -0,0 +1,111 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.durations."""
+from pathlib import Path
+import tempfile
+import time
+import unittest
+
+from ndk.durations import (
+    COMPACTION_RATIO,
+    DurationDatabase,
+    HISTORY_LENGTH,
+    Measurement,
+    Stopwatch,
+)
+
+
+class StopwatchTest(unittest.TestCase):
+    def test_measurement(self) -> None:
+        """Tests that the stopwatch measures the context."""
+        with Stopwatch('module', 'foo') as stopwatch:
+            time.sleep(0.01)
+        measurement = stopwatch.measurement
+        assert measurement is not None
+        self.assertEqual('module', measurement.kind)
+        self.assertEqual('foo', measurement.name)
+        self.assertGreaterEqual(measurement.wall_time, 0.01)
+        self.assertGreaterEqual(measurement.cpu_time, 0)
+        self.assertGreaterEqual(measurement.peak_rss, 0)
+
+
+class DurationDatabaseTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        """Tests that recorded measurements are loaded by later builds."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'logs/durations.jsonl'
+            database = DurationDatabase.load(path)
+            self.assertDictEqual({}, database.expected_durations('module'))
+            database.record(Measurement('module', 'foo', 2.0, 1.0, 100))
+            database.record(Measurement('module', 'foo', 4.0, 1.0, 100))
+            database.record(Measurement('test', 'bar', 1.0, 1.0, 100))
+
+            loaded = DurationDatabase.load(path)
+            self.assertDictEqual({'foo': 3.0},
+                                 loaded.expected_durations('module'))
+            self.assertEqual(1.0, loaded.expected_duration('test', 'bar'))
+            self.assertIsNone(loaded.expected_duration('test', 'foo'))
+
+    def test_corrupt_lines_ignored(self) -> None:
+        """Tests that a truncated line does not break loading."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'durations.jsonl'
+            DurationDatabase(path).record(
+                Measurement('module', 'foo', 2.0, 1.0, 100))
+            with path.open('a') as database_file:
+                database_file.write('{"kind": "module", "na')
+            with self.assertLogs('ndk.durations', 'WARNING'):
+                loaded = DurationDatabase.load(path)
+            self.assertDictEqual({'foo': 2.0},
+                                 loaded.expected_durations('module'))
+
+    def test_only_recent_history_used(self) -> None:
+        """Tests that old measurements stop affecting the estimate."""
+        database = DurationDatabase()
+        database.add(Measurement('module', 'foo', 100.0, 1.0, 100))
+        for _ in range(HISTORY_LENGTH):
+            database.add(Measurement('module', 'foo', 1.0, 1.0, 100))
+        self.assertEqual(1.0, database.expected_duration('module', 'foo'))
+
+    def test_compaction(self) -> None:
+        """Tests that the file is trimmed to the measurements still used."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'durations.jsonl'
+            database = DurationDatabase(path)
+            database.record_all(
+                Measurement('module', 'foo', float(i), 1.0, 100)
+                for i in range(COMPACTION_RATIO * HISTORY_LENGTH))
+            database.record(Measurement('module', 'bar', 1.0, 1.0, 100))
+            self.assertEqual(COMPACTION_RATIO * HISTORY_LENGTH + 1,
+                             len(path.read_text().splitlines()))
+
+            # Below the threshold, the file is left alone.
+            DurationDatabase.load(path)
+            self.assertEqual(COMPACTION_RATIO * HISTORY_LENGTH + 1,
+                             len(path.read_text().splitlines()))
+
+            database.record_all([
+                Measurement('module', 'foo', 100.0, 1.0, 100),
+                Measurement('module', 'foo', 200.0, 1.0, 100),
+            ])
+            loaded = DurationDatabase.load(path)
+            self.assertEqual(HISTORY_LENGTH + 1,
+                             len(path.read_text().splitlines()))
+            self.assertDictEqual(database.expected_durations('module'),
+                                 loaded.expected_durations('module'))
+            self.assertDictEqual(
+                loaded.expected_durations('module'),
+                DurationDatabase.load(path).expected_durations('module'))
@@ -0,0 +1,177 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.elf."""
+from pathlib import Path
+import struct
+import tempfile
+from typing import List, Tuple
+import unittest
+
+from ndk.elf import (
+    ElfError,
+    ElfFile,
+    ELFCLASS32,
+    ELFCLASS64,
+    ELFDATA2LSB,
+    ELFDATA2MSB,
+    ELF_MAGIC,
+    Note,
+    NT_ANDROID_IDENT,
+    SHT_NOTE,
+)
+
+
+SHT_PROGBITS = 1
+SHT_STRTAB = 3
+
+
+def _pad(data: bytes, alignment: int) -> bytes:
+    return data + b'\0' * (-len(data) % alignment)
+
+
+def make_note(name: str,
+              note_type: int,
+              desc: bytes,
+              byte_order: str = '<',
+              alignment: int = 4) -> bytes:
+    """Returns the encoding of a note."""
+    encoded_name = name.encode('utf-8') + b'\0'
+    header = struct.pack(byte_order + 'III', len(encoded_name), len(desc),
+                         note_type)
+    return header + _pad(encoded_name, alignment) + _pad(desc, alignment)
+
+
+def make_elf(sections: List[Tuple[str, int, bytes, int]],
+             elf_class: int = ELFCLASS64,
+             byte_data: int = ELFDATA2LSB) -> bytes:
+    """Returns a relocatable ELF file containing the given sections.
+
+    Args:
+        sections: The (name, type, contents, alignment) of each section,
+            following the null section. A section name table is appended.
+        elf_class: ELFCLASS32 or ELFCLASS64.
+        byte_data: ELFDATA2LSB or ELFDATA2MSB.
+    """
+    byte_order = '<' if byte_data == ELFDATA2LSB else '>'
+    if elf_class == ELFCLASS32:
+        header_fmt = byte_order + 'HHIIIIIHHHHHH'
+        section_fmt = byte_order + 'IIIIIIIIII'
+    else:
+        header_fmt = byte_order + 'HHIQQQIHHHHHH'
+        section_fmt = byte_order + 'IIQQQQIIQQ'
+    header_size = 16 + struct.calcsize(header_fmt)
+    section_size = struct.calcsize(section_fmt)
+
+    sections = sections + [('.shstrtab', SHT_STRTAB, b'', 1)]
+    names = b'\0'
+    name_offsets = []
+    for name, _, _, _ in sections:
+        name_offsets.append(len(names))
+        names += name.encode('utf-8') + b'\0'
+    sections[-1] = ('.shstrtab', SHT_STRTAB, names, 1)
+
+    body = b''
+    headers = [struct.pack(section_fmt, *[0] * 10)]
+    for name_offset, (_, sh_type, data, align) in zip(name_offsets,
+                                                       sections):
+        body = _pad(body, 8)
+        headers.append(
+            struct.pack(section_fmt, name_offset, sh_type, 0, 0,
+                        header_size + len(body), len(data), 0, 0, align, 0))
+        body += data
+    body = _pad(body, 8)
+
+    ident = _pad(ELF_MAGIC + bytes([elf_class, byte_data, 1]), 16)
+    header = struct.pack(header_fmt, 1, 0, 1, 0, 0, header_size + len(body),
+                         0, header_size, 0, 0, section_size, len(headers),
+                         len(headers) - 1)
+    return ident + header + body + b''.join(headers)
+
+
+def make_android_object(desc: bytes, elf_class: int = ELFCLASS64,
+                        byte_data: int = ELFDATA2LSB) -> bytes:
+    """Returns an object file with an Android ident note, like crtbegin.o."""
+    byte_order = '<' if byte_data == ELFDATA2LSB else '>'
+    note = make_note('Android', NT_ANDROID_IDENT, desc, byte_order)
+    return make_elf([
+        ('.text', SHT_PROGBITS, b'\xc3', 4),
+        ('.note.android.ident', SHT_NOTE, note, 4),
+    ], elf_class, byte_data)
+
+
+class ElfFileTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+
+    def write(self, data: bytes) -> Path:
+        path = self.temp_dir / 'test.o'
+        path.write_bytes(data)
+        return path
+
+    def test_sections(self) -> None:
+        """Tests that sections are read for every class and byte order."""
+        for elf_class in (ELFCLASS32, ELFCLASS64):
+            for byte_data in (ELFDATA2LSB, ELFDATA2MSB):
+                with self.subTest(elf_class=elf_class, byte_data=byte_data):
+                    path = self.write(
+                        make_android_object(b'\x15\0\0\0', elf_class,
+                                            byte_data))
+                    with ElfFile(path) as elf:
+                        self.assertListEqual(
+                            ['', '.text', '.note.android.ident', '.shstrtab'],
+                            [s.name for s in elf.sections])
+                        text = elf.section('.text')
+                        assert text is not None
+                        self.assertEqual(b'\xc3', elf.section_data(text))
+                        self.assertListEqual(
+                            [Note('Android', NT_ANDROID_IDENT, b'\x15\0\0\0')],
+                            list(elf.notes()))
+                        self.assertIsNone(elf.section('.missing'))
+
+    def test_note_alignment(self) -> None:
+        """Tests that notes in 8 byte aligned sections are read."""
+        notes = (make_note('GNU', 5, b'abcde', alignment=8) +
+                 make_note('GNU', 6, b'xyz', alignment=8))
+        path = self.write(
+            make_elf([('.note.gnu.property', SHT_NOTE, notes, 8)]))
+        with ElfFile(path) as elf:
+            self.assertListEqual(
+                [Note('GNU', 5, b'abcde'),
+                 Note('GNU', 6, b'xyz')], list(elf.notes()))
+
+    def test_not_elf(self) -> None:
+        """Tests that files that are not ELF files are rejected."""
+        for data in (b'', b'Android', b'\x7fELF' + b'\0' * 60):
+            with self.subTest(data=data):
+                with self.assertRaises(ElfError):
+                    ElfFile(self.write(data))
+
+    def test_truncated(self) -> None:
+        """Tests that truncated files are rejected."""
+        data = make_android_object(b'\x15\0\0\0')
+        with self.assertRaisesRegex(ElfError, 'truncated'):
+            ElfFile(self.write(data[:-10]))
+
+        # Cuts the note short by claiming a longer descriptor.
+        note = make_note('Android', NT_ANDROID_IDENT, b'\x15\0\0\0')
+        note = note[:4] + struct.pack('<I', 64) + note[8:]
+        path = self.write(
+            make_elf([('.note.android.ident', SHT_NOTE, note, 4)]))
+        with ElfFile(path) as elf:
+            with self.assertRaisesRegex(ElfError, 'truncated'):
+                list(elf.notes())
@@ -0,0 +1,252 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.file."""
+import os
+from pathlib import Path
+import shutil
+import tempfile
+import time
+from typing import Callable
+import unittest
+
+from ndk.file import (
+    copy_file,
+    copy_tree,
+    MIN_FILES_FOR_THREADS,
+    record_install,
+    record_installs,
+    tree_size,
+)
+
+
+RUN_BENCHMARKS = bool(os.environ.get('NDK_RUN_BENCHMARKS'))
+
+
+def make_tree(root: Path, num_files: int, size: int = 16) -> None:
+    """Creates a tree of num_files files spread over a few directories."""
+    for i in range(num_files):
+        path = root / f'dir{i % 8}/sub{i % 3}/file{i}'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(bytes([i % 256]) * size)
+
+
+class CopyTreeTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.src = self.temp_dir / 'src'
+        (self.src / 'bin').mkdir(parents=True)
+        (self.src / 'lib/empty').mkdir(parents=True)
+        (self.src / 'bin/tool').write_text('tool')
+        (self.src / 'bin/tool').chmod(0o755)
+        (self.src / 'bin/alias').symlink_to('tool')
+        (self.src / 'lib/libfoo.a').write_text('foo')
+        (self.src / 'lib64').symlink_to('lib')
+        os.utime(self.src / 'lib/libfoo.a', (1000000000, 1000000000))
+
+    def test_symlinks(self) -> None:
+        """Tests that symlinks are recreated when asked."""
+        dst = self.temp_dir / 'dst'
+        stats = copy_tree(self.src, dst, symlinks=True)
+        self.assertEqual(2, stats.symlinks)
+        self.assertEqual(2, stats.reflinks + stats.copies)
+        self.assertEqual('tool', os.readlink(dst / 'bin/alias'))
+        self.assertEqual('lib', os.readlink(dst / 'lib64'))
+        self.assertTrue((dst / 'lib/empty').is_dir())
+        self.assertEqual('tool', (dst / 'bin/tool').read_text())
+        self.assertTrue(os.access(dst / 'bin/tool', os.X_OK))
+        self.assertFalse(os.access(dst / 'lib/libfoo.a', os.X_OK))
+        self.assertEqual(1000000000, (dst / 'lib/libfoo.a').stat().st_mtime)
+
+    def test_follow_symlinks(self) -> None:
+        """Tests that symlinks are followed by default."""
+        dst = self.temp_dir / 'dst'
+        stats = copy_tree(self.src, dst)
+        self.assertEqual(0, stats.symlinks)
+        self.assertFalse((dst / 'bin/alias').is_symlink())
+        self.assertEqual('tool', (dst / 'bin/alias').read_text())
+        self.assertFalse((dst / 'lib64').is_symlink())
+        self.assertEqual('foo', (dst / 'lib64/libfoo.a').read_text())
+
+    def test_ignore(self) -> None:
+        """Tests that ignored names are not copied."""
+        dst = self.temp_dir / 'dst'
+        copy_tree(self.src, dst, ignore=shutil.ignore_patterns('*.a', 'bin'))
+        self.assertFalse((dst / 'bin').exists())
+        self.assertFalse((dst / 'lib/libfoo.a').exists())
+        self.assertTrue((dst / 'lib/empty').is_dir())
+
+    def test_merge(self) -> None:
+        """Tests that an existing destination is merged into."""
+        dst = self.temp_dir / 'dst'
+        (dst / 'lib').mkdir(parents=True)
+        (dst / 'lib/libfoo.a').write_text('old')
+        (dst / 'other').write_text('other')
+        copy_tree(self.src, dst, symlinks=True)
+        self.assertEqual('foo', (dst / 'lib/libfoo.a').read_text())
+        self.assertEqual('other', (dst / 'other').read_text())
+
+    def test_threads(self) -> None:
+        """Tests that large trees are copied completely by many threads."""
+        src = self.temp_dir / 'big'
+        num_files = 4 * MIN_FILES_FOR_THREADS
+        make_tree(src, num_files)
+        dst = self.temp_dir / 'dst'
+        stats = copy_tree(src, dst, num_threads=4)
+        self.assertEqual(num_files, stats.reflinks + stats.copies)
+        self.assertEqual(num_files * 16, stats.size)
+        for path in src.glob('*/*/*'):
+            self.assertEqual(path.read_bytes(),
+                             (dst / path.relative_to(src)).read_bytes())
+
+    def test_hardlinks(self) -> None:
+        """Tests that files are only shared with the source when allowed."""
+        dst = self.temp_dir / 'dst'
+        stats = copy_tree(self.src, dst, allow_hardlinks=True)
+        # Reflinks are preferred where the filesystem supports them.
+        self.assertEqual(4, stats.hardlinks + stats.reflinks)
+        if stats.hardlinks:
+            self.assertTrue((dst / 'bin/tool').samefile(self.src / 'bin/tool'))
+
+        copied = self.temp_dir / 'copied'
+        copy_tree(self.src, copied)
+        self.assertFalse(
+            (copied / 'bin/tool').samefile(self.src / 'bin/tool'))
+
+
+class CopyFileTest(unittest.TestCase):
+    def test_replaces_hardlink(self) -> None:
+        """Tests that copying over a hardlink does not modify its target."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src = Path(temp_dir) / 'src'
+            src.write_text('new')
+            other = Path(temp_dir) / 'other'
+            other.write_text('old')
+            dst = Path(temp_dir) / 'dst'
+            os.link(other, dst)
+            copy_file(src, dst, allow_hardlink=False)
+            self.assertEqual('new', dst.read_text())
+            self.assertEqual('old', other.read_text())
+
+    def test_large_file(self) -> None:
+        """Tests that files larger than a single kernel copy are copied."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src = Path(temp_dir) / 'src'
+            src.write_bytes(os.urandom(3 * 1024 * 1024 + 7))
+            dst = Path(temp_dir) / 'dst'
+            self.assertIn(copy_file(src, dst), ('reflink', 'copy'))
+            self.assertEqual(src.read_bytes(), dst.read_bytes())
+
+
+class RecordInstallsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+
+    def test_copies(self) -> None:
+        """Tests that copied files and symlinks are recorded."""
+        src = self.temp_dir / 'src'
+        make_tree(src, 4 * MIN_FILES_FOR_THREADS)
+        (src / 'alias').symlink_to('dir0')
+        dst = self.temp_dir / 'dst'
+        with record_installs() as record:
+            copy_tree(src, dst, symlinks=True)
+            copy_file(src / 'dir0/sub0/file0', dst)
+        self.assertEqual(4 * MIN_FILES_FOR_THREADS + 2, len(record.files))
+        self.assertEqual(4 * MIN_FILES_FOR_THREADS * 16 + 16 + len('dir0'),
+                         record.size)
+        self.assertIn(dst / 'file0', record.files)
+
+    def test_later_changes(self) -> None:
+        """Tests that the record reflects the install when it finished."""
+        dst = self.temp_dir / 'dst'
+        with record_installs() as record:
+            dst.mkdir()
+            (dst / 'removed').write_text('removed')
+            record_install(dst / 'removed')
+            (dst / 'appended').write_text('a')
+            record_install(dst / 'appended')
+            (dst / 'removed').unlink()
+            with (dst / 'appended').open('a') as appended:
+                appended.write('bc')
+            # Files written without being recorded are not counted.
+            (dst / 'unrecorded').write_text('unrecorded')
+        self.assertDictEqual({dst / 'appended': 3}, record.files)
+
+    def test_not_recording(self) -> None:
+        """Tests that copies are not recorded outside of an install."""
+        src = self.temp_dir / 'src'
+        src.write_text('src')
+        with record_installs() as record:
+            pass
+        copy_file(src, self.temp_dir / 'dst')
+        self.assertDictEqual({}, record.files)
+
+
+class TreeSizeTest(unittest.TestCase):
+    def test_tree_size(self) -> None:
+        """Tests that a tree's files are counted once, without following."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir) / 'root'
+            make_tree(root, 10)
+            (root / 'link').symlink_to('dir0')
+            self.assertEqual(10 * 16 + len('dir0'), tree_size(root))
+            self.assertEqual(16, tree_size(root / 'dir0/sub0/file0'))
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, 'set NDK_RUN_BENCHMARKS=1 to run')
+class CopyTreeBenchmark(unittest.TestCase):
+    """Compares copy_tree with the shutil.copytree it replaced in installs.
+
+    The tree resembles a toolchain prebuilt: thousands of mostly small files.
+    Set TMPDIR to measure a particular filesystem.
+    """
+
+    NUM_FILES = 5000
+    FILE_SIZE = 64 * 1024
+
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.src = self.temp_dir / 'src'
+        make_tree(self.src, self.NUM_FILES, self.FILE_SIZE)
+
+    def measure(self, name: str, copy: Callable[[Path], object]) -> None:
+        """Prints the time taken by a copy of the tree."""
+        dst = self.temp_dir / name
+        # Keeps writeback of earlier copies from being measured.
+        os.sync()
+        start = time.monotonic()
+        result = copy(dst)
+        elapsed = time.monotonic() - start
+        size_mb = self.NUM_FILES * self.FILE_SIZE / 1024**2
+        print(f'{name}: {self.NUM_FILES} files, {size_mb:.0f} MiB in '
+              f'{elapsed * 1000:.1f} ms {result or ""}')
+
+    def test_copy_tree(self) -> None:
+        """Measures each way of installing the tree."""
+        print()
+        self.measure('shutil.copytree',
+                     lambda dst: shutil.copytree(self.src, dst) and None)
+        self.measure('copy_tree 1 thread',
+                     lambda dst: copy_tree(self.src, dst, num_threads=1))
+        self.measure('copy_tree', lambda dst: copy_tree(self.src, dst))
+        self.measure(
+            'copy_tree hardlinks',
+            lambda dst: copy_tree(self.src, dst, allow_hardlinks=True))
@@ -0,0 +1,268 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.fingerprint."""
+import os
+from pathlib import Path
+import tempfile
+from typing import Iterable, List, Optional
+import unittest
+
+from ndk.builds import BuildContext, Module
+from ndk.fingerprint import (
+    DigestCache,
+    hash_inputs,
+    hash_module_inputs,
+    hash_roots,
+    ModuleStamps,
+    Stamp,
+    stamp_path,
+)
+from ndk.hosts import Host
+
+
+class FakeModule(Module):
+    no_notice = True
+
+    def __init__(self, name: str, path: str, deps: Iterable[str],
+                 inputs: Optional[List[Path]]) -> None:
+        self.name = name
+        self.path = Path(path)
+        self.deps = set(deps)
+        self.inputs = inputs
+        super().__init__()
+
+    @property
+    def fingerprint_inputs(self) -> Optional[List[Path]]:
+        return self.inputs
+
+    def build(self) -> None:
+        pass
+
+    def install(self) -> None:
+        self.get_install_path().mkdir(parents=True, exist_ok=True)
+
+
+class HashInputsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.src = Path(temp_dir.name) / 'src'
+        (self.src / 'include').mkdir(parents=True)
+        (self.src / 'include/foo.h').write_text('int foo();\n')
+        (self.src / 'foo.c').write_text('int foo() { return 0; }\n')
+
+    def hash(self) -> str:
+        return hash_inputs([self.src], DigestCache())
+
+    def test_contents(self) -> None:
+        """Tests that changing a file changes the hash."""
+        before = self.hash()
+        self.assertEqual(before, self.hash())
+        (self.src / 'include/foo.h').write_text('int foo(void);\n')
+        self.assertNotEqual(before, self.hash())
+
+    def test_tree(self) -> None:
+        """Tests that names, modes and symlinks are part of the hash."""
+        before = self.hash()
+        (self.src / 'foo.c').rename(self.src / 'bar.c')
+        renamed = self.hash()
+        self.assertNotEqual(before, renamed)
+        (self.src / 'bar.c').chmod(0o755)
+        executable = self.hash()
+        self.assertNotEqual(renamed, executable)
+        (self.src / 'baz.c').symlink_to('bar.c')
+        self.assertNotEqual(executable, self.hash())
+
+    def test_ignored_files(self) -> None:
+        """Tests that python intermediates do not affect the hash."""
+        before = self.hash()
+        (self.src / '__pycache__').mkdir()
+        (self.src / '__pycache__/foo.pyc').write_text('')
+        (self.src / '.git').mkdir()
+        self.assertEqual(before, self.hash())
+
+    def test_missing_input(self) -> None:
+        """Tests that a missing input is distinguished from an empty one."""
+        missing = self.src / 'missing'
+        empty = self.src / 'empty'
+        empty.mkdir()
+        self.assertNotEqual(hash_inputs([missing], DigestCache()),
+                            hash_inputs([empty], DigestCache()))
+
+    def test_cache(self) -> None:
+        """Tests that unchanged files are not read again."""
+        cache = DigestCache()
+        before = hash_inputs([self.src], cache)
+        self.assertEqual(2, cache.files_hashed)
+
+        cache = DigestCache(cache.entries)
+        self.assertEqual(before, hash_inputs([self.src], cache))
+        self.assertEqual(0, cache.files_hashed)
+
+        foo_c = self.src / 'foo.c'
+        foo_c.write_text('int foo() { return 1; }\n')
+        mtime_ns = foo_c.stat().st_mtime_ns + 1_000_000_000
+        os.utime(foo_c, ns=(mtime_ns, mtime_ns))
+        cache = DigestCache(cache.entries)
+        self.assertNotEqual(before, hash_inputs([self.src], cache))
+        self.assertEqual(1, cache.files_hashed)
+
+
+    def test_hash_roots(self) -> None:
+        """Tests that inputs hash the same on any number of threads."""
+        other = self.src.parent / 'other'
+        other.mkdir()
+        (other / 'bar.c').write_text('int bar();\n')
+        roots = [self.src, other, self.src]
+        serial = hash_roots(roots, {})
+        self.assertListEqual(sorted([self.src, other]), sorted(serial))
+        self.assertDictEqual(serial, hash_roots(roots, {}, num_threads=4))
+        self.assertEqual(hash_inputs([other], DigestCache()), serial[other][0])
+
+
+class StampTest(unittest.TestCase):
+    def test_round_trip(self) -> None:
+        """Tests that a saved stamp can be loaded."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'stamps/foo.json'
+            Stamp('abc', {'foo.c': (1, 2, 'def')}).save(path)
+            stamp = Stamp.load(path)
+            assert stamp is not None
+            self.assertEqual('abc', stamp.fingerprint)
+            self.assertDictEqual({'foo.c': (1, 2, 'def')}, stamp.digests)
+
+    def test_missing_or_corrupt(self) -> None:
+        """Tests that unusable stamps are treated as missing."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'foo.json'
+            self.assertIsNone(Stamp.load(path))
+            path.write_text('{"fingerprint": "ab')
+            with self.assertLogs('ndk.fingerprint', 'WARNING'):
+                self.assertIsNone(Stamp.load(path))
+
+
+class ModuleStampsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.src_a = self.temp_dir / 'src/a'
+        self.src_c = self.temp_dir / 'src/c'
+        for src in (self.src_a, self.src_c):
+            src.mkdir(parents=True)
+            (src / 'main.c').write_text('int main() {}\n')
+
+    def make_modules(self, *modules: FakeModule) -> List[FakeModule]:
+        context = BuildContext(self.temp_dir / 'out', self.temp_dir / 'dist',
+                               list(modules), Host.current(), '0')
+        for module in modules:
+            module.context = context
+        return list(modules)
+
+    @staticmethod
+    def build(modules: List[FakeModule]) -> None:
+        stamps = ModuleStamps(modules)
+        for module in modules:
+            stamps.invalidate(module)
+            module.install()
+            stamps.record(module)
+
+    @staticmethod
+    def up_to_date(modules: List[FakeModule]) -> List[str]:
+        return sorted(m.name for m in ModuleStamps(modules).up_to_date())
+
+    def test_unchanged(self) -> None:
+        """Tests that nothing is rebuilt if nothing changed."""
+        modules = self.make_modules(
+            FakeModule('a', 'a', [], [self.src_a]),
+            FakeModule('b', 'b', ['a'], []),
+        )
+        self.assertListEqual([], self.up_to_date(modules))
+        self.build(modules)
+        self.assertListEqual(['a', 'b'], self.up_to_date(modules))
+
+    def test_changes_propagate_to_dependents(self) -> None:
+        """Tests that modules depending on a changed module are rebuilt."""
+        modules = self.make_modules(
+            FakeModule('a', 'a', [], [self.src_a]),
+            FakeModule('b', 'b', ['a'], []),
+            FakeModule('c', 'c', [], [self.src_c]),
+        )
+        self.build(modules)
+        (self.src_a / 'main.c').write_text('int main() { return 1; }\n')
+        self.assertListEqual(['c'], self.up_to_date(modules))
+
+    def test_unknown_inputs(self) -> None:
+        """Tests that modules without declared inputs are always rebuilt."""
+        modules = self.make_modules(
+            FakeModule('a', 'a', [], None),
+            FakeModule('b', 'b', ['a'], []),
+            FakeModule('c', 'c', [], [self.src_c]),
+        )
+        self.build(modules)
+        self.assertListEqual(['c'], self.up_to_date(modules))
+
+    def test_shared_install_path(self) -> None:
+        """Tests that modules overwritten by a rebuilt module are rebuilt."""
+        modules = self.make_modules(
+            FakeModule('a', 'prebuilt', [], [self.src_a]),
+            FakeModule('b', 'prebuilt', [], []),
+            FakeModule('c', 'prebuilt/bin', [], [self.src_c]),
+        )
+        self.build(modules)
+        (self.src_c / 'main.c').write_text('int main() { return 1; }\n')
+        self.assertListEqual(['a', 'b'], self.up_to_date(modules))
+        (self.src_a / 'main.c').write_text('int main() { return 1; }\n')
+        self.assertListEqual([], self.up_to_date(modules))
+
+    def test_missing_install(self) -> None:
+        """Tests that a module is rebuilt if its install was removed."""
+        modules = self.make_modules(FakeModule('a', 'a', [], [self.src_a]))
+        self.build(modules)
+        modules[0].get_install_path().rmdir()
+        self.assertListEqual([], self.up_to_date(modules))
+
+    def test_invalidate(self) -> None:
+        """Tests that an interrupted rebuild does not leave a stamp."""
+        modules = self.make_modules(FakeModule('a', 'a', [], [self.src_a]))
+        self.build(modules)
+        self.assertTrue(stamp_path(modules[0]).exists())
+        ModuleStamps(modules).invalidate(modules[0])
+        self.assertFalse(stamp_path(modules[0]).exists())
+        self.assertListEqual([], self.up_to_date(modules))
+
+    def test_deferred(self) -> None:
+        """Tests that inputs hashed by the workers give the same stamps."""
+        modules = self.make_modules(
+            FakeModule('a', 'a', [], [self.src_a]),
+            FakeModule('b', 'b', ['a'], []),
+        )
+        eager = ModuleStamps(modules)
+        stamps = ModuleStamps(modules, eager=False)
+        self.assertDictEqual({}, stamps.inputs)
+        self.assertIsNone(stamps.fingerprint(modules[1]))
+        self.assertSetEqual(set(), stamps.up_to_date())
+        for module in modules:
+            inputs = hash_module_inputs(module,
+                                        stamps.known_digests_for(module))
+            assert inputs is not None
+            stamps.add_inputs(module, inputs)
+            module.install()
+            stamps.record(module)
+        for module in modules:
+            self.assertEqual(eager.fingerprint(module),
+                             stamps.fingerprint(module))
+        self.assertListEqual(['a', 'b'], self.up_to_date(modules))
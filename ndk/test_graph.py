@@ -14,12 +14,31 @@
 # limitations under the License.
 #
 """Test for ndk.graph."""
+import os
+import random
+import time
 from typing import cast, List, Optional
 import unittest
 
 import ndk.graph
 
 
+# Set NDK_RUN_BENCHMARKS=1 to run the (slow) graph benchmarks. Run pytest with
+# -s to see the results.
+RUN_BENCHMARKS = bool(os.environ.get('NDK_RUN_BENCHMARKS'))
+
+
+def make_chain(length: int) -> List[ndk.graph.Node]:
+    """Returns nodes forming a path of the given length.
+
+    Node names are zero padded so the nodes sort in path order.
+    """
+    nodes = [ndk.graph.Node(f'{i:08d}', []) for i in range(length)]
+    for i in range(length - 1):
+        nodes[i].outs.append(nodes[i + 1])
+    return nodes
+
+
 def cycle_test(paths: List[str]) -> Optional[List[str]]:
     """Forms a graph from the given paths and returns the found cycle, if any.
 
@@ -78,3 +97,44 @@ class GraphTest(unittest.TestCase):
     def test_no_cycle(self) -> None:
         """Test that None is returned when there is no cycle."""
         self.assertIsNone(cycle_test(['ABCD', 'CEF']))
+
+    def test_deep_graph(self) -> None:
+        """Test that deep graphs do not exhaust the stack."""
+        nodes = make_chain(100000)
+        self.assertIsNone(ndk.graph.Graph(nodes).find_cycle())
+        nodes[-1].outs.append(nodes[-3])
+        cycle = ndk.graph.Graph(nodes).find_cycle()
+        self.assertIsNotNone(cycle)
+        self.assertListEqual(nodes[-3:] + nodes[-3:-2],
+                             cast(List[ndk.graph.Node], cycle))
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, 'set NDK_RUN_BENCHMARKS=1 to run')
+class GraphBenchmark(unittest.TestCase):
+    """Cycle detection benchmarks on synthetic module graphs."""
+
+    NUM_NODES = 100000
+
+    def measure(self, name: str, nodes: List[ndk.graph.Node]) -> None:
+        """Prints the time taken to prove a graph acyclic."""
+        start = time.monotonic()
+        self.assertIsNone(ndk.graph.Graph(nodes).find_cycle())
+        elapsed = time.monotonic() - start
+        num_edges = sum(len(n.outs) for n in nodes)
+        print(f'{name}: {len(nodes)} nodes, {num_edges} edges in '
+              f'{elapsed * 1000:.1f} ms')
+
+    def test_chain(self) -> None:
+        """Measures a single path through every node."""
+        print()
+        self.measure('Chain', make_chain(self.NUM_NODES))
+
+    def test_random_dag(self) -> None:
+        """Measures a random DAG in which each node has a few deps."""
+        rng = random.Random(0)
+        nodes = make_chain(self.NUM_NODES)
+        for i, node in enumerate(nodes[:-1]):
+            for _ in range(4):
+                node.outs.append(nodes[rng.randrange(i + 1, len(nodes))])
+        print()
+        self.measure('Random DAG', nodes)
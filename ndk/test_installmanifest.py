@@ -0,0 +1,168 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.installmanifest."""
+import hashlib
+import json
+from pathlib import Path
+import tempfile
+import unittest
+
+from ndk.file import record_install, record_installs
+from ndk.installmanifest import (
+    check_budgets,
+    format_size_report,
+    InstalledFile,
+    InstallManifest,
+    load_budgets,
+    load_manifests,
+    SizeBudget,
+)
+
+
+def make_manifest(module: str, sizes: dict) -> InstallManifest:
+    return InstallManifest(module, [
+        InstalledFile(path, size, hashlib.sha256(path.encode()).hexdigest())
+        for path, size in sorted(sizes.items())
+    ])
+
+
+class InstallManifestTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+
+    def test_from_record(self) -> None:
+        """Tests that installed files and symlinks are hashed."""
+        root = self.temp_dir / 'ndk'
+        (root / 'lib').mkdir(parents=True)
+        outside = self.temp_dir / 'out/foo.o'
+        outside.parent.mkdir()
+        with record_installs() as record:
+            (root / 'lib/libfoo.a').write_bytes(b'foo')
+            record_install(root / 'lib/libfoo.a')
+            (root / 'lib/libbar.a').symlink_to('libfoo.a')
+            record_install(root / 'lib/libbar.a')
+            outside.write_bytes(b'o')
+            record_install(outside)
+        manifest = InstallManifest.from_record('foo', record, root)
+        self.assertEqual('foo', manifest.module)
+        self.assertListEqual([
+            InstalledFile('../out/foo.o', 1,
+                          hashlib.sha256(b'o').hexdigest()),
+            InstalledFile('lib/libbar.a', len('libfoo.a'),
+                          hashlib.sha256(b'libfoo.a').hexdigest()),
+            InstalledFile('lib/libfoo.a', 3,
+                          hashlib.sha256(b'foo').hexdigest()),
+        ], manifest.files)
+        self.assertEqual(1 + len('libfoo.a') + 3, manifest.size)
+
+    def test_save_load(self) -> None:
+        """Tests that a saved manifest loads unchanged."""
+        manifest = make_manifest('foo', {'a': 1, 'b/c': 2})
+        path = self.temp_dir / 'foo/install_manifest.json'
+        manifest.save(path)
+        self.assertEqual(manifest, InstallManifest.load(path))
+        self.assertListEqual(
+            [manifest],
+            load_manifests({
+                'foo': path,
+                'bar': self.temp_dir / 'bar/install_manifest.json',
+            }))
+
+    def test_largest(self) -> None:
+        """Tests that the largest files and directories are found."""
+        manifest = make_manifest('foo', {
+            'bin/a': 5,
+            'bin/b': 5,
+            'lib/c': 8,
+            'lib/sub/d': 1,
+            'e': 2,
+        })
+        self.assertListEqual(['lib/c', 'bin/a'],
+                             [f.path for f in manifest.largest_files(2)])
+        self.assertListEqual([('bin', 10), ('lib', 8), ('.', 2)],
+                             manifest.largest_directories(3))
+
+    def test_report(self) -> None:
+        """Tests that the report lists the largest module first."""
+        report = format_size_report([
+            make_manifest('small', {'a': 1}),
+            make_manifest('large', {'bin/b': 3 * 2**20, 'bin/c': 2**20}),
+            make_manifest('empty', {}),
+        ], top=1)
+        self.assertEqual(
+            'large: 4.0 MiB in 2 files\n'
+            '  Largest directories:\n'
+            '         4.0 MiB  bin\n'
+            '  Largest files:\n'
+            '         3.0 MiB  bin/b\n'
+            'small: 0.0 MiB in 1 files\n'
+            '  Largest directories:\n'
+            '         0.0 MiB  .\n'
+            '  Largest files:\n'
+            '         0.0 MiB  a\n'
+            'empty: 0.0 MiB in 0 files\n', report)
+
+
+class BudgetTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.path = Path(temp_dir.name) / 'budgets.json'
+
+    def load(self, data: object) -> dict:
+        self.path.write_text(json.dumps(data))
+        return load_budgets(self.path, ['foo', 'bar'])
+
+    def test_load(self) -> None:
+        """Tests that budgets are loaded for known modules."""
+        self.assertDictEqual(
+            {
+                'foo': SizeBudget(max_size_mib=1.5),
+                'bar': SizeBudget(max_files=10),
+            }, self.load({
+                'foo': {'max_size_mib': 1.5},
+                'bar': {'max_files': 10},
+            }))
+
+    def test_load_errors(self) -> None:
+        """Tests that mistakes in the budget file are reported."""
+        with self.assertRaisesRegex(ValueError, 'unknown module baz'):
+            self.load({'baz': {'max_files': 1}})
+        with self.assertRaisesRegex(ValueError, 'bad budget for foo'):
+            self.load({'foo': {'max_size': 1}})
+        with self.assertRaisesRegex(ValueError, 'expected an object'):
+            self.load([])
+        self.path.write_text('{')
+        with self.assertRaises(ValueError):
+            load_budgets(self.path, ['foo'])
+
+    def test_check(self) -> None:
+        """Tests that only modules over their budgets are reported."""
+        manifests = [
+            make_manifest('foo', {'a': 2 * 2**20, 'b': 1}),
+            make_manifest('bar', {'a': 1}),
+            make_manifest('baz', {'a': 100 * 2**20}),
+        ]
+        budgets = {
+            'foo': SizeBudget(max_size_mib=2, max_files=1),
+            'bar': SizeBudget(max_size_mib=1, max_files=1),
+        }
+        self.assertListEqual([
+            'foo is 2.0 MiB, over its budget of 2 MiB',
+            'foo has 2 files, over its budget of 1 files',
+        ], check_budgets(manifests, budgets))
@@ -0,0 +1,122 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Tests for ndk.trace."""
+import json
+import multiprocessing
+import os
+from pathlib import Path
+import tempfile
+import unittest
+
+import ndk.trace
+from ndk.trace import Span, write_trace
+
+
+def record_span(name: str) -> None:
+    with ndk.trace.span(name, 'test'):
+        pass
+
+
+class WriteTraceTest(unittest.TestCase):
+    def test_write_trace(self) -> None:
+        """Tests that spans are written as complete events."""
+        spans = [
+            Span('libc++', 'build', 1.5, 2.25, 0, 2, color='bad'),
+            Span('clang', 'install', 0.5, 1, 0, 1, args={'worker': 1}),
+        ]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / 'logs/trace.json'
+            write_trace(path, spans, {0: 'Build'}, {(0, 1): 'Worker 1'})
+            events = json.loads(path.read_text())['traceEvents']
+
+        metadata = [e for e in events if e['ph'] == 'M']
+        self.assertListEqual(
+            ['process_name', 'thread_name', 'thread_sort_index'],
+            [e['name'] for e in metadata])
+        self.assertListEqual([{
+            'name': 'clang',
+            'cat': 'install',
+            'ph': 'X',
+            'ts': 500000,
+            'dur': 1000000,
+            'pid': 0,
+            'tid': 1,
+            'args': {
+                'worker': 1
+            },
+        }, {
+            'name': 'libc++',
+            'cat': 'build',
+            'ph': 'X',
+            'ts': 1500000,
+            'dur': 2250000,
+            'pid': 0,
+            'tid': 2,
+            'cname': 'bad',
+        }], [e for e in events if e['ph'] == 'X'])
+
+
+class RecordTest(unittest.TestCase):
+    def setUp(self) -> None:
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        self.addCleanup(ndk.trace.stop_recording)
+
+    def test_not_recording(self) -> None:
+        """Tests that spans are dropped unless recording."""
+        record_span('dropped')
+        ndk.trace.start_recording(self.temp_dir / 'spans')
+        ndk.trace.stop_recording()
+        record_span('dropped')
+        self.assertListEqual(
+            [], ndk.trace.load_recorded_spans(self.temp_dir / 'spans'))
+
+    def test_worker_processes(self) -> None:
+        """Tests that spans of worker processes are merged into the trace."""
+        span_dir = self.temp_dir / 'spans'
+        ndk.trace.start_recording(span_dir)
+        with ndk.trace.span('outer', 'phase', modules=2):
+            process = multiprocessing.Process(target=record_span,
+                                              args=('worker', ))
+            process.start()
+            process.join()
+            record_span('inner')
+        ndk.trace.stop_recording()
+        # Corrupt lines from killed workers are ignored.
+        with (span_dir / '1.jsonl').open('w') as span_file:
+            span_file.write('{"name": "cut short", "categ')
+        trace_path = self.temp_dir / 'trace.json'
+        with self.assertLogs('ndk.trace', 'WARNING'):
+            ndk.trace.write_recorded_trace(span_dir, trace_path,
+                                           {os.getpid(): 'main'})
+
+        events = json.loads(trace_path.read_text())['traceEvents']
+        spans = {e['name']: e for e in events if e['ph'] == 'X'}
+        self.assertSetEqual({'outer', 'inner', 'worker'}, set(spans))
+        self.assertEqual(0, spans['outer']['ts'])
+        self.assertDictEqual({'modules': 2}, spans['outer']['args'])
+        self.assertEqual(os.getpid(), spans['inner']['pid'])
+        self.assertEqual(process.pid, spans['worker']['pid'])
+        self.assertGreaterEqual(spans['outer']['dur'], spans['inner']['dur'])
+        names = {
+            e['pid']: e['args']['name']
+            for e in events if e['name'] == 'process_name'
+        }
+        self.assertDictEqual({
+            os.getpid(): 'main',
+            process.pid: f'Worker {process.pid}'
+        }, names)
@@ -0,0 +1,291 @@
+#
+# Copyright (C) 2020 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""Records and writes timelines in the Chrome trace event format.
+
+The traces can be viewed with chrome://tracing or https://ui.perfetto.dev.
+Only complete ('X') events and the metadata naming processes and tracks are
+used.
+
+Spans of real work are recorded with span() once start_recording() has been
+called. Each process appends the spans it records to its own file in the
+trace directory, so worker processes need no coordination. The directory is
+passed to workers through the environment, which they inherit however they
+are started. write_recorded_trace() merges the files into a single trace.
+"""
+import contextlib
+from dataclasses import dataclass, field
+import json
+import logging
+import os
+from pathlib import Path
+import shutil
+import threading
+import time
+from typing import (Any, Dict, Iterable, Iterator, List, Mapping, Optional,
+                    TextIO, Tuple)
+
+
+# Environment variable naming the directory spans are recorded to.
+TRACE_DIR_ENV = 'NDK_TRACE_DIR'
+
+
+def logger() -> logging.Logger:
+    """Returns the module logger."""
+    return logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Span:
+    """A named interval on one track of a timeline.
+
+    Attributes:
+        name: Name of the span, e.g. the module built.
+        category: Kind of work, e.g. 'build' or 'test'.
+        start: Start time in seconds.
+        duration: Duration in seconds.
+        pid: Process the span belongs to.
+        tid: Thread (track) of the process the span is drawn on.
+        args: Extra details shown when the span is selected.
+        color: Reserved color name of the trace viewer, e.g. 'bad', or None
+            for the default.
+    """
+    name: str
+    category: str
+    start: float
+    duration: float
+    pid: int
+    tid: int
+    args: Dict[str, Any] = field(default_factory=dict)
+    color: Optional[str] = None
+
+
+def _micros(seconds: float) -> float:
+    return round(seconds * 1e6, 3)
+
+
+def trace_events(
+        spans: Iterable[Span],
+        process_names: Optional[Mapping[int, str]] = None,
+        thread_names: Optional[Mapping[Tuple[int, int], str]] = None
+) -> List[Dict[str, Any]]:
+    """Converts spans to trace events.
+
+    Args:
+        spans: Spans to convert.
+        process_names: Display names of processes, keyed by pid.
+        thread_names: Display names of tracks, keyed by (pid, tid).
+
+    Returns:
+        A list of trace events, sorted by time.
+    """
+    events: List[Dict[str, Any]] = []
+    for pid, name in sorted((process_names or {}).items()):
+        events.append({
+            'name': 'process_name',
+            'ph': 'M',
+            'pid': pid,
+            'args': {
+                'name': name
+            },
+        })
+    for (pid, tid), name in sorted((thread_names or {}).items()):
+        events.append({
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': pid,
+            'tid': tid,
+            'args': {
+                'name': name
+            },
+        })
+        # Keeps tracks in the order of their tids.
+        events.append({
+            'name': 'thread_sort_index',
+            'ph': 'M',
+            'pid': pid,
+            'tid': tid,
+            'args': {
+                'sort_index': tid
+            },
+        })
+    for span in sorted(spans, key=lambda s: (s.start, s.pid, s.tid)):
+        event: Dict[str, Any] = {
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': _micros(span.start),
+            'dur': _micros(span.duration),
+            'pid': span.pid,
+            'tid': span.tid,
+        }
+        if span.args:
+            event['args'] = span.args
+        if span.color is not None:
+            event['cname'] = span.color
+        events.append(event)
+    return events
+
+
+def write_trace(path: Path,
+                spans: Iterable[Span],
+                process_names: Optional[Mapping[int, str]] = None,
+                thread_names: Optional[Mapping[Tuple[int, int], str]] = None
+                ) -> None:
+    """Writes spans to a Chrome trace file.
+
+    Args:
+        path: Path to write the trace to.
+        spans: Spans to write.
+        process_names: Display names of processes, keyed by pid.
+        thread_names: Display names of tracks, keyed by (pid, tid).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps({
+            'traceEvents': trace_events(spans, process_names, thread_names),
+            'displayTimeUnit': 'ms',
+        }))
+
+
+# The span file of this process, and the pid it was opened by. A forked child
+# inherits the file of its parent but must open its own.
+_SPAN_FILE: Optional[TextIO] = None
+_SPAN_FILE_PID = 0
+# Guards _SPAN_FILE against workers that are threads.
+_SPAN_FILE_LOCK = threading.Lock()
+
+
+def start_recording(trace_dir: Path) -> None:
+    """Records spans of this process and of workers started from now on.
+
+    Args:
+        trace_dir: Directory to record spans to. Any existing contents are
+            removed.
+    """
+    if trace_dir.exists():
+        shutil.rmtree(trace_dir)
+    trace_dir.mkdir(parents=True)
+    os.environ[TRACE_DIR_ENV] = str(trace_dir)
+
+
+def stop_recording() -> None:
+    """Stops recording spans of this process."""
+    global _SPAN_FILE
+    os.environ.pop(TRACE_DIR_ENV, None)
+    with _SPAN_FILE_LOCK:
+        if _SPAN_FILE is not None and _SPAN_FILE_PID == os.getpid():
+            _SPAN_FILE.close()
+        _SPAN_FILE = None
+
+
+def _thread_id() -> int:
+    # Workers are either processes, best identified by their pid, or threads.
+    if threading.current_thread() is threading.main_thread():
+        return os.getpid()
+    return threading.get_ident() & 0x7fffffff
+
+
+def _record(span: Span) -> None:
+    global _SPAN_FILE, _SPAN_FILE_PID
+    trace_dir = os.environ.get(TRACE_DIR_ENV)
+    if trace_dir is None:
+        return
+    with _SPAN_FILE_LOCK:
+        if _SPAN_FILE is None or _SPAN_FILE_PID != span.pid:
+            _SPAN_FILE = open(Path(trace_dir) / f'{span.pid}.jsonl', 'a')
+            _SPAN_FILE_PID = span.pid
+        _SPAN_FILE.write(
+            json.dumps({
+                'name': span.name,
+                'category': span.category,
+                'start': span.start,
+                'duration': span.duration,
+                'pid': span.pid,
+                'tid': span.tid,
+                'args': span.args,
+            }) + '\n')
+        # Workers may be killed without warning.
+        _SPAN_FILE.flush()
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[None]:
+    """Records the time spent in a context as a span.
+
+    Does nothing unless recording was started by this process or the process
+    that started it.
+
+    >>> def span_example():
+    ...     with ndk.trace.span('clang', 'build'):
+    ...         do_something()
+
+    Args:
+        name: Name of the span, e.g. the module built.
+        category: Kind of work, e.g. 'build' or 'test'.
+        args: Extra details shown when the span is selected.
+    """
+    if TRACE_DIR_ENV not in os.environ:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        _record(
+            Span(name, category, start,
+                 time.time() - start, os.getpid(), _thread_id(), args))
+
+
+def load_recorded_spans(trace_dir: Path) -> List[Span]:
+    """Loads the spans recorded to a directory.
+
+    Lines that can't be parsed, such as one cut short by a killed worker,
+    are ignored.
+    """
+    spans = []
+    for path in sorted(trace_dir.glob('*.jsonl')):
+        with path.open() as span_file:
+            for line in span_file:
+                try:
+                    spans.append(Span(**json.loads(line)))
+                except (TypeError, ValueError):
+                    logger().warning('Ignoring corrupt span in %s: %s', path,
+                                     line.rstrip())
+    return spans
+
+
+def write_recorded_trace(trace_dir: Path, path: Path,
+                         process_names: Optional[Mapping[int, str]] = None
+                         ) -> None:
+    """Writes the spans recorded to a directory as a trace.
+
+    Times are made relative to the first span, and every process that is not
+    otherwise named is named as a worker.
+
+    Args:
+        trace_dir: Directory the spans were recorded to.
+        path: Path to write the trace to.
+        process_names: Display names of processes, keyed by pid.
+    """
+    spans = load_recorded_spans(trace_dir)
+    origin = min((s.start for s in spans), default=0.0)
+    rebased = [
+        Span(s.name, s.category, s.start - origin, s.duration, s.pid, s.tid,
+             s.args) for s in spans
+    ]
+    names = {s.pid: f'Worker {s.pid}' for s in spans}
+    names.update(process_names or {})
+    write_trace(path, rebased, names)
@@ -16,16 +16,21 @@
 """Defines WorkQueue for delegating asynchronous work to subprocesses."""
 from __future__ import absolute_import
 
-import ctypes  # pylint: disable=unused-import
+import ctypes
 import collections
+from dataclasses import dataclass
+import heapq
 import itertools
 import logging
 import multiprocessing
-import multiprocessing.managers
+from multiprocessing.connection import Connection
 import os
-from queue import Queue
+from pathlib import Path
+import queue
 import signal
 import sys
+import threading
+import time
 import traceback
 from types import FrameType
 from typing import (
@@ -35,9 +40,12 @@ from typing import (
     Dict,
     Generic,
     Iterable,
+    Iterator,
     List,
     Mapping,
     Optional,
+    Sequence,
+    Set,
     Tuple,
     TypeVar,
     Union,
@@ -102,55 +110,122 @@ def kill_process_group(group: ProcessGroup) -> None:
         os.kill(0, signal.SIGTERM)
 
 
+class StatusTable:
+    """Worker status strings stored in shared memory.
+
+    Each worker owns one fixed width slot in a block of shared memory, so
+    reading or writing a status is a plain memory access rather than a round
+    trip to a manager process. Only the owning worker writes to a slot.
+
+    Each slot has a sequence counter that the writer increments before and
+    after updating the slot (a seqlock). A reader that sees an odd counter, or
+    a counter that changed while it was copying the slot, retries.
+    """
+
+    SLOT_SIZE = 256
+
+    def __init__(self, num_slots: int) -> None:
+        self.num_slots = num_slots
+        self._data = multiprocessing.RawArray(ctypes.c_char,
+                                              num_slots * self.SLOT_SIZE)
+        self._sequence = multiprocessing.RawArray(ctypes.c_ulonglong,
+                                                  num_slots)
+
+    def set(self, slot: int, value: str) -> None:
+        """Sets the status stored in the given slot.
+
+        Statuses longer than SLOT_SIZE bytes are truncated.
+        """
+        encoded = value.encode('utf-8')[:self.SLOT_SIZE]
+        # Don't leave a partial multibyte character at the end.
+        encoded = encoded.decode('utf-8', 'ignore').encode('utf-8')
+        start = slot * self.SLOT_SIZE
+        self._sequence[slot] += 1
+        self._data[start:start + self.SLOT_SIZE] = encoded.ljust(
+            self.SLOT_SIZE, b'\0')
+        self._sequence[slot] += 1
+
+    def get(self, slot: int) -> str:
+        """Returns the status stored in the given slot."""
+        start = slot * self.SLOT_SIZE
+        while True:
+            sequence = self._sequence[slot]
+            if sequence % 2 == 0:
+                raw = self._data[start:start + self.SLOT_SIZE]
+                if self._sequence[slot] == sequence:
+                    return raw.rstrip(b'\0').decode('utf-8')
+            # A write is in progress. Let the writer finish.
+            time.sleep(0)
+
+
 class Worker:
     """A workqueue task executor."""
 
     IDLE_STATUS = 'IDLE'
+    PARKED_STATUS = 'PARKED'
     EXCEPTION_STATUS = 'EXCEPTION'
 
-    def __init__(self, data: Any, task_queue: Queue, result_queue: Queue,
-                 manager: multiprocessing.managers.SyncManager) -> None:
+    def __init__(self, data: Any, status_table: StatusTable,
+                 status_slot: int) -> None:
         """Creates a Worker object.
 
+        Each worker owns a pipe to the parent process. The parent sends a task
+        over the pipe only when the worker is idle, and the worker sends the
+        result back over the same pipe.
+
         Args:
-            task_queue: A multiprocessing.Queue of Tasks to retrieve work from.
-            result_queue: A multiprocessing.Queue to push results to.
+            data: Data to be passed to every task run by this worker.
+            status_table: Shared memory table holding the worker status.
+            status_slot: The slot in status_table owned by this worker.
         """
         self.data = data
-        self.task_queue = task_queue
-        self.result_queue = result_queue
-        # For multiprocess.Manager.Value, the type is actually ignored.
-        # https://stackoverflow.com/a/21290961/632035
-        self._status = manager.Value('', self.IDLE_STATUS)
-        self._status_lock = manager.Lock()
+        self._parent_conn, self._child_conn = multiprocessing.Pipe()
+        self._status_table = status_table
+        self._status_slot = status_slot
+        self._status_table.set(self._status_slot, self.IDLE_STATUS)
         self.process = multiprocessing.Process(target=self.main)
 
     @property
     def status(self) -> str:
         """The worker's current status."""
-        with self._status_lock:
-            # Typeshed has a seemingly incorrect definition of
-            # SyncManager.Value that just returns the wrapped type rather than
-            # the proxy type.
-            return self._status.value  # type: ignore
+        return self._status_table.get(self._status_slot)
 
     @status.setter
     def status(self, value: str) -> None:
         """Sets the status for the worker."""
-        with self._status_lock:
-            # Typeshed has a seemingly incorrect definition of
-            # SyncManager.Value that just returns the wrapped type rather than
-            # the proxy type.
-            self._status.value = value  # type: ignore
+        self._status_table.set(self._status_slot, value)
 
     def put_result(self, result: Any, status: str) -> None:
-        """Puts a result onto the result queue."""
-        with self._status_lock:
-            # Typeshed has a seemingly incorrect definition of
-            # SyncManager.Value that just returns the wrapped type rather than
-            # the proxy type.
-            self._status.value = status  # type: ignore
-        self.result_queue.put(result)
+        """Sends a result to the parent process."""
+        self.status = status
+        self._child_conn.send(result)
+
+    def send_task(self, task: 'Task') -> None:
+        """Sends a task to the worker process. Called from the parent."""
+        self._parent_conn.send(task)
+
+    def get_result(self) -> Any:
+        """Receives a result from the worker process. Called from the parent.
+
+        If the worker process exited without sending a result, a TaskError is
+        returned.
+        """
+        if self._parent_conn.poll():
+            try:
+                return self._parent_conn.recv()
+            except EOFError:
+                pass
+        return TaskError(f'worker {self.pid} exited unexpectedly')
+
+    @property
+    def connection(self) -> Connection:
+        """The parent's end of the pipe to the worker process."""
+        return self._parent_conn
+
+    @property
+    def sentinel(self) -> int:
+        """A handle that becomes ready when the worker process exits."""
+        return self.process.sentinel
 
     @property
     def pid(self) -> Optional[int]:
@@ -164,6 +239,8 @@ class Worker:
     def start(self) -> None:
         """Starts the worker process."""
         self.process.start()
+        # The child's end now belongs to the worker process.
+        self._child_conn.close()
 
     def terminate(self) -> None:
         """Terminates the worker process."""
@@ -180,12 +257,12 @@ class Worker:
         try:
             while True:
                 logger().debug('worker %d waiting for work', os.getpid())
-                task = self.task_queue.get()
+                task = self._child_conn.recv()
                 logger().debug('worker %d running task', os.getpid())
                 result = task.run(self)
                 logger().debug('worker %d putting result', os.getpid())
                 self.put_result(result, self.IDLE_STATUS)
-        except SystemExit:
+        except (SystemExit, EOFError):
             pass
         except:  # pylint: disable=bare-except
             logger().debug('worker %d raised exception', os.getpid())
@@ -200,27 +277,203 @@ class Worker:
         logger().debug('worker %d exiting', os.getpid())
 
 
+@dataclass(frozen=True)
+class Resources:
+    """Resources consumed by a task while it runs.
+
+    Attributes:
+        cpus: Number of CPU slots used. A task that runs its own parallel build
+            should request the number of jobs it will run. Every task holds
+            at least one slot.
+        memory_mib: Memory used in MiB.
+        exclusive: True if the task is a heavy build that must not run at the
+            same time as any other exclusive task.
+    """
+    cpus: int = 1
+    memory_mib: int = 0
+    exclusive: bool = False
+
+
 class Task:
     """A task to be executed by a worker process."""
 
-    def __init__(self, func: Callable[..., Any], args: Tuple,
-                 kwargs: Mapping[Any, Any]) -> None:
+    def __init__(self,
+                 func: Callable[..., Any],
+                 args: Tuple,
+                 kwargs: Mapping[Any, Any],
+                 priority: float = 0,
+                 resources: Resources = Resources()) -> None:
         """Creates a task.
 
         Args:
             func: An invocable object to be executed by a worker process.
             args: Arguments to be passed to the task.
             kwargs: Keyword arguments to be passed to the task.
+            priority: Tasks with a higher priority are dispatched first.
+            resources: Resources the task consumes while running. Only
+                enforced by ResourceWorkQueue.
         """
         self.func = func
         self.args = args
         self.kwargs = kwargs
+        self.priority = priority
+        self.resources = resources
 
     def run(self, worker_data: Any) -> Any:
         """Invokes the task."""
         return self.func(worker_data, *self.args, **self.kwargs)
 
 
+class TaskQueue:
+    """A queue of tasks waiting for an idle worker.
+
+    The queue lives in the parent process. Tasks stay here until a worker is
+    idle and are then sent directly to that worker, so no broker process is
+    needed to hold pending work. A TaskQueue may be shared by multiple
+    ProcessPoolWorkQueues.
+
+    Tasks are kept in one heap per distinct Resources, ordered by priority.
+    Tasks of equal priority are returned in order of insertion. Since every
+    task in a heap asks for the same resources, finding a task that fits
+    only needs to look at the head of each heap, and there are only as many
+    heaps as there are kinds of task.
+    """
+
+    def __init__(self) -> None:
+        self._buckets: Dict[Resources, List[Tuple[float, int, Task]]] = {}
+        self._counter = itertools.count()
+        self._size = 0
+
+    def put(self, task: Task) -> None:
+        """Adds a task to the queue."""
+        heapq.heappush(self._buckets.setdefault(task.resources, []),
+                       (-task.priority, next(self._counter), task))
+        self._size += 1
+
+    def _pop(self, resources: Resources) -> Task:
+        bucket = self._buckets[resources]
+        task = heapq.heappop(bucket)[2]
+        if not bucket:
+            del self._buckets[resources]
+        self._size -= 1
+        return task
+
+    def get(self) -> Task:
+        """Removes and returns the highest priority task."""
+        resources = min(self._buckets,
+                        key=lambda r: self._buckets[r][0][:2])
+        return self._pop(resources)
+
+    def get_first(self,
+                  fits: Callable[[Resources], bool]) -> Optional[Task]:
+        """Removes and returns the highest priority task whose resources fit.
+
+        Args:
+            fits: Returns True if a task with the given resources can run.
+
+        Returns:
+            The matching task, or None if no pending task matches.
+        """
+        heads = sorted(self._buckets.items(), key=lambda item: item[1][0][:2])
+        for resources, _ in heads:
+            if fits(resources):
+                return self._pop(resources)
+        return None
+
+    def empty(self) -> bool:
+        """Returns True if there are no pending tasks."""
+        return not self._size
+
+    def qsize(self) -> int:
+        """Returns the number of pending tasks."""
+        return self._size
+
+
+class ChunkResults(List[Any]):
+    """The results of a chunk of tasks, in the order of their arguments.
+
+    Distinguishes a chunk's results from a task that happens to return a
+    list. Work queues split these back into individual results.
+    """
+
+
+def run_chunk(worker: Any, func: Callable[..., Any],
+              chunk: Sequence[Sequence[Any]],
+              kwargs: Mapping[Any, Any]) -> ChunkResults:
+    """Runs func once for each set of arguments in the chunk."""
+    return ChunkResults(func(worker, *args, **kwargs) for args in chunk)
+
+
+def chunk_tasks(func: Callable[..., Any],
+                args_iterable: Iterable[Sequence[Any]],
+                chunksize: int,
+                kwargs: Mapping[Any, Any],
+                priority: float = 0,
+                resources: Resources = Resources()
+                ) -> Iterator[Tuple[Task, int]]:
+    """Groups calls to func into tasks of up to chunksize calls.
+
+    Args:
+        func: An invocable object to be executed for each set of arguments.
+        args_iterable: Positional arguments for each call.
+        chunksize: Maximum number of calls in each task.
+        kwargs: Keyword arguments passed to every call.
+        priority: Priority of each task.
+        resources: Resources consumed by each task.
+
+    Returns:
+        Iterator of (task, number of calls in the task).
+    """
+    if chunksize < 1:
+        raise ValueError(f'chunksize must be positive, got {chunksize}')
+    args_iterator = iter(args_iterable)
+    while True:
+        chunk = [tuple(args) for args in
+                 itertools.islice(args_iterator, chunksize)]
+        if not chunk:
+            return
+        yield Task(run_chunk, (func, chunk, kwargs), {}, priority,
+                   resources), len(chunk)
+
+
+def expand_chunks(results: Iterable[Any]) -> List[Any]:
+    """Splits the results of chunks into individual results."""
+    expanded: List[Any] = []
+    for result in results:
+        if isinstance(result, ChunkResults):
+            expanded.extend(result)
+        else:
+            expanded.append(result)
+    return expanded
+
+
+def drain_results(ready_results: Deque[Any], max_items: Optional[int],
+                  wait: Callable[[], List[Any]]) -> List[Any]:
+    """Takes results from a buffer, waiting for more if it is empty.
+
+    Results of chunked tasks arrive together but may be returned over several
+    calls when max_items is smaller than the chunk, so they are buffered.
+
+    Args:
+        ready_results: Results that have been received but not returned.
+        max_items: Maximum number of results to return, or None for no
+            limit.
+        wait: Waits for and returns results when none are buffered. Raises
+            any TaskError among them.
+
+    Returns:
+        List of results. Empty if wait returned nothing.
+    """
+    if not ready_results:
+        ready_results.extend(expand_chunks(wait()))
+    if max_items is None:
+        max_items = len(ready_results)
+    return [
+        ready_results.popleft()
+        for _ in range(min(max_items, len(ready_results)))
+    ]
+
+
 class ProcessPoolWorkQueue:
     """A pool of processes for executing work asynchronously."""
 
@@ -228,8 +481,7 @@ class ProcessPoolWorkQueue:
 
     def __init__(self,
                  num_workers: int = multiprocessing.cpu_count(),
-                 task_queue: Optional[Queue] = None,
-                 result_queue: Optional[Queue] = None,
+                 task_queue: Optional[TaskQueue] = None,
                  worker_data: Optional[Any] = None) -> None:
         """Creates a WorkQueue.
 
@@ -238,71 +490,138 @@ class ProcessPoolWorkQueue:
 
         Args:
             num_workers: Number of worker processes to spawn.
-            task_queue: multiprocessing.Queue for tasks. Allows multiple work
+            task_queue: TaskQueue for pending tasks. Allows multiple work
                 queues to share a single task queue. If None, the work queue
                 creates its own.
-            result_queue: multiprocessing.Queue for results. Allows multiple
-                work queues to share a single result queue. If None, the work
-                queue creates its own.
             worker_data: Data to be passed to every task run by this work
                 queue.
         """
-        self.manager = multiprocessing.Manager()
+        self.status_table = StatusTable(num_workers)
 
         if task_queue is None:
-            self.task_queue = self.manager.Queue()
-            self.owns_task_queue = True
+            self.task_queue = TaskQueue()
         else:
             self.task_queue = task_queue
-            self.owns_task_queue = False
-
-        if result_queue is None:
-            self.result_queue = self.manager.Queue()
-            self.owns_result_queue = True
-        else:
-            self.result_queue = result_queue
-            self.owns_result_queue = False
 
         self.worker_data = worker_data
 
         self.workers: List[Worker] = []
-        # multiprocessing.JoinableQueue's join isn't able to implement
-        # finished() because it doesn't come in a non-blocking flavor.
+        self.idle_workers: Deque[Worker] = collections.deque()
+        self.busy_workers: Set[Worker] = set()
+        # Workers that reported a TaskError. Their processes exit after
+        # reporting the error, but still need to be reaped by join().
+        self.failed_workers: List[Worker] = []
+        self.ready_results: Deque[Any] = collections.deque()
         self.num_tasks = 0
+        self.num_spawned = 0
         self._spawn_workers(num_workers)
 
     def add_task(self, func: Callable[..., Any], *args: Any,
-                 **kwargs: Any) -> None:
+                 priority: float = 0, **kwargs: Any) -> None:
         """Queues up a new task for execution.
 
-        Tasks are executed in order of insertion as worker processes become
-        available.
+        Tasks are executed in order of priority as worker processes become
+        available. Tasks of equal priority are executed in order of insertion.
 
         Args:
             func: An invocable object to be executed by a worker process.
             args: Arguments to be passed to the task.
+            priority: Tasks with a higher priority are dispatched first.
             kwargs: Keyword arguments to be passed to the task.
         """
-        self.task_queue.put(Task(func, args, kwargs))
+        self.task_queue.put(Task(func, args, kwargs, priority))
         self.num_tasks += 1
+        self.dispatch()
 
-    def get_result(self) -> Any:
-        """Gets a result from the queue, blocking until one is available."""
-        result = self.result_queue.get()
+    def add_tasks(self,
+                  func: Callable[..., Any],
+                  args_iterable: Iterable[Sequence[Any]],
+                  chunksize: int = 1,
+                  priority: float = 0,
+                  **kwargs: Any) -> None:
+        """Queues up a call of func for each set of arguments.
+
+        Calls are sent to workers in chunks, and each chunk sends back all of
+        its results at once. For tiny tasks this saves the IPC round trip
+        that would otherwise dominate. Results are still returned one per
+        call by get_results, and count individually towards num_tasks.
+
+        Args:
+            func: An invocable object to be executed by a worker process.
+            args_iterable: Positional arguments for each call.
+            chunksize: Maximum number of calls sent to a worker at once.
+            priority: Chunks with a higher priority are dispatched first.
+            kwargs: Keyword arguments to be passed to every call.
+        """
+        for task, count in chunk_tasks(func, args_iterable, chunksize,
+                                       kwargs, priority):
+            self.task_queue.put(task)
+            self.num_tasks += count
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """Sends pending tasks to idle workers."""
+        while self.idle_workers and not self.task_queue.empty():
+            worker = self.idle_workers.popleft()
+            worker.send_task(self.task_queue.get())
+            self.busy_workers.add(worker)
+
+    def receive_result(self, worker: Worker) -> Any:
+        """Receives the result of the task running on the given worker.
+
+        The worker is returned to the idle pool and given its next task. A
+        worker that failed is moved to failed_workers since its process exits
+        after reporting the error.
+        """
+        result = worker.get_result()
+        self.busy_workers.remove(worker)
         if isinstance(result, TaskError):
-            raise result
-        self.num_tasks -= 1
+            self.workers.remove(worker)
+            self.failed_workers.append(worker)
+        else:
+            self.idle_workers.append(worker)
+            self.dispatch()
         return result
 
+    def get_result(self) -> Any:
+        """Gets a result from the queue, blocking until one is available."""
+        return self.get_results(max_items=1)[0]
+
+    def get_results(self,
+                    max_items: Optional[int] = None,
+                    timeout: Optional[float] = None) -> List[Any]:
+        """Gets every result that is ready.
+
+        Blocks until at least one result is available, then collects every
+        other finished result without blocking again.
+
+        Args:
+            max_items: Maximum number of results to return, or None for no
+                limit.
+            timeout: Maximum time in seconds to wait for the first result, or
+                None to wait forever.
+
+        Returns:
+            List of results. Empty if the timeout expired.
+        """
+        def wait() -> List[Any]:
+            results = wait_for_results([self], max_items, timeout)
+            raise_task_errors(results)
+            return results
+
+        results = drain_results(self.ready_results, max_items, wait)
+        self.num_tasks -= len(results)
+        return results
+
     def terminate(self) -> None:
         """Terminates all worker processes."""
-        for worker in self.workers:
+        for worker in self.workers + self.failed_workers:
             logger().debug('terminating %d', worker.pid)
             worker.terminate()
 
     def join(self) -> None:
         """Waits for all worker processes to exit."""
-        for worker in self.workers:
+        for worker in self.workers + self.failed_workers:
             logger().debug('joining %d', worker.pid)
             worker.join(self.join_timeout)
             if worker.is_alive():
@@ -312,6 +631,9 @@ class ProcessPoolWorkQueue:
                     os.killpg(worker.pid, signal.SIGKILL)
                 worker.join()
         self.workers = []
+        self.failed_workers = []
+        self.idle_workers.clear()
+        self.busy_workers.clear()
 
     def finished(self) -> bool:
         """Returns True if all tasks have completed execution."""
@@ -324,11 +646,487 @@ class ProcessPoolWorkQueue:
             num_workers: Number of worker proceeses to spawn.
         """
         for _ in range(num_workers):
-            worker = Worker(
-                self.worker_data, self.task_queue, self.result_queue,
-                self.manager)
+            worker = Worker(self.worker_data, self.status_table,
+                            self.num_spawned)
+            self.num_spawned += 1
+            worker.start()
+            self.workers.append(worker)
+            self.idle_workers.append(worker)
+
+
+def raise_task_errors(results: Iterable[Any]) -> None:
+    """Raises the first TaskError in the given results, if any."""
+    for result in results:
+        if isinstance(result, TaskError):
+            raise result
+
+
+def wait_for_results(work_queues: Iterable[ProcessPoolWorkQueue],
+                     max_items: Optional[int] = None,
+                     timeout: Optional[float] = None) -> List[Any]:
+    """Waits for results from any of the given work queues.
+
+    A single wait covers every busy worker of every work queue, and every
+    worker found ready by that wait has its result received.
+
+    Args:
+        work_queues: Work queues to wait on.
+        max_items: Maximum number of results to receive, or None for no
+            limit.
+        timeout: Maximum time in seconds to wait, or None to wait forever.
+
+    Returns:
+        List of results. Empty if the timeout expired. If a worker failed, its
+        result is a TaskError. It is the caller's responsibility to raise it.
+
+    Raises:
+        RuntimeError: None of the work queues have any running tasks, either
+            because there is no work or because every worker has failed.
+    """
+    work_queues = list(work_queues)
+    waitables: Dict[Any, Tuple[ProcessPoolWorkQueue, Worker]] = {}
+    for work_queue in work_queues:
+        for worker in work_queue.busy_workers:
+            waitables[worker.connection] = (work_queue, worker)
+            waitables[worker.sentinel] = (work_queue, worker)
+    if not waitables:
+        task_queues = {id(wq.task_queue): wq.task_queue for wq in work_queues}
+        pending = sum(q.qsize() for q in task_queues.values())
+        if pending:
+            raise RuntimeError(
+                f'All workers have failed with {pending} tasks pending.')
+        raise RuntimeError('No tasks are running.')
+    ready = multiprocessing.connection.wait(list(waitables.keys()), timeout)
+    results: List[Any] = []
+    received: Set[Worker] = set()
+    for handle in ready:
+        if max_items is not None and len(results) >= max_items:
+            break
+        work_queue, worker = waitables[handle]
+        # Both the pipe and the sentinel of a worker may be ready.
+        if worker in received:
+            continue
+        received.add(worker)
+        results.append(work_queue.receive_result(worker))
+    return results
+
+
+# Thresholds for ElasticWorkQueue. Pressures are PSI "some avg10" values: the
+# percentage of the last ten seconds in which at least one task was stalled
+# waiting for the resource. Load is the one minute load average per CPU.
+CPU_PRESSURE_HIGH = 40.0
+CPU_PRESSURE_LOW = 10.0
+MEMORY_PRESSURE_HIGH = 10.0
+LOAD_HIGH = 1.5
+LOAD_LOW = 1.0
+
+
+@dataclass(frozen=True)
+class LoadSample:
+    """A sample of system load.
+
+    Attributes:
+        load: One minute load average per CPU, or None if unavailable.
+        cpu_pressure: CPU pressure, or None if PSI is unavailable.
+        memory_pressure: Memory pressure, or None if PSI is unavailable.
+    """
+    load: Optional[float]
+    cpu_pressure: Optional[float]
+    memory_pressure: Optional[float]
+
+
+class LoadMonitor:
+    """Samples system load from the load average and PSI.
+
+    Pressure stall information (PSI) is only available on Linux 4.20 or newer
+    and the load average is not available on Windows. Missing sources are
+    reported as None.
+    """
+    def __init__(self, pressure_dir: Path = Path('/proc/pressure')) -> None:
+        self.pressure_dir = pressure_dir
+
+    def read_pressure(self, resource: str) -> Optional[float]:
+        """Returns the "some avg10" pressure of the given resource."""
+        try:
+            text = (self.pressure_dir / resource).read_text()
+        except OSError:
+            return None
+        for line in text.splitlines():
+            fields = line.split()
+            if not fields or fields[0] != 'some':
+                continue
+            for field in fields[1:]:
+                key, _, value = field.partition('=')
+                if key == 'avg10':
+                    return float(value)
+        return None
+
+    def sample(self) -> LoadSample:
+        """Returns the current system load."""
+        try:
+            load: Optional[float] = (os.getloadavg()[0] /
+                                     multiprocessing.cpu_count())
+        except (AttributeError, OSError):
+            load = None
+        return LoadSample(load, self.read_pressure('cpu'),
+                          self.read_pressure('memory'))
+
+
+def adjust_num_workers(current: int, sample: LoadSample, min_workers: int,
+                       max_workers: int) -> int:
+    """Returns the number of workers that should be active.
+
+    Memory pressure halves the pool since swapping hurts every job on the
+    host. Otherwise the pool shrinks by one while the CPUs are overloaded and
+    grows by one while they have spare capacity, which is the common case for
+    I/O-bound tasks.
+
+    Args:
+        current: Number of currently active workers.
+        sample: Current system load.
+        min_workers: Lower bound for the result.
+        max_workers: Upper bound for the result.
+    """
+    target = current
+    if (sample.memory_pressure is not None
+            and sample.memory_pressure > MEMORY_PRESSURE_HIGH):
+        target = current // 2
+    elif ((sample.cpu_pressure is not None
+           and sample.cpu_pressure > CPU_PRESSURE_HIGH)
+          or (sample.load is not None and sample.load > LOAD_HIGH)):
+        target = current - 1
+    elif ((sample.cpu_pressure is None
+           or sample.cpu_pressure < CPU_PRESSURE_LOW)
+          and (sample.load is None or sample.load < LOAD_LOW)):
+        target = current + 1
+    return max(min_workers, min(max_workers, target))
+
+
+class ElasticWorkQueue(ProcessPoolWorkQueue):
+    """A work queue whose number of active workers follows system load.
+
+    Starts with min_workers and re-evaluates the load whenever tasks are
+    dispatched, at most once per sample_interval seconds. New workers are only
+    forked the first time the pool grows past its previous size. When the pool
+    shrinks, idle workers are parked rather than killed so that they can be
+    resumed without paying the cost of a fork.
+    """
+
+    def __init__(self,
+                 min_workers: int = 1,
+                 max_workers: int = multiprocessing.cpu_count(),
+                 task_queue: Optional[TaskQueue] = None,
+                 worker_data: Optional[Any] = None,
+                 load_monitor: Optional[LoadMonitor] = None,
+                 sample_interval: float = 1.0,
+                 **kwargs: Any) -> None:
+        """Creates an ElasticWorkQueue.
+
+        Args:
+            min_workers: Minimum number of active workers.
+            max_workers: Maximum number of active workers.
+            task_queue: TaskQueue for pending tasks. If None, the work queue
+                creates its own.
+            worker_data: Data to be passed to every task run by this work
+                queue.
+            load_monitor: Source of load samples. If None, a LoadMonitor for
+                this host.
+            sample_interval: Minimum number of seconds between load samples.
+            kwargs: Passed on to the base work queue. See
+                ElasticResourceWorkQueue.
+        """
+        assert 1 <= min_workers <= max_workers
+        super().__init__(0,
+                         task_queue=task_queue,
+                         worker_data=worker_data,
+                         **kwargs)
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.load_monitor = (LoadMonitor()
+                             if load_monitor is None else load_monitor)
+        self.sample_interval = sample_interval
+        self.last_sample_time: Optional[float] = None
+        self.parked_workers: Deque[Worker] = collections.deque()
+        self.status_table = StatusTable(max_workers)
+        self._spawn_workers(min_workers)
+
+    @property
+    def num_active_workers(self) -> int:
+        """Number of workers that are not parked."""
+        return len(self.workers) - len(self.parked_workers)
+
+    def resize(self) -> None:
+        """Samples the system load and parks or resumes workers to match."""
+        now = time.monotonic()
+        if (self.last_sample_time is not None
+                and now - self.last_sample_time < self.sample_interval):
+            return
+        self.last_sample_time = now
+
+        target = adjust_num_workers(self.num_active_workers,
+                                    self.load_monitor.sample(),
+                                    self.min_workers, self.max_workers)
+        while self.num_active_workers < target:
+            if self.parked_workers:
+                worker = self.parked_workers.popleft()
+                worker.status = Worker.IDLE_STATUS
+                self.idle_workers.append(worker)
+            elif self.num_spawned < self.max_workers:
+                self._spawn_workers(1)
+            else:
+                # Every status slot has been used by a worker that has since
+                # failed.
+                break
+        # Only idle workers can be parked. Busy workers are parked by a
+        # later resize once they finish, if the load is still high.
+        while self.num_active_workers > target and self.idle_workers:
+            worker = self.idle_workers.pop()
+            worker.status = Worker.PARKED_STATUS
+            self.parked_workers.append(worker)
+
+    def dispatch(self) -> None:
+        """Resizes the pool and sends pending tasks to idle workers."""
+        self.resize()
+        super().dispatch()
+
+    def join(self) -> None:
+        """Waits for all worker processes to exit."""
+        super().join()
+        self.parked_workers.clear()
+
+
+# A finished task: the work queue and worker that ran it and its result.
+ThreadResult = Tuple['ThreadPoolWorkQueue', 'ThreadWorker', Any]
+
+
+class ThreadWorker:
+    """A worker thread for a ThreadPoolWorkQueue.
+
+    Offers the same interface to tasks as Worker: a data attribute and a
+    status that can be set by the task and read by the UI.
+    """
+
+    def __init__(self, data: Any, work_queue: 'ThreadPoolWorkQueue',
+                 result_queue: 'queue.Queue[ThreadResult]') -> None:
+        self.data = data
+        self.status = Worker.IDLE_STATUS
+        self._work_queue = work_queue
+        self._result_queue = result_queue
+        self._tasks: 'queue.Queue[Optional[Task]]' = queue.Queue()
+        self.thread = threading.Thread(target=self.main, daemon=True)
+
+    def start(self) -> None:
+        """Starts the worker thread."""
+        self.thread.start()
+
+    def send_task(self, task: Task) -> None:
+        """Sends a task to the worker."""
+        self._tasks.put(task)
+
+    def stop(self) -> None:
+        """Asks the worker to exit once its current task finishes."""
+        self._tasks.put(None)
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        """Waits for the worker thread to exit."""
+        self.thread.join(timeout)
+
+    def is_alive(self) -> bool:
+        """Returns True if the worker thread is running."""
+        return self.thread.is_alive()
+
+    def main(self) -> None:
+        """Main loop for worker threads."""
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            try:
+                result = task.run(self)
+                self.status = Worker.IDLE_STATUS
+            except Exception as ex:  # pylint: disable=broad-except
+                self.status = Worker.EXCEPTION_STATUS
+                trace = ''.join(traceback.format_exception(*sys.exc_info()))
+                result = TaskError(trace)
+                result.__cause__ = ex
+            self._result_queue.put((self._work_queue, self, result))
+
+
+class ThreadPoolWorkQueue:
+    """A pool of threads for executing I/O-bound work asynchronously.
+
+    Has the same interface as ProcessPoolWorkQueue but runs tasks on threads
+    in this process. This is much cheaper to start and uses far less memory
+    than a process per worker, but only suits tasks that spend their time
+    waiting, such as tasks running adb. Tasks do not need to be picklable.
+
+    Running tasks cannot be interrupted: terminate() stops each worker after
+    its current task.
+    """
+
+    join_timeout = 8  # Timeout for join before giving up on a worker.
+
+    def __init__(self,
+                 num_workers: int = multiprocessing.cpu_count(),
+                 task_queue: Optional[TaskQueue] = None,
+                 worker_data: Optional[Any] = None,
+                 result_queue: Optional['queue.Queue[ThreadResult]'] = None
+                 ) -> None:
+        """Creates a ThreadPoolWorkQueue.
+
+        Args:
+            num_workers: Number of worker threads to spawn.
+            task_queue: TaskQueue for pending tasks. Allows multiple work
+                queues to share a single task queue. If None, the work queue
+                creates its own.
+            worker_data: Data to be passed to every task run by this work
+                queue.
+            result_queue: Queue for finished results. Work queues that are
+                waited on together with wait_for_thread_results must share
+                one.
+                If None, the work queue creates its own.
+        """
+        self.task_queue = TaskQueue() if task_queue is None else task_queue
+        self.result_queue: 'queue.Queue[ThreadResult]' = (
+            queue.Queue() if result_queue is None else result_queue)
+        self.worker_data = worker_data
+        self.workers: List[ThreadWorker] = []
+        self.idle_workers: Deque[ThreadWorker] = collections.deque()
+        self.busy_workers: Set[ThreadWorker] = set()
+        self.ready_results: Deque[Any] = collections.deque()
+        self.num_tasks = 0
+        for _ in range(num_workers):
+            worker = ThreadWorker(worker_data, self, self.result_queue)
             worker.start()
             self.workers.append(worker)
+            self.idle_workers.append(worker)
+
+    def add_task(self, func: Callable[..., Any], *args: Any,
+                 priority: float = 0, **kwargs: Any) -> None:
+        """Queues up a new task for execution.
+
+        Tasks are executed in order of priority as worker threads become
+        available. Tasks of equal priority are executed in order of insertion.
+
+        Args:
+            func: An invocable object to be executed by a worker thread.
+            args: Arguments to be passed to the task.
+            priority: Tasks with a higher priority are dispatched first.
+            kwargs: Keyword arguments to be passed to the task.
+        """
+        self.task_queue.put(Task(func, args, kwargs, priority))
+        self.num_tasks += 1
+        self.dispatch()
+
+    def add_tasks(self,
+                  func: Callable[..., Any],
+                  args_iterable: Iterable[Sequence[Any]],
+                  chunksize: int = 1,
+                  priority: float = 0,
+                  **kwargs: Any) -> None:
+        """Queues up a call of func for each set of arguments.
+
+        See ProcessPoolWorkQueue.add_tasks.
+        """
+        for task, count in chunk_tasks(func, args_iterable, chunksize,
+                                       kwargs, priority):
+            self.task_queue.put(task)
+            self.num_tasks += count
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """Sends pending tasks to idle workers."""
+        while self.idle_workers and not self.task_queue.empty():
+            worker = self.idle_workers.popleft()
+            worker.send_task(self.task_queue.get())
+            self.busy_workers.add(worker)
+
+    def receive_result(self, worker: ThreadWorker, result: Any) -> Any:
+        """Returns the worker to the idle pool and gives it its next task."""
+        self.busy_workers.remove(worker)
+        self.idle_workers.append(worker)
+        self.dispatch()
+        return result
+
+    def get_result(self) -> Any:
+        """Gets a result from the queue, blocking until one is available."""
+        return self.get_results(max_items=1)[0]
+
+    def get_results(self,
+                    max_items: Optional[int] = None,
+                    timeout: Optional[float] = None) -> List[Any]:
+        """Gets every result that is ready. See ProcessPoolWorkQueue."""
+        def wait() -> List[Any]:
+            results = wait_for_thread_results([self], self.result_queue,
+                                              max_items, timeout)
+            raise_task_errors(results)
+            return results
+
+        results = drain_results(self.ready_results, max_items, wait)
+        self.num_tasks -= len(results)
+        return results
+
+    def terminate(self) -> None:
+        """Stops all worker threads once their current task is done."""
+        for worker in self.workers:
+            worker.stop()
+
+    def join(self) -> None:
+        """Waits for all worker threads to exit."""
+        for worker in self.workers:
+            worker.join(self.join_timeout)
+            if worker.is_alive():
+                # Worker threads are daemons, so a hung task will not keep
+                # the process alive at exit.
+                logger().error('worker thread %s will not exit',
+                               worker.thread.name)
+        self.workers = []
+        self.idle_workers.clear()
+        self.busy_workers.clear()
+
+    def finished(self) -> bool:
+        """Returns True if all tasks have completed execution."""
+        return self.num_tasks == 0
+
+
+def wait_for_thread_results(work_queues: Iterable[ThreadPoolWorkQueue],
+                            result_queue: 'queue.Queue[ThreadResult]',
+                            max_items: Optional[int] = None,
+                            timeout: Optional[float] = None) -> List[Any]:
+    """Waits for results from any of the given thread work queues.
+
+    Blocks until the first result is available and then drains the result
+    queue without blocking.
+
+    Args:
+        work_queues: Work queues to wait on. They must all use result_queue.
+        result_queue: The result queue shared by the work queues.
+        max_items: Maximum number of results to receive, or None for no
+            limit.
+        timeout: Maximum time in seconds to wait, or None to wait forever.
+
+    Returns:
+        List of results. Empty if the timeout expired. If a task raised, its
+        result is a TaskError. It is the caller's responsibility to raise it.
+
+    Raises:
+        RuntimeError: None of the work queues have any running tasks.
+    """
+    if not any(work_queue.busy_workers for work_queue in work_queues):
+        raise RuntimeError('No tasks are running.')
+    try:
+        entries = [result_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while max_items is None or len(entries) < max_items:
+        try:
+            entries.append(result_queue.get_nowait())
+        except queue.Empty:
+            break
+    return [
+        work_queue.receive_result(worker, result)
+        for work_queue, worker, result in entries
+    ]
 
 
 class BasicWorker:
@@ -347,36 +1145,65 @@ class BasicWorkQueue:
     # pylint: disable=unused-argument
     def __init__(self,
                  num_workers: int = None,
-                 task_queue: Optional[Queue] = None,
-                 result_queue: Optional[Queue] = None,
+                 task_queue: Optional[TaskQueue] = None,
                  worker_data: Optional[Any] = None) -> None:
         """Creates a SerialWorkQueue."""
-        self.task_queue: Deque = collections.deque()
+        self.task_queue = TaskQueue()
         self.worker_data = worker_data
     # pylint: enable=unused-argument
 
     def add_task(self, func: Callable[..., Any], *args: Any,
-                 **kwargs: Any) -> None:
+                 priority: float = 0, **kwargs: Any) -> None:
         """Queues up a new task for execution.
 
-        Tasks are executed when get_result is called.
+        Tasks are executed when get_result is called, highest priority first.
 
         Args:
             func: An invocable object to be executed by a worker process.
             args: Arguments to be passed to the task.
+            priority: Tasks with a higher priority are executed first.
             kwargs: Keyword arguments to be passed to the task.
         """
-        self.task_queue.append(Task(func, args, kwargs))
+        self.task_queue.put(Task(func, args, kwargs, priority))
+
+    # pylint: disable=unused-argument
+    def add_tasks(self,
+                  func: Callable[..., Any],
+                  args_iterable: Iterable[Sequence[Any]],
+                  chunksize: int = 1,
+                  priority: float = 0,
+                  **kwargs: Any) -> None:
+        """Queues up a call of func for each set of arguments.
+
+        There is no IPC to save, so every call is queued as its own task.
+        chunksize is accepted for compatibility with the other work queues.
+        """
+        for args in args_iterable:
+            self.add_task(func, *args, priority=priority, **kwargs)
+    # pylint: enable=unused-argument
 
     def get_result(self) -> Any:
         """Executes a task and returns the result."""
-        task = self.task_queue.popleft()
+        task = self.task_queue.get()
         try:
             return task.run(BasicWorker(self.worker_data))
         except Exception as ex:
             trace = ''.join(traceback.format_exception(*sys.exc_info()))
             raise TaskError(trace) from ex
 
+    # pylint: disable=unused-argument
+    def get_results(self,
+                    max_items: Optional[int] = None,
+                    timeout: Optional[float] = None) -> List[Any]:
+        """Executes a single task and returns its result in a list.
+
+        Tasks only run when their results are requested, so there is never
+        more than one result ready. The arguments are accepted for
+        compatibility with the other work queues.
+        """
+        return [self.get_result()]
+    # pylint: enable=unused-argument
+
     def terminate(self) -> None:
         """Does nothing."""
 
@@ -386,7 +1213,7 @@ class BasicWorkQueue:
     @property
     def num_tasks(self) -> int:
         """Number of tasks that have not yet been claimed."""
-        return len(self.task_queue)
+        return self.task_queue.qsize()
 
     @property
     def workers(self) -> List[Worker]:
@@ -398,69 +1225,192 @@ class BasicWorkQueue:
         return self.num_tasks == 0
 
 
-class LoadRestrictingWorkQueue:
-    """Specialized work queue for building tests.
+class ResourceWorkQueue(ProcessPoolWorkQueue):
+    """A work queue that admits tasks only when their resources are free.
 
-    Building the libc++ tests is very demanding and we should not be running
-    more than one libc++ build at a time. The LoadRestrictingWorkQueue has a
-    normal task queue as well as a task queue served by only one worker.
+    Each task declares the Resources it consumes. The queue has a fixed number
+    of CPU slots, an optional memory budget and a single exclusive token, and
+    a task is only dispatched when everything it asks for is available.
+    Pending tasks are considered in priority order, but a task that does not
+    fit does not block smaller tasks behind it.
+
+    A task that asks for more than the queue has in total is run when the
+    queue is otherwise idle rather than never.
     """
 
-    def __init__(self, num_workers: int = multiprocessing.cpu_count()) -> None:
-        self.manager = multiprocessing.Manager()
-        self.result_queue = self.manager.Queue()
+    def __init__(self,
+                 num_workers: int = multiprocessing.cpu_count(),
+                 cpus: Optional[int] = None,
+                 memory_mib: Optional[int] = None,
+                 task_queue: Optional[TaskQueue] = None,
+                 worker_data: Optional[Any] = None) -> None:
+        """Creates a ResourceWorkQueue.
 
-        assert num_workers >= 2
+        Args:
+            num_workers: Number of worker processes to spawn.
+            cpus: Number of CPU slots to share between tasks. If None, the
+                number of CPUs on the machine.
+            memory_mib: Memory budget in MiB to share between tasks. If None,
+                memory is not accounted for.
+            task_queue: TaskQueue for pending tasks. If None, the work queue
+                creates its own.
+            worker_data: Data to be passed to every task run by this work
+                queue.
+        """
+        self.total_cpus = multiprocessing.cpu_count() if cpus is None else cpus
+        self.total_memory_mib = memory_mib
+        self.free_cpus = self.total_cpus
+        self.free_memory_mib = memory_mib
+        self.exclusive_held = False
+        self.running_tasks: Dict[Worker, Task] = {}
+        super().__init__(num_workers, task_queue, worker_data)
+
+    def add_task(self,
+                 func: Callable[..., Any],
+                 *args: Any,
+                 priority: float = 0,
+                 resources: Resources = Resources(),
+                 **kwargs: Any) -> None:
+        """Queues up a new task for execution.
 
-        self.main_task_queue = self.manager.Queue()
-        self.restricted_task_queue = self.manager.Queue()
+        Args:
+            func: An invocable object to be executed by a worker process.
+            args: Arguments to be passed to the task.
+            priority: Tasks with a higher priority are dispatched first.
+            resources: Resources the task consumes while running.
+            kwargs: Keyword arguments to be passed to the task.
+        """
+        self.task_queue.put(Task(func, args, kwargs, priority, resources))
+        self.num_tasks += 1
+        self.dispatch()
+
+    def add_tasks(self,
+                  func: Callable[..., Any],
+                  args_iterable: Iterable[Sequence[Any]],
+                  chunksize: int = 1,
+                  priority: float = 0,
+                  resources: Resources = Resources(),
+                  **kwargs: Any) -> None:
+        """Queues up a call of func for each set of arguments.
+
+        The calls in a chunk run one after another, so each chunk consumes
+        the resources of a single call. See ProcessPoolWorkQueue.add_tasks.
+        """
+        for task, count in chunk_tasks(func, args_iterable, chunksize,
+                                       kwargs, priority, resources):
+            self.task_queue.put(task)
+            self.num_tasks += count
+        self.dispatch()
+
+    def _clamp(self, resources: Resources) -> Tuple[int, int]:
+        """Returns the CPU and memory a task will hold while it runs."""
+        cpus = max(1, min(resources.cpus, self.total_cpus))
+        memory = resources.memory_mib
+        if self.total_memory_mib is not None:
+            memory = min(memory, self.total_memory_mib)
+        return cpus, memory
+
+    def fits(self, resources: Resources) -> bool:
+        """Returns True if the given resources are currently available."""
+        cpus, memory = self._clamp(resources)
+        if cpus > self.free_cpus:
+            return False
+        if (self.free_memory_mib is not None
+                and memory > self.free_memory_mib):
+            return False
+        return not (resources.exclusive and self.exclusive_held)
+
+    def _acquire(self, resources: Resources) -> None:
+        cpus, memory = self._clamp(resources)
+        self.free_cpus -= cpus
+        if self.free_memory_mib is not None:
+            self.free_memory_mib -= memory
+        if resources.exclusive:
+            self.exclusive_held = True
+
+    def _release(self, resources: Resources) -> None:
+        cpus, memory = self._clamp(resources)
+        self.free_cpus += cpus
+        if self.free_memory_mib is not None:
+            self.free_memory_mib += memory
+        if resources.exclusive:
+            self.exclusive_held = False
+
+    def dispatch(self) -> None:
+        """Sends pending tasks that fit to idle workers."""
+        while self.idle_workers:
+            # Every task holds a CPU slot, so none can fit. Checked first
+            # since this runs for every task added and every result.
+            if self.free_cpus <= 0:
+                return
+            task = self.task_queue.get_first(self.fits)
+            if task is None:
+                return
+            self._acquire(task.resources)
+            worker = self.idle_workers.popleft()
+            self.running_tasks[worker] = task
+            worker.send_task(task)
+            self.busy_workers.add(worker)
+
+    def receive_result(self, worker: Worker) -> Any:
+        """Receives a result and frees the resources held by its task."""
+        self._release(self.running_tasks.pop(worker).resources)
+        return super().receive_result(worker)
 
-        self.main_work_queue = WorkQueue(
-            num_workers - 1, task_queue=self.main_task_queue,
-            result_queue=self.result_queue)
+    def join(self) -> None:
+        """Waits for all worker processes to exit."""
+        super().join()
+        for task in self.running_tasks.values():
+            self._release(task.resources)
+        self.running_tasks.clear()
 
-        self.restricted_work_queue = WorkQueue(
-            1, task_queue=self.restricted_task_queue,
-            result_queue=self.result_queue)
 
-        self.num_tasks = 0
+class ElasticResourceWorkQueue(ElasticWorkQueue, ResourceWorkQueue):
+    """A ResourceWorkQueue whose number of active workers follows load.
 
-    def add_task(self, func: Callable[..., Any], *args: Any,
-                 **kwargs: Any) -> None:
-        self.main_task_queue.put(Task(func, args, kwargs))
-        self.num_tasks += 1
+    Tasks are admitted by their resources as in ResourceWorkQueue, and the
+    pool grows and shrinks as in ElasticWorkQueue. The keyword arguments of
+    ResourceWorkQueue, such as cpus, may be given as well as those of
+    ElasticWorkQueue.
+    """
 
-    def add_load_restricted_task(self, func: Callable[..., Any], *args: Any,
-                                 **kwargs: Any) -> None:
-        self.restricted_task_queue.put(Task(func, args, kwargs))
-        self.num_tasks += 1
 
-    def get_result(self) -> Any:
-        """Gets a result from the queue, blocking until one is available."""
-        result = self.result_queue.get()
-        if isinstance(result, TaskError):
-            raise result
-        self.num_tasks -= 1
-        return result
+def parse_worker_range(value: str) -> Tuple[int, int]:
+    """Parses a MIN:MAX worker range for an ElasticWorkQueue.
 
-    def terminate(self) -> None:
-        self.main_work_queue.terminate()
-        self.restricted_work_queue.terminate()
+    Raises:
+        ValueError: The range is malformed or empty.
+    """
+    min_text, sep, max_text = value.partition(':')
+    if not sep:
+        raise ValueError(f'expected MIN:MAX, got {value}')
+    min_workers, max_workers = int(min_text), int(max_text)
+    if not 1 <= min_workers <= max_workers:
+        raise ValueError(
+            f'expected 1 <= MIN <= MAX, got {min_workers}:{max_workers}')
+    return min_workers, max_workers
 
-    def join(self) -> None:
-        self.main_work_queue.join()
-        self.restricted_work_queue.join()
 
-    @property
-    def workers(self) -> List[Worker]:
-        """List of workers."""
-        return list(
-            itertools.chain(self.main_work_queue.workers,
-                            self.restricted_work_queue.workers))
+class LoadRestrictingWorkQueue(ResourceWorkQueue):
+    """Specialized work queue for building tests.
 
-    def finished(self) -> bool:
-        """Returns True if all tasks have completed execution."""
-        return self.num_tasks == 0
+    Building the libc++ tests is very demanding and we should not be running
+    more than one libc++ build at a time. Load restricted tasks hold the
+    exclusive resource so only one runs at a time.
+    """
+
+    def __init__(self, num_workers: int = multiprocessing.cpu_count()) -> None:
+        assert num_workers >= 2
+        super().__init__(num_workers, cpus=num_workers)
+
+    def add_load_restricted_task(self, func: Callable[..., Any], *args: Any,
+                                 priority: float = 0, **kwargs: Any) -> None:
+        """Queues up a task that may not run alongside another such task."""
+        self.add_task(func,
+                      *args,
+                      priority=priority,
+                      resources=Resources(exclusive=True),
+                      **kwargs)
 
 
 class ShardingGroup:
@@ -473,51 +1423,102 @@ ShardingGroupType = TypeVar('ShardingGroupType', bound=ShardingGroup)
 
 
 class ShardingWorkQueue(Generic[ShardingGroupType]):
-    def __init__(self, device_groups: Iterable[ShardingGroupType],
-                 procs_per_device: int) -> None:
-        self.manager = multiprocessing.Manager()
-        self.result_queue = self.manager.Queue()
-        self.task_queues: Dict[ShardingGroupType, Queue] = {}
+    def __init__(self,
+                 device_groups: Iterable[ShardingGroupType],
+                 procs_per_device: int,
+                 use_threads: bool = False) -> None:
+        """Creates a ShardingWorkQueue.
 
-        self.work_queues: Dict[ShardingGroupType, Dict[Any, WorkQueue]] = {}
+        Args:
+            device_groups: Groups of shards. Tasks are added to a group and
+                run on any shard in that group.
+            procs_per_device: Number of workers for each shard.
+            use_threads: True to run tasks on threads rather than processes.
+                Suits tasks that spend their time waiting, such as adb.
+        """
+        self.task_queues: Dict[ShardingGroupType, TaskQueue] = {}
+
+        self.work_queues: Dict[ShardingGroupType,
+                               Dict[Any, Union[WorkQueue,
+                                               ThreadPoolWorkQueue]]] = {}
+        self.result_queue: Optional['queue.Queue[ThreadResult]'] = None
+        if use_threads:
+            self.result_queue = queue.Queue()
+        self.ready_results: Deque[Any] = collections.deque()
         self.num_tasks = 0
         for group in device_groups:
             self.work_queues[group] = {}
-            self.task_queues[group] = self.manager.Queue()
+            self.task_queues[group] = TaskQueue()
             for shard in group.shards:
-                self.work_queues[group][shard] = WorkQueue(
-                    procs_per_device,
-                    task_queue=self.task_queues[group],
-                    result_queue=self.result_queue,
-                    worker_data=[shard])
+                if self.result_queue is not None:
+                    self.work_queues[group][shard] = ThreadPoolWorkQueue(
+                        procs_per_device,
+                        task_queue=self.task_queues[group],
+                        worker_data=[shard],
+                        result_queue=self.result_queue)
+                else:
+                    self.work_queues[group][shard] = WorkQueue(
+                        procs_per_device,
+                        task_queue=self.task_queues[group],
+                        worker_data=[shard])
 
     def add_task(self, group: ShardingGroupType, func: Callable[..., Any],
-                 *args: Any, **kwargs: Any) -> None:
-        self.task_queues[group].put(
-            Task(func, args, kwargs))
+                 *args: Any, priority: float = 0, **kwargs: Any) -> None:
+        self.task_queues[group].put(Task(func, args, kwargs, priority))
+        for work_queue in self.work_queues[group].values():
+            work_queue.dispatch()
         self.num_tasks += 1
 
+    def add_tasks(self,
+                  group: ShardingGroupType,
+                  func: Callable[..., Any],
+                  args_iterable: Iterable[Sequence[Any]],
+                  chunksize: int = 1,
+                  priority: float = 0,
+                  **kwargs: Any) -> None:
+        """Queues up a call of func on the group for each set of arguments.
+
+        See ProcessPoolWorkQueue.add_tasks.
+        """
+        for task, count in chunk_tasks(func, args_iterable, chunksize,
+                                       kwargs, priority):
+            self.task_queues[group].put(task)
+            self.num_tasks += count
+        for work_queue in self.work_queues[group].values():
+            work_queue.dispatch()
+
     def get_result(self) -> Any:
         """Gets a result from the queue, blocking until one is available."""
-        result = self.result_queue.get()
-        if isinstance(result, TaskError):
-            raise result
-        self.num_tasks -= 1
-        return result
+        return self.get_results(max_items=1)[0]
 
-    def get_results(self) -> List[Any]:
-        """Gets all pending results.
+    def get_results(self,
+                    max_items: Optional[int] = None,
+                    timeout: Optional[float] = None) -> List[Any]:
+        """Gets every result that is ready from any shard.
 
-        If no results are available, this will block until at least one is
-        available. It will then continue dequeing until the queue is empty, and
-        then return.
+        See ProcessPoolWorkQueue.get_results.
         """
-        results: List[Any] = []
-        results.append(self.get_result())
-        while not self.result_queue.empty():
-            results.append(self.get_result())
+        def wait() -> List[Any]:
+            if self.result_queue is not None:
+                results = wait_for_thread_results(self._all_work_queues(),
+                                                  self.result_queue,
+                                                  max_items, timeout)
+            else:
+                results = wait_for_results(self._all_work_queues(),
+                                           max_items, timeout)
+            raise_task_errors(results)
+            return results
+
+        results = drain_results(self.ready_results, max_items, wait)
+        self.num_tasks -= len(results)
         return results
 
+    def _all_work_queues(self) -> List[Any]:
+        return [
+            work_queue for group_queues in self.work_queues.values()
+            for work_queue in group_queues.values()
+        ]
+
     def terminate(self) -> None:
         for group_queues in self.work_queues.values():
             for work_queue in group_queues.values():
@@ -534,4 +1535,6 @@ class ShardingWorkQueue(Generic[ShardingGroupType]):
 
 
 WorkQueue = ProcessPoolWorkQueue
-AnyWorkQueue = Union[BasicWorkQueue, LoadRestrictingWorkQueue, ProcessPoolWorkQueue]
+AnyWorkQueue = Union[BasicWorkQueue, ElasticWorkQueue,
+                     LoadRestrictingWorkQueue, ProcessPoolWorkQueue,
+                     ThreadPoolWorkQueue]
@@ -28,10 +28,12 @@
 from __future__ import division, print_function
 import argparse
 import logging
+from pathlib import Path
 import struct
-import subprocess
 import sys
 
+import ndk.elf
+
 
 SEC_NAME = '.note.android.ident'
 NDK_RESERVED_SIZE = 64
@@ -42,12 +44,6 @@ def logger():
     return logging.getLogger(__name__)
 
 
-def round_up_to_nearest(val, step):
-    """Round an integer, val, to the next multiple of a positive integer,
-    step."""
-    return (val + (step - 1)) // step * step
-
-
 class StructParser(object):
     def __init__(self, buf):
         self.buf = buf
@@ -73,24 +69,6 @@ class StructParser(object):
         return fmt.unpack(self.read(fmt.size))
 
 
-def iterate_notes(sec_data):
-    sec_data = StructParser(sec_data)
-    while not sec_data.empty:
-        (namesz, descsz, kind) = sec_data.read_struct('<III', 'note header')
-        (name, desc) = sec_data.read_struct(
-            '{}s{}s'.format(
-                round_up_to_nearest(namesz, 4),
-                round_up_to_nearest(descsz, 4)),
-            'note body')
-        name = name[:namesz]
-        if len(name) > 0:
-            if name[-1:] == b'\0':
-                name = name[:-1]
-            else:
-                logger().warning('note name %s isn\'t NUL-terminated', name)
-        yield name, kind, desc[:descsz]
-
-
 def dump_android_ident_note(note):
     note = StructParser(note)
     (android_api,) = note.read_struct('<I', 'note descriptor')
@@ -110,34 +88,6 @@ def dump_android_ident_note(note):
         logger().warning('excess data at end of descriptor')
 
 
-# Get the offset to a section from the output of readelf
-def get_section_pos(sec_name, file_path):
-    cmd = ['readelf', '--sections', '-W', file_path]
-    output = subprocess.check_output(cmd)
-    lines = output.decode('utf-8').splitlines()
-    for line in lines:
-        logger().debug('Checking line for "%s": %s', sec_name, line)
-        # Looking for a line like the following (all whitespace of unknown
-        # width).
-        #
-        #   [ 8] .note.android.ident NOTE 00000000 0000ec 000098 00 A 0 0 4
-        #
-        # The only column that might have internal whitespace is the first one.
-        # Since we don't care about it, remove the head of the string until the
-        # closing bracket, then split.
-        if ']' not in line:
-            continue
-        line = line[line.index(']') + 1:]
-
-        sections = line.split()
-        if len(sections) < 5 or sec_name != sections[0]:
-            continue
-        off = int(sections[3], 16)
-        size = int(sections[4], 16)
-        return (off, size)
-    sys.exit('error: failed to find section: {}'.format(sec_name))
-
-
 def parse_args():
     """Parses command line arguments."""
     parser = argparse.ArgumentParser()
@@ -158,25 +108,24 @@ def main():
     else:
         logging.basicConfig()
 
-    file_path = args.file_path
-
-    with open(file_path, "rb") as obj_file:
-        (sec_off, sec_size) = get_section_pos(SEC_NAME, file_path)
-
-        obj_file.seek(sec_off)
-        sec_data = obj_file.read(sec_size)
-        if len(sec_data) != sec_size:
-            sys.exit('error: could not read {} section'.format(SEC_NAME))
-
-        print('----------ABI INFO----------')
-        if len(sec_data) == 0:
-            logger().warning('%s section is empty', SEC_NAME)
-        for (name, kind, desc) in iterate_notes(sec_data):
-            if (name, kind) == (b'Android', 1):
-                dump_android_ident_note(desc)
-            else:
-                logger().warning('unrecognized note (name %s, type %d)',
-                                 repr(name), kind)
+    try:
+        with ndk.elf.ElfFile(Path(args.file_path)) as elf:
+            section = elf.section(SEC_NAME)
+            if section is None:
+                sys.exit('error: failed to find section: {}'.format(SEC_NAME))
+            notes = list(elf.notes(section))
+    except ndk.elf.ElfError as ex:
+        sys.exit('error: {}'.format(ex))
+
+    print('----------ABI INFO----------')
+    if section.size == 0:
+        logger().warning('%s section is empty', SEC_NAME)
+    for note in notes:
+        if (note.name, note.type) == ('Android', ndk.elf.NT_ANDROID_IDENT):
+            dump_android_ident_note(note.desc)
+        else:
+            logger().warning('unrecognized note (name %s, type %d)',
+                             repr(note.name), note.type)
 
 
 if __name__ == '__main__':